@@ -19,6 +19,7 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 
+import array
 import asyncio
 import errno
 import functools
@@ -136,34 +137,55 @@ class AbstractQubesAPI:
         #: is this operation cancellable?
         self.cancellable = False
 
-        candidates = list(self.list_methods(self.method))
+        #: file descriptors to pass to the client along with the response
+        #: (over plain UNIX socket connections only), closed afterwards
+        self.response_fds = []
 
-        if not candidates:
+        try:
+            #: the method to execute
+            self._handler = self.get_method_table()[self.method]
+        except KeyError:
             raise ProtocolError('no such method: {!r}'.format(self.method))
-
-        assert len(candidates) == 1, \
-            'multiple candidates for method {!r}'.format(self.method)
-
-        #: the method to execute
-        self._handler = candidates[0]
         self._running_handler = None
 
     @classmethod
-    def list_methods(cls, select_method=None):
-        for attr in dir(cls):
-            func = getattr(cls, attr)
-            if not callable(func):
-                continue
+    def get_method_table(cls):
+        '''Return methods of this API, keyed by qrexec rpc name
 
-            try:
-                # pylint: disable=protected-access
-                rpcnames = func.rpcnames
-            except AttributeError:
-                continue
+        The table is built once per class, as both method names and endpoints
+        are known when the class is defined.
 
-            for mname, endpoint in rpcnames:
-                if select_method is None or mname == select_method:
-                    yield (func, mname, endpoint)
+        :rtype: dict of (func, rpcname, endpoint) tuples
+        '''
+        # use cls.__dict__, to not use the table of a parent class
+        if '_method_table' not in cls.__dict__:
+            table = {}
+            for attr in dir(cls):
+                func = getattr(cls, attr)
+                if not callable(func):
+                    continue
+
+                try:
+                    # pylint: disable=protected-access
+                    rpcnames = func.rpcnames
+                except AttributeError:
+                    continue
+
+                for mname, endpoint in rpcnames:
+                    assert mname not in table, \
+                        'multiple candidates for method {!r}'.format(mname)
+                    table[mname] = (func, mname, endpoint)
+            cls._method_table = table
+        return cls._method_table
+
+    @classmethod
+    def list_methods(cls, select_method=None):
+        table = cls.get_method_table()
+        if select_method is not None:
+            if select_method in table:
+                yield table[select_method]
+            return
+        yield from table.values()
 
     def execute(self, *, untrusted_payload):
         '''Execute management operation.
@@ -183,11 +205,24 @@ class AbstractQubesAPI:
         if self.cancellable and self._running_handler is not None:
             self._running_handler.cancel()
 
+    def close_response_fds(self):
+        '''Close :py:attr:`response_fds`, sent or not'''
+        while self.response_fds:
+            os.close(self.response_fds.pop())
+
 
-    def fire_event_for_permission(self, **kwargs):
-        '''Fire an event on the source qube to check for permission'''
-        return self.src.fire_event('admin-permission:' + self.method,
-            pre_event=True, dest=self.dest, arg=self.arg, **kwargs)
+    def fire_event_for_permission(self, *, api_method=None, dest=None,
+            arg=None, **kwargs):
+        '''Fire an event on the source qube to check for permission
+
+        *api_method*, *dest* and *arg* default to the ones of the current
+        call; bulk calls use them to check permission as if the corresponding
+        simple call was made.
+        '''
+        return self.src.fire_event(
+            'admin-permission:' + (api_method or self.method), pre_event=True,
+            dest=(self.dest if dest is None else dest),
+            arg=(self.arg if arg is None else arg), **kwargs)
 
     def fire_event_for_filter(self, iterable, **kwargs):
         '''Fire an event on the source qube to filter for permission'''
@@ -201,9 +236,112 @@ class AbstractQubesAPI:
             raise PermissionDenied()
 
 
+class QubesDaemonMuxTransport(object):
+    '''Transport of a single call on a multiplexed connection
+
+    It is what :py:class:`QubesDaemonProtocol` of that call writes its
+    response to. Data is buffered and sent to the connection as frames tagged
+    with the request ID; the last one has :py:attr:`MUX_END` (or
+    :py:attr:`MUX_ABORT`) flag set.
+
+    :param QubesDaemonProtocol connection: protocol of the connection
+    :param int request_id: ID of the call, chosen by the client
+    '''
+    # pylint: disable=no-self-use
+
+    #: more data for this call follows
+    MUX_DATA = 0
+    #: this is the last frame of the call
+    MUX_END = 1
+    #: the call failed without a response (one-shot connection would be
+    #: aborted)
+    MUX_ABORT = 2
+
+    def __init__(self, connection, request_id):
+        self.connection = connection
+        self.request_id = request_id
+        self.pending = []
+        self.len_pending = 0
+        self.closing = False
+
+    def write(self, data):
+        if self.closing or not data:
+            return
+        if not self.pending:
+            asyncio.get_event_loop().call_soon(self.flush)
+        self.pending.append(data)
+        self.len_pending += len(data)
+
+    def flush(self, flags=MUX_DATA):
+        '''Send buffered data as one frame'''
+        if not self.pending and flags == self.MUX_DATA:
+            return
+        data = b''.join(self.pending)
+        self.pending.clear()
+        self.len_pending = 0
+        self.connection.send_mux_frame(self.request_id, flags, data)
+
+    def can_write_eof(self):
+        return True
+
+    def write_eof(self):
+        self.finish(self.MUX_END)
+
+    def close(self):
+        self.finish(self.MUX_END)
+
+    def abort(self):
+        self.pending.clear()
+        self.finish(self.MUX_ABORT)
+
+    def finish(self, flags):
+        '''Send the final frame of the call'''
+        if self.closing:
+            return
+        self.closing = True
+        self.flush(flags)
+        self.connection.mux_request_done(self.request_id)
+
+    def is_closing(self):
+        return self.closing or self.connection.transport is None \
+            or self.connection.transport.is_closing()
+
+    def get_write_buffer_size(self):
+        if self.connection.transport is None:
+            return self.len_pending
+        return self.len_pending \
+            + self.connection.transport.get_write_buffer_size()
+
+
 class QubesDaemonProtocol(asyncio.Protocol):
+    '''Protocol of qubesd sockets
+
+    By default, a connection carries exactly one call: the client sends
+    ``src\\0method\\0dest\\0arg\\0payload``, closes its side of the
+    connection and reads the response until EOF.
+
+    A client can instead start the connection with :py:attr:`mux_magic`, to
+    issue multiple calls over it. Each call is sent as a frame with a header
+    (:py:attr:`mux_request_header`: request ID and length of the rest),
+    followed by the same ``src\\0method\\0dest\\0arg\\0payload`` as above.
+    Calls are executed concurrently and their responses are sent in order of
+    completion, in frames with :py:attr:`mux_response_header` (request ID,
+    flags and length). Concatenated data of all the frames with a given
+    request ID is exactly what one-shot connection would return; the last
+    frame has :py:attr:`QubesDaemonMuxTransport.MUX_END` flag, or
+    :py:attr:`QubesDaemonMuxTransport.MUX_ABORT` if the call failed without
+    a response. The ID can be reused after that. An empty request cancels
+    the call with its ID (for example ``admin.Events``). The server closes
+    the connection after the client closes its side and all the calls
+    are finished.
+    '''
     buffer_size = 65536
     header = struct.Struct('Bx')
+    #: prefix of multiplexed connection; valid one-shot requests never start
+    #: with ``\0``, because source qube name cannot be empty
+    mux_magic = b'\0QUBESD-MUX 1\0'
+    mux_request_header = struct.Struct('!II')
+    mux_response_header = struct.Struct('!IBI')
     # keep track of connections, to gracefully close them at server exit
     # (including cleanup of integration test)
     connections = set()
@@ -218,6 +356,12 @@ class QubesDaemonProtocol(asyncio.Protocol):
         self.debug = debug
         self.event_sent = False
         self.mgmt = None
+        #: :py:obj:`None` until the client chooses the framing
+        self.mux = None
+        self.untrusted_mux_buffer = bytearray()
+        #: calls in progress, by request ID
+        self.mux_requests = {}
+        self.mux_eof = False
 
     def connection_made(self, transport):
         self.transport = transport
@@ -229,9 +373,32 @@ class QubesDaemonProtocol(asyncio.Protocol):
         if self.mgmt is not None:
             self.mgmt.cancel()
         self.transport = None
-        self.connections.remove(self)
+        # calls on multiplexed connection are not registered
+        self.connections.discard(self)
+        requests = list(self.mux_requests.values())
+        self.mux_requests.clear()
+        for request in requests:
+            request.connection_lost(exc)
 
     def data_received(self, untrusted_data):  # pylint: disable=arguments-differ
+        if self.mux is None:
+            untrusted_data = self.untrusted_mux_buffer + untrusted_data
+            if len(untrusted_data) < len(self.mux_magic) \
+                    and self.mux_magic.startswith(untrusted_data):
+                # not enough data to decide yet
+                self.untrusted_mux_buffer[:] = untrusted_data
+                return
+            self.untrusted_mux_buffer.clear()
+            self.mux = untrusted_data.startswith(self.mux_magic)
+            if self.mux:
+                untrusted_data = untrusted_data[len(self.mux_magic):]
+            else:
+                untrusted_data = bytes(untrusted_data)
+
+        if self.mux:
+            self.mux_data_received(untrusted_data)
+            return
+
         if self.len_untrusted_buffer + len(untrusted_data) > self.buffer_size:
             self.app.log.warning('request too long')
             self.transport.abort()
@@ -242,6 +409,16 @@ class QubesDaemonProtocol(asyncio.Protocol):
             self.untrusted_buffer.write(untrusted_data)
 
     def eof_received(self):
+        if self.mux is None:
+            # too short to be a multiplexed connection
+            self.mux = False
+            self.len_untrusted_buffer += \
+                self.untrusted_buffer.write(self.untrusted_mux_buffer)
+            self.untrusted_mux_buffer.clear()
+
+        if self.mux:
+            return self.mux_eof_received()
+
         try:
             src, meth, dest, arg, untrusted_payload = \
                 self.untrusted_buffer.getvalue().split(b'\0', 4)
@@ -257,8 +434,91 @@ class QubesDaemonProtocol(asyncio.Protocol):
 
         return True
 
+    def mux_data_received(self, untrusted_data):
+        '''Split data of multiplexed connection into requests'''
+        buf = self.untrusted_mux_buffer
+        buf += untrusted_data
+        header_size = self.mux_request_header.size
+        while len(buf) >= header_size and not self.transport.is_closing():
+            request_id, untrusted_length = \
+                self.mux_request_header.unpack_from(buf)
+            if untrusted_length > self.buffer_size:
+                self.app.log.warning('request too long')
+                self.transport.abort()
+                return
+            length = untrusted_length
+            if len(buf) < header_size + length:
+                break
+            untrusted_request = bytes(buf[header_size:header_size + length])
+            del buf[:header_size + length]
+            self.mux_request_received(request_id, untrusted_request)
+
+    def mux_request_received(self, request_id, untrusted_request):
+        '''Start (or cancel) a call on multiplexed connection'''
+        if not untrusted_request:
+            request = self.mux_requests.get(request_id)
+            if request is not None and request.mgmt is not None:
+                request.mgmt.cancel()
+            return
+
+        if request_id in self.mux_requests:
+            self.app.log.warning('duplicate request id')
+            self.transport.abort()
+            return
+
+        try:
+            src, meth, dest, arg, untrusted_payload = \
+                untrusted_request.split(b'\0', 4)
+        except ValueError:
+            self.app.log.warning('framing error')
+            self.transport.abort()
+            return
+
+        request = type(self)(self.handler, app=self.app, debug=self.debug)
+        request.transport = QubesDaemonMuxTransport(self, request_id)
+        self.mux_requests[request_id] = request
+        asyncio.ensure_future(request.respond(
+            src, meth, dest, arg, untrusted_payload=untrusted_payload))
+
+    def mux_eof_received(self):
+        if self.untrusted_mux_buffer:
+            self.app.log.warning('framing error')
+            self.transport.abort()
+            return None
+        self.mux_eof = True
+        if not self.mux_requests:
+            self.transport.close()
+        # keep the connection open for responses of calls in progress
+        return True
+
+    def mux_request_done(self, request_id):
+        '''Called by :py:class:`QubesDaemonMuxTransport` after the last frame
+        of a call'''
+        request = self.mux_requests.pop(request_id, None)
+        if request is not None:
+            asyncio.get_event_loop().call_soon(request.connection_lost, None)
+        if self.mux_eof and not self.mux_requests \
+                and self.transport is not None:
+            self.transport.close()
+
+    def send_mux_frame(self, request_id, flags, data):
+        '''Send a frame of response on multiplexed connection'''
+        if self.transport is None:
+            return
+        self.transport.write(self.mux_response_header.pack(
+            request_id, flags, len(data)) + data)
+
     @asyncio.coroutine
     def respond(self, src, meth, dest, arg, *, untrusted_payload):
+        try:
+            yield from self._respond(src, meth, dest, arg,
+                untrusted_payload=untrusted_payload)
+        finally:
+            if self.mgmt is not None:
+                self.mgmt.close_response_fds()
+
+    @asyncio.coroutine
+    def _respond(self, src, meth, dest, arg, *, untrusted_payload):
         try:
             self.mgmt = self.handler(self.app, src, meth, dest, arg,
                 self.send_event)
@@ -304,7 +564,7 @@ class QubesDaemonProtocol(asyncio.Protocol):
 
         else:
             if not self.event_sent:
-                self.send_response(response)
+                self.send_response(response, fds=self.mgmt.response_fds)
             try:
                 self.transport.write_eof()
             except NotImplementedError:
@@ -320,27 +580,64 @@ class QubesDaemonProtocol(asyncio.Protocol):
     def send_header(self, *args):
         self.transport.write(self.header.pack(*args))
 
-    def send_response(self, content):
+    def send_response(self, content, fds=()):
         assert not self.event_sent
-        self.send_header(0x30)
+        if fds and not isinstance(self.transport, QubesDaemonMuxTransport):
+            self.send_fds(self.header.pack(0x30), fds)
+        else:
+            self.send_header(0x30)
         if content is not None:
             self.transport.write(content.encode('utf-8'))
 
+    def send_fds(self, data, fds):
+        '''Send *data* with file descriptors *fds* attached (SCM_RIGHTS)
+
+        This bypasses the transport, so it needs to be the first thing
+        written to the connection.
+        '''
+        assert not self.transport.get_write_buffer_size()
+        # the transport's socket object cannot send ancillary data
+        sock = socket.fromfd(self.transport.get_extra_info('socket').fileno(),
+            socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                array.array('i', fds))])
+        finally:
+            sock.close()
+
     def send_event(self, subject, event, **kwargs):
+        if self.transport is None:
+            return
+        self.send_event_data(self.encode_event(self.app, subject, event,
+            **kwargs))
+
+    def send_event_data(self, data):
+        '''Send an event already serialised with :py:meth:`encode_event`'''
         if self.transport is None:
             return
         self.event_sent = True
-        self.send_header(0x31)
+        self.transport.write(data)
 
-        if subject is not self.app:
-            self.transport.write(str(subject).encode('ascii'))
-        self.transport.write(b'\0')
+    @classmethod
+    def encode_event(cls, app, subject, event, **kwargs):
+        '''Serialise an event to the wire format
+
+        :param qubes.Qubes app: the app; events of the app itself are sent \
+            with empty subject
+        :rtype: bytes
+        '''
+        data = [cls.header.pack(0x31)]
 
-        self.transport.write(event.encode('ascii') + b'\0')
+        if subject is not app:
+            data.append(str(subject).encode('ascii'))
+        data.append(b'\0')
+
+        data.append(event.encode('ascii') + b'\0')
 
         for k, v in kwargs.items():
-            self.transport.write('{}\0{}\0'.format(k, str(v)).encode('ascii'))
-        self.transport.write(b'\0')
+            data.append('{}\0{}\0'.format(k, str(v)).encode('ascii'))
+        data.append(b'\0')
+        return b''.join(data)
 
     def send_exception(self, exc):
         self.send_header(0x32)
@@ -25,53 +25,142 @@ import asyncio
 import functools
 import itertools
 import os
+import stat
 import string
 import subprocess
 
 import libvirt
-import pkg_resources
 import yaml
 
 import qubes.api
 import qubes.backup
 import qubes.config
 import qubes.devices
+import qubes.executors
 import qubes.firewall
 import qubes.storage
+import qubes.storage.manifest
 import qubes.utils
 import qubes.vm
 import qubes.vm.adminvm
 import qubes.vm.qubesvm
 
 
-class QubesMgmtEventsDispatcher:
-    def __init__(self, filters, send_event):
-        self.filters = filters
-        self.send_event = send_event
+class QubesMgmtEventsBus:
+    '''Fan-out of events to ``admin.Events`` subscribers
+
+    A single set of handlers is installed on the app and all the domains,
+    regardless of the number of subscribers. Subscribers are grouped by
+    destination and permission filters, so filters run once per group, and
+    each event is serialised to the wire format once, however many
+    subscribers receive it. Permission handlers usually create new filters
+    for each call, so filters are compared by their code and parameters
+    (see :py:meth:`filter_key`), not by identity.
+
+    A subscriber having more than :py:attr:`max_pending` bytes of events not
+    yet sent is not keeping up, and is handled according to
+    :py:attr:`overflow_policy`.
+
+    :param qubes.Qubes app: the app
+    '''
+
+    #: size (in bytes) of events queued for a subscriber, above which it is
+    #: considered as not keeping up
+    max_pending = 4 * 1024 * 1024
+
+    #: what to do with a subscriber not keeping up: ``'disconnect'`` it
+    #: (the client should reconnect and refresh its state), or ``'drop'``
+    #: events until it catches up
+    overflow_policy = 'disconnect'
+
+    #: internal events, not sent to subscribers
+    internal_event_prefixes = (
+        'admin-permission:',
+        'device-get:',
+        'device-list:',
+        'device-list-attached:',
+    )
+    internal_events = ('domain-is-fully-usable',)
+
+    def __init__(self, app):
+        self.app = app
+        # (dest, filter keys) -> (filters, list of send_event callables);
+        # dest is None for subscribers of all events
+        self.groups = {}
+
+    def subscribe(self, dest, filters, send_event):
+        '''Start sending events to *send_event*
+
+        :param qubes.vm.BaseVM dest: send only events of this domain, or all \
+            events if :py:obj:`None`
+        :param filters: filters returned by ``admin-permission:admin.Events``
+        :param send_event: ``send_event`` of the API call object
+        '''
+        if not self.groups:
+            self.app.add_handler('*', self.app_handler)
+            self.app.add_handler('domain-add', self.on_domain_add)
+            self.app.add_handler('domain-delete', self.on_domain_delete)
+            for vm in self.app.domains:
+                vm.add_handler('*', self.vm_handler)
+        key = (dest, tuple(self.filter_key(f) for f in filters))
+        if key not in self.groups:
+            self.groups[key] = (tuple(filters), [])
+        self.groups[key][1].append(send_event)
+
+    def unsubscribe(self, dest, filters, send_event):
+        '''Stop sending events to *send_event*'''
+        key = (dest, tuple(self.filter_key(f) for f in filters))
+        self.groups[key][1].remove(send_event)
+        if not self.groups[key][1]:
+            del self.groups[key]
+        if not self.groups:
+            self.app.remove_handler('*', self.app_handler)
+            self.app.remove_handler('domain-add', self.on_domain_add)
+            self.app.remove_handler('domain-delete', self.on_domain_delete)
+            for vm in self.app.domains:
+                vm.remove_handler('*', self.vm_handler)
+
+    @staticmethod
+    def filter_key(event_filter):
+        '''Key identifying what *event_filter* does: functions with the same
+        code, default arguments and closure (like a lambda created by
+        a permission handler with the same parameters on each call) get the
+        same key. Unhashable parameters are compared by identity, other
+        callables are identified by themselves.
+        '''
+        code = getattr(event_filter, '__code__', None)
+        if code is None:
+            return event_filter
+        params = list(event_filter.__defaults__ or ())
+        for name, value in sorted((event_filter.__kwdefaults__ or {}).items(),
+                key=lambda item: item[0]):
+            params.extend((name, value))
+        try:
+            params.extend(cell.cell_contents
+                for cell in event_filter.__closure__ or ())
+        except ValueError:
+            # a closure cell not set yet
+            return event_filter
+        key = [code]
+        for param in params:
+            try:
+                hash(param)
+            except TypeError:
+                # kept alive by the filter stored in the group
+                param = (type(param), id(param))
+            key.append(param)
+        return tuple(key)
 
     def vm_handler(self, subject, event, **kwargs):
         # do not send internal events
-        if event.startswith('admin-permission:'):
-            return
-        if event.startswith('device-get:'):
-            return
-        if event.startswith('device-list:'):
-            return
-        if event.startswith('device-list-attached:'):
-            return
-        if event in ('domain-is-fully-usable',):
+        if event.startswith(self.internal_event_prefixes):
             return
-
-        if not list(qubes.api.apply_filters([(subject, event, kwargs)],
-                self.filters)):
+        if event in self.internal_events:
             return
-        self.send_event(subject, event, **kwargs)
+        self.dispatch(subject, event, kwargs, vm=subject)
 
     def app_handler(self, subject, event, **kwargs):
-        if not list(qubes.api.apply_filters([(subject, event, kwargs)],
-                self.filters)):
-            return
-        self.send_event(subject, event, **kwargs)
+        self.dispatch(subject, event, kwargs)
 
     def on_domain_add(self, subject, event, vm):
         # pylint: disable=unused-argument
@@ -81,6 +170,43 @@ class QubesMgmtEventsDispatcher:
         # pylint: disable=unused-argument
         vm.remove_handler('*', self.vm_handler)
 
+    def dispatch(self, subject, event, kwargs, vm=None):
+        '''Send an event to all interested subscribers
+
+        :param qubes.vm.BaseVM vm: domain which fired the event, \
+            :py:obj:`None` for events of the app
+        '''
+        data = None
+        for (dest, _), (filters, subscribers) in list(self.groups.items()):
+            if dest is not None and dest is not vm:
+                continue
+            if filters and not list(qubes.api.apply_filters(
+                    [(subject, event, kwargs)], filters)):
+                continue
+            for send_event in list(subscribers):
+                protocol = getattr(send_event, '__self__', None)
+                if not isinstance(protocol, qubes.api.QubesDaemonProtocol):
+                    send_event(subject, event, **kwargs)
+                    continue
+                if data is None:
+                    data = protocol.encode_event(self.app, subject, event,
+                        **kwargs)
+                self.send_data(protocol, data)
+
+    def send_data(self, protocol, data):
+        '''Send serialised event, unless the subscriber is not keeping up'''
+        transport = protocol.transport
+        if transport is None or transport.is_closing():
+            return
+        if transport.get_write_buffer_size() > self.max_pending:
+            if self.overflow_policy == 'drop':
+                return
+            self.app.log.warning(
+                'admin.Events client not receiving events, disconnecting')
+            transport.abort()
+            return
+        protocol.send_event_data(data)
+
 
 class QubesAdminAPI(qubes.api.AbstractQubesAPI):
     '''Implementation of Qubes Management API calls
@@ -93,6 +219,18 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
     SOCKNAME = '/var/run/qubesd.sock'
 
+    @qubes.api.method('admin.api.List', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def api_list(self):
+        '''List all methods of this API'''
+        self.enforce(not self.arg)
+        self.enforce(self.dest.name == 'dom0')
+
+        methods = self.fire_event_for_filter(self.get_method_table())
+
+        return ''.join('{}\n'.format(mname) for mname in sorted(methods))
+
     @qubes.api.method('admin.vmclass.List', no_payload=True,
         scope='global', read=True)
     @asyncio.coroutine
@@ -102,7 +240,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.enforce(self.dest.name == 'dom0')
 
         entrypoints = self.fire_event_for_filter(
-            pkg_resources.iter_entry_points(qubes.vm.VM_ENTRY_POINT))
+            qubes.utils.iter_entry_points(qubes.vm.VM_ENTRY_POINT))
 
         return ''.join('{}\n'.format(ep.name)
             for ep in entrypoints)
@@ -125,6 +263,98 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
                 vm.get_power_state())
             for vm in sorted(domains))
 
+    @qubes.api.method('admin.vm.ListData', scope='global', read=True)
+    @asyncio.coroutine
+    def vm_list_data(self, untrusted_payload):
+        '''List domains with selected properties, features and tags
+
+        The payload is a whitespace separated list of selectors:
+        ``property:NAME``, ``feature:NAME`` (``*`` as NAME selects all of
+        them) and ``tags``. Empty payload selects everything.
+
+        Each domain is described by the same line as in ``admin.vm.List``,
+        followed by ``NAME property PROPERTY VALUE``, ``NAME feature FEATURE
+        VALUE`` and ``NAME tag TAG`` lines, where ``VALUE`` is escaped like in
+        ``admin.vm.property.GetAll``. Domains are filtered as in
+        ``admin.vm.List``. Each property, feature and tag is listed only if
+        ``admin.vm.property.Get``, ``admin.vm.feature.Get`` and
+        ``admin.vm.tag.Get`` respectively would be allowed for it.
+        '''
+        self.enforce(not self.arg)
+
+        try:
+            untrusted_selectors = untrusted_payload.decode('ascii').split()
+        except UnicodeDecodeError:
+            raise qubes.api.ProtocolError('Invalid selectors')
+        if not untrusted_selectors:
+            untrusted_selectors = ['property:*', 'feature:*', 'tags']
+
+        properties = set()
+        features = set()
+        tags = False
+        for untrusted_selector in untrusted_selectors:
+            kind, _, untrusted_name = untrusted_selector.partition(':')
+            # names are used only for lookups
+            if untrusted_selector == 'tags':
+                tags = True
+            elif kind == 'property' and untrusted_name:
+                properties.add(untrusted_name)
+            elif kind == 'feature' and untrusted_name:
+                features.add(untrusted_name)
+            else:
+                raise qubes.api.ProtocolError('Invalid selector')
+        del untrusted_selectors
+
+        if self.dest.name == 'dom0':
+            domains = self.fire_event_for_filter(self.app.domains)
+        else:
+            domains = self.fire_event_for_filter([self.dest])
+        domains = self.fire_event_for_filter(domains,
+            api_method='admin.vm.List')
+
+        lines = []
+        for vm in sorted(domains):
+            lines.append('{} class={} state={}\n'.format(
+                vm.name,
+                vm.__class__.__name__,
+                vm.get_power_state()))
+
+            if properties:
+                vm_properties = (prop for prop in vm.property_list()
+                    if ('*' in properties or prop.__name__ in properties)
+                    and self._permitted('admin.vm.property.Get', vm,
+                        prop.__name__))
+                lines.extend('{} property {} {}\n'.format(
+                        vm.name, prop.__name__,
+                        self._escape(self._serialize_property(vm, prop)))
+                    for prop in sorted(vm_properties))
+
+            if features:
+                vm_features = (feature for feature in vm.features
+                    if ('*' in features or feature in features)
+                    and self._permitted('admin.vm.feature.Get', vm, feature))
+                lines.extend('{} feature {} {}\n'.format(
+                        vm.name, feature, self._escape(vm.features[feature]))
+                    for feature in sorted(vm_features))
+
+            if tags:
+                vm_tags = (tag for tag in vm.tags
+                    if self._permitted('admin.vm.tag.Get', vm, tag))
+                lines.extend('{} tag {}\n'.format(vm.name, tag)
+                    for tag in sorted(vm_tags))
+
+        return ''.join(lines)
+
+    def _permitted(self, api_method, dest, arg):
+        '''Check permission as if *api_method* was called on *dest* with
+        *arg*, without failing the current call'''
+        try:
+            self.fire_event_for_permission(api_method=api_method, dest=dest,
+                arg=arg)
+        except qubes.api.PermissionDenied:
+            return False
+        return True
+
     @qubes.api.method('admin.vm.property.List', no_payload=True,
         scope='local', read=True)
     @asyncio.coroutine
@@ -168,7 +398,10 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         self.fire_event_for_permission()
 
-        property_def = dest.property_get_def(self.arg)
+        return self._serialize_property(dest, dest.property_get_def(self.arg))
+
+    @staticmethod
+    def _serialize_property(dest, property_def):
         # explicit list to be sure that it matches protocol spec
         if isinstance(property_def, qubes.vm.VMProperty):
             property_type = 'vm'
@@ -176,21 +409,53 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             property_type = 'int'
         elif property_def.type is bool:
             property_type = 'bool'
-        elif self.arg == 'label':
+        elif property_def.__name__ == 'label':
             property_type = 'label'
         else:
             property_type = 'str'
 
         try:
-            value = getattr(dest, self.arg)
+            value = getattr(dest, property_def.__name__)
         except AttributeError:
             return 'default=True type={} '.format(property_type)
         else:
             return 'default={} type={} {}'.format(
-                str(dest.property_is_default(self.arg)),
+                str(dest.property_is_default(property_def)),
                 property_type,
                 str(value) if value is not None else '')
 
+    @staticmethod
+    def _escape(value):
+        '''Escape a value, so it fits in one line of bulk response'''
+        return str(value).replace('\\', '\\\\').replace('\n', '\\n')
+
+    @qubes.api.method('admin.vm.property.GetAll', no_payload=True,
+        scope='local', read=True)
+    @asyncio.coroutine
+    def vm_property_get_all(self):
+        '''Get values of all properties on a qube'''
+        return self._property_get_all(self.dest)
+
+    @qubes.api.method('admin.property.GetAll', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def property_get_all(self):
+        '''Get values of all global properties'''
+        self.enforce(self.dest.name == 'dom0')
+        return self._property_get_all(self.app)
+
+    def _property_get_all(self, dest):
+        '''Return ``NAME VALUE`` line for each property, where ``VALUE`` is
+        what ``admin.vm.property.Get`` would return, with backslashes and
+        newlines escaped'''
+        self.enforce(not self.arg)
+
+        properties = self.fire_event_for_filter(dest.property_list())
+
+        return ''.join('{} {}\n'.format(prop.__name__,
+                self._escape(self._serialize_property(dest, prop)))
+            for prop in sorted(properties))
+
     @qubes.api.method('admin.vm.property.GetDefault', no_payload=True,
         scope='local', read=True)
     @asyncio.coroutine
@@ -336,7 +601,8 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         # properties defined in API
         volume_properties = [
             'pool', 'vid', 'size', 'usage', 'rw', 'source', 'path',
-            'save_on_stop', 'snap_on_start', 'revisions_to_keep']
+            'save_on_stop', 'snap_on_start', 'revisions_to_keep',
+            'usage_timestamp']
 
         def _serialize(value):
             if callable(value):
@@ -383,7 +649,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         ret = volume.revert(revision)
         if asyncio.iscoroutine(ret):
             yield from ret
-        self.app.save()
+        self.app.save(full=True)
 
     # write=True because this allow to clone VM - and most likely modify that
     # one - still having the same data
@@ -440,7 +706,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             op_retval = yield from op_retval
 
         self.dest.volumes[self.arg] = op_retval
-        self.app.save()
+        self.app.save(full=True)
 
     @qubes.api.method('admin.vm.volume.Resize',
         scope='local', write=True)
@@ -457,7 +723,21 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.fire_event_for_permission(size=size)
 
         yield from self.dest.storage.resize(self.arg, size)
-        self.app.save()
+        self.app.save(full=True)
+
+    def _attach_volume_fd(self, path, flags):
+        '''Pass *path*, opened with *flags*, to the client along with the
+        response - so it does not need privileges to open it itself.
+
+        Only regular files and block devices are passed, opening a pipe
+        could block qubesd until the other end is opened.
+        '''
+        try:
+            mode = os.stat(path).st_mode
+        except OSError:
+            return
+        if stat.S_ISREG(mode) or stat.S_ISBLK(mode):
+            self.response_fds.append(os.open(path, flags | os.O_CLOEXEC))
 
     @qubes.api.method('admin.vm.volume.Import', no_payload=True,
         scope='local', write=True)
@@ -471,6 +751,9 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         internal.vm.volume.ImportEnd (with either b'ok' or b'fail' as a
         payload) and response from that call will be actually send to the
         caller.
+
+        The path is also passed opened for writing, if the client connected
+        directly to the socket (see :program:`qubesd-stream`).
         '''
         self.enforce(self.arg in self.dest.volumes.keys())
 
@@ -480,8 +763,16 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             raise qubes.exc.QubesVMNotHaltedError(self.dest)
 
         path = yield from self.dest.storage.import_data(self.arg)
+        # left by an earlier admin.vm.volume.ImportWithManifest that was
+        # never ended, internal.vm.volume.ImportEnd would store it
+        try:
+            os.unlink(os.path.join(self.dest.dir_path,
+                self.arg + qubes.storage.manifest.IMPORT_SUFFIX))
+        except FileNotFoundError:
+            pass
         self.enforce(' ' not in path)
         size = self.dest.volumes[self.arg].size
+        self._attach_volume_fd(path, os.O_WRONLY)
 
         # when we know the action is allowed, inform extensions that it will
         # be performed
@@ -489,6 +780,92 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         return '{} {}'.format(size, path)
 
+    @qubes.api.method('admin.vm.volume.ImportWithManifest', no_payload=True,
+        scope='local', write=True)
+    @asyncio.coroutine
+    def vm_volume_import_with_manifest(self):
+        '''Import volume data, writing only the blocks that changed.
+
+        Like admin.vm.volume.Import, but the import starts with the current
+        volume data, and the response passes (in this order) the volume
+        opened for reading and writing, the file to write the manifest of
+        the imported image to and - if still valid - the stored manifest of
+        the current data. The data is transferred by
+        :program:`qubesd-stream`, see :py:mod:`qubes.storage.manifest`.
+        '''
+        self.enforce(self.arg in self.dest.volumes.keys())
+
+        self.fire_event_for_permission()
+
+        if not self.dest.is_halted():
+            raise qubes.exc.QubesVMNotHaltedError(self.dest)
+
+        volume = self.dest.volumes[self.arg]
+        manifest_path = os.path.join(self.dest.dir_path,
+            self.arg + qubes.storage.manifest.SUFFIX)
+        try:
+            current_stamp = qubes.storage.manifest.stamp(volume)
+        except OSError:
+            current_stamp = None
+
+        path = yield from self.dest.storage.import_data(self.arg,
+            keep_data=True)
+        try:
+            self.enforce(' ' not in path)
+            size = volume.size
+            self._attach_volume_fd(path, os.O_RDWR)
+            if not self.response_fds:
+                raise qubes.storage.StoragePoolException(
+                    'Volume {} does not support import with a manifest'.format(
+                        self.arg))
+            self.response_fds.append(os.open(
+                os.path.join(self.dest.dir_path,
+                    self.arg + qubes.storage.manifest.IMPORT_SUFFIX),
+                os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644))
+            if current_stamp is not None:
+                stored_fd = qubes.storage.manifest.open_stored(manifest_path,
+                    current_stamp)
+                if stored_fd is not None:
+                    self.response_fds.append(stored_fd)
+
+            self.dest.fire_event('domain-volume-import-begin',
+                volume=self.arg)
+        except:
+            # nobody is going to finish the import
+            self.close_response_fds()
+            yield from self.dest.storage.import_data_end(self.arg,
+                success=False)
+            raise
+
+        return '{} {}'.format(size, path)
+
+    # write=True, because this gives the same access to the data as
+    # admin.vm.volume.CloneFrom
+    @qubes.api.method('admin.vm.volume.Export', no_payload=True,
+        scope='local', write=True)
+    @asyncio.coroutine
+    def vm_volume_export(self):
+        '''Export volume data.
+
+        Like admin.vm.volume.Import, this only returns the size and a path
+        to read the data from (also passed opened, if possible), the data
+        is sent to the caller by :program:`qubesd-stream`, which reports
+        the progress with internal.vm.volume.ExportProgress.
+        '''
+        self.enforce(self.arg in self.dest.volumes.keys())
+
+        volume = self.dest.volumes[self.arg]
+
+        self.fire_event_for_permission(volume=volume)
+
+        path = volume.export()
+        self.enforce(' ' not in path)
+        self._attach_volume_fd(path, os.O_RDONLY)
+
+        self.dest.fire_event('domain-volume-export-begin', volume=self.arg)
+
+        return '{} {}'.format(volume.size, path)
+
     @qubes.api.method('admin.vm.volume.Set.revisions_to_keep',
         scope='local', write=True)
     @asyncio.coroutine
@@ -506,7 +883,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.fire_event_for_permission(newvalue=newvalue)
 
         self.dest.volumes[self.arg].revisions_to_keep = newvalue
-        self.app.save()
+        self.app.save(full=True)
 
     @qubes.api.method('admin.vm.volume.Set.rw',
         scope='local', write=True)
@@ -526,7 +903,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             raise qubes.exc.QubesVMNotHaltedError(self.dest)
 
         self.dest.volumes[self.arg].rw = newvalue
-        self.app.save()
+        self.app.save(full=True)
 
     @qubes.api.method('admin.vm.tag.List', no_payload=True,
         scope='local', read=True)
@@ -701,7 +1078,63 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.fire_event_for_permission(newvalue=newvalue)
 
         pool.revisions_to_keep = newvalue
-        self.app.save()
+        self.app.save(full=True)
+
+    @qubes.api.method('admin.pool.Set.prepared_snapshots',
+        scope='global', write=True)
+    @asyncio.coroutine
+    def pool_set_prepared_snapshots(self, untrusted_payload):
+        self.enforce(self.dest.name == 'dom0')
+        self.enforce(self.arg in self.app.pools.keys())
+        pool = self.app.pools[self.arg]
+        # supported only by some pool drivers
+        self.enforce(hasattr(pool, 'prepared_snapshots'))
+        try:
+            untrusted_value = int(untrusted_payload.decode('ascii'))
+        except (UnicodeDecodeError, ValueError):
+            raise qubes.api.ProtocolError('Invalid value')
+        del untrusted_payload
+        self.enforce(untrusted_value >= 0)
+        newvalue = untrusted_value
+        del untrusted_value
+
+        self.fire_event_for_permission(newvalue=newvalue)
+
+        pool.prepared_snapshots = newvalue
+        self.app.save(full=True)
+
+    @qubes.api.method('admin.executor.Info', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def executor_info(self):
+        '''Metrics of the executors running blocking calls of qubesd, see
+        :py:mod:`qubes.executors`'''
+        self.enforce(self.dest.name == 'dom0')
+        self.enforce(not self.arg)
+
+        self.fire_event_for_permission()
+
+        return ''.join('{} {}\n'.format(name,
+                ' '.join('{}={}'.format(key, value)
+                    for key, value in sorted(metrics.items())))
+            for name, metrics in qubes.executors.metrics().items())
+
+    @qubes.api.method('admin.store.Flush', no_payload=True,
+        scope='global', write=True)
+    @asyncio.coroutine
+    def store_flush(self):
+        '''Write pending changes to :file:`qubes.xml` now
+
+        qubesd may delay writing :file:`qubes.xml` (see ``--save-delay``), so
+        a call changing the configuration can return before the change is on
+        the disk. This call returns only after all the changes made by the
+        calls which returned before it are written.'''
+        self.enforce(self.dest.name == 'dom0')
+        self.enforce(not self.arg)
+
+        self.fire_event_for_permission()
+
+        self.app.flush_save()
 
     @qubes.api.method('admin.label.List', no_payload=True,
         scope='global', read=True)
@@ -779,7 +1212,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         label = qubes.Label(new_index, color, self.arg)
         self.app.labels[new_index] = label
-        self.app.save()
+        self.app.save(full=True)
 
     @qubes.api.method('admin.label.Remove', no_payload=True,
         scope='global', write=True)
@@ -802,7 +1235,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.fire_event_for_permission(label=label)
 
         del self.app.labels[label.index]
-        self.app.save()
+        self.app.save(full=True)
 
     @qubes.api.method('admin.vm.Start', no_payload=True,
         scope='local', execute=True)
@@ -863,15 +1296,11 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         # cache event filters, to not call an event each time an event arrives
         event_filters = self.fire_event_for_permission()
 
-        dispatcher = QubesMgmtEventsDispatcher(event_filters, self.send_event)
-        if self.dest.name == 'dom0':
-            self.app.add_handler('*', dispatcher.app_handler)
-            self.app.add_handler('domain-add', dispatcher.on_domain_add)
-            self.app.add_handler('domain-delete', dispatcher.on_domain_delete)
-            for vm in self.app.domains:
-                vm.add_handler('*', dispatcher.vm_handler)
-        else:
-            self.dest.add_handler('*', dispatcher.vm_handler)
+        bus = getattr(self.app, 'api_admin_events_bus', None)
+        if bus is None:
+            bus = self.app.api_admin_events_bus = QubesMgmtEventsBus(self.app)
+        dest = None if self.dest.name == 'dom0' else self.dest
+        bus.subscribe(dest, event_filters, self.send_event)
 
         # send artificial event as a confirmation that connection is established
         self.send_event(self.app, 'connection-established')
@@ -882,15 +1311,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             # the above waiting was already interrupted, this is all we need
             pass
 
-        if self.dest.name == 'dom0':
-            self.app.remove_handler('*', dispatcher.app_handler)
-            self.app.remove_handler('domain-add', dispatcher.on_domain_add)
-            self.app.remove_handler('domain-delete',
-                dispatcher.on_domain_delete)
-            for vm in self.app.domains:
-                vm.remove_handler('*', dispatcher.vm_handler)
-        else:
-            self.dest.remove_handler('*', dispatcher.vm_handler)
+        bus.unsubscribe(dest, event_filters, self.send_event)
 
     @qubes.api.method('admin.vm.feature.List', no_payload=True,
         scope='local', read=True)
@@ -991,7 +1412,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.app.save()
 
     @qubes.api.method('admin.vm.Create.{endpoint}', endpoints=(ep.name
-            for ep in pkg_resources.iter_entry_points(qubes.vm.VM_ENTRY_POINT)),
+            for ep in qubes.utils.iter_entry_points(qubes.vm.VM_ENTRY_POINT)),
         scope='global', write=True)
     @asyncio.coroutine
     def vm_create(self, endpoint, untrusted_payload=None):
@@ -999,7 +1420,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             untrusted_payload=untrusted_payload)
 
     @qubes.api.method('admin.vm.CreateInPool.{endpoint}', endpoints=(ep.name
-            for ep in pkg_resources.iter_entry_points(qubes.vm.VM_ENTRY_POINT)),
+            for ep in qubes.utils.iter_entry_points(qubes.vm.VM_ENTRY_POINT)),
         scope='global', write=True)
     @asyncio.coroutine
     def vm_create_in_pool(self, endpoint, untrusted_payload=None):
@@ -1091,7 +1512,8 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         except:
             del self.app.domains[vm]
             raise
-        self.app.save()
+        # files are on disk already, don't leave them unreferenced
+        self.app.save(sync=True)
 
     @qubes.api.method('admin.vm.CreateDisposable', no_payload=True,
         scope='global', write=True)
@@ -1134,10 +1556,11 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             self.app.log.exception('Error while removing VM \'%s\' files',
                 self.dest.name)
 
-        self.app.save()
+        # files are removed already, don't leave references to them
+        self.app.save(sync=True)
 
     @qubes.api.method('admin.vm.device.{endpoint}.Available', endpoints=(ep.name
-            for ep in pkg_resources.iter_entry_points('qubes.devices')),
+            for ep in qubes.utils.iter_entry_points('qubes.devices')),
             no_payload=True,
         scope='local', read=True)
     @asyncio.coroutine
@@ -1172,7 +1595,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             for ident in sorted(dev_info))
 
     @qubes.api.method('admin.vm.device.{endpoint}.List', endpoints=(ep.name
-            for ep in pkg_resources.iter_entry_points('qubes.devices')),
+            for ep in qubes.utils.iter_entry_points('qubes.devices')),
             no_payload=True,
         scope='local', read=True)
     @asyncio.coroutine
@@ -1209,7 +1632,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
     # persistent=True) and volatile state of running VM (with persistent=False).
     # For this reason, write=True + execute=True
     @qubes.api.method('admin.vm.device.{endpoint}.Attach', endpoints=(ep.name
-            for ep in pkg_resources.iter_entry_points('qubes.devices')),
+            for ep in qubes.utils.iter_entry_points('qubes.devices')),
         scope='local', write=True, execute=True)
     @asyncio.coroutine
     def vm_device_attach(self, endpoint, untrusted_payload):
@@ -1253,7 +1676,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
     # persistent=True) and volatile state of running VM (with persistent=False).
     # For this reason, write=True + execute=True
     @qubes.api.method('admin.vm.device.{endpoint}.Detach', endpoints=(ep.name
-            for ep in pkg_resources.iter_entry_points('qubes.devices')),
+            for ep in qubes.utils.iter_entry_points('qubes.devices')),
             no_payload=True,
         scope='local', write=True, execute=True)
     @asyncio.coroutine
@@ -1280,7 +1703,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
     # For this reason, write=True + execute=True
     @qubes.api.method('admin.vm.device.{endpoint}.Set.persistent',
         endpoints=(ep.name
-            for ep in pkg_resources.iter_entry_points('qubes.devices')),
+            for ep in qubes.utils.iter_entry_points('qubes.devices')),
         scope='local', write=True, execute=True)
     @asyncio.coroutine
     def vm_device_set_persistent(self, endpoint, untrusted_payload):
@@ -1303,7 +1726,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             persistent=persistent)
 
         self.dest.devices[devclass].update_persistent(dev, persistent)
-        self.app.save()
+        self.app.save(full=True)
 
     @qubes.api.method('admin.vm.firewall.Get', no_payload=True,
             scope='local', read=True)
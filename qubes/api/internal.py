@@ -22,14 +22,181 @@
 
 import asyncio
 import json
+import os
+import shutil
 import subprocess
 
 import qubes.api
 import qubes.api.admin
+import qubes.storage.manifest
 import qubes.vm.adminvm
 import qubes.vm.dispvm
 
 
+#: where :py:class:`SystemInfo` is published by qubesd
+SYSTEM_INFO_PATH = '/var/run/qubes/system-info'
+
+
+def unpublish_system_info(path=SYSTEM_INFO_PATH):
+    '''Remove the snapshot published by :py:class:`SystemInfo` - at qubesd
+    start, before anything may change, as the previous instance might not
+    have removed it. Until a new one is published, clients ask qubesd.
+
+    :return: generation of the removed snapshot, or 0
+    '''
+    try:
+        with open(path, 'rb') as info_file:
+            generation = int(info_file.readline())
+    except (OSError, ValueError):
+        generation = 0
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    return generation
+
+
+class SystemInfo:
+    '''Information about domains needed to evaluate qrexec policy, as
+    returned by internal.GetSystemInfo.
+
+    It is built once and then kept up to date from ``domain-add``,
+    ``domain-delete``, ``property-set:*``/``property-del:*`` and
+    ``domain-tag-*`` events, re-encoding only the entry of the domain that
+    changed. Each change of the data increases :py:attr:`generation`;
+    events which leave the entry as it was (most properties are not
+    included) do not.
+
+    If *path* is given, the snapshot is also published there on each
+    change, before the event that caused it returns (so before the response
+    to the Admin API call), as the generation number on the first line,
+    followed by the JSON data. The file is replaced atomically, so it can be
+    read (or mapped) without locking; consumers can compare just the first
+    line to skip unchanged snapshots. See :py:func:`unpublish_system_info`
+    for removing a snapshot left by a previous qubesd instance.
+
+    :param qubes.Qubes app: the app
+    :param str path: where to publish the snapshot, or :py:obj:`None`
+    :param str group: group owning the published file
+    :param int generation: generation of the last snapshot published \
+        before, for numbering to continue after qubesd restart
+    '''
+
+    def __init__(self, app, path=None, group='qubes', generation=0):
+        self.app = app
+        self.path = path
+        self.group = group
+        #: number of the current snapshot, increased with each change
+        self.generation = generation + 1
+        # domain name -> encoded entry
+        self._entries = self._build()
+        self._data = None
+
+        self.app.add_handler('domain-add', self.on_domain_add)
+        self.app.add_handler('domain-delete', self.on_domain_delete)
+        self.app.add_handler('property-set:default_dispvm',
+            self.on_app_default_dispvm)
+        self.app.add_handler('property-del:default_dispvm',
+            self.on_app_default_dispvm)
+        for vm in self.app.domains:
+            vm.add_handler('*', self.vm_handler)
+        if self.path is not None:
+            self.publish()
+
+    def close(self):
+        '''Stop tracking changes and remove the published snapshot'''
+        self.app.remove_handler('domain-add', self.on_domain_add)
+        self.app.remove_handler('domain-delete', self.on_domain_delete)
+        self.app.remove_handler('property-set:default_dispvm',
+            self.on_app_default_dispvm)
+        self.app.remove_handler('property-del:default_dispvm',
+            self.on_app_default_dispvm)
+        for vm in self.app.domains:
+            vm.remove_handler('*', self.vm_handler)
+        if self.path is not None:
+            unpublish_system_info(self.path)
+
+    @staticmethod
+    def domain_info(domain):
+        '''Information about a single domain'''
+        return {
+            'tags': list(domain.tags),
+            'type': domain.__class__.__name__,
+            'template_for_dispvms':
+                getattr(domain, 'template_for_dispvms', False),
+            'default_dispvm': (str(domain.default_dispvm) if
+                getattr(domain, 'default_dispvm', None) else None),
+            'icon': str(domain.label.icon),
+        }
+
+    @property
+    def data(self):
+        '''The snapshot, encoded as JSON'''
+        if self._data is None:
+            self._data = '{"domains": {' + ', '.join(
+                json.dumps(name) + ': ' + entry
+                for name, entry in sorted(self._entries.items())) + '}}'
+        return self._data
+
+    def _update(self, domain):
+        entry = json.dumps(self.domain_info(domain))
+        if self._entries.get(domain.name) != entry:
+            self._entries[domain.name] = entry
+            self._changed()
+
+    def _build(self):
+        return {domain.name: json.dumps(self.domain_info(domain))
+            for domain in self.app.domains}
+
+    def _rebuild(self):
+        entries = self._build()
+        if entries != self._entries:
+            self._entries = entries
+            self._changed()
+
+    def _changed(self):
+        self._data = None
+        self.generation += 1
+        if self.path is not None:
+            self.publish()
+
+    def publish(self):
+        '''Write the current snapshot to :py:attr:`path`'''
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as info_file:
+            os.fchmod(info_file.fileno(), 0o640)
+            if self.group is not None:
+                shutil.chown(tmp_path, group=self.group)
+            info_file.write('{}\n'.format(self.generation))
+            info_file.write(self.data)
+        os.rename(tmp_path, self.path)
+
+    def vm_handler(self, subject, event, **kwargs):
+        # pylint: disable=unused-argument
+        if event == 'property-set:name':
+            # other domains refer to this one by name
+            self._rebuild()
+        elif event.startswith(('property-set:', 'property-del:',
+                'domain-tag-add:', 'domain-tag-delete:')):
+            self._update(subject)
+
+    def on_domain_add(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        vm.add_handler('*', self.vm_handler)
+        self._update(vm)
+
+    def on_domain_delete(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        vm.remove_handler('*', self.vm_handler)
+        self._entries.pop(vm.name, None)
+        self._changed()
+
+    def on_app_default_dispvm(self, subject, event, **kwargs):
+        # pylint: disable=unused-argument
+        # default value of default_dispvm of domains
+        self._rebuild()
+
+
 class QubesInternalAPI(qubes.api.AbstractQubesAPI):
     ''' Communication interface for dom0 components,
     by design the input here is trusted.'''
@@ -42,19 +209,11 @@ class QubesInternalAPI(qubes.api.AbstractQubesAPI):
         self.enforce(self.dest.name == 'dom0')
         self.enforce(not self.arg)
 
-        system_info = {'domains': {
-            domain.name: {
-                'tags': list(domain.tags),
-                'type': domain.__class__.__name__,
-                'template_for_dispvms':
-                    getattr(domain, 'template_for_dispvms', False),
-                'default_dispvm': (str(domain.default_dispvm) if
-                    getattr(domain, 'default_dispvm', None) else None),
-                'icon': str(domain.label.icon),
-            } for domain in self.app.domains
-        }}
-
-        return json.dumps(system_info)
+        system_info = getattr(self.app, 'api_internal_system_info', None)
+        if system_info is None:
+            system_info = self.app.api_internal_system_info = \
+                SystemInfo(self.app)
+        return system_info.data
 
     @qubes.api.method('internal.vm.volume.ImportEnd')
     @asyncio.coroutine
@@ -71,16 +230,74 @@ class QubesInternalAPI(qubes.api.AbstractQubesAPI):
             yield from self.dest.storage.import_data_end(self.arg,
                 success=success)
         except:
+            self._import_manifest_end(False)
             self.dest.fire_event('domain-volume-import-end', volume=self.arg,
                 success=False)
             raise
 
+        self._import_manifest_end(success)
+
         self.dest.fire_event('domain-volume-import-end', volume=self.arg,
             success=success)
 
         if not success:
             raise qubes.exc.QubesException('Data import failed')
 
+    def _import_manifest_end(self, success):
+        '''Store the manifest written by admin.vm.volume.ImportWithManifest
+        (if that was the call), or drop the one of the replaced data.'''
+        manifest_path = os.path.join(self.dest.dir_path,
+            self.arg + qubes.storage.manifest.SUFFIX)
+        import_path = os.path.join(self.dest.dir_path,
+            self.arg + qubes.storage.manifest.IMPORT_SUFFIX)
+        try:
+            with open(import_path, 'rb') as manifest_io:
+                data = manifest_io.read()
+            os.unlink(import_path)
+        except FileNotFoundError:
+            data = None
+        if not success:
+            return
+        if data:
+            qubes.storage.manifest.store(manifest_path, data,
+                qubes.storage.manifest.stamp(self.dest.volumes[self.arg]))
+        else:
+            try:
+                os.unlink(manifest_path)
+            except FileNotFoundError:
+                pass
+
+    @qubes.api.method('internal.vm.volume.ImportProgress')
+    @asyncio.coroutine
+    def vm_volume_import_progress(self, untrusted_payload):
+        '''
+        Progress of admin.vm.volume.Import, reported by
+        :program:`qubesd-stream`. The payload is "TRANSFERRED RATE", where
+        TRANSFERRED is the number of bytes of input processed so far and
+        RATE the average throughput in bytes per second.
+        '''
+        self._volume_progress('domain-volume-import-progress',
+            untrusted_payload)
+
+    @qubes.api.method('internal.vm.volume.ExportProgress')
+    @asyncio.coroutine
+    def vm_volume_export_progress(self, untrusted_payload):
+        '''
+        Progress of admin.vm.volume.Export, in the same format as
+        internal.vm.volume.ImportProgress.
+        '''
+        self._volume_progress('domain-volume-export-progress',
+            untrusted_payload)
+
+    def _volume_progress(self, event, untrusted_payload):
+        self.enforce(self.arg in self.dest.volumes.keys())
+        transferred, rate = (int(value)
+            for value in untrusted_payload.decode('ascii').split())
+
+        self.dest.fire_event(event, volume=self.arg,
+            size=self.dest.volumes[self.arg].size,
+            transferred=transferred, rate=rate)
+
     @qubes.api.method('internal.SuspendPre', no_payload=True)
     @asyncio.coroutine
     def suspend_pre(self):
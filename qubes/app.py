@@ -33,6 +33,7 @@ import tempfile
 import time
 import traceback
 import uuid
+import zlib
 
 import asyncio
 import jinja2
@@ -58,6 +59,7 @@ else:
 
 # pylint: disable=wrong-import-position
 import qubes
+import qubes.executors
 import qubes.ext
 import qubes.utils
 import qubes.storage
@@ -365,6 +367,136 @@ class QubesHost:
         return (current_time, current)
 
 
+class VMIndex(dict):
+    '''Mapping of ``qid`` to VM, with secondary indexes
+
+    Besides the primary ``qid`` key, VMs are indexed by name and by UUID,
+    and the list of VMs in iteration order is cached until the next change.
+    The indexes are maintained on every item assignment and removal, so code
+    manipulating this mapping directly does not leave them stale.
+
+    Methods which would bypass the indexes are disarmed (they raise
+    :py:class:`NotImplementedError`).
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(VMIndex, self).__init__()
+        #: name -> VM
+        self.by_name = {}
+        #: UUID -> VM
+        self.by_uuid = {}
+        # qid -> (name, uuid) as they were indexed
+        self._keys = {}
+        # qids of VMs that had no UUID when indexed (it is set later, on
+        # domain-init/domain-load)
+        self._missing_uuid = set()
+        self._sorted = None
+        #: incremented on every change of the mapping
+        self.generation = 0
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, qid, vm):
+        if qid in self:
+            self._unindex(qid)
+        super(VMIndex, self).__setitem__(qid, vm)
+        self._index(qid, vm)
+        self._sorted = None
+        self.generation += 1
+
+    def __delitem__(self, qid):
+        self._unindex(qid)
+        super(VMIndex, self).__delitem__(qid)
+        self._sorted = None
+        self.generation += 1
+
+    def update(self, *args, **kwargs):
+        for qid, vm in dict(*args, **kwargs).items():
+            self[qid] = vm
+
+    def clear(self):
+        super(VMIndex, self).clear()
+        self.by_name.clear()
+        self.by_uuid.clear()
+        self._keys.clear()
+        self._missing_uuid.clear()
+        self._sorted = None
+        self.generation += 1
+
+    def pop(self, *args, **kwargs):
+        '''Not implemented
+        :raises: NotImplementedError
+        '''
+        raise NotImplementedError()
+
+    def popitem(self):
+        '''Not implemented
+        :raises: NotImplementedError
+        '''
+        raise NotImplementedError()
+
+    def setdefault(self, *args, **kwargs):
+        '''Not implemented
+        :raises: NotImplementedError
+        '''
+        raise NotImplementedError()
+
+    def _index(self, qid, vm):
+        name = getattr(vm, 'name', None)
+        try:
+            vm_uuid = vm.uuid
+        except AttributeError:
+            vm_uuid = None
+        if name is not None:
+            self.by_name[name] = vm
+        if vm_uuid is not None:
+            self.by_uuid[vm_uuid] = vm
+        else:
+            self._missing_uuid.add(qid)
+        self._keys[qid] = (name, vm_uuid)
+
+    def _unindex(self, qid):
+        vm = super(VMIndex, self).__getitem__(qid)
+        name, vm_uuid = self._keys.pop(qid)
+        if self.by_name.get(name) is vm:
+            del self.by_name[name]
+        if self.by_uuid.get(vm_uuid) is vm:
+            del self.by_uuid[vm_uuid]
+        self._missing_uuid.discard(qid)
+
+    def reindex(self, vm):
+        '''Refresh index entries of a VM after its name or UUID changed
+
+        Does nothing if *vm* is not held in this mapping.
+        '''
+        qid = getattr(vm, 'qid', None)
+        if qid is None or self.get(qid) is not vm:
+            return
+        self._unindex(qid)
+        self._index(qid, vm)
+        self._sorted = None
+
+    def get_by_uuid(self, vm_uuid):
+        '''Find VM by its UUID
+
+        :raises KeyError: when there is no such VM
+        '''
+        if vm_uuid not in self.by_uuid and self._missing_uuid:
+            for qid in list(self._missing_uuid):
+                self._unindex(qid)
+                self._index(qid, self[qid])
+        return self.by_uuid[vm_uuid]
+
+    def sorted_values(self):
+        '''Cached, sorted list of VMs
+
+        The list is never modified in place, only replaced after the mapping
+        changes, so it is safe to keep iterating over it meanwhile.
+        '''
+        if self._sorted is None:
+            self._sorted = sorted(self.values())
+        return self._sorted
+
+
 class VMCollection:
     '''A collection of Qubes VMs
 
@@ -372,17 +504,49 @@ class VMCollection:
     and whole VM object's presence.
 
     Iterating over VMCollection will yield machine objects.
+
+    Lookups by ``qid``, name and UUID are dictionary lookups (see
+    :py:class:`VMIndex`), and the sorted list of machines is cached until the
+    collection changes.
+
+    The collection also keeps reverse indexes of VM-to-VM dependencies listed
+    in :py:attr:`dependency_properties` (for example netvm -> connected VMs),
+    see :py:meth:`get_dependent_vms`.
     '''
 
+    #: VM properties tracked by reverse dependency indexes
+    dependency_properties = ('netvm', 'template', 'default_dispvm')
+
     def __init__(self, app):
         self.app = app
-        self._dict = dict()
+        # propname -> (target -> set of VMs)
+        self._dependents = None
+        # VM -> (propname -> target)
+        self._dependencies = {}
+        self._dependents_generation = None
+        self._dict = VMIndex()
 
 
     def close(self):
         del self.app
         self._dict.clear()
         del self._dict
+        self.refresh_dependencies()
+
+    @property
+    def _dict(self):
+        return self._vms
+
+    @_dict.setter
+    def _dict(self, value):
+        if not isinstance(value, VMIndex):
+            value = VMIndex(value)
+        self._vms = value
+        self.refresh_dependencies()
+
+    @_dict.deleter
+    def _dict(self):
+        del self._vms
 
 
     def __repr__(self):
@@ -413,7 +577,7 @@ class VMCollection:
         names are sorted by lexical order.
         '''
 
-        return iter(sorted(vm.name for vm in self._dict.values()))
+        return iter(sorted(self._dict.by_name))
 
 
     def vms(self):
@@ -422,7 +586,7 @@ class VMCollection:
         vms are sorted by qid.
         '''
 
-        return iter(sorted(self._dict.values()))
+        return iter(self._dict.sorted_values())
 
     __iter__ = vms
     values = vms
@@ -449,7 +613,11 @@ class VMCollection:
             raise ValueError('A VM named {!s} already exists'
                 .format(value.name))
 
+        in_sync = self._dependencies_in_sync()
         self._dict[value.qid] = value
+        if in_sync and _enable_events:
+            self._index_dependencies(value)
+            self._dependents_generation = self._dict.generation
         if _enable_events:
             value.events_enabled = True
             self.app.fire_event('domain-add', vm=value)
@@ -461,19 +629,13 @@ class VMCollection:
             return self._dict[key]
 
         if isinstance(key, str):
-            for vm in self:
-                if vm.name == key:
-                    return vm
-            raise KeyError(key)
+            return self._dict.by_name[key]
 
         if isinstance(key, qubes.vm.BaseVM):
             key = key.uuid
 
         if isinstance(key, uuid.UUID):
-            for vm in self:
-                if vm.uuid == key:
-                    return vm
-            raise KeyError(key)
+            return self._dict.get_by_uuid(key)
 
         raise KeyError(key)
 
@@ -491,22 +653,102 @@ class VMCollection:
             if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
                 # already undefined
                 pass
+        in_sync = self._dependencies_in_sync()
         del self._dict[vm.qid]
+        if in_sync:
+            self._unindex_dependencies(vm)
+            self._dependents_generation = self._dict.generation
         self.app.fire_event('domain-delete', vm=vm)
 
     def __contains__(self, key):
-        return any((key in (vm, vm.qid, vm.name))
-                   for vm in self)
+        if isinstance(key, int):
+            return key in self._dict
+        if isinstance(key, str):
+            return key in self._dict.by_name
+        if isinstance(key, qubes.vm.BaseVM):
+            return self._dict.get(getattr(key, 'qid', None)) is key
+        return False
+
+    def reindex(self, vm):
+        '''Update name and UUID indexes after *vm* changed either of them'''
+        self._dict.reindex(vm)
 
 
     def __len__(self):
         return len(self._dict)
 
 
+    def _dependencies_in_sync(self):
+        return self._dependents is not None and \
+            self._dependents_generation == self._dict.generation
+
+    def _index_dependencies(self, vm):
+        edges = {}
+        for propname in self.dependency_properties:
+            try:
+                target = getattr(vm, propname)
+            except AttributeError:
+                continue
+            if target is None:
+                continue
+            edges[propname] = target
+            self._dependents[propname].setdefault(target, set()).add(vm)
+        self._dependencies[vm] = edges
+
+    def _unindex_dependencies(self, vm):
+        for propname, target in self._dependencies.pop(vm, {}).items():
+            dependents = self._dependents[propname].get(target)
+            if dependents is None:
+                continue
+            dependents.discard(vm)
+            if not dependents:
+                del self._dependents[propname][target]
+
+    def refresh_dependencies(self):
+        '''Drop reverse dependency indexes, to be rebuilt on next use
+
+        Call this when a change affects dependencies of many VMs at once,
+        for example when a global default (like ``default_netvm``) changes.
+        '''
+        self._dependents = None
+        self._dependencies = {}
+        self._dependents_generation = None
+
+    def update_dependencies(self, vm):
+        '''Update reverse dependency indexes after *vm* changed one of
+        :py:attr:`dependency_properties`'''
+        if not self._dependencies_in_sync():
+            return
+        if self._dict.get(getattr(vm, 'qid', None)) is not vm:
+            return
+        self._unindex_dependencies(vm)
+        self._index_dependencies(vm)
+
+    def get_dependent_vms(self, vm, propname):
+        '''Get VMs which have *propname* property set to *vm*
+
+        The result is sorted and its cost is proportional to the number of
+        dependent VMs, not to the size of the collection.
+
+        :param qubes.vm.BaseVM vm: the VM depended upon
+        :param str propname: one of :py:attr:`dependency_properties`
+        :rtype: list
+        '''
+        if not self._dependencies_in_sync():
+            self.refresh_dependencies()
+            self._dependents = {propname_: {}
+                for propname_ in self.dependency_properties}
+            for domain in self._dict.values():
+                self._index_dependencies(domain)
+            self._dependents_generation = self._dict.generation
+
+        return sorted(domain
+            for domain in self._dependents[propname].get(vm, ())
+            if getattr(domain, propname, None) is vm)
+
     def get_vms_based_on(self, template):
         template = self[template]
-        return set(vm for vm in self
-            if hasattr(vm, 'template') and vm.template == template)
+        return set(self.get_dependent_vms(template, 'template'))
 
 
     def get_vms_connected_to(self, netvm):
@@ -519,7 +761,7 @@ class VMCollection:
 
         while new_vms:
             cur_vm = new_vms.pop()
-            for vm in cur_vm.connected_vms:
+            for vm in self.get_dependent_vms(cur_vm, 'netvm'):
                 if vm in dependent_vms:
                     continue
                 dependent_vms.add(vm)
@@ -549,6 +791,104 @@ class VMCollection:
             'http://dilbert.com/strip/2001-10-25')[random.randint(0, 1)])
 
 
+class StoreJournal:
+    '''Append-only journal of changes to :file:`qubes.xml`
+
+    Instead of rewriting the whole store on every :py:meth:`Qubes.save`,
+    domains changed since the last save are serialised and appended to
+    a journal file next to the store, each record followed by ``fsync()``.
+    The journal is replayed on load and removed by the next full write of the
+    store (compaction).
+
+    The first line of the journal identifies the store file it applies to (by
+    inode, modification time and size). A full write always replaces the
+    store with a new file, so a journal left behind by a crash during
+    compaction is recognised as stale and ignored. Each record is prefixed
+    with its length and CRC32, so a partially written last record is
+    discarded.
+
+    :param str path: path to the journal file
+    '''
+
+    MAGIC = b'QUBES-JOURNAL 1'
+
+    def __init__(self, path):
+        #: path to the journal file
+        self.path = path
+        #: size of the valid part of the journal, 0 if there is none
+        self.size = 0
+
+    def _header(self, store_stat):
+        return b'%s %d %d %d\n' % (self.MAGIC, store_stat.st_ino,
+            store_stat.st_mtime_ns, store_stat.st_size)
+
+    def read(self, store_stat):
+        '''Read journal records applicable to the store
+
+        :param os.stat_result store_stat: :py:func:`os.fstat` of the store
+        :return: list of records (:py:class:`lxml.etree._Element`)
+        '''
+        self.size = 0
+        try:
+            fh = open(self.path, 'rb')
+        except FileNotFoundError:
+            return []
+
+        entries = []
+        with fh:
+            if fh.readline() != self._header(store_stat):
+                # stale journal, will be overwritten
+                return []
+            size = fh.tell()
+            for line in iter(fh.readline, b''):
+                try:
+                    length, checksum = (int(x, 16) for x in line.split())
+                except ValueError:
+                    break
+                data = fh.read(length + 1)
+                if len(data) != length + 1 or not data.endswith(b'\n') \
+                        or zlib.crc32(data[:-1]) != checksum:
+                    break
+                entries.append(lxml.etree.fromstring(data[:-1]))
+                size = fh.tell()
+        self.size = size
+        return entries
+
+    def append(self, entry, store_stat):
+        '''Append a record and wait for it to reach the disk
+
+        :param lxml.etree._Element entry: the record
+        :param os.stat_result store_stat: :py:func:`os.fstat` of the store
+        '''
+        data = lxml.etree.tostring(entry, encoding='utf-8')
+        record = b'%x %x\n%s\n' % (len(data), zlib.crc32(data), data)
+        with open(self.path, 'ab') as fh:
+            if not self.size:
+                fh.truncate(0)
+                fh.write(self._header(store_stat))
+                try:
+                    os.fchown(fh.fileno(), -1, grp.getgrnam('qubes').gr_gid)
+                    os.fchmod(fh.fileno(), 0o660)
+                except KeyError:  # group 'qubes' not found
+                    # don't change mode if no 'qubes' group in the system
+                    pass
+            else:
+                # drop a partially written record, if any
+                fh.truncate(self.size)
+            fh.write(record)
+            fh.flush()
+            os.fsync(fh.fileno())
+            self.size = fh.tell()
+
+    def remove(self):
+        '''Remove the journal, after its contents got written to the store'''
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.size = 0
+
+
 def _default_pool(app):
     ''' Default storage pool.
 
@@ -595,6 +935,13 @@ def _setter_pool(app, prop, value):
         raise qubes.exc.QubesPropertyValueError(app, prop, value,
             'No such storage pool')
 
+def _setter_threads(app, prop, value):
+    value = int(value)
+    if value <= 0:
+        raise qubes.exc.QubesPropertyValueError(app, prop, value,
+            'Number of threads must be positive')
+    return value
+
 def _setter_default_netvm(app, prop, value):
     # skip netvm loop check while loading qubes.xml, to avoid tricky loading
     # order
@@ -603,16 +950,18 @@ def _setter_default_netvm(app, prop, value):
 
     if value is None:
         return value
-    # forbid setting to a value that would result in netvm loop
-    for vm in app.domains:
+    # forbid setting to a value that would result in netvm loop: that is when
+    # the new value, or any VM upstream of it, uses default netvm
+    vm = value
+    seen = set()
+    while vm is not None and vm not in seen:
+        seen.add(vm)
         if not hasattr(vm, 'netvm'):
-            continue
-        if not vm.property_is_default('netvm'):
-            continue
-        if value == vm \
-                or value in app.domains.get_vms_connected_to(vm):
+            break
+        if vm.property_is_default('netvm'):
             raise qubes.exc.QubesPropertyValueError(app, prop, value,
                 'Network loop on \'{!s}\''.format(vm))
+        vm = vm.netvm
     return value
 
 
@@ -702,7 +1051,7 @@ class Qubes(qubes.PropertyHolder):
             :param pool: Pool object
 
     Methods and attributes:
-    '''
+    '''  # pylint: disable=too-many-instance-attributes
 
     default_netvm = qubes.VMProperty('default_netvm', load_stage=3,
         default=None, allow_none=True,
@@ -775,6 +1124,24 @@ class Qubes(qubes.PropertyHolder):
         type=int,
         doc='Interval in seconds for VM stats reporting (memory, CPU usage)')
 
+    executor_storage_threads = qubes.property('executor_storage_threads',
+        load_stage=3,
+        default=qubes.executors.DEFAULT_MAX_WORKERS['storage'],
+        type=int, setter=_setter_threads,
+        doc='Number of threads for blocking operations of each storage pool')
+
+    executor_qmemman_threads = qubes.property('executor_qmemman_threads',
+        load_stage=3,
+        default=qubes.executors.DEFAULT_MAX_WORKERS['qmemman'],
+        type=int, setter=_setter_threads,
+        doc='Number of threads for memory requests to qmemman')
+
+    executor_libvirt_threads = qubes.property('executor_libvirt_threads',
+        load_stage=3,
+        default=qubes.executors.DEFAULT_MAX_WORKERS['libvirt'],
+        type=int, setter=_setter_threads,
+        doc='Number of threads for blocking libvirt calls')
+
     # TODO #1637 #892
     check_updates_vm = qubes.property('check_updates_vm',
         type=bool, setter=qubes.property.bool,
@@ -816,6 +1183,35 @@ class Qubes(qubes.PropertyHolder):
                     qubes.config.qubes_base_dir,
                     qubes.config.system_path['qubes_store_filename']))
 
+        #: journal of changes not yet written to the main store file
+        self.journal = StoreJournal(self._store + '.journal')
+
+        #: if :py:obj:`True`, :py:meth:`save` appends changed domains to the
+        #: :py:attr:`journal` instead of rewriting the whole store
+        self.use_journal = False
+
+        #: journal size (in bytes) above which :py:meth:`save` compacts it
+        #: into the main store file
+        self.journal_max_size = 1024 * 1024
+
+        # changes since the last save: qids of added/modified domains, qids
+        # of removed domains, and whether anything else changed
+        self._changed_domains = set()
+        self._removed_domains = set()
+        self._changed_other = False
+
+        #: if not :py:obj:`None`, :py:meth:`save` only schedules writing
+        #: the store, after this many seconds without another save request
+        self.save_delay = None
+
+        #: maximum time (in seconds) a scheduled save can be postponed by
+        #: subsequent save requests, see :py:attr:`save_delay`
+        self.save_max_delay = 5
+
+        self._save_handle = None
+        self._save_deadline = None
+        self._save_lock = True
+
         super(Qubes, self).__init__(xml=None, **kwargs)
 
         self.__load_timestamp = None
@@ -893,6 +1289,7 @@ class Qubes(qubes.PropertyHolder):
 
         fh = self._acquire_lock()
         self.xml = lxml.etree.parse(fh)
+        self._replay_journal(os.fstat(fh.fileno()))
 
         # stage 1: load labels and pools
         for node in self.xml.xpath('./labels/label'):
@@ -915,16 +1312,19 @@ class Qubes(qubes.PropertyHolder):
             vm.load_properties(load_stage=2)
             vm.init_log()
             self.domains.add(vm, _enable_events=False)
+            vm.add_handler('*', self._on_domain_event_journal)
 
         if 0 not in self.domains:
             self.domains.add(
                 qubes.vm.adminvm.AdminVM(self, None),
                 _enable_events=False)
+            self.domains[0].add_handler('*', self._on_domain_event_journal)
 
         self._migrate_global_properties()
 
         # stage 3: load global properties
         self.load_properties(load_stage=3)
+        self._configure_executors()
 
         # stage 4: fill all remaining VM properties
         for vm in self.domains:
@@ -944,7 +1344,7 @@ class Qubes(qubes.PropertyHolder):
 
         # get a file timestamp (before closing it - still holding the lock!),
         #  to detect whether anyone else have modified it in the meantime
-        self.__load_timestamp = os.path.getmtime(self._store)
+        self.__load_timestamp = self._get_store_timestamp()
 
         if not lock:
             self._release_lock()
@@ -975,7 +1375,7 @@ class Qubes(qubes.PropertyHolder):
     def __str__(self):
         return type(self).__name__
 
-    def save(self, lock=True):
+    def save(self, lock=True, sync=False, full=False):
         '''Save all data to qubes.xml
 
         There are several problems with saving :file:`qubes.xml` which must be
@@ -986,18 +1386,112 @@ class Qubes(qubes.PropertyHolder):
         - Attempts to write two or more files concurrently. This is done by
           sophisticated locking.
 
+        If :py:attr:`use_journal` is set and only some domains were added,
+        modified or removed since the last save, just those domains are
+        appended to the :py:attr:`journal`. Other changes (global properties,
+        pools), *full*, or the journal growing over
+        :py:attr:`journal_max_size`, cause the whole store to be written and
+        the journal to be removed.
+
+        Changes are tracked by events, so any change which does not fire one
+        (like a new label, or settings of a pool or a volume) needs the
+        caller to pass *full*.
+
+        If :py:attr:`save_delay` is set, the data is not written immediately.
+        Instead, a single write is scheduled in the event loop, after
+        :py:attr:`save_delay` seconds without another call to this method,
+        but no later than :py:attr:`save_max_delay` seconds after the first
+        one. Use *sync* (or :py:meth:`flush_save`) when the data needs to be
+        on the disk before proceeding. Admin API clients can ask for the
+        latter with ``admin.store.Flush``.
+
         :param bool lock: keep file locked after saving
+        :param bool sync: write immediately, together with any pending save
+        :param bool full: write the whole store, not just the journal
         :throws EnvironmentError: failure on saving
         '''
 
+        if full:
+            self._changed_other = True
+
+        if self.save_delay is not None and not sync:
+            self._schedule_save(lock)
+            return
+        self._cancel_scheduled_save()
+
         if not self.__locked_fh:
             self._acquire_lock(for_save=True)
 
+        if self._journal_usable():
+            self._save_journal()
+        else:
+            self._save_store()
+
+        self._changed_domains.clear()
+        self._removed_domains.clear()
+        self._changed_other = False
+
+        # update stored timestamp, in case of multiple save() calls without
+        # loading qubes.xml again
+        self.__load_timestamp = self._get_store_timestamp()
+
+        if not lock:
+            self._release_lock()
+
+    def flush_save(self):
+        '''Write the store now, if there is a save scheduled
+
+        See :py:attr:`save_delay`.
+        '''
+        if self._save_handle is not None:
+            self.save(lock=self._save_lock, sync=True)
+
+    def _journal_usable(self):
+        '''Whether the changes since the last save can be appended to the
+        journal, instead of writing the whole store'''
+        if not self.use_journal or self.__load_timestamp is None:
+            return False
+        if self._changed_other:
+            return False
+        if not (self._changed_domains or self._removed_domains):
+            return False
+        return self.journal.size < self.journal_max_size
+
+    def _schedule_save(self, lock):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        if self._save_deadline is None:
+            self._save_deadline = now + self.save_max_delay
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+        self._save_lock = lock
+        self._save_handle = loop.call_at(
+            min(now + self.save_delay, self._save_deadline),
+            self._scheduled_save)
+
+    def _cancel_scheduled_save(self):
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+        self._save_handle = None
+        self._save_deadline = None
+
+    def _scheduled_save(self):
+        self._save_handle = None
+        try:
+            self.save(lock=self._save_lock, sync=True)
+        except Exception:  # pylint: disable=broad-except
+            self.log.exception('Failed to save %s, will retry', self._store)
+            self._schedule_save(self._save_lock)
+
+    def _save_store(self):
         fh_new = tempfile.NamedTemporaryFile(
             prefix=self._store, delete=False)
         lxml.etree.ElementTree(self.__xml__()).write(
             fh_new, encoding='utf-8', pretty_print=True)
         fh_new.flush()
+        # the journal is removed below, so the new file must be on the disk
+        # first
+        os.fsync(fh_new.fileno())
         try:
             os.chown(fh_new.name, -1, grp.getgrnam('qubes').gr_gid)
             os.chmod(fh_new.name, 0o660)
@@ -1005,18 +1499,47 @@ class Qubes(qubes.PropertyHolder):
             # don't change mode if no 'qubes' group in the system
             pass
         os.rename(fh_new.name, self._store)
-
-        # update stored mtime, in case of multiple save() calls without
-        # loading qubes.xml again
-        self.__load_timestamp = os.path.getmtime(self._store)
+        self.journal.remove()
 
         # this releases lock for all other processes,
         # but they should instantly block on the new descriptor
         self.__locked_fh.close()
         self.__locked_fh = fh_new
 
-        if not lock:
-            self._release_lock()
+    def _save_journal(self):
+        entry = lxml.etree.Element('changes')
+        for qid in sorted(self._removed_domains):
+            lxml.etree.SubElement(entry, 'removed-domain',
+                id='domain-' + str(qid))
+        for qid in sorted(self._changed_domains):
+            entry.append(self.domains[qid].__xml__())
+        self.journal.append(entry, os.fstat(self.__locked_fh.fileno()))
+
+    def _replay_journal(self, store_stat):
+        entries = self.journal.read(store_stat)
+        if not entries:
+            return
+        self.log.debug('replaying %d journal entries', len(entries))
+        domains = self.xml.find('./domains')
+        for entry in entries:
+            for node in entry:
+                old_node = domains.find(
+                    './domain[@id=\'{}\']'.format(node.get('id')))
+                if node.tag == 'domain':
+                    if old_node is not None:
+                        domains.replace(old_node, node)
+                    else:
+                        domains.append(node)
+                elif node.tag == 'removed-domain':
+                    if old_node is not None:
+                        domains.remove(old_node)
+
+    def _get_store_timestamp(self):
+        try:
+            journal_size = os.path.getsize(self.journal.path)
+        except FileNotFoundError:
+            journal_size = None
+        return (os.path.getmtime(self._store), journal_size)
 
 
     def close(self):
@@ -1030,6 +1553,9 @@ class Qubes(qubes.PropertyHolder):
 
         super().close()
 
+        # pending save, if any, is lost - see flush_save()
+        self._cancel_scheduled_save()
+
         if self._domain_event_callback_id is not None:
             self.vmm.libvirt_conn.domainEventDeregisterAny(
                 self._domain_event_callback_id)
@@ -1076,7 +1602,7 @@ class Qubes(qubes.PropertyHolder):
                 continue
 
             if self.__load_timestamp and \
-                    os.path.getmtime(self._store) != self.__load_timestamp:
+                    self._get_store_timestamp() != self.__load_timestamp:
                 os.close(fd)
                 raise qubes.exc.QubesException(
                     'Someone else modified qubes.xml in the meantime')
@@ -1400,6 +1926,61 @@ class Qubes(qubes.PropertyHolder):
             except AttributeError:
                 pass
 
+    @qubes.events.handler('domain-add')
+    def on_domain_add_journal(self, event, vm):
+        # pylint: disable=unused-argument
+        vm.add_handler('*', self._on_domain_event_journal)
+        self._changed_domains.add(vm.qid)
+
+    @qubes.events.handler('domain-delete')
+    def on_domain_delete_journal(self, event, vm):
+        # pylint: disable=unused-argument
+        self._changed_domains.discard(vm.qid)
+        self._removed_domains.add(vm.qid)
+
+    @qubes.events.handler('property-set:*', 'property-del:*',
+        'pool-add', 'pool-delete')
+    def on_change_journal(self, event, **kwargs):
+        '''Global configuration changed, next save can't be journaled'''
+        # pylint: disable=unused-argument
+        self._changed_other = True
+
+    #: domain events which mean the domain needs to be saved again
+    _journal_domain_events = (
+        'property-set:',
+        'property-del:',
+        'domain-feature-set:',
+        'domain-feature-delete:',
+        'domain-tag-add:',
+        'domain-tag-delete:',
+        'device-attach:',
+        'device-detach:',
+    )
+
+    def _on_domain_event_journal(self, vm, event, **kwargs):
+        # pylint: disable=unused-argument
+        if event == 'property-set:name':
+            # other domains refer to this one by name
+            self._changed_other = True
+        elif event.startswith(self._journal_domain_events):
+            self._changed_domains.add(vm.qid)
+
+
+    @qubes.events.handler(
+        'property-set:executor_storage_threads',
+        'property-del:executor_storage_threads',
+        'property-set:executor_qmemman_threads',
+        'property-del:executor_qmemman_threads',
+        'property-set:executor_libvirt_threads',
+        'property-del:executor_libvirt_threads')
+    def on_executor_threads_change(self, event, name, *args, **kwargs):
+        # pylint: disable=unused-argument
+        self._configure_executors()
+
+    def _configure_executors(self):
+        qubes.executors.configure('storage', self.executor_storage_threads)
+        qubes.executors.configure('qmemman', self.executor_qmemman_threads)
+        qubes.executors.configure('libvirt', self.executor_libvirt_threads)
 
     @qubes.events.handler('property-pre-set:clockvm')
     def on_property_pre_set_clockvm(self, event, name, newvalue, oldvalue=None):
@@ -1427,6 +2008,15 @@ class Qubes(qubes.PropertyHolder):
                 'is not running ({!r}).'.format(name, newvalue.name))
 
 
+    @qubes.events.handler('property-del:default_netvm',
+        'property-set:default_dispvm', 'property-del:default_dispvm')
+    def on_default_dependency_change(self, event, name, newvalue=None,
+            oldvalue=None):
+        '''Default changed for all VMs using it, drop reverse dependency
+        indexes'''
+        # pylint: disable=unused-argument
+        self.domains.refresh_dependencies()
+
     @qubes.events.handler('property-set:default_fw_netvm')
     def on_property_set_default_fw_netvm(self, event, name, newvalue,
             oldvalue=None):
@@ -1446,6 +2036,8 @@ class Qubes(qubes.PropertyHolder):
     def on_property_set_default_netvm(self, event, name, newvalue,
             oldvalue=None):
         # pylint: disable=unused-argument
+        # netvm of all the VMs using the default one has changed
+        self.domains.refresh_dependencies()
         for vm in self.domains:
             if hasattr(vm, 'provides_network') and not vm.provides_network and \
                     hasattr(vm, 'netvm') and vm.property_is_default('netvm'):
@@ -27,7 +27,46 @@ import asyncio
 import collections
 import fnmatch
 
-import itertools
+
+#: incremented when handlers registered at class level change, to invalidate
+#: all dispatch tables
+_dispatch_generation = 0
+
+#: maximal number of events in the dispatch table of a class, and of an
+#: object; event names can come from untrusted input (for example
+#: ``domain-feature-set:NAME``), so a full table is emptied before adding
+#: another one
+CLASS_DISPATCH_TABLE_SIZE = 1024
+INSTANCE_DISPATCH_TABLE_SIZE = 256
+
+
+def invalidate_dispatch_tables():
+    '''Mark cached handler lists of all classes and objects as stale.
+
+    Call this after modifying ``__handlers__`` of a class directly (like
+    extensions do). :py:meth:`Emitter.add_handler` and
+    :py:meth:`Emitter.remove_handler` take care of this themselves.
+    '''
+    global _dispatch_generation  # pylint: disable=global-statement
+    _dispatch_generation += 1
+
+
+def _compile_handlers(handlers_dicts, event):
+    '''Resolve handler patterns matching *event* into a list of handlers.
+
+    :param handlers_dicts: ``__handlers__`` dicts, in the calling order
+    :returns: tuple of (handler, is_coroutine) pairs
+    '''
+    compiled = []
+    for handlers_dict in handlers_dicts:
+        handlers = [h_func for h_name, h_func_set in handlers_dict.items()
+                    for h_func in h_func_set
+                    if fnmatch.fnmatch(event, h_name)]
+        compiled.extend((func, asyncio.iscoroutinefunction(func))
+            for func in sorted(handlers,
+                key=(lambda handler: hasattr(handler, 'ha_bound')),
+                reverse=True))
+    return tuple(compiled)
 
 
 def handler(*events):
@@ -74,6 +113,10 @@ class EmitterMeta(type):
     def __init__(cls, name, bases, dict_):
         super(EmitterMeta, cls).__init__(name, bases, dict_)
         cls.__handlers__ = collections.defaultdict(set)
+        # (event, pre_event) -> handlers registered for the class and its
+        # bases, see Emitter._get_handlers()
+        cls._dispatch_table = {}
+        cls._dispatch_table_generation = _dispatch_generation
 
         try:
             propnames = set(prop.__name__ for prop in cls.property_list())
@@ -99,6 +142,11 @@ class Emitter(metaclass=EmitterMeta):
 
     By default all events are disabled not to interfere with loading from XML.
     To enable event dispatch, set :py:attr:`events_enabled` to :py:obj:`True`.
+
+    Handlers matching an event name are resolved once and cached in dispatch
+    tables, per class and (for objects with their own handlers) per object,
+    of at most :py:data:`CLASS_DISPATCH_TABLE_SIZE` and
+    :py:data:`INSTANCE_DISPATCH_TABLE_SIZE` events.
     '''
 
     def __init__(self, *args, **kwargs):
@@ -106,6 +154,8 @@ class Emitter(metaclass=EmitterMeta):
         if not hasattr(self, 'events_enabled'):
             self.events_enabled = False
         self.__handlers__ = collections.defaultdict(set)
+        self._instance_dispatch_table = {}
+        self._instance_dispatch_gen = _dispatch_generation
 
     def close(self):
         self.events_enabled = False
@@ -121,6 +171,7 @@ class Emitter(metaclass=EmitterMeta):
 
         # pylint: disable=no-member
         self.__handlers__[event].add(func)
+        self._instance_dispatch_table.clear()
 
     def remove_handler(self, event, func):
         '''Remove event handler from subject's class.
@@ -136,6 +187,50 @@ class Emitter(metaclass=EmitterMeta):
 
         # pylint: disable=no-member
         self.__handlers__[event].remove(func)
+        if not self.__handlers__[event]:
+            del self.__handlers__[event]
+        self._instance_dispatch_table.clear()
+
+    def _get_handlers(self, event, pre_event):
+        '''Get handlers for an event, in calling order.
+
+        :returns: tuple of (handler, is_coroutine) pairs
+        '''
+        # pylint: disable=no-member,protected-access
+        key = (event, pre_event)
+        cls = type(self)
+        if cls._dispatch_table_generation != _dispatch_generation:
+            cls._dispatch_table = {}
+            cls._dispatch_table_generation = _dispatch_generation
+        try:
+            class_handlers = cls._dispatch_table[key]
+        except KeyError:
+            if len(cls._dispatch_table) >= CLASS_DISPATCH_TABLE_SIZE:
+                cls._dispatch_table.clear()
+            order = cls.__mro__ if pre_event else reversed(cls.__mro__)
+            class_handlers = cls._dispatch_table[key] = _compile_handlers(
+                (klass.__handlers__ for klass in order
+                    if hasattr(klass, '__handlers__')), event)
+
+        if not self.__handlers__:
+            return class_handlers
+
+        if self._instance_dispatch_gen != _dispatch_generation:
+            self._instance_dispatch_table.clear()
+            self._instance_dispatch_gen = _dispatch_generation
+        try:
+            return self._instance_dispatch_table[key]
+        except KeyError:
+            if len(self._instance_dispatch_table) >= \
+                    INSTANCE_DISPATCH_TABLE_SIZE:
+                self._instance_dispatch_table.clear()
+            instance_handlers = _compile_handlers((self.__handlers__,), event)
+            if pre_event:
+                handlers = instance_handlers + class_handlers
+            else:
+                handlers = class_handlers + instance_handlers
+            self._instance_dispatch_table[key] = handlers
+            return handlers
 
     def _fire_event(self, event, kwargs, pre_event=False):
         '''Fire event for classes in given order.
@@ -146,28 +241,14 @@ class Emitter(metaclass=EmitterMeta):
         if not self.events_enabled:
             return [], []
 
-        order = itertools.chain((self,), self.__class__.__mro__)
-        if not pre_event:
-            order = reversed(list(order))
-
         effects = []
         async_effects = []
-        for i in order:
-            try:
-                handlers_dict = i.__handlers__
-            except AttributeError:
-                continue
-            handlers = [h_func for h_name, h_func_set in handlers_dict.items()
-                        for h_func in h_func_set
-                        if fnmatch.fnmatch(event, h_name)]
-            for func in sorted(handlers,
-                    key=(lambda handler: hasattr(handler, 'ha_bound')),
-                    reverse=True):
-                effect = func(self, event, **kwargs)
-                if asyncio.iscoroutinefunction(func):
-                    async_effects.append(effect)
-                elif effect is not None:
-                    effects.extend(effect)
+        for func, is_coroutine in self._get_handlers(event, pre_event):
+            effect = func(self, event, **kwargs)
+            if is_coroutine:
+                async_effects.append(effect)
+            elif effect is not None:
+                effects.extend(effect)
         return effects, async_effects
 
     def fire_event(self, event, pre_event=False, **kwargs):
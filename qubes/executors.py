@@ -0,0 +1,153 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+'''Thread pools for blocking calls of qubesd subsystems.
+
+Blocking calls are not made in the event loop's default executor, where
+a few long reflink copies could make a qmemman request wait for a free
+thread, but each subsystem (and each storage pool) gets its own
+:py:class:`Executor`. The number of threads of each subsystem is set by
+:py:func:`configure` (from properties of :py:class:`qubes.Qubes`).
+'''
+
+import concurrent.futures
+import threading
+import time
+
+#: default number of threads of an executor, by subsystem
+DEFAULT_MAX_WORKERS = {
+    'storage': 4,
+    'qmemman': 2,
+    'libvirt': 4,
+}
+
+_max_workers = dict(DEFAULT_MAX_WORKERS)
+_executors = {}
+
+
+class Executor(concurrent.futures.ThreadPoolExecutor):
+    '''Thread pool keeping metrics of its queue.
+
+    :param str name: name of the executor
+    :param str subsystem: subsystem it belongs to
+    :param int max_workers: maximum number of threads
+    '''
+
+    def __init__(self, name, subsystem, max_workers):
+        # no thread_name_prefix, it is not supported before Python 3.6
+        super().__init__(max_workers=max_workers)
+        #: name of the executor
+        self.name = name
+        #: subsystem it belongs to, see :py:data:`DEFAULT_MAX_WORKERS`
+        self.subsystem = subsystem
+        #: maximum number of threads
+        self.max_workers = max_workers
+        #: calls waiting for a free thread
+        self.queued = 0
+        #: calls in progress
+        self.running = 0
+        #: calls done
+        self.completed = 0
+        #: total time (in seconds) calls waited for a free thread
+        self.wait_time = 0.0
+        #: longest time (in seconds) a call waited for a free thread
+        self.max_wait_time = 0.0
+        self._metrics_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        # pylint: disable=arguments-differ
+        with self._metrics_lock:
+            self.queued += 1
+        future = super().submit(self._run, time.monotonic(),
+            fn, args, kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def _run(self, submitted, fn, args, kwargs):
+        wait_time = time.monotonic() - submitted
+        with self._metrics_lock:
+            self.queued -= 1
+            self.running += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._metrics_lock:
+                self.running -= 1
+                self.completed += 1
+
+    def _done(self, future):
+        if future.cancelled():
+            # did not get to _run()
+            with self._metrics_lock:
+                self.queued -= 1
+
+    @property
+    def metrics(self):
+        '''Current metrics of the executor, as a dict'''
+        with self._metrics_lock:
+            started = self.running + self.completed
+            return {
+                'max_workers': self.max_workers,
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'avg_wait_time': self.wait_time / started if started else 0.0,
+                'max_wait_time': self.max_wait_time,
+            }
+
+
+def get(subsystem, name=None):
+    '''Get the executor *name* (by default the same as *subsystem*),
+    creating it if needed.
+
+    :param str subsystem: subsystem, see :py:data:`DEFAULT_MAX_WORKERS`
+    :param str name: name of the executor, for subsystems with more than \
+        one (like ``'storage-POOLNAME'``)
+    '''
+    if name is None:
+        name = subsystem
+    executor = _executors.get(name)
+    if executor is None or executor.max_workers != _max_workers[subsystem]:
+        if executor is not None:
+            # let the calls already submitted finish in the old one
+            executor.shutdown(wait=False)
+        executor = _executors[name] = Executor(name, subsystem,
+            _max_workers[subsystem])
+    return executor
+
+
+def configure(subsystem, max_workers):
+    '''Set the number of threads of executors of *subsystem*, applied to
+    existing executors the next time they are used.'''
+    if subsystem not in _max_workers:
+        raise KeyError(subsystem)
+    _max_workers[subsystem] = max_workers
+
+
+def metrics():
+    '''Metrics of all the executors, by name'''
+    return {name: executor.metrics
+        for name, executor in sorted(_executors.items())}
+
+
+def shutdown(wait=True):
+    '''Shut down all the executors'''
+    for executor in _executors.values():
+        executor.shutdown(wait=wait)
+    _executors.clear()
@@ -25,8 +25,8 @@ some systems. They may be OS- or architecture-dependent or custom-developed for
 particular customer.
 '''
 
-import pkg_resources
 import qubes.events
+import qubes.utils
 
 
 class Extension:
@@ -51,12 +51,14 @@ class Extension:
                         # pylint: disable=no-member
                         qubes.Qubes.__handlers__[event].add(attr)
 
+            qubes.events.invalidate_dispatch_tables()
+
         return cls._instance
 
 
 def get_extensions():
     return set(ext.load()()
-        for ext in pkg_resources.iter_entry_points('qubes.ext'))
+        for ext in qubes.utils.iter_entry_points('qubes.ext'))
 
 
 def handler(*events, **kwargs):
@@ -24,19 +24,23 @@
 
 from __future__ import absolute_import
 
+import contextlib
 import inspect
+import json
+import logging
 import os
 import os.path
 import string  # pylint: disable=deprecated-module
 import subprocess
+import threading
 import time
 from datetime import datetime
 
 import asyncio
 import lxml.etree
-import pkg_resources
 import qubes
 import qubes.exc
+import qubes.executors
 import qubes.utils
 
 STORAGE_ENTRY_POINT = 'qubes.storage'
@@ -80,6 +84,13 @@ class Volume:
     #: disk space used by this volume, can be smaller than :py:attr:`size`
     #: for sparse volumes
     usage = 0
+    #: when :py:attr:`usage` was measured (seconds since the epoch), if it
+    #: is a cached value; :py:obj:`None` if it is current
+    usage_timestamp = None
+    #: called as ``copy_progress(copied, total)`` (possibly from executor
+    #: threads) while the driver copies data into this volume, see
+    #: :py:class:`CopyProgress`; :py:obj:`None` if nobody is interested
+    copy_progress = None
 
     def __init__(self, name, pool, vid,
             revisions_to_keep=0, rw=False, save_on_stop=False, size=0,
@@ -188,7 +199,7 @@ class Volume:
         '''
         raise self._not_implemented("export")
 
-    def import_data(self):
+    def import_data(self, keep_data=False):
         ''' Returns a path to overwrite volume data.
 
             This method is called after volume was already :py:meth:`create`-ed.
@@ -199,6 +210,11 @@ class Volume:
             on the fly), the returned path may be a pipe.
 
             This can be implemented as a coroutine.
+
+            :param keep_data: start with the current volume data (as a
+                snapshot or a reflink, where possible) instead of zeroes, so
+                that only changed blocks need to be written; pools not
+                supporting it raise :py:class:`NotImplementedError`
         '''
         raise self._not_implemented("import_data")
 
@@ -233,6 +249,17 @@ class Volume:
         '''
         raise self._not_implemented("is_dirty")
 
+    def data_stamp(self):
+        ''' Identify the current volume data, for
+        :py:func:`qubes.storage.manifest.stamp`. The stamp must change
+        whenever the data changes.
+
+        :return: ASCII string without newlines, or :py:obj:`None` to use \
+            stat(2) of the :py:meth:`export` path
+        '''
+        # pylint: disable=no-self-use
+        return None
+
     def is_outdated(self):
         ''' Returns `True` if this snapshot of a source volume (for
         `snap_on_start`=True) is outdated.
@@ -404,6 +431,7 @@ class Storage:
             # migrate old config
             del volume_config['internal']
         volume = pool.init_volume(self.vm, volume_config)
+        volume.copy_progress = CopyProgress(self.vm, name)
         self.vm.volumes[name] = volume
         return volume
 
@@ -663,14 +691,16 @@ class Storage:
         return self.vm.volumes[volume].export()
 
     @asyncio.coroutine
-    def import_data(self, volume):
+    def import_data(self, volume, keep_data=False):
         ''' Helper function to import volume data (pool.import_data(volume))'''
         assert isinstance(volume, (Volume, str)), \
             "You need to pass a Volume or pool name as str"
-        if isinstance(volume, Volume):
-            ret = volume.import_data()
+        if not isinstance(volume, Volume):
+            volume = self.vm.volumes[volume]
+        if keep_data:
+            ret = volume.import_data(keep_data=True)
         else:
-            ret = self.vm.volumes[volume].import_data()
+            ret = volume.import_data()
 
         if asyncio.iscoroutine(ret):
             ret = yield from ret
@@ -785,6 +815,12 @@ class Pool:
         ''' Returns the pool config to be written to qubes.xml '''
         raise self._not_implemented("config")
 
+    @property
+    def executor(self):
+        ''' Executor for blocking operations of this pool, see
+        :py:mod:`qubes.executors` '''
+        return qubes.executors.get('storage', 'storage-' + self.name)
+
     def destroy(self):
         ''' Called when removing the pool. Use this for implementation specific
             clean up.
@@ -847,6 +883,513 @@ class Pool:
         return NotImplementedError(msg)
 
 
+class CopyProgress:
+    ''' Progress of copying data into a volume, reported by the driver
+    (as :py:attr:`Volume.copy_progress`) from any thread, and fired as
+    ``domain-volume-copy-progress`` event of the domain, from the event loop.
+
+    The event is fired at most every :py:attr:`interval` seconds, and when
+    the copy is done.
+
+    :param vm: domain owning the volume
+    :param str name: name of the volume in the domain
+    '''  # pylint: disable=too-few-public-methods
+
+    #: minimal time (in seconds) between two events
+    interval = 1
+
+    def __init__(self, vm, name):
+        self.vm = vm
+        self.name = name
+        self._loop = asyncio.get_event_loop()
+        self._last = None
+
+    def __call__(self, copied, total):
+        now = time.monotonic()
+        done = copied >= total
+        if not done and self._last is not None and \
+                now - self._last < self.interval:
+            return
+        # the next copy reports its start right away
+        self._last = None if done else now
+        self._loop.call_soon_threadsafe(self._fire, copied, total)
+
+    def _fire(self, copied, total):
+        self.vm.fire_event('domain-volume-copy-progress', volume=self.name,
+            copied=copied, total=total)
+
+
+class SnapshotReserve:
+    ''' Snapshots of volumes, prepared before they are needed
+
+    Making a snapshot of the source volume is on the critical path of
+    starting each VM with a ``snap_on_start`` volume - every DispVM and
+    every VM based on a template. A pool driver can keep a few such
+    snapshots ready: the volume being started :py:meth:`claim`\\ s one of
+    them (and only needs to rename it), and the reserve is refilled in the
+    background, once the pool was not asked for a snapshot for
+    :py:attr:`refill_delay` seconds.
+
+    Only *hot* volumes get snapshots prepared - the ones that were asked
+    for one since qubesd started. When a volume changes (for example is
+    committed at VM shutdown), its prepared snapshots are outdated and the
+    driver needs to call :py:meth:`invalidate`.
+
+    :param int size: how many snapshots to keep for each volume, 0 disables \
+        the reserve
+    :param prepare: coroutine function creating a snapshot of a volume: \
+        ``prepare(volume)``, returning the snapshot's identifier
+    :param discard: coroutine function removing snapshots of a volume: \
+        ``discard(volume, snapshots)``, where *snapshots* is a list of \
+        identifiers, or :py:obj:`None` for snapshots left behind by \
+        a previous qubesd instance
+    '''
+
+    #: how long (in seconds) the pool needs to be idle, before the reserve
+    #: is refilled
+    refill_delay = 2
+
+    def __init__(self, size, prepare, discard, log=None):
+        #: how many snapshots to keep for each volume
+        self.size = size
+        self._prepare = prepare
+        self._discard = discard
+        self.log = log or logging.getLogger('qubes.storage')
+        #: prepared snapshots, by vid of the source volume
+        self.snapshots = {}
+        self._volumes = {}
+        self._generations = {}
+        self._to_discard = []
+        self._refill_handle = None
+        self._refill_task = None
+
+    def claim(self, volume):
+        ''' Take a prepared snapshot of *volume*
+
+        :return: identifier of the snapshot, or :py:obj:`None` if there is \
+            none ready
+        '''
+        if not self.size:
+            return None
+        if volume.vid not in self._volumes:
+            self.snapshots[volume.vid] = []
+            # kept across forget(), so snapshots claimed before it are
+            # still recognised as outdated
+            self._generations.setdefault(volume.vid, 0)
+            self._to_discard.append((volume, None))
+        # the volume object might have been replaced
+        self._volumes[volume.vid] = volume
+        self._schedule_refill()
+        snapshots = self.snapshots[volume.vid]
+        if snapshots:
+            return snapshots.pop(0)
+        return None
+
+    def generation(self, volume):
+        ''' Number of times *volume* was :py:meth:`invalidate`\\ d
+
+        A driver takes it right after :py:meth:`claim`\\ ing a snapshot, and
+        compares it again before using the snapshot: if it has changed, the
+        snapshot is outdated.
+
+        :return: generation, or :py:obj:`None` if no snapshots of *volume* \
+            are prepared
+        '''
+        if volume.vid not in self._volumes:
+            return None
+        return self._generations[volume.vid]
+
+    def invalidate(self, volume):
+        ''' Drop prepared snapshots of *volume*, because it has changed '''
+        snapshots = self.snapshots.get(volume.vid)
+        if snapshots is None:
+            return
+        self._generations[volume.vid] += 1
+        self.snapshots[volume.vid] = []
+        if snapshots:
+            self._to_discard.append((volume, snapshots))
+        self._schedule_refill()
+
+    def reject(self, volume, snapshot):
+        ''' Give back a claimed snapshot of *volume*, which turned out to be
+        unusable, to be removed '''
+        self._to_discard.append((volume, [snapshot]))
+        self._schedule_refill()
+
+    def forget(self, volume):
+        ''' Stop preparing snapshots of *volume*, for example because it is
+        being removed
+
+        :return: list of snapshots that were prepared, to be removed by \
+            the caller
+        '''
+        if self._volumes.pop(volume.vid, None) is not None:
+            self._generations[volume.vid] += 1
+        return self.snapshots.pop(volume.vid, [])
+
+    def set_size(self, size):
+        ''' Change how many snapshots to keep for each volume '''
+        self.size = size
+        if self.snapshots:
+            self._schedule_refill()
+
+    def close(self):
+        ''' Cancel refilling of the reserve '''
+        if self._refill_handle is not None:
+            self._refill_handle.cancel()
+            self._refill_handle = None
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            self._refill_task = None
+
+    def _schedule_refill(self):
+        if self._refill_handle is not None:
+            self._refill_handle.cancel()
+        self._refill_handle = asyncio.get_event_loop().call_later(
+            self.refill_delay, self._start_refill)
+
+    def _start_refill(self):
+        self._refill_handle = None
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.ensure_future(self._refill())
+
+    @asyncio.coroutine
+    def _refill(self):
+        # pylint: disable=undefined-loop-variable
+        # stop when the pool gets busy, a refill is scheduled again then
+        while self._refill_handle is None:
+            if self._to_discard:
+                volume, snapshots = self._to_discard.pop(0)
+                try:
+                    yield from self._discard(volume, snapshots)
+                except Exception:  # pylint: disable=broad-except
+                    self.log.exception(
+                        'Failed to remove prepared snapshots of %s',
+                        volume.vid)
+                continue
+
+            for vid, snapshots in self.snapshots.items():
+                if len(snapshots) > self.size:
+                    self._to_discard.append(
+                        (self._volumes[vid], snapshots[self.size:]))
+                    del snapshots[self.size:]
+                if len(snapshots) < self.size:
+                    break
+            else:
+                if not self._to_discard:
+                    return
+                continue
+
+            volume = self._volumes[vid]
+            generation = self._generations[vid]
+            try:
+                snapshot = yield from self._prepare(volume)
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception(
+                    'Failed to prepare snapshot of %s', volume.vid)
+                # don't retry until it's needed again
+                self.forget(volume)
+                continue
+            if self._generations.get(vid) == generation:
+                self.snapshots[vid].append(snapshot)
+            else:
+                # the volume has changed in the meantime
+                self._to_discard.append((volume, [snapshot]))
+
+
+class UsageCache:
+    ''' Disk usage of volumes, as measured by their pool
+
+    Measuring the usage of a volume may be cheap, but not if done for all
+    the volumes of the system on each refresh of a GUI tool. So a value is
+    measured only when it is asked for the first time, and then again when
+    the pool :py:meth:`update`\\ s it after changing the volume (creating,
+    committing, importing data etc.). Values older than :py:attr:`max_age`
+    are still returned right away, but get all rescanned in the background,
+    at most every :py:attr:`min_interval` seconds.
+
+    :param measure: function returning the current usage of a volume: \
+        ``measure(volume)``; it is called from executor threads too
+    :param pool: pool of the volumes, rescans run in its \
+        :py:attr:`Pool.executor`
+    '''
+
+    #: how old (in seconds) a value can get, before it is rescanned
+    max_age = 30
+
+    #: minimal time (in seconds) between the starts of two rescans
+    min_interval = 10
+
+    def __init__(self, measure, pool=None, log=None):
+        self._measure = measure
+        self.pool = pool
+        self.log = log or logging.getLogger('qubes.storage')
+        #: cached values: (usage, timestamp) by volume
+        self.usage = {}
+        self._last_rescan = None
+        self._rescan_handle = None
+        self._rescan_task = None
+
+    def get(self, volume):
+        ''' Return the (cached) usage of *volume* '''
+        try:
+            usage, timestamp = self.usage[volume]
+        except KeyError:
+            return self.update(volume)
+        if time.time() - timestamp > self.max_age:
+            if not asyncio.get_event_loop().is_running():
+                # no worker will do it, and nobody is waiting on us
+                return self.update(volume)
+            self._schedule_rescan()
+        return usage
+
+    def timestamp(self, volume):
+        ''' Return when the usage of *volume* was measured, as seconds
+        since the epoch, or :py:obj:`None` if it is not cached '''
+        try:
+            return self.usage[volume][1]
+        except KeyError:
+            return None
+
+    def update(self, volume):
+        ''' Measure the usage of *volume* now, because it has changed '''
+        usage = self._measure(volume)
+        self.usage[volume] = (usage, time.time())
+        return usage
+
+    def forget(self, volume):
+        ''' Drop the cached usage of *volume*, for example because it was
+        removed '''
+        self.usage.pop(volume, None)
+
+    def close(self):
+        ''' Cancel the rescan in progress or scheduled '''
+        if self._rescan_handle is not None:
+            self._rescan_handle.cancel()
+            self._rescan_handle = None
+        if self._rescan_task is not None:
+            self._rescan_task.cancel()
+            self._rescan_task = None
+
+    def _schedule_rescan(self):
+        if self._rescan_handle is not None or (
+                self._rescan_task is not None and
+                not self._rescan_task.done()):
+            return
+        delay = 0
+        if self._last_rescan is not None:
+            delay = max(0,
+                self._last_rescan + self.min_interval - time.monotonic())
+        self._rescan_handle = asyncio.get_event_loop().call_later(
+            delay, self._start_rescan)
+
+    def _start_rescan(self):
+        self._rescan_handle = None
+        self._last_rescan = time.monotonic()
+        self._rescan_task = asyncio.ensure_future(self._rescan())
+
+    @asyncio.coroutine
+    def _rescan(self):
+        volumes = list(self.usage)
+        try:
+            results = yield from asyncio.get_event_loop().run_in_executor(
+                self.pool.executor if self.pool is not None else None,
+                self._measure_all, volumes)
+        except Exception:  # pylint: disable=broad-except
+            self.log.exception('Failed to rescan disk usage of volumes')
+            return
+        for volume, usage, timestamp in results:
+            # skip volumes forgotten or updated in the meantime
+            if volume in self.usage and self.usage[volume][1] < timestamp:
+                self.usage[volume] = (usage, timestamp)
+
+    def _measure_all(self, volumes):
+        results = []
+        for volume in volumes:
+            timestamp = time.time()
+            try:
+                results.append((volume, self._measure(volume), timestamp))
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception('Failed to measure disk usage of %s',
+                    volume.vid)
+        return results
+
+
+class RevisionJanitor:
+    ''' Background removal of old revisions of the volumes of a pool
+
+    Removing revisions above ``revisions_to_keep`` when a volume is
+    committed makes the VM shutdown - and so a restart - wait for it, while
+    nobody needs it done right away. Instead, the driver :py:meth:`add`\\ s
+    them to a queue, removed by a background task: at most
+    :py:attr:`batch_size` revisions at a time, every :py:attr:`interval`
+    seconds. Volume starts are wrapped in :py:meth:`busy` - nothing gets
+    removed until the pool did not start volumes (nor queue revisions) for
+    :py:attr:`delay` seconds.
+
+    The queue is saved to *path* on each change, so revisions queued when
+    qubesd got stopped are removed after it starts again. Queued revisions
+    are not to be listed by the volumes anymore (see
+    :py:meth:`__contains__`), nor removed by them, unless they
+    :py:meth:`take` them from the queue first.
+
+    Revisions are identified by strings (LVM volume names, file paths...).
+    :py:meth:`add` and :py:meth:`take` can be called from executor threads
+    too.
+
+    :param path: file storing the queue
+    :param remove: coroutine function removing revisions: \
+        ``remove(revisions)``
+    '''
+
+    #: how long (in seconds) the pool needs to be idle, before revisions
+    #: get removed
+    delay = 5
+
+    #: minimal time (in seconds) between two removals
+    interval = 1
+
+    #: maximal number of revisions removed at a time
+    batch_size = 4
+
+    def __init__(self, path, remove, log=None):
+        self.path = path
+        self._remove = remove
+        self.log = log or logging.getLogger('qubes.storage')
+        self._loop = asyncio.get_event_loop()
+        self._lock = threading.Lock()
+        #: revisions to remove, oldest first
+        self.queue = []
+        self._queued = set()
+        self._removing = []
+        self._busy = 0
+        self._idle = None
+        self._not_before = 0
+        self._task = None
+        self._closed = False
+        try:
+            with open(self.path) as queue_file:
+                self.add(json.load(queue_file))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError):
+            self.log.exception('Failed to load queue of revisions to '
+                'remove from %s', self.path)
+
+    def __contains__(self, revision):
+        return revision in self._queued
+
+    def add(self, revisions):
+        ''' Queue *revisions* for removal '''
+        revisions = [str(revision) for revision in revisions
+            if revision not in self._queued]
+        if not revisions:
+            return
+        with self._lock:
+            self.queue.extend(revisions)
+            self._queued.update(revisions)
+            self._save()
+        self._postpone(self.delay)
+        self._loop.call_soon_threadsafe(self._start)
+
+    def take(self, predicate):
+        ''' Remove the queued revisions matching *predicate* from the
+        queue, for example because their volume is being removed
+
+        :return: list of the revisions, to be removed by the caller
+        '''
+        with self._lock:
+            taken = [revision for revision in self.queue
+                if predicate(revision)]
+            if taken:
+                self.queue = [revision for revision in self.queue
+                    if revision not in taken]
+                self._queued.difference_update(taken)
+                self._save()
+        return taken
+
+    @contextlib.contextmanager
+    def busy(self):
+        ''' Context manager postponing removals, for example while
+        a volume is being started '''
+        self._busy += 1
+        try:
+            yield
+        finally:
+            self._busy -= 1
+            self._postpone(self.delay)
+            if not self._busy and self._idle is not None:
+                if not self._idle.done():
+                    self._idle.set_result(None)
+                self._idle = None
+
+    def close(self):
+        ''' Cancel the removal in progress; the queue stays saved '''
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _postpone(self, seconds):
+        self._not_before = max(self._not_before,
+            time.monotonic() + seconds)
+
+    def _save(self):
+        # called with self._lock held
+        revisions = self._removing + self.queue
+        try:
+            if not revisions:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(self.path)
+                return
+            tmp_path = self.path + '~'
+            with open(tmp_path, 'w') as queue_file:
+                json.dump(revisions, queue_file)
+                queue_file.flush()
+                os.fsync(queue_file.fileno())
+            os.rename(tmp_path, self.path)
+        except OSError:
+            self.log.exception('Failed to save queue of revisions to '
+                'remove to %s', self.path)
+
+    def _start(self):
+        if self._closed or not self.queue:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run(), loop=self._loop)
+
+    @asyncio.coroutine
+    def _run(self):
+        while self.queue:
+            if self._busy:
+                self._idle = self._loop.create_future()
+                yield from self._idle
+                continue
+            wait = self._not_before - time.monotonic()
+            if wait > 0:
+                yield from asyncio.sleep(wait)
+                continue
+            with self._lock:
+                self._removing = self.queue[:self.batch_size]
+                del self.queue[:self.batch_size]
+            try:
+                yield from self._remove(self._removing)
+            except asyncio.CancelledError:
+                # qubesd is stopping, keep them queued
+                with self._lock:
+                    self.queue[:0] = self._removing
+                    self._removing = []
+                raise
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception('Failed to remove old revisions %s',
+                    ', '.join(self._removing))
+            with self._lock:
+                self._queued.difference_update(self._removing)
+                self._removing = []
+                self._save()
+            self._postpone(self.interval)
+
+
 @asyncio.coroutine
 def _wait_and_reraise(futures):
     if futures:
@@ -871,7 +1414,7 @@ def _sanitize_config(config):
 def pool_drivers():
     """ Return a list of EntryPoints names """
     return [ep.name
-            for ep in pkg_resources.iter_entry_points(STORAGE_ENTRY_POINT)]
+            for ep in qubes.utils.iter_entry_points(STORAGE_ENTRY_POINT)]
 
 
 def driver_parameters(name):
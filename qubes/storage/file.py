@@ -27,9 +27,11 @@ from __future__ import absolute_import
 import os
 import os.path
 import re
+import stat
 import subprocess
 
 import qubes.storage
+import qubes.storage.filecopy
 
 BLKSIZE = 512
 
@@ -60,6 +62,8 @@ class FilePool(qubes.storage.Pool):
         assert dir_path, "No pool dir_path specified"
         self.dir_path = os.path.normpath(dir_path)
         self._volumes = []
+        self._usage_cache = qubes.storage.UsageCache(
+            FileVolume.measure_usage, pool=self)
 
     @property
     def config(self):
@@ -108,7 +112,7 @@ class FilePool(qubes.storage.Pool):
         self._revisions_to_keep = value
 
     def destroy(self):
-        pass
+        self._usage_cache.close()
 
     def setup(self):
         create_dir_if_not_exists(self.dir_path)
@@ -179,6 +183,7 @@ class FilePool(qubes.storage.Pool):
 class FileVolume(qubes.storage.Volume):
     ''' Parent class for the xen volumes implementation which expects a
         `target_dir` param on initialization.  '''
+    # pylint: disable=protected-access
 
     def __init__(self, dir_path, **kwargs):
         self.dir_path = dir_path
@@ -206,19 +211,20 @@ class FileVolume(qubes.storage.Volume):
             'Volume size must be > 0'
         if not self.snap_on_start:
             create_sparse_file(self.path, self.size)
+        self.pool._usage_cache.update(self)
 
     def remove(self):
         if not self.snap_on_start:
             _remove_if_exists(self.path)
         if self.snap_on_start or self.save_on_stop:
             _remove_if_exists(self.path_cow)
+        self.pool._usage_cache.forget(self)
 
     def is_dirty(self):
         if not self.save_on_stop:
             return False
         if os.path.exists(self.path_cow):
-            stat = os.stat(self.path_cow)
-            return stat.st_blocks > 0
+            return os.stat(self.path_cow).st_blocks > 0
         return False
 
     def resize(self, size):
@@ -252,6 +258,7 @@ class FileVolume(qubes.storage.Volume):
             subprocess.check_call(['losetup', '--set-capacity',
                                    loop_dev])
         self.size = size
+        self.pool._usage_cache.update(self)
 
     def commit(self):
         msg = 'Tried to commit a non commitable volume {!r}'.format(self)
@@ -265,6 +272,7 @@ class FileVolume(qubes.storage.Volume):
                 os.unlink(self.path_cow)
 
         create_sparse_file(self.path_cow, self.size)
+        self.pool._usage_cache.update(self)
         return self
 
     def export(self):
@@ -279,20 +287,28 @@ class FileVolume(qubes.storage.Volume):
                     src_volume, self))
         if self.save_on_stop:
             _remove_if_exists(self.path)
-            copy_file(src_volume.export(), self.path)
+            copy_file(src_volume.export(), self.path,
+                progress=self.copy_progress)
+            self.pool._usage_cache.update(self)
         return self
 
-    def import_data(self):
+    def import_data(self, keep_data=False):
         if not self.save_on_stop:
             raise qubes.storage.StoragePoolException(
                 "Can not import into save_on_stop=False volume {!s}".format(
                     self))
-        create_sparse_file(self.path_import, self.size)
+        if keep_data and os.path.exists(self.path):
+            copy_file(self.path, self.path_import,
+                progress=self.copy_progress)
+            os.truncate(self.path_import, self.size)
+        else:
+            create_sparse_file(self.path_import, self.size)
         return self.path_import
 
     def import_data_end(self, success):
         if success:
             os.rename(self.path_import, self.path)
+            self.pool._usage_cache.update(self)
         else:
             os.unlink(self.path_import)
         return self
@@ -396,7 +412,18 @@ class FileVolume(qubes.storage.Volume):
 
     @property
     def usage(self):
-        ''' Returns the actualy used space '''
+        ''' Returns the actualy used space, as last measured by
+        :py:meth:`measure_usage` '''
+        return self.pool._usage_cache.get(self)
+
+    @property
+    def usage_timestamp(self):
+        ''' When :py:attr:`usage` was measured, in seconds since the epoch '''
+        timestamp = self.pool._usage_cache.timestamp(self)
+        return None if timestamp is None else int(timestamp)
+
+    def measure_usage(self):
+        ''' Returns the actualy used space, measured now '''
         usage = 0
         if self.save_on_stop or self.snap_on_start:
             usage = get_disk_usage(self.path_cow)
@@ -449,8 +476,9 @@ def get_disk_usage(path):
         return 0
 
     ret = get_disk_usage_one(st)
+    if not stat.S_ISDIR(st.st_mode):
+        return ret
 
-    # if path is not a directory, this is skipped
     for dirpath, dirnames, filenames in os.walk(path):
         for name in dirnames + filenames:
             ret += get_disk_usage_one(os.lstat(os.path.join(dirpath, name)))
@@ -467,9 +495,12 @@ def create_dir_if_not_exists(path):
         os.mkdir(path)
 
 
-def copy_file(source, destination):
-    '''Effective file copy, preserving sparse files etc.'''
-    # We prefer to use Linux's cp, because it nicely handles sparse files
+def copy_file(source, destination, progress=None):
+    '''Effective file copy, preserving sparse files etc.
+
+    :param progress: called with the progress of the copy, see
+        :py:attr:`qubes.storage.Volume.copy_progress`
+    '''
     assert os.path.exists(source), \
         "Missing the source %s to copy from" % source
     assert not os.path.exists(destination), \
@@ -480,10 +511,9 @@ def copy_file(source, destination):
         os.makedirs(parent_dir)
 
     try:
-        cmd = ['cp', '--sparse=always',
-               '--reflink=auto', source, destination]
-        subprocess.check_call(cmd)
-    except subprocess.CalledProcessError:
+        qubes.storage.filecopy.copy_file(source, destination,
+            progress=progress)
+    except OSError:
         raise IOError('Error while copying {!r} to {!r}'.format(source,
                                                                 destination))
 
@@ -0,0 +1,271 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+''' In-process copying of (sparse) disk images, shared by the file based
+storage drivers.
+
+The whole file is reflinked with FICLONE if the filesystem supports it.
+Otherwise the data extents of the source are found with
+:py:data:`os.SEEK_DATA`/:py:data:`os.SEEK_HOLE` (so holes stay holes), split
+into chunks and copied by a few threads in parallel - each chunk with
+FICLONERANGE, :py:func:`os.copy_file_range` or plain reads and writes,
+whichever works first.
+'''
+
+import asyncio
+import concurrent.futures
+import errno
+import fcntl
+import os
+import struct
+import threading
+
+import qubes.storage
+
+FICLONE = 1074041865        # defined in <linux/fs.h>
+FICLONERANGE = 1075876877   # defined in <linux/fs.h>
+
+#: size of the chunks of data extents copied in parallel
+CHUNK_SIZE = 64 * 1024**2
+
+#: size of a single read/write when copy_file_range() is not available
+BUFFER_SIZE = 1024**2
+
+#: number of threads copying a single file
+THREADS = min(4, os.cpu_count() or 1)
+
+# errors meaning that a copy method is not supported for this pair of
+# files, not that the copy failed
+_UNSUPPORTED_ERRNOS = (errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+    errno.EOPNOTSUPP, errno.EXDEV)
+
+
+class CopyCancelled(qubes.storage.StoragePoolException):
+    ''' Raised by :py:meth:`FileCopy.run` when the copy got cancelled '''
+
+
+class FileCopy:
+    ''' Copy of a file, preserving holes.
+
+    A single instance can be used for one copy at a time. :py:meth:`cancel`
+    can be called from any thread; the copy is then aborted with
+    :py:class:`CopyCancelled` as soon as the chunks in progress are done.
+
+    :param progress: called as ``progress(copied, total)`` (in bytes of
+        data, holes excluded) from the copying threads, as data gets copied
+    :param threads: number of threads copying chunks in parallel
+    '''
+
+    def __init__(self, progress=None, threads=None):
+        self.progress = progress
+        self.threads = threads or THREADS
+        self.copied = 0
+        self.total = 0
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._clone_range = True
+        self._copy_file_range = hasattr(os, 'copy_file_range')
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        ''' Abort the copy in progress, and any started later '''
+        self._cancelled.set()
+
+    def run(self, src, dst):
+        ''' Copy the file at path *src* into the (existing or new) file
+        at path *dst*, truncating it first.
+
+        :returns: whether all the data was reflinked instead of copied
+        '''
+        self.copied = 0
+        self.total = 0
+        self._check_cancelled()
+        with open(src, 'rb') as src_io, open(dst, 'wb') as dst_io:
+            size = os.fstat(src_io.fileno()).st_size
+            if attempt_ficlone(src_io.fileno(), dst_io.fileno()):
+                self.total = size
+                self._report(size)
+                return True
+            chunks = list(_chunks(data_extents(src_io.fileno(), size)))
+            self.total = sum(length for _, length in chunks)
+            dst_io.truncate(size)
+            self._clone_range = True
+            self._copy_chunks(src_io.fileno(), dst_io.fileno(), chunks)
+            return self._clone_range and bool(chunks)
+
+    def _copy_chunks(self, src_fd, dst_fd, chunks):
+        if len(chunks) <= 1 or self.threads == 1:
+            for offset, length in chunks:
+                self._copy_chunk(src_fd, dst_fd, offset, length)
+            return
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.threads) as executor:
+            futures = [executor.submit(self._copy_chunk,
+                    src_fd, dst_fd, offset, length)
+                for offset, length in chunks]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+            except:
+                # let the other threads stop early
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def _copy_chunk(self, src_fd, dst_fd, offset, length):
+        self._check_cancelled()
+        if self._clone_range:
+            if _attempt_ficlonerange(src_fd, dst_fd, offset, length):
+                self._report(length)
+                return
+            self._clone_range = False
+        end = offset + length
+        if self._copy_file_range:
+            offset = self._copy_range(src_fd, dst_fd, offset, end)
+        self._copy_buffered(src_fd, dst_fd, offset, end)
+
+    def _copy_range(self, src_fd, dst_fd, offset, end):
+        ''' Copy with copy_file_range(); return the offset up to which
+        it got done, which is before *end* only if it is not supported.
+        '''
+        while offset < end and self._copy_file_range:
+            try:
+                # added in Python 3.8
+                copied = getattr(os, 'copy_file_range')(src_fd, dst_fd,
+                    end - offset, offset, offset)
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+                self._copy_file_range = False
+                break
+            if not copied:
+                # source got truncated
+                return end
+            offset += copied
+            self._report(copied)
+            self._check_cancelled()
+        return offset
+
+    def _copy_buffered(self, src_fd, dst_fd, offset, end):
+        while offset < end:
+            data = os.pread(src_fd, min(BUFFER_SIZE, end - offset), offset)
+            if not data:
+                break
+            # keep zeroed blocks sparse, like cp --sparse=always
+            if data.count(0) != len(data):
+                written = 0
+                while written < len(data):
+                    written += os.pwrite(dst_fd, data[written:],
+                        offset + written)
+            offset += len(data)
+            self._report(len(data))
+            self._check_cancelled()
+
+    def _report(self, length):
+        with self._lock:
+            self.copied += length
+            copied = self.copied
+        if self.progress is not None:
+            self.progress(copied, self.total)
+
+    def _check_cancelled(self):
+        if self._cancelled.is_set():
+            raise CopyCancelled('Copy cancelled')
+
+
+def attempt_ficlone(src_fd, dst_fd):
+    ''' Reflink the whole file *src_fd* into *dst_fd*; return whether
+    the filesystem supported it.
+    '''
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError:
+        return False
+
+
+def _attempt_ficlonerange(src_fd, dst_fd, offset, length):
+    # struct file_clone_range from <linux/fs.h>
+    arg = struct.pack('qQQQ', src_fd, offset, length, offset)
+    try:
+        fcntl.ioctl(dst_fd, FICLONERANGE, arg)
+        return True
+    except OSError:
+        return False
+
+
+def data_extents(fd, size):
+    ''' Yield (offset, length) of the data extents of a file '''
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # only a hole left
+                return
+            if e.errno != errno.EINVAL:
+                raise
+            # SEEK_DATA not supported, take everything as data
+            yield offset, size - offset
+            return
+        if start >= size:
+            return
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end - start
+        offset = end
+
+
+def _chunks(extents, chunk_size=None):
+    chunk_size = chunk_size or CHUNK_SIZE
+    for offset, length in extents:
+        while length > chunk_size:
+            yield offset, chunk_size
+            offset += chunk_size
+            length -= chunk_size
+        if length:
+            yield offset, length
+
+
+def copy_file(src, dst, progress=None):
+    ''' Copy *src* to *dst* with a new :py:class:`FileCopy`.
+
+    :returns: whether all the data was reflinked instead of copied
+    '''
+    return FileCopy(progress=progress).run(src, dst)
+
+
+@asyncio.coroutine
+def run_in_executor(copier, executor, func, *args):
+    ''' Run ``func(*args)``, which copies files with *copier*, in
+    *executor* (:py:obj:`None` for the default one). If the coroutine gets
+    cancelled, the copy is cancelled too, and waited for - so the files are
+    not touched anymore when it returns.
+    '''
+    future = asyncio.get_event_loop().run_in_executor(executor, func, *args)
+    try:
+        return (yield from asyncio.shield(future))
+    except asyncio.CancelledError:
+        copier.cancel()
+        try:
+            yield from future
+        except CopyCancelled:
+            pass
+        raise
@@ -18,19 +18,31 @@
 #
 
 ''' Driver for storing vm images in a LVM thin pool '''
+import codecs
 import functools
+import json
 import logging
 import os
+import pty
 import subprocess
+import termios
 
 import time
 
 import asyncio
+import collections
+import collections.abc
 
 import qubes
+import qubes.config
 import qubes.storage
 import qubes.utils
 
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
 
 def check_lvm_version():
     #Check if lvm is very very old, like in Travis-CI
@@ -74,13 +86,21 @@ class ThinPool(qubes.storage.Pool):
 
     Volume's revision_id format is "{timestamp}-back", where timestamp is in
     '%s' format (seconds since unix epoch)
+
+    If *prepared_snapshots* is set, that many snapshots of each volume
+    used as a source of "-snap" volumes are kept ready, with
+    "-{random_id}-prep" suffix, see :py:class:`qubes.storage.SnapshotReserve`.
+
+    Revisions above *revisions_to_keep* are removed in the background, see
+    :py:class:`qubes.storage.RevisionJanitor`.
     '''  # pylint: disable=protected-access
 
     size_cache = None
 
     driver = 'lvm_thin'
 
-    def __init__(self, volume_group, thin_pool, revisions_to_keep=1, **kwargs):
+    def __init__(self, volume_group, thin_pool, revisions_to_keep=1,
+            prepared_snapshots=0, **kwargs):
         super(ThinPool, self).__init__(revisions_to_keep=revisions_to_keep,
                                        **kwargs)
         self.volume_group = volume_group
@@ -89,6 +109,14 @@ class ThinPool(qubes.storage.Pool):
         self.log = logging.getLogger('qubes.storage.lvm.%s' % self._pool_id)
 
         self._volume_objects_cache = {}
+        self._snapshot_reserve = qubes.storage.SnapshotReserve(
+            int(prepared_snapshots), self._prepare_snapshot,
+            self._discard_snapshots, log=self.log)
+        self._revision_janitor = qubes.storage.RevisionJanitor(
+            os.path.join(qubes.config.qubes_base_dir,
+                'lvm-{}-{}.revisions-to-remove'.format(volume_group,
+                    thin_pool)),
+            self._remove_revisions, log=self.log)
 
     def __repr__(self):
         return '<{} at {:#x} name={!r} volume_group={!r} thin_pool={!r}>'.\
@@ -104,10 +132,22 @@ class ThinPool(qubes.storage.Pool):
             'thin_pool': self.thin_pool,
             'driver': ThinPool.driver,
             'revisions_to_keep': self.revisions_to_keep,
+            'prepared_snapshots': self.prepared_snapshots,
         }
 
+    @property
+    def prepared_snapshots(self):
+        '''How many snapshots of each hot volume to keep ready'''
+        return self._snapshot_reserve.size
+
+    @prepared_snapshots.setter
+    def prepared_snapshots(self, value):
+        self._snapshot_reserve.set_size(int(value))
+
     def destroy(self):
-        pass  # TODO Should we remove an existing pool?
+        self._snapshot_reserve.close()
+        self._revision_janitor.close()
+        # TODO Should we remove an existing pool?
 
     def init_volume(self, vm, volume_config):
         ''' Initialize a :py:class:`qubes.storage.Volume` from `volume_config`.
@@ -161,12 +201,13 @@ class ThinPool(qubes.storage.Pool):
     def list_volumes(self):
         ''' Return a list of volumes managed by this pool '''
         volumes = []
-        for vid, vol_info in size_cache.items():
-            if not vid.startswith(self.volume_group + '/'):
-                continue
+        for name, vol_info in size_cache.volume_group(
+                self.volume_group).items():
+            vid = self.volume_group + '/' + name
             if vol_info['pool_lv'] != self.thin_pool:
                 continue
-            if vid.endswith('-snap') or vid.endswith('-import'):
+            if vid.endswith('-snap') or vid.endswith('-import') or \
+                    vid.endswith('-prep'):
                 # implementation detail volume
                 continue
             if vid.endswith('-back'):
@@ -178,6 +219,40 @@ class ThinPool(qubes.storage.Pool):
             volumes.append(volume)
         return volumes
 
+    @asyncio.coroutine
+    def _prepare_snapshot(self, volume):
+        '''Create a snapshot of *volume* for :py:attr:`_snapshot_reserve`'''
+        snapshot = '{}-{}-prep'.format(volume.vid,
+            qubes.utils.random_string())
+        with (yield from volume._lock):
+            cmd = ['clone', volume._vid_current, snapshot]
+            yield from qubes_lvm_coro(cmd, self.log)
+        yield from refresh_cache_coro()
+        return snapshot
+
+    @asyncio.coroutine
+    def _discard_snapshots(self, volume, snapshots):
+        '''Remove snapshots of *volume* prepared by
+        :py:meth:`_prepare_snapshot`'''
+        if snapshots is None:
+            volume_group, prefix = volume.vid.split('/', 1)
+            prefix += '-'
+            snapshots = [volume_group + '/' + name
+                for name in size_cache.volume_group(volume_group)
+                if name.startswith(prefix) and name.endswith('-prep') and
+                    name[len(prefix):].count('-') == 1]
+        if snapshots:
+            yield from qubes_lvm_coro(['remove'] + snapshots, self.log)
+
+    @asyncio.coroutine
+    def _remove_revisions(self, vids):
+        '''Remove old revisions for :py:attr:`_revision_janitor`'''
+        # removed in the meantime, along with their volume
+        vids = [vid for vid in vids if vid in size_cache]
+        if vids:
+            yield from qubes_lvm_coro(['remove'] + vids, self.log)
+            yield from refresh_cache_coro()
+
     @property
     def size(self):
         try:
@@ -188,7 +263,7 @@ class ThinPool(qubes.storage.Pool):
 
     @property
     def usage(self):
-        refresh_cache()
+        refresh_cache([self._pool_id])
         try:
             return qubes.storage.lvm.size_cache[
                 self.volume_group + '/' + self.thin_pool]['usage']
@@ -197,28 +272,52 @@ class ThinPool(qubes.storage.Pool):
 
 
 _init_cache_cmd = ['lvs', '--noheadings', '-o',
-   'vg_name,pool_lv,name,lv_size,data_percent,lv_attr,origin',
+   'vg_name,pool_lv,name,lv_size,data_percent,lv_attr,origin,lv_uuid',
    '--units', 'b', '--separator', ';']
 
+#: :program:`lvs` messages about volumes given by name, which are missing
+_lvs_missing_messages = ('Failed to find logical volume',
+    'Volume group', 'Cannot process volume group')
+
 def _parse_lvm_cache(lvm_output):
     result = {}
 
     for line in lvm_output.splitlines():
         line = line.decode().strip()
         pool_name, pool_lv, name, size, usage_percent, attr, \
-            origin = line.split(';', 6)
+            origin, uuid = line.split(';', 7)
         if '' in [pool_name, name, size, usage_percent]:
             continue
         name = pool_name + "/" + name
         size = int(size[:-1])  # Remove 'B' suffix
         usage = int(size / 100 * float(usage_percent))
         result[name] = {'size': size, 'usage': usage, 'pool_lv': pool_lv,
-            'attr': attr, 'origin': origin}
+            'attr': attr, 'origin': origin, 'uuid': uuid}
 
     return result
 
-def init_cache(log=logging.getLogger('qubes.storage.lvm')):
-    cmd = _init_cache_cmd
+def _process_lvs_output(returncode, stderr, log):
+    '''Check the exit status of :program:`lvs`
+
+    When asked for particular volumes, :program:`lvs` fails if some of them
+    do not exist - which is expected for volumes that were just removed, so
+    it is not considered an error.
+    '''
+    err = [line for line in stderr.decode().splitlines()
+        if line.strip() and not any(msg in line
+            for msg in _lvs_missing_messages)]
+    if returncode != 0 and (err or not stderr.strip()):
+        raise qubes.storage.StoragePoolException(stderr)
+    if err:
+        log.warning('\n'.join(err))
+
+def init_cache(log=logging.getLogger('qubes.storage.lvm'), vids=None):
+    '''Get information about LVM volumes
+
+    :param vids: list of volumes (``vg/lv``) to get information about, \
+        :py:obj:`None` for all
+    '''
+    cmd = _init_cache_cmd + list(vids or [])
     if os.getuid() != 0:
         cmd = ['sudo'] + cmd
     environ = os.environ.copy()
@@ -226,17 +325,46 @@ def init_cache(log=logging.getLogger('qubes.storage.lvm')):
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
         close_fds=True, env=environ)
     out, err = p.communicate()
-    return_code = p.returncode
-    if return_code == 0 and err:
-        log.warning(err)
-    elif return_code != 0:
-        raise qubes.storage.StoragePoolException(err)
+    _process_lvs_output(p.returncode, err, log)
 
     return _parse_lvm_cache(out)
 
+def _parse_lvm_report(lvs):
+    '''Like :py:func:`_parse_lvm_cache`, but for a JSON report of
+    :py:data:`_init_cache_cmd` made by :py:class:`LvmShell`'''
+    result = {}
+
+    for volume in lvs:
+        if '' in [volume['vg_name'], volume['lv_name'], volume['lv_size'],
+                volume['data_percent']]:
+            continue
+        name = volume['vg_name'] + '/' + volume['lv_name']
+        size = int(volume['lv_size'])
+        usage = int(size / 100 * float(volume['data_percent']))
+        result[name] = {'size': size, 'usage': usage,
+            'pool_lv': volume['pool_lv'], 'attr': volume['lv_attr'],
+            'origin': volume['origin'], 'uuid': volume['lv_uuid']}
+
+    return result
+
 @asyncio.coroutine
-def init_cache_coro(log=logging.getLogger('qubes.storage.lvm')):
-    cmd = _init_cache_cmd
+def init_cache_coro(log=logging.getLogger('qubes.storage.lvm'), vids=None):
+    '''Coroutine version of :py:func:`init_cache`'''
+    shell = _get_lvm_shell()
+    if shell is not None:
+        try:
+            report = yield from shell.run(
+                _init_cache_cmd[:1] + ['--nosuffix'] + _init_cache_cmd[1:] +
+                list(vids or []))
+        except LvmShellError:
+            pass
+        else:
+            returncode, _, err = _lvm_report_status(report)
+            _process_lvs_output(returncode, err, log)
+            lvs = report['report'][0]['lv'] if report.get('report') else []
+            return _parse_lvm_report(lvs)
+
+    cmd = _init_cache_cmd + list(vids or [])
     if os.getuid() != 0:
         cmd = ['sudo'] + cmd
     environ = os.environ.copy()
@@ -246,16 +374,170 @@ def init_cache_coro(log=logging.getLogger('qubes.storage.lvm')):
         stderr=subprocess.PIPE,
         close_fds=True, env=environ)
     out, err = yield from p.communicate()
-    return_code = p.returncode
-    if return_code == 0 and err:
-        log.warning(err)
-    elif return_code != 0:
-        raise qubes.storage.StoragePoolException(err)
+    _process_lvs_output(p.returncode, err, log)
 
     return _parse_lvm_cache(out)
 
-size_cache_time = 0
-size_cache = init_cache()
+
+class LvmCache(collections.abc.Mapping):
+    '''Information about LVM volumes, as reported by :program:`lvs`
+
+    Volumes are stored per volume group, but looked up by their full
+    ``vg/lv`` name. Each of them is a dict with ``size``, ``usage``,
+    ``pool_lv``, ``attr`` and ``origin`` keys.
+
+    Instead of rescanning all the volumes after each change, volumes
+    touched by an LVM command are marked as changed (see
+    :py:meth:`invalidate`) and only those are refreshed, with
+    :program:`lvs` called for them by name. Refresh requests arriving while
+    a refresh is running are merged into the next one, so concurrent
+    callers share a single :program:`lvs` call - each refresh is one
+    *generation* of the cache.
+
+    :param dict volumes: initial content, as returned by :py:func:`init_cache`
+    '''
+
+    #: how old (in seconds) can information about a volume get before
+    #: :py:func:`refresh_cache` refreshes it - usage changes without notice
+    max_age = 30
+    #: how many volumes to pass to a single :program:`lvs` call
+    batch_size = 100
+
+    def __init__(self, volumes=None,
+            log=logging.getLogger('qubes.storage.lvm')):
+        self.log = log
+        #: volumes, by volume group and then by LV name
+        self.volume_groups = {}
+        #: :py:func:`time.monotonic` of the last full scan
+        self.scan_time = 0
+        #: :py:func:`time.monotonic` of the last refresh of each volume,
+        #: if refreshed since the last full scan
+        self.updated = {}
+        #: number of finished refreshes
+        self.generation = 0
+        self._changed = set()
+        self._full_scan = False
+        self._next_refresh = None
+        self._worker = None
+        if volumes is not None:
+            self.replace(volumes)
+
+    def __getitem__(self, vid):
+        volume_group, _, name = vid.partition('/')
+        return self.volume_groups[volume_group][name]
+
+    def __iter__(self):
+        for volume_group, volumes in self.volume_groups.items():
+            for name in volumes:
+                yield volume_group + '/' + name
+
+    def __len__(self):
+        return sum(len(volumes) for volumes in self.volume_groups.values())
+
+    def volume_group(self, volume_group):
+        '''Volumes of a volume group, as a dict keyed by LV name'''
+        return self.volume_groups.get(volume_group, {})
+
+    def replace(self, volumes):
+        '''Replace the whole content with results of a full scan'''
+        self.volume_groups = {}
+        self.updated = {}
+        self.scan_time = time.monotonic()
+        self.update(volumes, volumes)
+
+    def update(self, vids, volumes):
+        '''Store refreshed information about *vids*
+
+        :param vids: the volumes that were asked for
+        :param dict volumes: the volumes that were found, as returned by \
+            :py:func:`init_cache`
+        '''
+        now = time.monotonic()
+        for vid in vids:
+            volume_group, _, name = vid.partition('/')
+            if vid in volumes:
+                self.volume_groups.setdefault(volume_group, {})[name] = \
+                    volumes[vid]
+            elif volume_group in self.volume_groups:
+                self.volume_groups[volume_group].pop(name, None)
+            self.updated[vid] = now
+
+    def invalidate(self, vids):
+        '''Mark volumes as changed, to be refreshed by the next refresh'''
+        self._changed.update(vids)
+
+    def is_stale(self, vid):
+        '''Check if information about a volume should be refreshed'''
+        return vid in self._changed or \
+            self.updated.get(vid, self.scan_time) + self.max_age < \
+            time.monotonic()
+
+    def refresh(self, vids=None):
+        '''Refresh *vids* (all volumes if :py:obj:`None`) synchronously'''
+        if vids is None:
+            self.replace(init_cache(self.log))
+            self._changed.clear()
+        else:
+            vids = sorted(set(vids))
+            self._changed.difference_update(vids)
+            for i in range(0, len(vids), self.batch_size):
+                batch = vids[i:i+self.batch_size]
+                self.update(batch, init_cache(self.log, vids=batch))
+        self.generation += 1
+
+    def request_refresh(self, vids=None):
+        '''Schedule refresh of *vids* (all volumes if :py:obj:`None`), in
+        addition to volumes marked as changed
+
+        :return: future of the refresh (:py:class:`asyncio.Future`), its \
+            result is the generation number
+        '''
+        if vids is None:
+            self._full_scan = True
+        else:
+            self.invalidate(vids)
+        if self._next_refresh is None:
+            self._next_refresh = asyncio.get_event_loop().create_future()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._work())
+        return self._next_refresh
+
+    @asyncio.coroutine
+    def refresh_coro(self, vids=None):
+        '''Refresh *vids* (all volumes if :py:obj:`None`) and volumes marked
+        as changed
+
+        The refresh running currently (if any) might have started before
+        the caller's changes, so the caller waits for the next one.
+        '''
+        return (yield from asyncio.shield(self.request_refresh(vids)))
+
+    @asyncio.coroutine
+    def _work(self):
+        while self._next_refresh is not None:
+            future, self._next_refresh = self._next_refresh, None
+            full_scan, self._full_scan = self._full_scan, False
+            vids, self._changed = sorted(self._changed), set()
+            try:
+                if full_scan:
+                    self.replace((yield from init_cache_coro(self.log)))
+                else:
+                    for i in range(0, len(vids), self.batch_size):
+                        batch = vids[i:i+self.batch_size]
+                        self.update(batch,
+                            (yield from init_cache_coro(self.log,
+                                vids=batch)))
+            except Exception as e:  # pylint: disable=broad-except
+                # try again next time
+                self._full_scan = self._full_scan or full_scan
+                self._changed.update(vids)
+                future.set_exception(e)
+            else:
+                self.generation += 1
+                future.set_result(self.generation)
+
+
+size_cache = LvmCache(init_cache())
 
 
 def _revision_sort_key(revision):
@@ -321,13 +603,19 @@ class ThinVolume(qubes.storage.Volume):
 
     @property
     def revisions(self):
-        name_prefix = self.vid + '-'
+        # pylint: disable=protected-access
+        volume_group, name_prefix = self.vid.split('/', 1)
+        name_prefix += '-'
         revisions = {}
-        for revision_vid in size_cache:
+        for revision_vid in size_cache.volume_group(volume_group):
             if not revision_vid.startswith(name_prefix):
                 continue
             if not revision_vid.endswith('-back'):
                 continue
+            if volume_group + '/' + revision_vid in \
+                    self.pool._revision_janitor:
+                # about to be removed
+                continue
             revision_vid = revision_vid[len(name_prefix):]
             if revision_vid.count('-') > 1:
                 # VM+volume name is a prefix of another VM, see #4680
@@ -387,11 +675,34 @@ class ThinVolume(qubes.storage.Volume):
         for rev_id in revisions:
             # safety check
             assert rev_id != self._vid_current
-            try:
-                cmd = ['remove', self.vid + '-' + rev_id]
-                yield from qubes_lvm_coro(cmd, self.log)
-            except qubes.storage.StoragePoolException:
-                pass
+        if not revisions:
+            return
+        try:
+            cmd = ['remove'] + [self.vid + '-' + rev_id
+                for rev_id in revisions]
+            yield from qubes_lvm_coro(cmd, self.log)
+        except qubes.storage.StoragePoolException:
+            pass
+
+    def _prune_revisions(self):
+        '''Queue revisions above :py:attr:`revisions_to_keep` for removal
+        by the pool, see :py:class:`qubes.storage.RevisionJanitor`'''
+        revisions = sorted(self.revisions.items(), key=_revision_sort_key)
+        # pylint: disable=invalid-unary-operand-type
+        revisions = revisions[:(-self.revisions_to_keep) or None]
+        for rev_id, _ in revisions:
+            # safety check
+            assert self.vid + '-' + rev_id != self._vid_current
+        # pylint: disable=protected-access
+        self.pool._revision_janitor.add(
+            [self.vid + '-' + rev_id for rev_id, _ in revisions])
+
+    def _is_revision(self, vid):
+        '''Whether *vid* is a revision of this volume'''
+        name = vid[len(self.vid) + 1:]
+        # VM+volume name may be a prefix of another VM, see #4680
+        return vid.startswith(self.vid + '-') and name.endswith('-back') \
+            and name.count('-') == 1
 
     @asyncio.coroutine
     def _commit(self, vid_to_commit=None, keep=False):
@@ -425,19 +736,22 @@ class ThinVolume(qubes.storage.Volume):
             cmd = ['rename', self.vid,
                    '{}-{}-back'.format(self.vid, int(time.time()))]
             yield from qubes_lvm_coro(cmd, self.log)
-            yield from reset_cache_coro()
+            yield from refresh_cache_coro()
 
         cmd = ['clone' if keep else 'rename',
                vid_to_commit,
                self.vid]
         yield from qubes_lvm_coro(cmd, self.log)
-        yield from reset_cache_coro()
+        yield from refresh_cache_coro()
         # make sure the one we've committed right now is properly
         # detected as the current one - before removing anything
         assert self._vid_current == self.vid
 
-        # and remove old snapshots, if needed
-        yield from self._remove_revisions()
+        # snapshots prepared by the pool are outdated now
+        # pylint: disable=protected-access
+        self.pool._snapshot_reserve.invalidate(self)
+        # and remove old snapshots, if needed - in the background
+        self._prune_revisions()
 
     @locked
     @asyncio.coroutine
@@ -455,33 +769,41 @@ class ThinVolume(qubes.storage.Volume):
                     str(self.size)
                 ]
             yield from qubes_lvm_coro(cmd, self.log)
-            yield from reset_cache_coro()
+            yield from refresh_cache_coro()
         return self
 
     @locked
     @asyncio.coroutine
     def remove(self):
         assert self.vid
+        vids = []
         try:
             if os.path.exists('/dev/' + self._vid_snap):
-                cmd = ['remove', self._vid_snap]
-                yield from qubes_lvm_coro(cmd, self.log)
+                vids.append(self._vid_snap)
         except AttributeError:
             pass
 
         try:
             if os.path.exists('/dev/' + self._vid_import):
-                cmd = ['remove', self._vid_import]
-                yield from qubes_lvm_coro(cmd, self.log)
+                vids.append(self._vid_import)
         except AttributeError:
             pass
 
-        yield from self._remove_revisions(self.revisions.keys())
-        if not os.path.exists(self.path):
+        current_exists = os.path.exists('/dev/' + self.vid)
+        if current_exists:
+            vids.append(self.vid)
+        # pylint: disable=protected-access
+        vids.extend(self.pool._snapshot_reserve.forget(self))
+        # revisions queued for removal get listed again
+        self.pool._revision_janitor.take(self._is_revision)
+        # removed with a single lvremove call, see _remove_batched()
+        coros = [self._remove_revisions(list(self.revisions))]
+        if vids:
+            coros.append(qubes_lvm_coro(['remove'] + vids, self.log))
+        yield from asyncio.gather(*coros)
+        if not current_exists:
             return
-        cmd = ['remove', self.path]
-        yield from qubes_lvm_coro(cmd, self.log)
-        yield from reset_cache_coro()
+        yield from refresh_cache_coro()
         # pylint: disable=protected-access
         self.pool._volume_objects_cache.pop(self.vid, None)
 
@@ -492,6 +814,16 @@ class ThinVolume(qubes.storage.Volume):
         devpath = self.path
         return devpath
 
+    def data_stamp(self):
+        ''' UUID and size of the exported LV - a commit replaces it with a
+        new LV, :py:meth:`resize` changes the size. The device node can't be
+        used, as it is recreated on each activation. '''
+        try:
+            vol_info = size_cache[self.path[len('/dev/'):]]
+        except KeyError:
+            return None
+        return 'lvm {} {}'.format(vol_info['uuid'], vol_info['size'])
+
     @locked
     @asyncio.coroutine
     def import_volume(self, src_volume):
@@ -536,18 +868,22 @@ class ThinVolume(qubes.storage.Volume):
 
     @locked
     @asyncio.coroutine
-    def import_data(self):
+    def import_data(self, keep_data=False):
         ''' Returns an object that can be `open()`. '''
         if self.is_dirty():
             raise qubes.storage.StoragePoolException(
                 'Cannot import data to dirty volume {}, stop the qube first'.
                 format(self.vid))
         self.abort_if_import_in_progress()
-        # pylint: disable=protected-access
-        cmd = ['create', self.pool._pool_id, self._vid_import.split('/')[1],
-               str(self.size)]
+        if keep_data and os.path.exists('/dev/' + self._vid_current):
+            # thin snapshot, only the blocks written later get allocated
+            cmd = ['clone', self._vid_current, self._vid_import]
+        else:
+            cmd = ['create',
+                   self.pool._pool_id,  # pylint: disable=protected-access
+                   self._vid_import.split('/')[1], str(self.size)]
         yield from qubes_lvm_coro(cmd, self.log)
-        yield from reset_cache_coro()
+        yield from refresh_cache_coro()
         devpath = '/dev/' + self._vid_import
         return devpath
 
@@ -608,7 +944,9 @@ class ThinVolume(qubes.storage.Volume):
             yield from qubes_lvm_coro(cmd, self.log)
         cmd = ['clone', self.vid + '-' + revision, self.vid]
         yield from qubes_lvm_coro(cmd, self.log)
-        yield from reset_cache_coro()
+        yield from refresh_cache_coro()
+        # pylint: disable=protected-access
+        self.pool._snapshot_reserve.invalidate(self)
         return self
 
     @locked
@@ -642,17 +980,42 @@ class ThinVolume(qubes.storage.Volume):
         elif self.save_on_stop or not self.snap_on_start:
             cmd = ['extend', self._vid_current, str(size)]
             yield from qubes_lvm_coro(cmd, self.log)
-        yield from reset_cache_coro()
+            # pylint: disable=protected-access
+            self.pool._snapshot_reserve.invalidate(self)
+        yield from refresh_cache_coro()
+
+    def _claim_prepared_snapshot(self):
+        '''Take a snapshot of :py:attr:`source` prepared by its pool, if
+        there is one'''
+        # pylint: disable=protected-access
+        source = self.source
+        if source is None or not isinstance(source.pool, ThinPool) or \
+                source.pool.volume_group != self.volume_group:
+            return None
+        reserve = source.pool._snapshot_reserve
+        snapshot = reserve.claim(source)
+        if snapshot is None:
+            return None
+        origin = source._vid_current.split('/', 1)[1]
+        if snapshot not in size_cache or \
+                size_cache[snapshot]['origin'] != origin:
+            # not a snapshot of the current source content
+            reserve.reject(source, snapshot)
+            return None
+        return snapshot
 
     @asyncio.coroutine
     def _snapshot(self):
+        prepared = self._claim_prepared_snapshot()
         try:
             cmd = ['remove', self._vid_snap]
             yield from qubes_lvm_coro(cmd, self.log)
         except:  # pylint: disable=bare-except
             pass
 
-        if self.source is None:
+        if prepared is not None:
+            cmd = ['rename', prepared, self._vid_snap]
+        elif self.source is None:
             cmd = ['clone', self._vid_current, self._vid_snap]
         else:
             cmd = ['clone', self.source.path, self._vid_snap]
@@ -662,14 +1025,16 @@ class ThinVolume(qubes.storage.Volume):
     @asyncio.coroutine
     def start(self):
         self.abort_if_import_in_progress()
-        try:
-            if self.snap_on_start or self.save_on_stop:
-                if not self.save_on_stop or not self.is_dirty():
-                    yield from self._snapshot()
-            else:
-                yield from self._reset()
-        finally:
-            yield from reset_cache_coro()
+        # pylint: disable=protected-access
+        with self.pool._revision_janitor.busy():
+            try:
+                if self.snap_on_start or self.save_on_stop:
+                    if not self.save_on_stop or not self.is_dirty():
+                        yield from self._snapshot()
+                else:
+                    yield from self._reset()
+            finally:
+                yield from refresh_cache_coro()
         return self
 
     @locked
@@ -685,7 +1050,7 @@ class ThinVolume(qubes.storage.Volume):
                 cmd = ['remove', self.vid]
                 yield from qubes_lvm_coro(cmd, self.log)
         finally:
-            yield from reset_cache_coro()
+            yield from refresh_cache_coro()
         return self
 
     def verify(self):
@@ -722,7 +1087,7 @@ class ThinVolume(qubes.storage.Volume):
     @property
     def usage(self):  # lvm thin usage always returns at least the same usage as
                       # the parent
-        refresh_cache()
+        refresh_cache([self._vid_current])
         try:
             return qubes.storage.lvm.size_cache[self._vid_current]['usage']
         except KeyError:
@@ -744,10 +1109,23 @@ def _get_lvm_cmdline(cmd):
 
     :param cmd: array of str, where cmd[0] is action and the rest are arguments
     :return array of str appropriate for subprocess.Popen
+
+    The 'remove' action accepts any number of volumes.
     '''
+    lvm_cmd = _get_lvm_command(cmd)
+    if os.getuid() != 0:
+        cmd = ['sudo', 'lvm'] + lvm_cmd
+    else:
+        cmd = ['lvm'] + lvm_cmd
+
+    return cmd
+
+def _get_lvm_command(cmd):
+    ''' Build :program:`lvm` command (without ``lvm`` itself) for an action,
+    see :py:func:`_get_lvm_cmdline`'''
     action = cmd[0]
     if action == 'remove':
-        lvm_cmd = ['lvremove', '-f', cmd[1]]
+        lvm_cmd = ['lvremove', '-f'] + cmd[1:]
     elif action == 'clone':
         lvm_cmd = ['lvcreate', '-kn', '-ay', '-s', cmd[1], '-n', cmd[2]]
     elif action == 'create':
@@ -765,12 +1143,26 @@ def _get_lvm_cmdline(cmd):
     if lvm_is_very_old:
         # old lvm in trusty image used there does not support -k option
         lvm_cmd = [x for x in lvm_cmd if x != '-kn']
-    if os.getuid() != 0:
-        cmd = ['sudo', 'lvm'] + lvm_cmd
-    else:
-        cmd = ['lvm'] + lvm_cmd
+    return lvm_cmd
 
-    return cmd
+def _get_lvm_command_vids(cmd):
+    ''' Return volumes (``vg/lv``) changed by an action, see
+    :py:func:`_get_lvm_cmdline`'''
+    action = cmd[0]
+    if action == 'remove':
+        vids = cmd[1:]
+    elif action in ('extend', 'activate'):
+        vids = [cmd[1]]
+    elif action == 'clone':
+        vids = [cmd[2]]
+    elif action == 'create':
+        vids = [cmd[1], cmd[1].split('/')[0] + '/' + cmd[2]]
+    elif action == 'rename':
+        vids = [cmd[1], cmd[2]]
+    else:
+        vids = []
+    return [vid[len('/dev/'):] if vid.startswith('/dev/') else vid
+        for vid in vids]
 
 def _process_lvm_output(returncode, stdout, stderr, log):
     '''Process output of LVM, determine if the call was successful and
@@ -793,6 +1185,7 @@ def _process_lvm_output(returncode, stdout, stderr, log):
 def qubes_lvm(cmd, log=logging.getLogger('qubes.storage.lvm')):
     ''' Call :program:`lvm` to execute an LVM operation '''
     # the only caller for this non-coroutine version is ThinVolume.export()
+    size_cache.invalidate(_get_lvm_command_vids(cmd))
     cmd = _get_lvm_cmdline(cmd)
     environ = os.environ.copy()
     environ['LC_ALL'] = 'C.utf8'
@@ -805,7 +1198,27 @@ def qubes_lvm(cmd, log=logging.getLogger('qubes.storage.lvm')):
 def qubes_lvm_coro(cmd, log=logging.getLogger('qubes.storage.lvm')):
     ''' Call :program:`lvm` to execute an LVM operation
 
-    Coroutine version of :py:func:`qubes_lvm`'''
+    Coroutine version of :py:func:`qubes_lvm`. The operation is executed by
+    :py:class:`LvmShell`, if available. Volumes changed by it are marked as
+    such in :py:data:`size_cache`, see :py:func:`refresh_cache_coro`.
+    Removals are merged with concurrent ones, see :py:func:`_remove_batched`.
+    '''
+    if cmd[0] == 'remove' and lvm_batch_enabled:
+        return (yield from _remove_batched(cmd[1:], log))
+    return (yield from _run_lvm_coro(cmd, log))
+
+@asyncio.coroutine
+def _run_lvm_coro(cmd, log):
+    size_cache.invalidate(_get_lvm_command_vids(cmd))
+    shell = _get_lvm_shell()
+    if shell is not None:
+        try:
+            report = yield from shell.run(_get_lvm_command(cmd))
+        except LvmShellError:
+            pass
+        else:
+            return _process_lvm_output(*_lvm_report_status(report), log=log)
+
     cmd = _get_lvm_cmdline(cmd)
     environ = os.environ.copy()
     environ['LC_ALL'] = 'C.utf8'
@@ -817,16 +1230,404 @@ def qubes_lvm_coro(cmd, log=logging.getLogger('qubes.storage.lvm')):
     return _process_lvm_output(p.returncode, out, err, log)
 
 
+#: set to :py:obj:`False` to run each removal separately
+lvm_batch_enabled = True
+
+#: removals waiting for :py:func:`_remove_worker`, by volume group
+_pending_removals = {}
+#: tasks of :py:func:`_remove_worker`, by volume group
+_removal_workers = {}
+
+@asyncio.coroutine
+def _remove_batched(vids, log):
+    '''Remove volumes, together with removals requested concurrently
+
+    Volumes are removed with a single :program:`lvremove` call, shared with
+    everyone removing volumes of the same volume group at the same time -
+    like all the volumes of a VM being stopped, or several VMs stopped
+    at once. Requests arriving while :program:`lvremove` is running are
+    merged into the next call. Each caller gets an error only if its own
+    volumes were not removed.
+    '''
+    vids = [vid[len('/dev/'):] if vid.startswith('/dev/') else vid
+        for vid in vids]
+    volume_group = vids[0].split('/')[0]
+    future = asyncio.get_event_loop().create_future()
+    _pending_removals.setdefault(volume_group, []).append((vids, future))
+    worker = _removal_workers.get(volume_group)
+    if worker is None or worker.done():
+        _removal_workers[volume_group] = asyncio.ensure_future(
+            _remove_worker(volume_group, log))
+    return (yield from asyncio.shield(future))
+
+@asyncio.coroutine
+def _remove_worker(volume_group, log):
+    while _pending_removals.get(volume_group):
+        batch = _pending_removals.pop(volume_group)
+        vids = sorted({vid for request_vids, _ in batch
+            for vid in request_vids})
+        try:
+            yield from _run_lvm_coro(['remove'] + vids, log)
+        except qubes.storage.StoragePoolException as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                continue
+            # find out which volumes are left, to report only to their
+            # callers
+            try:
+                remaining = yield from init_cache_coro(log, vids=vids)
+            except qubes.storage.StoragePoolException:
+                remaining = vids
+            for request_vids, future in batch:
+                failed = [vid for vid in request_vids if vid in remaining]
+                if failed:
+                    future.set_exception(qubes.storage.StoragePoolException(
+                        'Failed to remove {}: {}'.format(
+                            ', '.join(failed), e)))
+                else:
+                    future.set_result(True)
+        except Exception as e:  # pylint: disable=broad-except
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for _, future in batch:
+                future.set_result(True)
+
+
+class LvmShellError(Exception):
+    '''Raised when :py:class:`LvmShell` cannot be used'''
+
+
+class LvmShell:
+    '''Long-running :program:`lvm` shell executing LVM commands
+
+    Starting :program:`lvm` for each operation (and having it read its
+    configuration and scan devices) is expensive, so commands are written to
+    a single :program:`lvm` shell process instead. They are queued and
+    executed in order, one at a time - LVM takes global metadata lock for
+    most of them anyway. Each command is run with JSON log report written to
+    ``LVM_REPORT_FD``, which is where its exit status is read from, the same
+    way as :program:`lvmdbusd` does it.
+
+    If the shell cannot be started, or a command does not finish in
+    :py:attr:`timeout` seconds, :py:meth:`run` raises
+    :py:class:`LvmShellError` and the caller should execute the command
+    the usual way. The shell is not used again then.
+    '''
+
+    #: command starting the shell
+    command = ['lvm']
+    prompt = b'lvm> '
+    #: options added to each command, to get its status in the report
+    report_options = ['--reportformat', 'json',
+        '--config', 'log/report_command_log=1']
+    #: how long (in seconds) to wait for a command to finish
+    timeout = 120
+    #: buffer size of the report and stdout readers; both are read while
+    #: the command runs, so this limits only the chunks, not the output
+    read_limit = 1024**2
+
+    def __init__(self, log=logging.getLogger('qubes.storage.lvm.shell')):
+        self.log = log
+        self.process = None
+        self._stdin_fd = None
+        self._report = None
+        self._report_transport = None
+        self._report_buffer = ''
+        self._report_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._queue = collections.deque()
+        self._worker = None
+        #: the shell failed to start, don't try again
+        self.failed = False
+
+    @asyncio.coroutine
+    def run(self, lvm_cmd):
+        '''Execute a :program:`lvm` command
+
+        :param list lvm_cmd: the command, without ``lvm`` itself
+        :return: report of the command (:py:class:`dict`)
+        :raises LvmShellError: if the shell is not available (the command \
+            was not executed)
+        '''
+        if self.failed:
+            raise LvmShellError('lvm shell not available')
+        if any(not arg or set(arg) & set(' \t\n\'"\\') for arg in lvm_cmd):
+            # quoting rules of lvm shell are not worth the trouble
+            raise LvmShellError('unsupported argument')
+        future = asyncio.get_event_loop().create_future()
+        self._queue.append((lvm_cmd, future))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._work())
+        # the command will be executed anyway, let it finish in order
+        return (yield from asyncio.shield(future))
+
+    @asyncio.coroutine
+    def _work(self):
+        while self._queue:
+            lvm_cmd, future = self._queue.popleft()
+            try:
+                if self.failed:
+                    raise LvmShellError('lvm shell not available')
+                if self.process is None:
+                    yield from self._start()
+                result = yield from self._execute(lvm_cmd)
+            except Exception as e:  # pylint: disable=broad-except
+                if not isinstance(e, LvmShellError):
+                    # state of the shell is unknown, start a new one
+                    self.close()
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    @asyncio.coroutine
+    def _start(self):
+        environ = os.environ.copy()
+        environ['LC_ALL'] = 'C.utf8'
+        report_read, report_write = os.pipe()
+        environ['LVM_REPORT_FD'] = str(report_write)
+        # readline wants a terminal
+        self._stdin_fd, stdin_slave = pty.openpty()
+        attrs = termios.tcgetattr(stdin_slave)
+        attrs[3] &= ~termios.ECHO
+        termios.tcsetattr(stdin_slave, termios.TCSANOW, attrs)
+        try:
+            self.process = yield from asyncio.create_subprocess_exec(
+                *self.command,
+                stdin=stdin_slave,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                pass_fds=(report_write,),
+                env=environ,
+                limit=self.read_limit)
+            self._report = asyncio.StreamReader(limit=self.read_limit)
+            self._report_transport, _ = \
+                yield from asyncio.get_event_loop().connect_read_pipe(
+                    lambda: asyncio.StreamReaderProtocol(self._report),
+                    os.fdopen(report_read, 'rb', 0))
+            report_read = None
+            yield from self._read_prompt()
+        except (OSError, asyncio.IncompleteReadError) as e:
+            self.failed = True
+            self.close()
+            self.log.warning('failed to start lvm shell: %s', e)
+            raise LvmShellError('failed to start lvm shell')
+        finally:
+            os.close(stdin_slave)
+            os.close(report_write)
+            if report_read is not None:
+                os.close(report_read)
+
+    @asyncio.coroutine
+    def _read_prompt(self):
+        # not readuntil(), the output before the prompt can be longer than
+        # the limit of the reader
+        tail = b''
+        while not tail.endswith(self.prompt):
+            chunk = yield from self.process.stdout.read(self.read_limit)
+            if not chunk:
+                raise asyncio.IncompleteReadError(tail, None)
+            tail = (tail + chunk)[-len(self.prompt):]
+
+    @asyncio.coroutine
+    def _read_report(self, lvm_cmd):
+        decoder = json.JSONDecoder()
+        while True:
+            data = self._report_buffer.lstrip()
+            # don't try to decode a large report after each chunk
+            if data[-16:].rstrip().endswith('}'):
+                try:
+                    report, end = decoder.raw_decode(data)
+                except ValueError:
+                    pass
+                else:
+                    self._report_buffer = data[end:]
+                    return report
+            chunk = yield from self._report.read(self.read_limit)
+            if not chunk:
+                raise qubes.storage.StoragePoolException(
+                    'no report from lvm shell for {}'.format(lvm_cmd[0]))
+            self._report_buffer += self._report_decoder.decode(chunk)
+
+    @asyncio.coroutine
+    def _execute(self, lvm_cmd):
+        line = ' '.join(lvm_cmd + self.report_options) + '\n'
+        os.write(self._stdin_fd, line.encode())
+        # read both at the same time, lvm blocks on writing a large report
+        # (whatever is printed on stdout is in the report too) otherwise
+        exchange = asyncio.gather(self._read_report(lvm_cmd),
+            self._read_prompt(), return_exceptions=True)
+        try:
+            report, prompt = yield from asyncio.wait_for(exchange,
+                self.timeout)
+        except asyncio.TimeoutError:
+            # the reads get cancelled, nobody is interested in how
+            exchange.add_done_callback(
+                lambda future: future.cancelled() or future.exception())
+            self.failed = True
+            self.close()
+            self.log.warning('lvm shell did not finish %s in %ss, '
+                'not using it anymore', lvm_cmd[0], self.timeout)
+            raise LvmShellError('lvm shell timed out')
+        if isinstance(prompt, asyncio.IncompleteReadError):
+            raise qubes.storage.StoragePoolException(
+                'lvm shell exited while running {}'.format(lvm_cmd[0]))
+        for result in (prompt, report):
+            if isinstance(result, Exception):
+                raise result
+        return report
+
+    def close(self):
+        '''Terminate the shell; next command will start a new one'''
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+        self.process = None
+        if self._stdin_fd is not None:
+            os.close(self._stdin_fd)
+            self._stdin_fd = None
+        if self._report_transport is not None:
+            self._report_transport.close()
+            self._report_transport = None
+        self._report = None
+        self._report_buffer = ''
+        self._report_decoder.reset()
+
+    @asyncio.coroutine
+    def stop(self):
+        '''Terminate the shell and wait for it to exit'''
+        process = self.process
+        self.close()
+        if process is not None:
+            yield from process.wait()
+
+
+def _lvm_report_status(report):
+    '''Convert log report of a command to ``(returncode, stdout, stderr)``
+    for :py:func:`_process_lvm_output`'''
+    failed = False
+    messages = []
+    for entry in report.get('log', []):
+        if entry['log_type'] == 'status':
+            if entry['log_ret_code'] != '1':  # ECMD_PROCESSED
+                failed = True
+        elif entry['log_type'] in ('error', 'warn'):
+            if entry['log_type'] == 'error':
+                failed = True
+            messages.append(entry['log_message'])
+    if failed and not messages:
+        messages.append('lvm command failed')
+    return 5 if failed else 0, b'', '\n'.join(messages).encode()
+
+
+#: the shell used by :py:func:`qubes_lvm_coro`, see :py:func:`_get_lvm_shell`
+lvm_shell = None
+
+#: set to :py:obj:`False` to always start :program:`lvm` for each command
+lvm_shell_enabled = True
+
+def _get_lvm_shell():
+    '''Return :py:class:`LvmShell` to use, or :py:obj:`None`
+
+    The shell is used only when running as root - :program:`sudo` would not
+    pass ``LVM_REPORT_FD`` to it.
+    '''
+    if not lvm_shell_enabled or os.getuid() != 0:
+        return None
+    if qubes.storage.lvm.lvm_shell is None:
+        qubes.storage.lvm.lvm_shell = LvmShell()
+    if qubes.storage.lvm.lvm_shell.failed:
+        return None
+    return qubes.storage.lvm.lvm_shell
+
+
 def reset_cache():
-    qubes.storage.lvm.size_cache = init_cache()
-    qubes.storage.lvm.size_cache_time = time.monotonic()
+    '''Rescan all LVM volumes'''
+    size_cache.refresh()
 
 @asyncio.coroutine
 def reset_cache_coro():
-    qubes.storage.lvm.size_cache = yield from init_cache_coro()
-    qubes.storage.lvm.size_cache_time = time.monotonic()
+    '''Rescan all LVM volumes
 
-def refresh_cache():
-    '''Reset size cache, if it's older than 30sec '''
-    if size_cache_time+30 < time.monotonic():
-        reset_cache()
+    Concurrent callers share a single scan, see
+    :py:meth:`LvmCache.refresh_coro`.
+    '''
+    yield from size_cache.refresh_coro()
+
+@asyncio.coroutine
+def refresh_cache_coro():
+    '''Refresh LVM volumes changed by :py:func:`qubes_lvm_coro` (or
+    otherwise marked as changed)'''
+    yield from size_cache.refresh_coro(())
+
+def _log_refresh_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.getLogger('qubes.storage.lvm').warning(
+            'failed to refresh LVM volumes: %s', future.exception())
+
+def refresh_cache(vids):
+    '''Refresh information about *vids*, if it's stale
+
+    Information is considered stale after :py:attr:`LvmCache.max_age`
+    seconds, or when the volume was changed. When the event loop is running
+    (in qubesd), this doesn't wait for :program:`lvm` - the refresh is done
+    in the background and the cached information is used meanwhile.
+    '''
+    _start_udev_monitor()
+    vids = [vid for vid in vids if size_cache.is_stale(vid)]
+    if not vids:
+        return
+    if asyncio.get_event_loop().is_running():
+        size_cache.request_refresh(vids).add_done_callback(
+            _log_refresh_error)
+    else:
+        size_cache.refresh(vids)
+
+
+#: :py:class:`pyudev.Monitor` of device-mapper devices, see
+#: :py:func:`_start_udev_monitor`
+udev_monitor = None
+
+#: set to :py:obj:`False` to not watch uevents
+udev_monitor_enabled = True
+
+def _start_udev_monitor():
+    '''Watch uevents of device-mapper devices, to refresh
+    :py:data:`size_cache` also after changes done outside of qubesd
+
+    This requires :py:mod:`pyudev` and a running event loop, otherwise it
+    does nothing.
+    '''
+    if pyudev is None or not udev_monitor_enabled or \
+            qubes.storage.lvm.udev_monitor is not None:
+        return
+    loop = asyncio.get_event_loop()
+    if not loop.is_running():
+        return
+    try:
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by('block', device_type='disk')
+        monitor.start()
+    except (OSError, ImportError) as e:
+        logging.getLogger('qubes.storage.lvm').warning(
+            'failed to watch uevents: %s', e)
+        qubes.storage.lvm.udev_monitor_enabled = False
+        return
+    loop.add_reader(monitor.fileno(), _udev_event_received, monitor)
+    qubes.storage.lvm.udev_monitor = monitor
+
+def _udev_event_received(monitor):
+    vids = []
+    for device in iter(functools.partial(monitor.poll, timeout=0), None):
+        volume_group = device.get('DM_VG_NAME')
+        name = device.get('DM_LV_NAME')
+        if volume_group and name:
+            vids.append(volume_group + '/' + name)
+    if vids:
+        size_cache.request_refresh(vids).add_done_callback(
+            _log_refresh_error)
+
+def stop_udev_monitor():
+    '''Stop watching uevents, see :py:func:`_start_udev_monitor`'''
+    monitor = qubes.storage.lvm.udev_monitor
+    if monitor is not None:
+        asyncio.get_event_loop().remove_reader(monitor.fileno())
+        qubes.storage.lvm.udev_monitor = None
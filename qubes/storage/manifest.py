@@ -0,0 +1,169 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+''' Block-hash manifests of volume images, for deduplicated imports
+(``admin.vm.volume.ImportWithManifest``).
+
+A manifest is text: a header line ``BLOCK_SIZE SIZE``, then a line with
+the hex SHA-256 digest of each block of the image (the last one may be
+shorter than ``BLOCK_SIZE``), and an empty line.
+
+After an import, the manifest is stored next to the qube's files, along
+with a *stamp* of the volume data it describes (see :py:func:`stamp`). It
+is used for the next import only if the stamp still matches, that is if
+the volume was not written since; otherwise the current data gets hashed
+again.
+'''
+
+import hashlib
+import os
+
+from qubes.storage import filecopy
+
+#: allowed block sizes
+MIN_BLOCK_SIZE = 64 * 1024
+MAX_BLOCK_SIZE = 64 * 1024**2
+
+#: suffix of stored manifests (after the volume name)
+SUFFIX = '.manifest'
+
+#: suffix of manifests of imports in progress
+IMPORT_SUFFIX = '.manifest-import'
+
+_DIGEST_SIZE = hashlib.sha256().digest_size
+
+
+class Manifest:
+    ''' Block hashes of a volume image.
+
+    :param int block_size: size of a block
+    :param int size: size of the image
+    :param list hashes: digests (:py:class:`bytes`) of the blocks
+    '''
+
+    def __init__(self, block_size, size, hashes):
+        self.block_size = block_size
+        self.size = size
+        self.hashes = hashes
+
+    @classmethod
+    def parse(cls, untrusted_data):
+        ''' Parse and validate a manifest; raise :py:class:`ValueError`
+        if it is not valid. '''
+        untrusted_lines = untrusted_data.split(b'\n')
+        if len(untrusted_lines) < 2 or untrusted_lines[-2:] != [b'', b'']:
+            raise ValueError('Manifest not terminated with an empty line')
+        untrusted_header = untrusted_lines[0].split(b' ')
+        if len(untrusted_header) != 2 or \
+                not all(value.isdigit() for value in untrusted_header):
+            raise ValueError('Invalid manifest header')
+        block_size, size = (int(value) for value in untrusted_header)
+        if block_size & (block_size - 1) or \
+                not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
+            raise ValueError('Invalid block size {}'.format(block_size))
+        untrusted_hashes = untrusted_lines[1:-2]
+        if len(untrusted_hashes) != -(-size // block_size):
+            raise ValueError('Wrong number of blocks in manifest')
+        hashes = []
+        for untrusted_hash in untrusted_hashes:
+            if len(untrusted_hash) != 2 * _DIGEST_SIZE:
+                raise ValueError('Invalid block hash')
+            hashes.append(bytes.fromhex(untrusted_hash.decode('ascii')))
+        return cls(block_size, size, hashes)
+
+    def dump(self):
+        ''' Serialize the manifest, as parsed by :py:meth:`parse` '''
+        return b''.join(
+            [b'%d %d\n' % (self.block_size, self.size)]
+            + [digest.hex().encode('ascii') + b'\n' for digest in self.hashes]
+            + [b'\n'])
+
+    def block_length(self, index):
+        ''' Length of the block *index*, the last one can be shorter '''
+        return min(self.block_size, self.size - index * self.block_size)
+
+    @classmethod
+    def from_fd(cls, fd, block_size, size):
+        ''' Compute the manifest of *size* bytes of data of *fd* '''
+        hashes = []
+        zero_hash = None
+        extents = filecopy.data_extents(fd, size)
+        extent = next(extents, None)
+        for index in range(-(-size // block_size)):
+            offset = index * block_size
+            length = min(block_size, size - offset)
+            while extent is not None and sum(extent) <= offset:
+                extent = next(extents, None)
+            if extent is None or extent[0] >= offset + length:
+                # a hole, no need to read it
+                if zero_hash is None or length != block_size:
+                    zero_hash = hashlib.sha256(bytes(length)).digest()
+                hashes.append(zero_hash)
+                continue
+            digest = hashlib.sha256()
+            while length:
+                data = os.pread(fd, min(length, 1024**2), offset)
+                if not data:
+                    raise ValueError('Unexpected end of volume data')
+                digest.update(data)
+                offset += len(data)
+                length -= len(data)
+            hashes.append(digest.digest())
+        return cls(block_size, size, hashes)
+
+
+def stamp(volume):
+    ''' Identify the current data of *volume*: by
+    :py:meth:`qubes.storage.Volume.data_stamp` if the pool provides it,
+    otherwise by stat(2) of its export path, which changes when
+    the image is replaced by a new one (like the reflink pool does on
+    commit) or written (for files).
+    '''
+    volume_stamp = volume.data_stamp()
+    if volume_stamp is not None:
+        return volume_stamp
+    st = os.stat(volume.export())
+    return '{} {} {} {} {}'.format(st.st_dev, st.st_ino, st.st_rdev,
+        st.st_size, st.st_mtime_ns)
+
+
+def open_stored(path, expected_stamp):
+    ''' Open the stored manifest at *path*, if its stamp matches
+    *expected_stamp*; return a file descriptor positioned at the manifest
+    data, or :py:obj:`None` '''
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    except FileNotFoundError:
+        return None
+    header = os.pread(fd, 4096, 0)
+    stored_stamp, newline, _ = header.partition(b'\n')
+    if not newline or stored_stamp != expected_stamp.encode('ascii'):
+        os.close(fd)
+        return None
+    os.lseek(fd, len(stored_stamp) + 1, os.SEEK_SET)
+    return fd
+
+
+def store(path, data, current_stamp):
+    ''' Store manifest *data* at *path*, with the stamp of the data '''
+    tmp_path = path + '~'
+    with open(tmp_path, 'wb') as manifest_io:
+        manifest_io.write(current_stamp.encode('ascii') + b'\n')
+        manifest_io.write(data)
+        manifest_io.flush()
+        os.fsync(manifest_io.fileno())
+    os.rename(tmp_path, path)
@@ -24,34 +24,50 @@
 
 import asyncio
 import collections
+import ctypes
 import errno
 import fcntl
 import functools
 import glob
 import logging
 import os
-import subprocess
 import tempfile
 from contextlib import contextmanager, suppress
 
 import qubes.storage
+import qubes.storage.filecopy
+import qubes.utils
 
 BLKSIZE = 512
-FICLONE = 1074041865        # defined in <linux/fs.h>
 LOOP_SET_CAPACITY = 0x4C07  # defined in <linux/loop.h>
 LOGGER = logging.getLogger('qubes.storage.reflink')
 
+# ioprio_set(2)/ioprio_get(2) syscall numbers, and constants from
+# <linux/ioprio.h>
+_SYS_IOPRIO = {'x86_64': (251, 252), 'aarch64': (30, 31)}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
 
 class ReflinkPool(qubes.storage.Pool):
     driver = 'file-reflink'
     _known_dir_path_prefixes = ['appvms', 'vm-templates']
 
     def __init__(self, dir_path, setup_check='yes', revisions_to_keep=1,
-                 **kwargs):
+                 prepared_snapshots=0, **kwargs):
         super().__init__(revisions_to_keep=revisions_to_keep, **kwargs)
         self._volumes = {}
         self.dir_path = os.path.abspath(dir_path)
         self.setup_check = qubes.property.bool(None, None, setup_check)
+        self._snapshot_reserve = qubes.storage.SnapshotReserve(
+            int(prepared_snapshots), self._prepare_snapshot,
+            self._discard_snapshots, log=LOGGER)
+        self._usage_cache = qubes.storage.UsageCache(
+            ReflinkVolume.measure_usage, pool=self, log=LOGGER)
+        self._revision_janitor = qubes.storage.RevisionJanitor(
+            os.path.join(self.dir_path, '.revisions-to-remove'),
+            self._remove_revisions, log=LOGGER)
 
     def setup(self):
         created = _make_dir(self.dir_path)
@@ -89,7 +105,9 @@ class ReflinkPool(qubes.storage.Pool):
         return self._volumes[vid]
 
     def destroy(self):
-        pass
+        self._snapshot_reserve.close()
+        self._usage_cache.close()
+        self._revision_janitor.close()
 
     @property
     def config(self):
@@ -97,9 +115,51 @@ class ReflinkPool(qubes.storage.Pool):
             'name': self.name,
             'dir_path': self.dir_path,
             'driver': ReflinkPool.driver,
-            'revisions_to_keep': self.revisions_to_keep
+            'revisions_to_keep': self.revisions_to_keep,
+            'prepared_snapshots': self.prepared_snapshots,
         }
 
+    @property
+    def prepared_snapshots(self):
+        ''' How many copies of the clean image of each hot volume to keep
+            ready for snap_on_start volumes based on it, see
+            :py:class:`qubes.storage.SnapshotReserve`.
+        '''
+        return self._snapshot_reserve.size
+
+    @prepared_snapshots.setter
+    def prepared_snapshots(self, value):
+        self._snapshot_reserve.set_size(int(value))
+
+    @asyncio.coroutine
+    def _prepare_snapshot(self, volume):
+        # pylint: disable=protected-access
+        path = '{}-prep-{}.img'.format(volume._path_vid,
+                                       qubes.utils.random_string())
+        copier = qubes.storage.filecopy.FileCopy()
+        with (yield from volume._lock):
+            yield from qubes.storage.filecopy.run_in_executor(
+                copier, self.executor,
+                _copy_file, volume._path_clean, path, copier)
+        return path
+
+    @asyncio.coroutine
+    def _discard_snapshots(self, volume, snapshots):
+        # pylint: disable=protected-access
+        if snapshots is None:
+            snapshots = volume._prepared_snapshots
+        for path in snapshots:
+            yield from asyncio.get_event_loop().run_in_executor(
+                self.executor, _remove_file, path)
+
+    @asyncio.coroutine
+    def _remove_revisions(self, paths):
+        ''' Remove old revision images for :py:attr:`_revision_janitor`,
+            with the idle I/O priority.
+        '''
+        yield from asyncio.get_event_loop().run_in_executor(
+            self.executor, _remove_files_idle, paths)
+
     @property
     def size(self):
         statvfs = os.statvfs(self.dir_path)
@@ -120,18 +180,34 @@ class ReflinkPool(qubes.storage.Pool):
 
 def _unblock(method):
     ''' Decorator transforming a synchronous volume method into a
-        coroutine that runs the original method in the event loop's
-        thread-based default executor, under a per-volume lock.
+        coroutine that runs the original method in the pool's executor,
+        under a per-volume lock.
     '''
     @asyncio.coroutine
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
         with (yield from self._lock):  # pylint: disable=protected-access
             return (yield from asyncio.get_event_loop().run_in_executor(
-                None, functools.partial(method, self, *args, **kwargs)))
+                self.pool.executor,
+                functools.partial(method, self, *args, **kwargs)))
+    return wrapper
+
+def _invalidating(method):
+    ''' Decorator for volume coroutines which may change the clean image,
+        making copies of it prepared by the pool outdated.
+    '''
+    @asyncio.coroutine
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        # pylint: disable=protected-access
+        try:
+            return (yield from method(self, *args, **kwargs))
+        finally:
+            self.pool._snapshot_reserve.invalidate(self)
     return wrapper
 
 class ReflinkVolume(qubes.storage.Volume):
+    # pylint: disable=protected-access
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._lock = asyncio.Lock()
@@ -145,6 +221,7 @@ class ReflinkVolume(qubes.storage.Volume):
     def create(self):
         if self.save_on_stop and not self.snap_on_start:
             _create_sparse_file(self._path_clean, self.size)
+        self.pool._usage_cache.update(self)
         return self
 
     @_unblock
@@ -161,14 +238,26 @@ class ReflinkVolume(qubes.storage.Volume):
         raise qubes.storage.StoragePoolException(
             'Missing image file {!r} for volume {}'.format(img, self.vid))
 
-    @_unblock
+    @asyncio.coroutine
     def remove(self):
+        # prepared copies are removed below
+        self.pool._snapshot_reserve.forget(self)
+        return (yield from self._remove())
+
+    @_unblock
+    def _remove(self):
         ''' Drop volume object from pool; remove volume images from
             oldest to newest; remove empty VM directory.
         '''
-        self.pool._volumes.pop(self, None)  # pylint: disable=protected-access
+        self.pool._volumes.pop(self, None)
+        self.pool._usage_cache.forget(self)
         self._cleanup()
-        self._prune_revisions(keep=0)
+        for path in self._prepared_snapshots:
+            _remove_file(path)
+        # revisions queued for removal get listed again
+        self.pool._revision_janitor.take(self._is_revision)
+        for number, timestamp in self.revisions.items():
+            _remove_file(self._path_revision(number, timestamp))
         _remove_file(self._path_clean)
         _remove_file(self._path_dirty)
         _remove_empty_dir(os.path.dirname(self._path_dirty))
@@ -190,20 +279,49 @@ class ReflinkVolume(qubes.storage.Volume):
     def is_dirty(self):
         return self.save_on_stop and os.path.exists(self._path_dirty)
 
-    @_unblock
+    @property
+    def _prepared_snapshots(self):
+        ''' Copies of the clean image prepared by the pool '''
+        return glob.glob(glob.escape(self._path_vid) + '-prep-*.img')
+
+    @asyncio.coroutine
     def start(self):
+        prepared = generation = None
+        if self.snap_on_start and isinstance(self.source.pool, ReflinkPool):
+            # pylint: disable=protected-access
+            reserve = self.source.pool._snapshot_reserve
+            prepared = reserve.claim(self.source)
+            generation = reserve.generation(self.source)
+        with self.pool._revision_janitor.busy():
+            return (yield from self._start(prepared, generation))
+
+    @_unblock
+    def _start(self, prepared=None, generation=None):
         self._cleanup()
         if self.is_dirty():  # implies self.save_on_stop
+            if prepared is not None:
+                _remove_file(prepared)
             return self
         if self.snap_on_start:
             # pylint: disable=protected-access
-            _copy_file(self.source._path_clean, self._path_clean)
+            # the source could have been committed since the claim
+            if prepared is not None and generation == \
+                    self.source.pool._snapshot_reserve.generation(self.source):
+                _rename_file(prepared, self._path_clean)
+            else:
+                if prepared is not None:
+                    _remove_file(prepared)
+                _copy_file(self.source._path_clean, self._path_clean,
+                           progress=self.copy_progress)
         if self.snap_on_start or self.save_on_stop:
-            _copy_file(self._path_clean, self._path_dirty)
+            _copy_file(self._path_clean, self._path_dirty,
+                       progress=self.copy_progress)
         else:
             _create_sparse_file(self._path_dirty, self.size)
+        self.pool._usage_cache.update(self)
         return self
 
+    @_invalidating
     @_unblock
     def stop(self):
         if self.save_on_stop:
@@ -211,6 +329,7 @@ class ReflinkVolume(qubes.storage.Volume):
         else:
             _remove_file(self._path_dirty)
             _remove_file(self._path_clean)
+        self.pool._usage_cache.update(self)
         return self
 
     def _commit(self, path_from):
@@ -226,13 +345,22 @@ class ReflinkVolume(qubes.storage.Volume):
         _copy_file(self._path_clean,
                    self._path_revision(self._next_revision_number, timestamp))
 
-    def _prune_revisions(self, keep=None):
-        if keep is None:
-            keep = self.revisions_to_keep
+    def _prune_revisions(self):
+        ''' Queue revisions above revisions_to_keep for removal by the
+            pool's janitor.
+        '''
+        keep = self.revisions_to_keep
         # pylint: disable=invalid-unary-operand-type
-        for number, timestamp in list(self.revisions.items())[:-keep or None]:
-            _remove_file(self._path_revision(number, timestamp))
+        self.pool._revision_janitor.add(
+            self._path_revision(number, timestamp)
+            for number, timestamp in list(self.revisions.items())[
+                :-keep or None])
+
+    def _is_revision(self, path):
+        ''' Whether path is a revision image of this volume '''
+        return path.startswith(self._path_clean + '.')
 
+    @_invalidating
     @_unblock
     def revert(self, revision=None):
         if self.is_dirty():
@@ -245,8 +373,10 @@ class ReflinkVolume(qubes.storage.Volume):
         path_revision = self._path_revision(number, timestamp)
         self._add_revision()
         _rename_file(path_revision, self._path_clean)
+        self.pool._usage_cache.update(self)
         return self
 
+    @_invalidating
     @_unblock
     def resize(self, size):
         ''' Expand a read-write volume image; notify any corresponding
@@ -272,6 +402,7 @@ class ReflinkVolume(qubes.storage.Volume):
         self.size = size
         if update:
             _update_loopdev_sizes(self._path_dirty)
+        self.pool._usage_cache.update(self)
         return self
 
     def export(self):
@@ -281,29 +412,37 @@ class ReflinkVolume(qubes.storage.Volume):
         return self._path_clean
 
     @_unblock
-    def import_data(self):
+    def import_data(self, keep_data=False):
         if not self.save_on_stop:
             raise NotImplementedError(
                 'Cannot import_data: {} is not save_on_stop'.format(self.vid))
-        _create_sparse_file(self._path_import, self.size)
+        if keep_data and os.path.exists(self._path_clean):
+            _copy_file(self._path_clean, self._path_import,
+                       progress=self.copy_progress)
+            _resize_file(self._path_import, self.size)
+        else:
+            _create_sparse_file(self._path_import, self.size)
         return self._path_import
 
     def _import_data_end(self, success):
         if success:
             self._commit(self._path_import)
+            self.pool._usage_cache.update(self)
         else:
             _remove_file(self._path_import)
         return self
 
-    import_data_end = _unblock(_import_data_end)
+    import_data_end = _invalidating(_unblock(_import_data_end))
 
+    @_invalidating
     @_unblock
     def import_volume(self, src_volume):
         if not self.save_on_stop:
             return self
         try:
             success = False
-            _copy_file(src_volume.export(), self._path_import)
+            _copy_file(src_volume.export(), self._path_import,
+                       progress=self.copy_progress)
             success = True
         finally:
             self._import_data_end(success)
@@ -316,21 +455,40 @@ class ReflinkVolume(qubes.storage.Volume):
 
     @property
     def _next_revision_number(self):
-        numbers = self.revisions.keys()
+        # revisions being removed are still counted, not to reuse numbers
+        numbers = self._revisions(queued=True).keys()
         if numbers:
             return str(int(list(numbers)[-1]) + 1)
         return '1'
 
     @property
     def revisions(self):
+        return self._revisions()
+
+    def _revisions(self, queued=False):
         prefix = self._path_clean + '.'
         paths = glob.iglob(glob.escape(prefix) + '*@*Z')
+        if not queued:
+            paths = (path for path in paths
+                     if path not in self.pool._revision_janitor)
         items = (path[len(prefix):-1].split('@') for path in paths)
         return collections.OrderedDict(sorted(items,
                                               key=lambda item: int(item[0])))
 
     @property
     def usage(self):
+        ''' Return volume disk usage from the VM's perspective, as last
+            measured by :py:meth:`measure_usage`.
+        '''
+        return self.pool._usage_cache.get(self)
+
+    @property
+    def usage_timestamp(self):
+        ''' When :py:attr:`usage` was measured, in seconds since the epoch '''
+        timestamp = self.pool._usage_cache.timestamp(self)
+        return None if timestamp is None else int(timestamp)
+
+    def measure_usage(self):
         ''' Return volume disk usage from the VM's perspective. It is
             usually much lower from the host's perspective due to CoW.
         '''
@@ -389,6 +547,33 @@ def _remove_file(path):
         _fsync_dir(os.path.dirname(path))
         LOGGER.info('Removed file: %s', path)
 
+def _remove_files_idle(paths):
+    with _idle_io_priority():
+        for path in paths:
+            _remove_file(path)
+
+@contextmanager
+def _idle_io_priority():
+    ''' Switch the calling thread to the idle I/O scheduling class (if
+        supported) for the duration of the block.
+    '''
+    syscalls = _SYS_IOPRIO.get(os.uname().machine)
+    if syscalls is None:
+        yield
+        return
+    sys_ioprio_set, sys_ioprio_get = syscalls
+    libc = ctypes.CDLL(None, use_errno=True)
+    # pid 0 is the calling thread
+    prio = libc.syscall(sys_ioprio_get, IOPRIO_WHO_PROCESS, 0)
+    if prio < 0 or libc.syscall(sys_ioprio_set, IOPRIO_WHO_PROCESS, 0,
+                                IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) < 0:
+        yield
+        return
+    try:
+        yield
+    finally:
+        libc.syscall(sys_ioprio_set, IOPRIO_WHO_PROCESS, 0, prio)
+
 def _remove_empty_dir(path):
     try:
         os.rmdir(path)
@@ -432,26 +617,21 @@ def _update_loopdev_sizes(img):
         with open('/dev/' + sys_path.split('/')[3]) as dev_io:
             fcntl.ioctl(dev_io.fileno(), LOOP_SET_CAPACITY)
 
-def _attempt_ficlone(src, dst):
-    try:
-        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
-        return True
-    except OSError:
-        return False
+def _copy_file(src, dst, copier=None, progress=None):
+    ''' Copy src to dst as a reflink if possible, sparse if not.
 
-def _copy_file(src, dst):
-    ''' Copy src to dst as a reflink if possible, sparse if not. '''
+        :param copier: :py:class:`qubes.storage.filecopy.FileCopy` to use,
+            e.g. to be able to cancel the copy
+        :param progress: progress callback for a new copier, see
+            :py:attr:`qubes.storage.Volume.copy_progress`
+    '''
+    if copier is None:
+        copier = qubes.storage.filecopy.FileCopy(progress=progress)
     with _replace_file(dst) as tmp_io:
-        with open(src, 'rb') as src_io:
-            if _attempt_ficlone(src_io, tmp_io):
-                LOGGER.info('Reflinked file: %s -> %s', src, tmp_io.name)
-                return True
-        LOGGER.info('Copying file: %s -> %s', src, tmp_io.name)
-        cmd = 'cp', '--sparse=always', src, tmp_io.name
-        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if p.returncode != 0:
-            raise qubes.storage.StoragePoolException(str(p))
-        return False
+        reflinked = copier.run(src, tmp_io.name)
+        LOGGER.info('%s file: %s -> %s',
+                    'Reflinked' if reflinked else 'Copied', src, tmp_io.name)
+        return reflinked
 
 def is_supported(dst_dir, src_dir=None):
     ''' Return whether destination directory supports reflink copies
@@ -463,4 +643,5 @@ def is_supported(dst_dir, src_dir=None):
     with tempfile.TemporaryFile(dir=src_dir) as src, \
          tempfile.TemporaryFile(dir=dst_dir) as dst:
         src.write(b'foo')  # don't let any fs get clever with empty files
-        return _attempt_ficlone(src, dst)
+        return qubes.storage.filecopy.attempt_ficlone(src.fileno(),
+                                                      dst.fileno())
@@ -62,6 +62,7 @@ import qubes.devices
 import qubes.events
 import qubes.exc
 import qubes.ext.pci
+import qubes.utils
 import qubes.vm.standalonevm
 import qubes.vm.templatevm
 
@@ -343,11 +344,13 @@ class substitute_entry_points(object):
     def __enter__(self):
         self._orig_iter_entry_points = pkg_resources.iter_entry_points
         pkg_resources.iter_entry_points = self._iter_entry_points
+        qubes.utils.refresh_entry_points()
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
         pkg_resources.iter_entry_points = self._orig_iter_entry_points
         self._orig_iter_entry_points = None
+        qubes.utils.refresh_entry_points()
 
 
 class QubesTestCase(unittest.TestCase):
@@ -1320,6 +1323,7 @@ def load_tests(loader, tests, pattern): # pylint: disable=unused-argument
     for modname in (
             # unit tests
             'qubes.tests.events',
+            'qubes.tests.executors',
             'qubes.tests.devices',
             'qubes.tests.devices_block',
             'qubes.tests.firewall',
@@ -1328,6 +1332,8 @@ def load_tests(loader, tests, pattern): # pylint: disable=unused-argument
             'qubes.tests.storage',
             'qubes.tests.storage_file',
             'qubes.tests.storage_reflink',
+            'qubes.tests.storage_filecopy',
+            'qubes.tests.storage_manifest',
             'qubes.tests.storage_lvm',
             'qubes.tests.storage_kernels',
             'qubes.tests.ext',
@@ -1342,8 +1348,11 @@ def load_tests(loader, tests, pattern): # pylint: disable=unused-argument
             'qubes.tests.api_admin',
             'qubes.tests.api_misc',
             'qubes.tests.api_internal',
+            'qubes.tests.tools.qubesd_stream',
             'qubespolicy.tests',
             'qubespolicy.tests.cli',
+            'qubespolicy.tests.daemon',
+            'qubespolicy.tests.graph',
             ):
         tests.addTests(loader.loadTestsFromName(modname))
 
@@ -18,7 +18,9 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 
+import array
 import asyncio
+import os
 import socket
 import unittest.mock
 
@@ -34,6 +36,7 @@ class TestMgmt(object):
         self.dest = dest
         self.arg = arg
         self.send_event = send_event
+        self.response_fds = []
         try:
             self.function = {
                 'mgmt.success': self.success,
@@ -41,6 +44,7 @@ class TestMgmt(object):
                 'mgmt.qubesexception': self.qubesexception,
                 'mgmt.exception': self.exception,
                 'mgmt.event': self.event,
+                'mgmt.fd': self.fd,
             }[self.method.decode()]
         except KeyError:
             raise qubes.api.ProtocolError('Invalid method')
@@ -53,6 +57,10 @@ class TestMgmt(object):
     def cancel(self):
         self.task.cancel()
 
+    def close_response_fds(self):
+        while self.response_fds:
+            os.close(self.response_fds.pop())
+
     @asyncio.coroutine
     def success(self, untrusted_payload):
         return 'src: {!r}, dest: {!r}, arg: {!r}, payload: {!r}'.format(
@@ -71,6 +79,14 @@ class TestMgmt(object):
     def exception(self, untrusted_payload):
         raise Exception('exception')
 
+    @asyncio.coroutine
+    def fd(self, untrusted_payload):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, untrusted_payload)
+        os.close(write_fd)
+        self.response_fds.append(read_fd)
+        return 'fd'
+
     @asyncio.coroutine
     def event(self, untrusted_payload):
         future = asyncio.get_event_loop().create_future()
@@ -170,3 +186,120 @@ class TC_00_QubesDaemonProtocol(qubes.tests.QubesTestCase):
         with self.assertNotRaises(asyncio.TimeoutError):
             self.loop.run_until_complete(
                 asyncio.wait_for(self.protocol.mgmt.task, 1))
+
+    def test_006_fd(self):
+        # the fd would be lost by StreamReader, receive it from the socket
+        self.writer.transport.pause_reading()
+        self.writer.write(b'dom0\0mgmt.fd\0dom0\0arg\0payload')
+        self.writer.write_eof()
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        fds = array.array('i')
+        data, ancdata, _, _ = self.sock_client.recvmsg(1,
+            socket.CMSG_SPACE(fds.itemsize))
+        self.assertEqual(data, b'0')
+        self.assertEqual(len(ancdata), 1)
+        fds.frombytes(ancdata[0][2])
+        with open(fds[0], 'rb') as fd_io:
+            self.assertEqual(fd_io.read(), b'payload')
+        self.writer.transport.resume_reading()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response, b'\0fd')
+        self.assertEqual(self.protocol.mgmt.response_fds, [])
+
+    def send_mux_request(self, request_id, request):
+        header = qubes.api.QubesDaemonProtocol.mux_request_header
+        self.writer.write(header.pack(request_id, len(request)) + request)
+
+    def read_mux_frame(self):
+        header = qubes.api.QubesDaemonProtocol.mux_response_header
+        with self.assertNotRaises(asyncio.TimeoutError):
+            data = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.readexactly(header.size), 1))
+            request_id, flags, length = header.unpack(data)
+            data = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.readexactly(length), 1))
+        return request_id, flags, data
+
+    def test_100_mux_messages(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.mux_magic)
+        self.send_mux_request(1, b'dom0\0mgmt.success\0dom0\0arg\0payload')
+        self.send_mux_request(2, b'dom0\0mgmt.success_none\0dom0\0arg\0')
+        self.send_mux_request(3, b'dom0\0mgmt.qubesexception\0dom0\0arg\0')
+        self.send_mux_request(4, b'dom0\0mgmt.exception\0dom0\0arg\0')
+        self.writer.write_eof()
+        responses = {}
+        for _ in range(4):
+            request_id, flags, data = self.read_mux_frame()
+            self.assertNotIn(request_id, responses)
+            responses[request_id] = (flags, data)
+        self.assertEqual(responses, {
+            1: (qubes.api.QubesDaemonMuxTransport.MUX_END,
+                b"0\0src: b'dom0', dest: b'dom0', arg: b'arg', "
+                b"payload: b'payload'"),
+            2: (qubes.api.QubesDaemonMuxTransport.MUX_END, b"0\0"),
+            3: (qubes.api.QubesDaemonMuxTransport.MUX_END,
+                b"2\0QubesException\0\0qubes-exception\0"),
+            4: (qubes.api.QubesDaemonMuxTransport.MUX_ABORT, b""),
+        })
+        # the server closes the connection after all calls are finished
+        with self.assertNotRaises(asyncio.TimeoutError):
+            rest = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(rest, b'')
+        self.assertFalse(self.protocol.mux_requests)
+
+    def test_101_mux_in_parts(self):
+        data = qubes.api.QubesDaemonProtocol.mux_request_header.pack(
+            5, 34) + b'dom0\0mgmt.success\0dom0\0arg\0payload'
+        data = qubes.api.QubesDaemonProtocol.mux_magic + data
+        for i in range(0, len(data), 3):
+            self.writer.write(data[i:i+3])
+            self.loop.run_until_complete(self.writer.drain())
+            self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.read_mux_frame(),
+            (5, qubes.api.QubesDaemonMuxTransport.MUX_END,
+                b"0\0src: b'dom0', dest: b'dom0', arg: b'arg', "
+                b"payload: b'payload'"))
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            rest = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(rest, b'')
+
+    def test_102_mux_completion_order(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.mux_magic)
+        self.send_mux_request(1, b'dom0\0mgmt.event\0dom0\0arg\0payload')
+        self.assertEqual(self.read_mux_frame(),
+            (1, qubes.api.QubesDaemonMuxTransport.MUX_DATA,
+                b"1\0subject\0event\0payload\0payload\0\0"))
+        # other calls are handled while the event stream is running
+        self.send_mux_request(2, b'dom0\0mgmt.success_none\0dom0\0arg\0')
+        self.assertEqual(self.read_mux_frame(),
+            (2, qubes.api.QubesDaemonMuxTransport.MUX_END, b"0\0"))
+        # empty request cancels the call
+        self.send_mux_request(1, b'')
+        while True:
+            request_id, flags, _ = self.read_mux_frame()
+            self.assertEqual(request_id, 1)
+            if flags != qubes.api.QubesDaemonMuxTransport.MUX_DATA:
+                break
+        self.assertEqual(flags, qubes.api.QubesDaemonMuxTransport.MUX_END)
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            rest = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(rest, b'')
+
+    def test_103_mux_duplicate_id(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.mux_magic)
+        self.send_mux_request(1, b'dom0\0mgmt.event\0dom0\0arg\0payload')
+        self.send_mux_request(1, b'dom0\0mgmt.success_none\0dom0\0arg\0')
+        # framing violation aborts the whole connection
+        with self.assertNotRaises(asyncio.TimeoutError):
+            rest = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(rest, b'')
+        self.assertIsNone(self.protocol.transport)
+        self.assertFalse(self.protocol.mux_requests)
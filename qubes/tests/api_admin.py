@@ -40,7 +40,8 @@ import qubes.storage
 # properties defined in API
 volume_properties = [
     'pool', 'vid', 'size', 'usage', 'rw', 'source', 'path',
-    'save_on_stop', 'snap_on_start', 'revisions_to_keep']
+    'save_on_stop', 'snap_on_start', 'revisions_to_keep',
+    'usage_timestamp']
 
 
 class AdminAPITestCase(qubes.tests.QubesTestCase):
@@ -127,6 +128,99 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertEqual(value,
             'test-vm1 class=AppVM state=Halted\n')
 
+    def test_002_vm_list_data(self):
+        self.vm.features['feature1'] = 'multi\nline\\value'
+        self.vm.tags.add('tag1')
+        value = self.call_mgmt_func(b'admin.vm.ListData', b'dom0', b'',
+            b'property:label property:netvm property:no-such-property\n'
+            b'feature:feature1 tags')
+        self.assertEqual(value,
+            'dom0 class=AdminVM state=Running\n'
+            'dom0 property label default=False type=label black\n'
+            'test-template class=TemplateVM state=Halted\n'
+            'test-template property label default=False type=label black\n'
+            'test-template property netvm default=True type=vm \n'
+            'test-vm1 class=AppVM state=Halted\n'
+            'test-vm1 property label default=False type=label red\n'
+            'test-vm1 property netvm default=True type=vm \n'
+            'test-vm1 feature feature1 multi\\nline\\\\value\n'
+            'test-vm1 tag tag1\n')
+        # permission is checked as for the corresponding simple calls
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.vm.List',
+            kwargs={'dest': self.app.domains[0], 'arg': ''})
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.vm.property.Get',
+            kwargs={'dest': self.vm, 'arg': 'netvm'})
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.vm.feature.Get',
+            kwargs={'dest': self.vm, 'arg': 'feature1'})
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.vm.tag.Get',
+            kwargs={'dest': self.vm, 'arg': 'tag1'})
+
+    def test_003_vm_list_data_filter(self):
+        self.vm.features['feature1'] = 'value1'
+        self.vm.features['feature2'] = 'value2'
+        self.vm.tags.add('tag1')
+        denied = {
+            ('admin.vm.property.Get', 'label'),
+            ('admin.vm.feature.Get', 'feature1'),
+            ('admin.vm.tag.Get', 'tag1'),
+        }
+        def check_permission(event, pre_event, dest, arg):
+            # pylint: disable=unused-argument
+            if (event.split(':', 1)[1], arg) in denied:
+                raise qubes.api.PermissionDenied()
+            return []
+        self.app.domains[0].fire_event = unittest.mock.Mock(
+            side_effect=check_permission)
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.vm.ListData', b'test-vm1', b'')
+        value = self.loop.run_until_complete(mgmt_obj.execute(
+            untrusted_payload=b'property:name property:label feature:* tags'))
+        self.assertEqual(value,
+            'test-vm1 class=AppVM state=Halted\n'
+            'test-vm1 property name default=False type=str test-vm1\n'
+            'test-vm1 feature feature2 value2\n')
+
+    def test_004_vm_list_data_invalid_selector(self):
+        with self.assertRaises(qubes.api.ProtocolError):
+            self.call_mgmt_func(b'admin.vm.ListData', b'dom0', b'',
+                b'property:')
+        with self.assertRaises(qubes.api.ProtocolError):
+            self.call_mgmt_func(b'admin.vm.ListData', b'dom0', b'',
+                b'volume:root')
+
+    def test_005_api_list(self):
+        value = self.call_mgmt_func(b'admin.api.List', b'dom0')
+        methods = value.splitlines()
+        self.assertEqual(methods, sorted(methods))
+        self.assertIn('admin.api.List', methods)
+        self.assertIn('admin.vm.property.Get', methods)
+        self.assertIn('admin.vm.Create.AppVM', methods)
+        self.assertEqual(set(methods), set(mname for _, mname, _ in
+            qubes.api.admin.QubesAdminAPI.list_methods()))
+
+    def test_006_api_method_table(self):
+        table = qubes.api.admin.QubesAdminAPI.get_method_table()
+        self.assertIs(table,
+            qubes.api.admin.QubesAdminAPI.get_method_table())
+        func, mname, endpoint = table['admin.vm.Create.AppVM']
+        self.assertEqual(func, qubes.api.admin.QubesAdminAPI.vm_create)
+        self.assertEqual(mname, 'admin.vm.Create.AppVM')
+        self.assertEqual(endpoint, 'AppVM')
+        self.assertEqual(
+            list(qubes.api.admin.QubesAdminAPI.list_methods(
+                'admin.vm.property.Get')),
+            [table['admin.vm.property.Get']])
+        self.assertEqual(
+            list(qubes.api.admin.QubesAdminAPI.list_methods('no.such.method')),
+            [])
+        with self.assertRaises(qubes.api.ProtocolError):
+            qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+                b'no.such.method', b'dom0', b'')
+
     def test_010_vm_property_list(self):
         # this test is kind of stupid, but at least check if appropriate
         # admin-permission event is fired
@@ -180,6 +274,18 @@ class TC_00_VMs(AdminAPITestCase):
             b'provides_network')
         self.assertEqual(value, 'type=bool False')
 
+    def test_027_vm_property_get_all(self):
+        self.vm.kernelopts = 'opt1\nopt2\\'
+        value = self.call_mgmt_func(b'admin.vm.property.GetAll', b'test-vm1')
+        lines = value.splitlines()
+        self.assertEqual(len(lines), len(self.vm.property_list()))
+        self.assertIn('name default=False type=str test-vm1', lines)
+        self.assertIn('vcpus default=True type=int 2', lines)
+        self.assertIn('label default=False type=label red', lines)
+        self.assertIn('netvm default=True type=vm ', lines)
+        self.assertIn('kernelopts default=False type=str opt1\\nopt2\\\\',
+            lines)
+
     def test_030_vm_property_set_vm(self):
         netvm = self.app.add_new_vm('AppVM', label='red', name='test-net',
             template='test-template', provides_network=True)
@@ -1046,6 +1152,123 @@ class TC_00_VMs(AdminAPITestCase):
                 unittest.mock.call(vm2, 'test-event2', arg1='abc'),
             ])
 
+    def test_272_events_shared_filters(self):
+        filter_calls = []
+
+        def on_permission(subject, event, **kwargs):
+            # pylint: disable=unused-argument
+            # a new filter for each call, as permission handlers do
+            excluded = 'filtered-event'
+            def event_filter(item):
+                filter_calls.append(item)
+                return item[1] != excluded
+            yield event_filter
+
+        self.emitter.add_handler('admin-permission:admin.Events',
+            on_permission)
+        self.emitter.events_enabled = True
+        send_event1 = unittest.mock.Mock(spec=[])
+        send_event2 = unittest.mock.Mock(spec=[])
+        mgmt_obj1 = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.Events', b'dom0', b'', send_event=send_event1)
+        mgmt_obj2 = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.Events', b'dom0', b'', send_event=send_event2)
+
+        @asyncio.coroutine
+        def fire_event():
+            self.vm.fire_event('test-event', arg1='abc')
+            self.vm.fire_event('filtered-event')
+            mgmt_obj1.cancel()
+            mgmt_obj2.cancel()
+
+        loop = asyncio.get_event_loop()
+        execute_tasks = [
+            asyncio.ensure_future(mgmt_obj1.execute(untrusted_payload=b'')),
+            asyncio.ensure_future(mgmt_obj2.execute(untrusted_payload=b'')),
+        ]
+        asyncio.ensure_future(fire_event())
+        loop.run_until_complete(asyncio.wait(execute_tasks))
+        for send_event in (send_event1, send_event2):
+            self.assertEqual(send_event.mock_calls,
+                [
+                    unittest.mock.call(self.app, 'connection-established'),
+                    unittest.mock.call(self.vm, 'test-event', arg1='abc')
+                ])
+        # filters are called once for each event, not for each subscriber
+        self.assertEqual(filter_calls, [
+            (self.vm, 'test-event', {'arg1': 'abc'}),
+            (self.vm, 'filtered-event', {}),
+        ])
+        self.assertFalse(self.app.api_admin_events_bus.groups)
+
+    def test_273_events_bus_backpressure(self):
+        bus = qubes.api.admin.QubesMgmtEventsBus(self.app)
+        protocols = []
+        for _ in range(2):
+            protocol = qubes.api.QubesDaemonProtocol(None, app=self.app)
+            protocol.transport = unittest.mock.Mock()
+            protocol.transport.is_closing.return_value = False
+            protocol.transport.get_write_buffer_size.return_value = 0
+            bus.subscribe(None, [], protocol.send_event)
+            protocols.append(protocol)
+
+        self.vm.fire_event('test-event', arg1='abc')
+        expected = b'1\0test-vm1\0test-event\0arg1\0abc\0\0'
+        for protocol in protocols:
+            protocol.transport.write.assert_called_once_with(expected)
+            protocol.transport.reset_mock()
+
+        protocols[0].transport.get_write_buffer_size.return_value = \
+            bus.max_pending + 1
+        self.vm.fire_event('test-event', arg1='abc')
+        self.assertFalse(protocols[0].transport.write.called)
+        protocols[0].transport.abort.assert_called_once_with()
+        protocols[1].transport.write.assert_called_once_with(expected)
+
+        protocols[0].transport.reset_mock()
+        bus.overflow_policy = 'drop'
+        self.vm.fire_event('test-event', arg1='abc')
+        self.assertFalse(protocols[0].transport.write.called)
+        self.assertFalse(protocols[0].transport.abort.called)
+
+        for protocol in protocols:
+            bus.unsubscribe(None, [], protocol.send_event)
+        self.assertNotIn(bus.vm_handler, self.vm.__handlers__.get('*', ()))
+
+    def test_274_events_bus_filter_key(self):
+        def make_filter(excluded):
+            return lambda item: item[1] != excluded
+        key = qubes.api.admin.QubesMgmtEventsBus.filter_key
+        self.assertEqual(key(make_filter('event1')),
+            key(make_filter('event1')))
+        self.assertNotEqual(key(make_filter('event1')),
+            key(make_filter('event2')))
+        self.assertNotEqual(key(make_filter('event1')),
+            key(lambda item: item[1] != 'event1'))
+        # unhashable parameters are compared by identity
+        excluded = ['event1']
+        self.assertEqual(key(make_filter(excluded)),
+            key(make_filter(excluded)))
+        self.assertNotEqual(key(make_filter(excluded)),
+            key(make_filter(['event1'])))
+        self.assertNotEqual(key(lambda item, *, excluded=excluded: True),
+            key(lambda item, *, excluded=['event1']: True))
+
+        bus = qubes.api.admin.QubesMgmtEventsBus(self.app)
+        send_events = [unittest.mock.Mock(spec=[]) for _ in range(3)]
+        bus.subscribe(None, [make_filter('event1')], send_events[0])
+        bus.subscribe(None, [make_filter('event1')], send_events[1])
+        bus.subscribe(None, [make_filter('event2')], send_events[2])
+        self.assertEqual(len(bus.groups), 2)
+        self.vm.fire_event('event1')
+        self.assertFalse(send_events[0].called)
+        self.assertFalse(send_events[1].called)
+        send_events[2].assert_called_once_with(self.vm, 'event1')
+        bus.unsubscribe(None, [make_filter('event1')], send_events[0])
+        bus.unsubscribe(None, [make_filter('event1')], send_events[1])
+        bus.unsubscribe(None, [make_filter('event2')], send_events[2])
+        self.assertFalse(bus.groups)
+
     def test_280_feature_list(self):
         self.vm.features['test-feature'] = 'some-value'
         value = self.call_mgmt_func(b'admin.vm.feature.List', b'test-vm1')
@@ -1417,6 +1640,13 @@ class TC_00_VMs(AdminAPITestCase):
             b'default_kernel')
         self.assertEqual(value, 'default=False type=str 1.0')
 
+    def test_411_property_get_all(self):
+        # actual function tested for admin.vm.property.* already
+        value = self.call_mgmt_func(b'admin.property.GetAll', b'dom0')
+        self.assertIn('default_kernel default=False type=str 1.0\n', value)
+        self.assertEqual(len(value.splitlines()),
+            len(self.app.property_list()))
+
     def test_420_propert_set_str(self):
         # actual function tested for admin.vm.property.* already
         with unittest.mock.patch('qubes.property.__set__') as mock:
@@ -1684,7 +1914,7 @@ class TC_00_VMs(AdminAPITestCase):
         mock_rmtree.assert_called_once_with(
             '/tmp/qubes-test-dir/appvms/test-vm1')
         mock_remove.assert_called_once_with()
-        self.app.save.assert_called_once_with()
+        self.app.save.assert_called_once_with(sync=True)
 
     @unittest.mock.patch('qubes.storage.Storage.remove')
     @unittest.mock.patch('shutil.rmtree')
@@ -1712,6 +1942,104 @@ class TC_00_VMs(AdminAPITestCase):
                 self.call_mgmt_func(b'admin.vm.volume.Import', b'test-vm1',
                     b'private')
 
+    def test_512_vm_volume_import_fd(self):
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.vm.volume.Import', b'test-vm1', b'private')
+        self.loop.run_until_complete(mgmt_obj.execute(untrusted_payload=b''))
+        self.addCleanup(mgmt_obj.close_response_fds)
+        self.assertEqual(len(mgmt_obj.response_fds), 1)
+        self.assertEqual(
+            os.fstat(mgmt_obj.response_fds[0]).st_ino,
+            os.stat('/tmp/qubes-test-dir/appvms/test-vm1/'
+                'private-import.img').st_ino)
+
+    def test_513_vm_volume_export(self):
+        value = self.call_mgmt_func(b'admin.vm.volume.Export', b'test-vm1',
+            b'private')
+        self.assertEqual(value, '{} {}'.format(
+            2*2**30, '/tmp/qubes-test-dir/appvms/test-vm1/private.img'))
+        self.assertFalse(self.app.save.called)
+
+    def test_514_vm_volume_export_invalid_volume(self):
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.volume.Export', b'test-vm1',
+                b'no-such-volume')
+
+    def test_515_vm_volume_import_with_manifest(self):
+        manifest_path = os.path.join(self.vm.dir_path, 'private.manifest')
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.vm.volume.ImportWithManifest', b'test-vm1', b'private')
+        value = self.loop.run_until_complete(
+            mgmt_obj.execute(untrusted_payload=b''))
+        self.addCleanup(mgmt_obj.close_response_fds)
+        self.assertEqual(value, '{} {}'.format(
+            2*2**30, '/tmp/qubes-test-dir/appvms/test-vm1/private-import.img'))
+        # volume and the new manifest, no valid stored one
+        self.assertEqual(len(mgmt_obj.response_fds), 2)
+        self.assertEqual(os.fstat(mgmt_obj.response_fds[1]).st_ino,
+            os.stat(manifest_path + '-import').st_ino)
+
+    def test_516_vm_volume_import_with_stored_manifest(self):
+        manifest_path = os.path.join(self.vm.dir_path, 'private.manifest')
+        volume_path = self.vm.volumes['private'].export()
+        os.makedirs(self.vm.dir_path)
+        with open(volume_path, 'wb') as volume_io:
+            volume_io.truncate(2*2**30)
+        qubes.storage.manifest.store(manifest_path, b'manifest',
+            qubes.storage.manifest.stamp(self.vm.volumes['private']))
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.vm.volume.ImportWithManifest', b'test-vm1', b'private')
+        self.loop.run_until_complete(mgmt_obj.execute(untrusted_payload=b''))
+        self.addCleanup(mgmt_obj.close_response_fds)
+        self.assertEqual(len(mgmt_obj.response_fds), 3)
+        self.assertEqual(os.read(mgmt_obj.response_fds[2], 100), b'manifest')
+
+    def test_517_vm_volume_import_with_manifest_running(self):
+        with unittest.mock.patch.object(
+                self.vm, 'get_power_state', lambda: 'Running'):
+            with self.assertRaises(qubes.exc.QubesVMNotHaltedError):
+                self.call_mgmt_func(b'admin.vm.volume.ImportWithManifest',
+                    b'test-vm1', b'private')
+
+    def test_518_vm_volume_import_with_manifest_failed(self):
+        manifest_path = os.path.join(self.vm.dir_path, 'private.manifest')
+        volume_path = self.vm.volumes['private'].export()
+        os.makedirs(self.vm.dir_path)
+        with open(volume_path, 'wb') as volume_io:
+            volume_io.truncate(2*2**30)
+        qubes.storage.manifest.store(manifest_path, b'manifest',
+            qubes.storage.manifest.stamp(self.vm.volumes['private']))
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.vm.volume.ImportWithManifest', b'test-vm1', b'private')
+        self.addCleanup(mgmt_obj.close_response_fds)
+        import_data_end = unittest.mock.Mock(
+            wraps=self.vm.storage.import_data_end)
+        with unittest.mock.patch.object(qubes.storage.manifest,
+                'open_stored', side_effect=OSError('failed')), \
+                unittest.mock.patch.object(self.vm.storage,
+                    'import_data_end', import_data_end), \
+                unittest.mock.patch('os.close', wraps=os.close) as close:
+            with self.assertRaises(OSError):
+                self.loop.run_until_complete(
+                    mgmt_obj.execute(untrusted_payload=b''))
+        # the volume and the new manifest opened before the failure
+        self.assertEqual(len(close.mock_calls), 2)
+        self.assertEqual(mgmt_obj.response_fds, [])
+        import_data_end.assert_called_once_with('private', success=False)
+        self.assertFalse(os.path.exists(
+            '/tmp/qubes-test-dir/appvms/test-vm1/private-import.img'))
+
+    def test_519_vm_volume_import_drops_import_manifest(self):
+        # left by an ImportWithManifest that was never ended
+        import_manifest_path = os.path.join(self.vm.dir_path,
+            'private.manifest-import')
+        os.makedirs(self.vm.dir_path)
+        with open(import_manifest_path, 'wb') as manifest_io:
+            manifest_io.write(b'stale manifest')
+        self.call_mgmt_func(b'admin.vm.volume.Import', b'test-vm1',
+            b'private')
+        self.assertFalse(os.path.exists(import_manifest_path))
+
     def setup_for_clone(self):
         self.pool = unittest.mock.MagicMock()
         self.app.pools['test'] = self.pool
@@ -1762,7 +2090,7 @@ class TC_00_VMs(AdminAPITestCase):
         self.vm2.volumes['private'].import_volume.assert_called_once_with(
             self.vm2.volumes['private']
         )
-        self.app.save.assert_called_once_with()
+        self.app.save.assert_called_once_with(full=True)
 
     def test_521_vm_volume_clone_invalid_volume(self):
         self.setup_for_clone()
@@ -2300,7 +2628,7 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertIsNone(value)
         dev = qubes.devices.DeviceInfo(self.vm, '1234')
         self.assertIn(dev, self.vm.devices['testclass'].persistent())
-        self.app.save.assert_called_once_with()
+        self.app.save.assert_called_once_with(full=True)
 
     def test_651_vm_device_set_persistent_false_unchanged(self):
         self.vm.add_handler('device-list:testclass',
@@ -2315,7 +2643,7 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertIsNone(value)
         dev = qubes.devices.DeviceInfo(self.vm, '1234')
         self.assertNotIn(dev, self.vm.devices['testclass'].persistent())
-        self.app.save.assert_called_once_with()
+        self.app.save.assert_called_once_with(full=True)
 
     def test_652_vm_device_set_persistent_false(self):
         self.vm.add_handler('device-list:testclass',
@@ -2336,7 +2664,7 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertIsNone(value)
         self.assertNotIn(dev, self.vm.devices['testclass'].persistent())
         self.assertIn(dev, self.vm.devices['testclass'].attached())
-        self.app.save.assert_called_once_with()
+        self.app.save.assert_called_once_with(full=True)
 
     def test_653_vm_device_set_persistent_true_unchanged(self):
         self.vm.add_handler('device-list:testclass',
@@ -2356,7 +2684,7 @@ class TC_00_VMs(AdminAPITestCase):
         dev = qubes.devices.DeviceInfo(self.vm, '1234')
         self.assertIn(dev, self.vm.devices['testclass'].persistent())
         self.assertIn(dev, self.vm.devices['testclass'].attached())
-        self.app.save.assert_called_once_with()
+        self.app.save.assert_called_once_with(full=True)
 
     def test_654_vm_device_set_persistent_not_attached(self):
         self.vm.add_handler('device-list:testclass',
@@ -2391,7 +2719,7 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertIsNone(value)
         self.assertEqual(self.app.pools['test-pool'].mock_calls, [])
         self.assertEqual(self.app.pools['test-pool'].revisions_to_keep, 2)
-        self.app.save.assert_called_once_with()
+        self.app.save.assert_called_once_with(full=True)
 
     def test_661_pool_set_revisions_to_keep_negative(self):
         self.app.pools['test-pool'] = unittest.mock.Mock()
@@ -2409,6 +2737,50 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertEqual(self.app.pools['test-pool'].mock_calls, [])
         self.assertFalse(self.app.save.called)
 
+    def test_663_pool_set_prepared_snapshots(self):
+        self.app.pools['test-pool'] = unittest.mock.Mock()
+        value = self.call_mgmt_func(b'admin.pool.Set.prepared_snapshots',
+            b'dom0', b'test-pool', b'2')
+        self.assertIsNone(value)
+        self.assertEqual(self.app.pools['test-pool'].mock_calls, [])
+        self.assertEqual(self.app.pools['test-pool'].prepared_snapshots, 2)
+        self.app.save.assert_called_once_with(full=True)
+
+    def test_664_pool_set_prepared_snapshots_negative(self):
+        self.app.pools['test-pool'] = unittest.mock.Mock()
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.pool.Set.prepared_snapshots',
+                b'dom0', b'test-pool', b'-2')
+        self.assertEqual(self.app.pools['test-pool'].mock_calls, [])
+        self.assertFalse(self.app.save.called)
+
+    def test_665_pool_set_prepared_snapshots_unsupported(self):
+        self.app.pools['test-pool'] = unittest.mock.Mock(
+            spec=qubes.storage.Pool)
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.pool.Set.prepared_snapshots',
+                b'dom0', b'test-pool', b'2')
+        self.assertFalse(self.app.save.called)
+
+    def test_666_executor_info(self):
+        with unittest.mock.patch('qubes.executors.metrics',
+                return_value={'storage-test-pool': {
+                    'max_workers': 4, 'queued': 1, 'running': 4,
+                    'completed': 10, 'avg_wait_time': 0.5,
+                    'max_wait_time': 2.0}}):
+            value = self.call_mgmt_func(b'admin.executor.Info', b'dom0')
+        self.assertEqual(value,
+            'storage-test-pool avg_wait_time=0.5 completed=10 '
+            'max_wait_time=2.0 max_workers=4 queued=1 running=4\n')
+        self.assertFalse(self.app.save.called)
+
+    def test_667_store_flush(self):
+        with unittest.mock.patch.object(self.app, 'flush_save') as flush_save:
+            value = self.call_mgmt_func(b'admin.store.Flush', b'dom0')
+        self.assertIsNone(value)
+        flush_save.assert_called_once_with()
+        self.assertFalse(self.app.save.called)
+
     def test_670_vm_volume_set_revisions_to_keep(self):
         self.vm.volumes = unittest.mock.MagicMock()
         volumes_conf = {
@@ -2423,7 +2795,7 @@ class TC_00_VMs(AdminAPITestCase):
             [unittest.mock.call.keys(),
             ('__getitem__', ('private',), {})])
         self.assertEqual(self.vm.volumes['private'].revisions_to_keep, 2)
-        self.app.save.assert_called_once_with()
+        self.app.save.assert_called_once_with(full=True)
 
     def test_671_vm_volume_set_revisions_to_keep_negative(self):
         self.vm.volumes = unittest.mock.MagicMock()
@@ -2461,7 +2833,7 @@ class TC_00_VMs(AdminAPITestCase):
             [unittest.mock.call.keys(),
             ('__getitem__', ('private',), {})])
         self.assertEqual(self.vm.volumes['private'].rw, True)
-        self.app.save.assert_called_once_with()
+        self.app.save.assert_called_once_with(full=True)
 
     def test_681_vm_volume_set_rw_invalid(self):
         self.vm.volumes = unittest.mock.MagicMock()
@@ -2481,6 +2853,7 @@ class TC_00_VMs(AdminAPITestCase):
             b'admin.vm.Remove',
             b'admin.vm.property.List',
             b'admin.vm.property.Get',
+            b'admin.vm.property.GetAll',
             b'admin.vm.property.Help',
             #b'admin.vm.property.HelpRst',
             b'admin.vm.property.Reset',
@@ -2536,8 +2909,10 @@ class TC_00_VMs(AdminAPITestCase):
     def test_991_vm_unexpected_argument(self):
         methods_with_no_argument = [
             b'admin.vm.List',
+            b'admin.vm.ListData',
             b'admin.vm.Remove',
             b'admin.vm.property.List',
+            b'admin.vm.property.GetAll',
             b'admin.vm.feature.List',
             b'admin.vm.tag.List',
             b'admin.vm.firewall.Get',
@@ -2578,12 +2953,14 @@ class TC_00_VMs(AdminAPITestCase):
     def test_992_dom0_unexpected_payload(self):
         methods_with_no_payload = [
             b'admin.vmclass.List',
+            b'admin.api.List',
             b'admin.vm.List',
             b'admin.label.List',
             b'admin.label.Get',
             b'admin.label.Remove',
             b'admin.property.List',
             b'admin.property.Get',
+            b'admin.property.GetAll',
             b'admin.property.Help',
             #b'admin.property.HelpRst',
             b'admin.property.Reset',
@@ -2619,6 +2996,7 @@ class TC_00_VMs(AdminAPITestCase):
     def test_993_dom0_unexpected_argument(self):
         methods_with_no_argument = [
             b'admin.vmclass.List',
+            b'admin.api.List',
             b'admin.vm.List',
             b'admin.label.List',
             b'admin.property.List',
@@ -2654,6 +3032,7 @@ class TC_00_VMs(AdminAPITestCase):
         # because of invalid destination, not invalid arguments
         methods_for_dom0_only = [
             b'admin.vmclass.List',
+            b'admin.api.List',
             b'admin.vm.Create.AppVM',
             b'admin.vm.CreateInPool.AppVM',
             b'admin.label.List',
@@ -2679,6 +3058,8 @@ class TC_00_VMs(AdminAPITestCase):
             #b'admin.pool.volume.Resize',
             b'admin.backup.Execute',
             b'admin.backup.Info',
+            b'admin.executor.Info',
+            b'admin.store.Flush',
         ]
         # make sure also no methods on actual VM gets called
         vm_mock = unittest.mock.MagicMock()
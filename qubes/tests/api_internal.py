@@ -18,7 +18,13 @@
 # You should have received a copy of the GNU General Public License along
 # with this program; if not, see <http://www.gnu.org/licenses/>.
 import asyncio
+import json
+import os
+import shutil
+import tempfile
+
 import qubes.api.internal
+import qubes.storage.manifest
 import qubes.tests
 import qubes.vm.adminvm
 from unittest import mock
@@ -162,3 +168,202 @@ class TC_00_API_Misc(qubes.tests.QubesTestCase):
             no_qrexec_vm.mock_calls)
         self.assertIn(('resume', (), {}),
             no_qrexec_vm.mock_calls)
+
+    def test_010_volume_import_progress(self):
+        self.dest.volumes = {'private': mock.Mock(size=4096)}
+        ret = self.call_mgmt_func(b'internal.vm.volume.ImportProgress',
+            b'private', b'1024 512')
+        self.assertIsNone(ret)
+        self.dest.fire_event.assert_called_once_with(
+            'domain-volume-import-progress', volume='private', size=4096,
+            transferred=1024, rate=512)
+
+    def test_011_volume_export_progress(self):
+        self.dest.volumes = {'private': mock.Mock(size=4096)}
+        ret = self.call_mgmt_func(b'internal.vm.volume.ExportProgress',
+            b'private', b'4096 2048')
+        self.assertIsNone(ret)
+        self.dest.fire_event.assert_called_once_with(
+            'domain-volume-export-progress', volume='private', size=4096,
+            transferred=4096, rate=2048)
+
+    def test_012_volume_progress_invalid_volume(self):
+        self.dest.volumes = {'private': mock.Mock(size=4096)}
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'internal.vm.volume.ImportProgress',
+                b'root', b'1024 512')
+        self.assertFalse(self.dest.fire_event.called)
+
+    def setup_import_end(self):
+        self.dest.dir_path = tempfile.mkdtemp(prefix='test-import-end-')
+        self.addCleanup(shutil.rmtree, self.dest.dir_path)
+        volume_path = os.path.join(self.dest.dir_path, 'private.img')
+        with open(volume_path, 'wb') as volume_io:
+            volume_io.write(b'data')
+        self.dest.volumes = {'private': mock.Mock(**{
+            'export.return_value': volume_path,
+            'data_stamp.return_value': None})}
+        self.dest.storage.import_data_end = mock_coro(
+            self.dest.storage.import_data_end)
+        return volume_path, os.path.join(self.dest.dir_path,
+            'private.manifest')
+
+    def test_020_import_end_with_manifest(self):
+        volume_path, manifest_path = self.setup_import_end()
+        with open(manifest_path + '-import', 'wb') as manifest_io:
+            manifest_io.write(b'manifest')
+        self.call_mgmt_func(b'internal.vm.volume.ImportEnd', b'private',
+            b'ok')
+        self.assertFalse(os.path.exists(manifest_path + '-import'))
+        fd = qubes.storage.manifest.open_stored(manifest_path,
+            qubes.storage.manifest.stamp(self.dest.volumes['private']))
+        self.assertIsNotNone(fd)
+        with open(fd, 'rb') as manifest_io:
+            self.assertEqual(manifest_io.read(), b'manifest')
+
+    def test_021_import_end_with_manifest_fail(self):
+        _, manifest_path = self.setup_import_end()
+        with open(manifest_path + '-import', 'wb') as manifest_io:
+            manifest_io.write(b'manifest')
+        with self.assertRaises(qubes.exc.QubesException):
+            self.call_mgmt_func(b'internal.vm.volume.ImportEnd', b'private',
+                b'fail')
+        self.assertFalse(os.path.exists(manifest_path + '-import'))
+        self.assertFalse(os.path.exists(manifest_path))
+
+    def test_022_import_end_drops_manifest(self):
+        _, manifest_path = self.setup_import_end()
+        with open(manifest_path, 'wb') as manifest_io:
+            manifest_io.write(b'stamp\nmanifest')
+        self.call_mgmt_func(b'internal.vm.volume.ImportEnd', b'private',
+            b'ok')
+        self.assertFalse(os.path.exists(manifest_path))
+
+
+class TC_10_SystemInfo(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = qubes.Qubes('/tmp/qubestest.xml', load=False,
+            offline_mode=True)
+        self.addCleanup(self.cleanup_qubes)
+        self.app.load_initial_values()
+        self.template = self.app.add_new_vm('TemplateVM',
+            name='test-template', label='green')
+        self.appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'system-info')
+
+    def cleanup_qubes(self):
+        self.app.close()
+        del self.app
+        del self.template
+        del self.appvm
+
+    def assertSystemInfo(self, system_info):
+        self.assertEqual(json.loads(system_info.data), {'domains': {
+            domain.name: qubes.api.internal.SystemInfo.domain_info(domain)
+            for domain in self.app.domains}})
+
+    def read_published(self):
+        with open(self.path) as info_file:
+            generation = int(info_file.readline())
+            return generation, json.load(info_file)
+
+    def test_000_initial(self):
+        system_info = qubes.api.internal.SystemInfo(self.app)
+        self.addCleanup(system_info.close)
+        self.assertSystemInfo(system_info)
+        self.assertEqual(
+            json.loads(system_info.data)['domains']['test-vm'], {
+                'tags': [],
+                'type': 'AppVM',
+                'template_for_dispvms': False,
+                'default_dispvm': None,
+                'icon': 'appvm-red',
+            })
+
+    def test_001_domain_add_delete(self):
+        system_info = qubes.api.internal.SystemInfo(self.app)
+        self.addCleanup(system_info.close)
+        generation = system_info.generation
+        vm = self.app.add_new_vm('AppVM', name='test-vm2',
+            template=self.template, label='blue')
+        self.assertGreater(system_info.generation, generation)
+        self.assertSystemInfo(system_info)
+        generation = system_info.generation
+        del self.app.domains[vm]
+        self.assertGreater(system_info.generation, generation)
+        self.assertSystemInfo(system_info)
+        self.assertNotIn('test-vm2', json.loads(system_info.data)['domains'])
+
+    def test_002_domain_changes(self):
+        system_info = qubes.api.internal.SystemInfo(self.app)
+        self.addCleanup(system_info.close)
+        generation = system_info.generation
+        self.appvm.template_for_dispvms = True
+        self.appvm.tags.add('tag1')
+        self.assertEqual(system_info.generation, generation + 2)
+        self.assertSystemInfo(system_info)
+        self.appvm.tags.remove('tag1')
+        self.assertSystemInfo(system_info)
+        # unrelated events do not change it
+        generation = system_info.generation
+        self.appvm.fire_event('domain-feature-set:test', feature='test',
+            value='1')
+        self.assertEqual(system_info.generation, generation)
+        # neither do changes of properties not included in the data...
+        self.appvm.qrexec_timeout = 120
+        # nor setting the value already there
+        self.appvm.template_for_dispvms = True
+        self.assertEqual(system_info.generation, generation)
+
+    def test_003_default_dispvm(self):
+        system_info = qubes.api.internal.SystemInfo(self.app)
+        self.addCleanup(system_info.close)
+        self.appvm.template_for_dispvms = True
+        # changes default_dispvm of all domains using the default
+        self.app.default_dispvm = self.appvm
+        self.assertSystemInfo(system_info)
+        self.assertEqual(json.loads(system_info.data)
+            ['domains']['test-template']['default_dispvm'], 'test-vm')
+        del self.app.default_dispvm
+        self.assertSystemInfo(system_info)
+
+    def test_010_publish(self):
+        system_info = qubes.api.internal.SystemInfo(self.app, self.path,
+            group=None)
+        self.addCleanup(system_info.close)
+        self.assertEqual(self.read_published(),
+            (system_info.generation, json.loads(system_info.data)))
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+        self.appvm.template_for_dispvms = True
+        self.appvm.tags.add('tag1')
+        # published right away, before the API call returns
+        generation, data = self.read_published()
+        self.assertEqual(generation, system_info.generation)
+        self.assertEqual(data['domains']['test-vm']['tags'], ['tag1'])
+
+    def test_011_publish_restart(self):
+        system_info = qubes.api.internal.SystemInfo(self.app, self.path,
+            group=None)
+        generation = system_info.generation
+        self.appvm.template_for_dispvms = True
+        system_info.close()
+        self.assertFalse(os.path.exists(self.path))
+        # left by a previous instance, which crashed
+        with open(self.path, 'w') as info_file:
+            info_file.write('{}\n{{}}'.format(generation + 10))
+        self.assertEqual(
+            qubes.api.internal.unpublish_system_info(self.path),
+            generation + 10)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(
+            qubes.api.internal.unpublish_system_info(self.path), 0)
+        # numbering continues from the snapshot of the previous instance
+        system_info = qubes.api.internal.SystemInfo(self.app, self.path,
+            group=None, generation=generation + 10)
+        self.addCleanup(system_info.close)
+        self.assertGreater(system_info.generation, generation + 10)
+        self.assertEqual(self.read_published()[0], system_info.generation)
@@ -20,8 +20,10 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import asyncio
 import os
 import unittest.mock as mock
+import uuid
 
 import lxml.etree
 
@@ -252,6 +254,65 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.assertEventFired(self.app, 'domain-delete',
             kwargs={'vm': self.testvm2})
 
+    def test_009_getitem_uuid(self):
+        self.testvm2.uuid = uuid.uuid4()
+        self.vms.add(self.testvm1)
+        self.vms.add(self.testvm2)
+
+        self.assertIs(self.vms[self.testvm2.uuid], self.testvm2)
+        self.assertIs(self.vms[self.testvm2], self.testvm2)
+        with self.assertRaises(KeyError):
+            self.vms[uuid.uuid4()]
+
+    def test_010_uuid_set_after_add(self):
+        class TestVMLateUUID(qubes.tests.init.TestVM):
+            uuid = qubes.property('uuid', type=uuid.UUID)
+
+        testvm3 = TestVMLateUUID(None, None, qid=3, name='testvm3')
+        self.addCleanup(testvm3.close)
+        # like while loading qubes.xml - VM gets its UUID on domain-load
+        self.vms.add(testvm3, _enable_events=False)
+        testvm3.uuid = uuid.uuid4()
+
+        self.assertIs(self.vms[testvm3.uuid], testvm3)
+
+    def test_011_rename(self):
+        self.app.domains = self.vms
+        self.testvm1.app = self.app
+        self.vms.add(self.testvm1)
+        self.vms.add(self.testvm2)
+
+        self.testvm1.name = 'testvm3'
+
+        self.assertIs(self.vms['testvm3'], self.testvm1)
+        self.assertIn('testvm3', self.vms)
+        self.assertNotIn('testvm1', self.vms)
+        with self.assertRaises(KeyError):
+            self.vms['testvm1']
+        self.assertEqual(list(self.vms.names()), ['testvm2', 'testvm3'])
+        self.assertEqual(list(self.vms), [self.testvm2, self.testvm1])
+
+    def test_012_vms_cache_invalidated(self):
+        self.vms.add(self.testvm2)
+        self.assertEqual(list(self.vms), [self.testvm2])
+
+        self.vms.add(self.testvm1)
+        self.assertEqual(list(self.vms), [self.testvm1, self.testvm2])
+
+        del self.vms['testvm1']
+        self.assertEqual(list(self.vms), [self.testvm2])
+
+    def test_013_dict_direct_modification(self):
+        self.vms.add(self.testvm1)
+        self.vms._dict[2] = self.testvm2
+
+        self.assertIs(self.vms['testvm2'], self.testvm2)
+        self.assertEqual(list(self.vms), [self.testvm1, self.testvm2])
+
+        del self.vms._dict[1]
+        self.assertNotIn('testvm1', self.vms)
+        self.assertNotIn(self.testvm1, self.vms)
+
     def test_100_get_new_unused_qid(self):
         self.vms.add(self.testvm1)
         self.vms.add(self.testvm2)
@@ -449,6 +510,10 @@ class TC_90_Qubes(qubes.tests.QubesTestCase):
             os.unlink('/tmp/qubestest.xml')
         except:
             pass
+        try:
+            os.unlink('/tmp/qubestest.xml.journal')
+        except:
+            pass
         super().tearDown()
 
     def setUp(self):
@@ -567,6 +632,201 @@ class TC_90_Qubes(qubes.tests.QubesTestCase):
             with self.assertRaises(qubes.exc.QubesVMInUseError):
                 del self.app.domains[appvm]
 
+    def test_300_dependent_vms(self):
+        netvm = self.app.add_new_vm('AppVM', name='test-netvm',
+            template=self.template, provides_network=True, netvm=None,
+            label='red')
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, netvm=netvm, label='red')
+        self.assertEqual(list(netvm.connected_vms), [appvm])
+        self.assertEqual(list(self.template.appvms), [netvm, appvm])
+        self.assertEqual(self.app.domains.get_vms_based_on(self.template),
+            {netvm, appvm})
+
+        appvm.netvm = None
+        self.assertEqual(list(netvm.connected_vms), [])
+        del appvm.netvm
+        self.assertEqual(self.app.domains.get_vms_connected_to(netvm), set())
+
+        self.app.default_netvm = netvm
+        self.assertEqual(list(netvm.connected_vms), [appvm])
+        self.assertEqual(self.app.domains.get_vms_connected_to(netvm),
+            {appvm})
+
+        with mock.patch.object(self.app, 'vmm'):
+            self.app.default_netvm = None
+            del self.app.domains[appvm]
+        self.assertEqual(list(netvm.connected_vms), [])
+        self.assertEqual(list(self.template.appvms), [netvm])
+
+    def test_301_dependent_vms_default_dispvm(self):
+        dispvm = self.app.add_new_vm('AppVM', name='test-dvm',
+            template=self.template, template_for_dispvms=True,
+            label='red')
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.assertEqual(
+            self.app.domains.get_dependent_vms(dispvm, 'default_dispvm'), [])
+        self.app.default_dispvm = dispvm
+        self.assertIn(appvm,
+            self.app.domains.get_dependent_vms(dispvm, 'default_dispvm'))
+        appvm.default_dispvm = None
+        self.assertNotIn(appvm,
+            self.app.domains.get_dependent_vms(dispvm, 'default_dispvm'))
+
+    def save_with_journal(self):
+        # no kernels installed in test environment
+        self.app.default_kernel = None
+        self.app.save()
+        self.app.use_journal = True
+
+    def load_copy(self):
+        app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True)
+        self.addCleanup(app.close)
+        return app
+
+    def test_400_journal(self):
+        self.save_with_journal()
+        with open('/tmp/qubestest.xml', 'rb') as xml_file:
+            orig_xml = xml_file.read()
+
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.app.save()
+        appvm.tags.add('test-tag')
+        appvm.features['test-feature'] = '1'
+        self.app.save()
+        self.assertTrue(os.path.exists('/tmp/qubestest.xml.journal'))
+        with open('/tmp/qubestest.xml', 'rb') as xml_file:
+            self.assertEqual(xml_file.read(), orig_xml)
+
+        app2 = self.load_copy()
+        self.assertIn('test-vm', app2.domains)
+        self.assertIn('test-tag', app2.domains['test-vm'].tags)
+        self.assertEqual(app2.domains['test-vm'].features['test-feature'],
+            '1')
+        self.assertEqual(app2.domains['test-vm'].template.name,
+            self.template.name)
+
+        with mock.patch.object(self.app, 'vmm'):
+            del self.app.domains['test-vm']
+        self.app.save()
+        self.assertNotIn('test-vm', self.load_copy().domains)
+
+    def test_401_journal_compact(self):
+        self.save_with_journal()
+        self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.app.save()
+        self.assertTrue(os.path.exists('/tmp/qubestest.xml.journal'))
+
+        # global property change is not journaled
+        self.app.default_template = self.template
+        self.app.save()
+        self.assertFalse(os.path.exists('/tmp/qubestest.xml.journal'))
+        self.assertIn('test-vm', self.load_copy().domains)
+
+        self.app.journal_max_size = 0
+        self.app.domains['test-vm'].tags.add('test-tag')
+        self.app.save()
+        self.assertFalse(os.path.exists('/tmp/qubestest.xml.journal'))
+        self.assertIn('test-tag', self.load_copy().domains['test-vm'].tags)
+
+    def test_402_journal_torn_write(self):
+        self.save_with_journal()
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.app.save()
+        with open('/tmp/qubestest.xml.journal', 'ab') as journal:
+            journal.write(b'100 0\n<changes>')
+
+        self.assertIn('test-vm', self.load_copy().domains)
+
+        appvm.tags.add('test-tag')
+        self.app.save()
+        self.assertIn('test-tag', self.load_copy().domains['test-vm'].tags)
+
+    def test_403_journal_stale(self):
+        self.save_with_journal()
+        self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.app.save()
+        with open('/tmp/qubestest.xml.journal', 'rb') as journal:
+            stale_journal = journal.read()
+        with mock.patch.object(self.app, 'vmm'):
+            del self.app.domains['test-vm']
+        self.app.use_journal = False
+        self.app.save()
+
+        # like after a crash between writing qubes.xml and removing journal
+        with open('/tmp/qubestest.xml.journal', 'wb') as journal:
+            journal.write(stale_journal)
+        self.assertNotIn('test-vm', self.load_copy().domains)
+
+    def test_404_journal_untracked_change(self):
+        self.save_with_journal()
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        self.app.save()
+        appvm.tags.add('test-tag')
+        # fires no event, like admin.label.Create
+        self.app.labels[9] = qubes.Label(9, '0x123456', 'test-label')
+        self.app.save(full=True)
+        self.assertFalse(os.path.exists('/tmp/qubestest.xml.journal'))
+        app2 = self.load_copy()
+        self.assertIn('test-tag', app2.domains['test-vm'].tags)
+        self.assertIn(9, app2.labels)
+
+    def test_410_save_delayed(self):
+        self.app.default_kernel = None
+        self.app.save_delay = 0.1
+        with mock.patch.object(self.app, '_save_store') as mock_save:
+            self.app.save()
+            self.app.add_new_vm('AppVM', name='test-vm',
+                template=self.template, label='red')
+            self.app.save()
+            self.assertFalse(mock_save.called)
+            self.loop.run_until_complete(asyncio.sleep(0.3))
+            mock_save.assert_called_once_with()
+
+    def test_411_save_delayed_max_delay(self):
+        self.app.default_kernel = None
+        self.app.save_delay = 0.2
+        self.app.save_max_delay = 0.3
+        with mock.patch.object(self.app, '_save_store') as mock_save:
+            for _ in range(5):
+                self.app.save()
+                self.loop.run_until_complete(asyncio.sleep(0.1))
+            mock_save.assert_called_once_with()
+
+    def test_412_save_delayed_sync(self):
+        self.app.default_kernel = None
+        self.app.save_delay = 0.1
+        with mock.patch.object(self.app, '_save_store') as mock_save:
+            self.app.save()
+            self.app.save(sync=True)
+            mock_save.assert_called_once_with()
+            self.app.save()
+            self.app.flush_save()
+            self.assertEqual(mock_save.call_count, 2)
+            self.app.flush_save()
+            self.loop.run_until_complete(asyncio.sleep(0.2))
+            self.assertEqual(mock_save.call_count, 2)
+
+    def test_413_save_delayed_journal(self):
+        self.save_with_journal()
+        self.app.save_delay = 0.1
+        self.app.domains[self.template.qid].tags.add('test-tag')
+        self.app.save()
+        # change not firing any event, cannot be journaled
+        self.app.labels[9] = qubes.Label(9, '0x000000', 'test-label')
+        self.app.save(full=True)
+        self.loop.run_until_complete(asyncio.sleep(0.3))
+        self.assertFalse(os.path.exists('/tmp/qubestest.xml.journal'))
+        app2 = self.load_copy()
+        self.assertIn(9, app2.labels)
+        self.assertIn('test-tag', app2.domains[self.template.name].tags)
+
     @qubes.tests.skipUnlessGit
     def test_900_example_xml_in_doc(self):
         self.assertXMLIsValid(
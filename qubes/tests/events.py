@@ -191,3 +191,67 @@ class TC_00_Emitter(qubes.tests.QubesTestCase):
         self.assertEqual(testevent_fired[0], 4)
         emitter.fire_event('testevent')
         self.assertEqual(testevent_fired[0], 4)
+
+    def test_007_handlers_changed_after_fire(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            def on_testevent_1(self, event):
+                yield 'testevent_1'
+
+        def on_testevent_2(subject, event):
+            yield 'testevent_2'
+
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+        self.assertEqual(emitter.fire_event('testevent'), ['testevent_1'])
+
+        emitter.add_handler('test*', on_testevent_2)
+        self.assertEqual(emitter.fire_event('testevent'),
+            ['testevent_1', 'testevent_2'])
+
+        emitter.remove_handler('test*', on_testevent_2)
+        self.assertEqual(emitter.fire_event('testevent'), ['testevent_1'])
+
+    def test_008_class_handlers_changed_after_fire(self):
+        class TestEmitter(qubes.events.Emitter):
+            pass
+
+        class TestEmitterSubclass(TestEmitter):
+            pass
+
+        def on_testevent(subject, event):
+            yield 'testevent'
+
+        emitter = TestEmitterSubclass()
+        emitter.events_enabled = True
+        self.assertEqual(emitter.fire_event('testevent'), [])
+
+        # like extensions do
+        TestEmitter.__handlers__['testevent'].add(on_testevent)
+        qubes.events.invalidate_dispatch_tables()
+        self.assertEqual(emitter.fire_event('testevent'), ['testevent'])
+
+    def test_009_dispatch_tables_bounded(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('domain-feature-set:*')
+            def on_feature_set(self, event, feature):
+                # pylint: disable=no-self-use,unused-argument
+                yield feature
+
+        def on_feature_set(subject, event, feature):
+            # pylint: disable=unused-argument
+            yield 'instance'
+
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+        emitter.add_handler('domain-feature-set:*', on_feature_set)
+        for i in range(2000):
+            feature = 'feature{}'.format(i)
+            self.assertEqual(emitter.fire_event(
+                'domain-feature-set:' + feature, feature=feature),
+                [feature, 'instance'])
+        # pylint: disable=protected-access
+        self.assertLessEqual(len(TestEmitter._dispatch_table),
+            qubes.events.CLASS_DISPATCH_TABLE_SIZE)
+        self.assertLessEqual(len(emitter._instance_dispatch_table),
+            qubes.events.INSTANCE_DISPATCH_TABLE_SIZE)
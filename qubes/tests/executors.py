@@ -0,0 +1,94 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+import concurrent.futures
+import threading
+import unittest.mock
+
+import qubes.executors
+import qubes.tests
+
+
+class TC_00_Executors(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        patch = unittest.mock.patch.multiple(qubes.executors,
+            _max_workers=dict(qubes.executors.DEFAULT_MAX_WORKERS),
+            _executors={})
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(qubes.executors.shutdown)
+
+    def test_000_get(self):
+        executor = qubes.executors.get('qmemman')
+        self.assertIs(qubes.executors.get('qmemman'), executor)
+        self.assertEqual(executor.max_workers,
+            qubes.executors.DEFAULT_MAX_WORKERS['qmemman'])
+        pool_executor = qubes.executors.get('storage', 'storage-pool1')
+        self.assertIsNot(pool_executor,
+            qubes.executors.get('storage', 'storage-pool2'))
+        self.assertEqual(pool_executor.subsystem, 'storage')
+
+    def test_001_configure(self):
+        executor = qubes.executors.get('libvirt')
+        qubes.executors.configure('libvirt', 1)
+        new_executor = qubes.executors.get('libvirt')
+        self.assertIsNot(new_executor, executor)
+        self.assertEqual(new_executor.max_workers, 1)
+        with self.assertRaises(KeyError):
+            qubes.executors.configure('no-such-subsystem', 1)
+
+    def test_002_metrics(self):
+        qubes.executors.configure('storage', 1)
+        executor = qubes.executors.get('storage', 'storage-pool1')
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            return release.wait()
+
+        first = executor.submit(block)
+        started.wait()
+        second = executor.submit(lambda: 42)
+        third = executor.submit(lambda: 43)
+        self.assertTrue(third.cancel())
+        metrics = executor.metrics
+        self.assertEqual(metrics['queued'], 1)
+        self.assertEqual(metrics['running'], 1)
+        release.set()
+        self.assertTrue(first.result())
+        self.assertEqual(second.result(), 42)
+        metrics = qubes.executors.metrics()['storage-pool1']
+        self.assertEqual(metrics['queued'], 0)
+        self.assertEqual(metrics['running'], 0)
+        self.assertEqual(metrics['completed'], 2)
+        self.assertEqual(metrics['max_workers'], 1)
+        self.assertGreater(metrics['max_wait_time'], 0)
+
+    def test_003_python35_signature(self):
+        # Python 3.5 ThreadPoolExecutor accepts only max_workers
+        orig_init = concurrent.futures.ThreadPoolExecutor.__init__
+
+        def init(self, max_workers=None):
+            orig_init(self, max_workers=max_workers)
+
+        with unittest.mock.patch.object(concurrent.futures.ThreadPoolExecutor,
+                '__init__', init):
+            executor = qubes.executors.get('qmemman')
+        self.assertEqual(executor.name, 'qmemman')
+        self.assertEqual(executor.submit(lambda: 42).result(), 42)
@@ -21,13 +21,16 @@
 #
 
 import unittest
+import unittest.mock
 import uuid
 
 import lxml.etree
+import pkg_resources
 
 import qubes
 import qubes.app
 import qubes.events
+import qubes.utils
 import qubes.vm
 
 import qubes.tests
@@ -456,3 +459,48 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
 
 #   def test_201_get_vms_connected_to(self):
 #       pass
+
+
+class TC_40_EntryPoints(qubes.tests.QubesTestCase):
+    def tearDown(self):
+        qubes.utils.refresh_entry_points()
+        super().tearDown()
+
+    def test_000_iter_entry_points(self):
+        with unittest.mock.patch('pkg_resources.iter_entry_points',
+                wraps=pkg_resources.iter_entry_points) as mock_iter:
+            qubes.utils.refresh_entry_points()
+            self.assertIn('testclass', [ep.name for ep in
+                qubes.utils.iter_entry_points('qubes.devices')])
+            self.assertEqual([ep.name for ep in
+                qubes.utils.iter_entry_points('qubes.devices', 'testclass')],
+                ['testclass'])
+            # the group is scanned only once
+            mock_iter.assert_called_once_with('qubes.devices')
+
+            qubes.utils.refresh_entry_points()
+            list(qubes.utils.iter_entry_points('qubes.devices'))
+            self.assertEqual(mock_iter.call_count, 2)
+
+    def test_001_get_entry_point_one(self):
+        devclass = qubes.utils.get_entry_point_one('qubes.devices',
+            'testclass')
+        self.assertEqual(devclass.__name__, 'TestDevice')
+        with unittest.mock.patch('pkg_resources.iter_entry_points') \
+                as mock_iter:
+            self.assertIs(
+                qubes.utils.get_entry_point_one('qubes.devices', 'testclass'),
+                devclass)
+            self.assertFalse(mock_iter.called)
+        with self.assertRaises(KeyError):
+            qubes.utils.get_entry_point_one('qubes.devices', 'no-such-class')
+
+    def test_002_substitute_entry_points(self):
+        self.assertNotIn('test', [ep.name for ep in
+            qubes.utils.iter_entry_points('qubes.storage')])
+        with qubes.tests.substitute_entry_points('qubes.storage',
+                'qubes.tests.storage'):
+            self.assertIn('test', [ep.name for ep in
+                qubes.utils.iter_entry_points('qubes.storage')])
+        self.assertNotIn('test', [ep.name for ep in
+            qubes.utils.iter_entry_points('qubes.storage')])
@@ -16,7 +16,13 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
+import asyncio
+import concurrent.futures
+import json
+import os
 import shutil
+import tempfile
+import threading
 import unittest.mock
 import qubes.log
 import qubes.storage
@@ -164,3 +170,329 @@ class TC_00_Pool(QubesTestCase):
         self.loop.run_until_complete(vm.create_on_disk(pool=pool))
         with self.assertRaises(qubes.exc.QubesPoolInUseError):
             self.loop.run_until_complete(self.app.remove_pool(pool_name))
+
+
+class TC_10_SnapshotReserve(QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.prepared = 0
+        self.discarded = []
+        self.reserve = qubes.storage.SnapshotReserve(2,
+            self.prepare, self.discard)
+        self.reserve.refill_delay = 0
+        self.addCleanup(self.reserve.close)
+        self.volume = unittest.mock.Mock(vid='vm-template-root')
+        self.prepare_allowed = asyncio.Event()
+        self.prepare_allowed.set()
+
+    @asyncio.coroutine
+    def prepare(self, volume):
+        self.prepared += 1
+        snapshot = '{}-{}'.format(volume.vid, self.prepared)
+        yield from self.prepare_allowed.wait()
+        return snapshot
+
+    @asyncio.coroutine
+    def discard(self, volume, snapshots):
+        self.discarded.append((volume.vid, snapshots))
+
+    def refill(self):
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+    def test_000_claim(self):
+        self.assertIsNone(self.reserve.claim(self.volume))
+        self.refill()
+        # leftovers from a previous run are removed first
+        self.assertEqual(self.discarded, [('vm-template-root', None)])
+        self.assertEqual(self.reserve.snapshots,
+            {'vm-template-root': ['vm-template-root-1', 'vm-template-root-2']})
+        self.assertEqual(self.reserve.claim(self.volume), 'vm-template-root-1')
+        self.refill()
+        self.assertEqual(self.reserve.snapshots,
+            {'vm-template-root': ['vm-template-root-2', 'vm-template-root-3']})
+
+    def test_001_disabled(self):
+        self.reserve.size = 0
+        self.assertIsNone(self.reserve.claim(self.volume))
+        self.refill()
+        self.assertEqual(self.prepared, 0)
+        self.assertEqual(self.reserve.snapshots, {})
+
+    def test_002_invalidate(self):
+        self.reserve.claim(self.volume)
+        self.refill()
+        self.reserve.invalidate(self.volume)
+        self.assertIsNone(self.reserve.claim(self.volume))
+        self.refill()
+        self.assertEqual(self.discarded, [
+            ('vm-template-root', None),
+            ('vm-template-root', ['vm-template-root-1', 'vm-template-root-2']),
+        ])
+        self.assertEqual(self.reserve.snapshots,
+            {'vm-template-root': ['vm-template-root-3', 'vm-template-root-4']})
+
+    def test_003_invalidate_while_preparing(self):
+        self.prepare_allowed.clear()
+        self.reserve.claim(self.volume)
+        self.refill()
+        # first prepare() is in progress
+        self.assertEqual(self.prepared, 1)
+        self.reserve.invalidate(self.volume)
+        self.prepare_allowed.set()
+        self.refill()
+        self.assertIn(('vm-template-root', ['vm-template-root-1']),
+            self.discarded)
+        self.assertNotIn('vm-template-root-1',
+            self.reserve.snapshots['vm-template-root'])
+
+    def test_004_not_while_busy(self):
+        self.reserve.refill_delay = 10
+        self.reserve.claim(self.volume)
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual(self.prepared, 0)
+
+    def test_005_forget(self):
+        self.reserve.claim(self.volume)
+        self.refill()
+        self.assertEqual(self.reserve.forget(self.volume),
+            ['vm-template-root-1', 'vm-template-root-2'])
+        self.assertEqual(self.reserve.snapshots, {})
+
+    def test_006_shrink(self):
+        self.reserve.claim(self.volume)
+        self.refill()
+        self.reserve.set_size(1)
+        self.refill()
+        self.assertEqual(self.reserve.snapshots,
+            {'vm-template-root': ['vm-template-root-1']})
+        self.assertEqual(self.discarded[-1],
+            ('vm-template-root', ['vm-template-root-2']))
+
+
+    def test_007_generation(self):
+        self.assertIsNone(self.reserve.generation(self.volume))
+        self.reserve.claim(self.volume)
+        generation = self.reserve.generation(self.volume)
+        self.assertIsNotNone(generation)
+        self.reserve.invalidate(self.volume)
+        self.assertNotEqual(self.reserve.generation(self.volume), generation)
+        generation = self.reserve.generation(self.volume)
+        self.reserve.forget(self.volume)
+        self.assertIsNone(self.reserve.generation(self.volume))
+        # a volume with the same vid is a different one
+        self.reserve.claim(self.volume)
+        self.assertNotEqual(self.reserve.generation(self.volume), generation)
+        self.assertGreater(self.reserve.generation(self.volume), generation)
+
+
+class TC_11_UsageCache(QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.usage = {'vm-root': 100, 'vm-private': 200}
+        self.measured = []
+        self.cache = qubes.storage.UsageCache(self.measure)
+        self.addCleanup(self.cache.close)
+        self.volumes = [unittest.mock.Mock(vid=vid) for vid in self.usage]
+
+    def measure(self, volume):
+        self.measured.append(volume.vid)
+        return self.usage[volume.vid]
+
+    @asyncio.coroutine
+    def get(self, volume):
+        return self.cache.get(volume)
+
+    def test_000_get(self):
+        root = self.volumes[0]
+        self.assertIsNone(self.cache.timestamp(root))
+        self.assertEqual(self.cache.get(root), 100)
+        self.usage['vm-root'] = 150
+        self.assertEqual(self.cache.get(root), 100)
+        self.assertEqual(self.measured, ['vm-root'])
+        self.assertIsNotNone(self.cache.timestamp(root))
+
+    def test_001_update_forget(self):
+        root = self.volumes[0]
+        self.cache.get(root)
+        self.usage['vm-root'] = 150
+        self.assertEqual(self.cache.update(root), 150)
+        self.assertEqual(self.cache.get(root), 150)
+        self.cache.forget(root)
+        self.assertNotIn(root, self.cache.usage)
+
+    def test_002_stale_rescan(self):
+        for volume in self.volumes:
+            self.cache.get(volume)
+        self.cache.max_age = -1
+        self.usage = {'vm-root': 150, 'vm-private': 250}
+        # the cached value is returned, all volumes get rescanned
+        self.assertEqual(
+            self.loop.run_until_complete(self.get(self.volumes[0])), 100)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(self.cache.usage[self.volumes[1]][0], 250)
+        self.assertEqual(sorted(self.measured),
+            ['vm-private', 'vm-private', 'vm-root', 'vm-root'])
+
+    def test_003_rate_limit(self):
+        root = self.volumes[0]
+        self.cache.get(root)
+        self.cache.max_age = -1
+        self.loop.run_until_complete(self.get(root))
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(self.measured, ['vm-root', 'vm-root'])
+        # next rescan only after min_interval
+        self.loop.run_until_complete(self.get(root))
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(self.measured, ['vm-root', 'vm-root'])
+        self.assertIsNotNone(self.cache._rescan_handle)
+
+    def test_004_stale_without_loop(self):
+        root = self.volumes[0]
+        self.cache.get(root)
+        self.cache.max_age = -1
+        self.usage['vm-root'] = 150
+        self.assertEqual(self.cache.get(root), 150)
+        self.assertIsNone(self.cache._rescan_handle)
+
+    def test_005_rescan_in_pool_executor(self):
+        pool = unittest.mock.Mock(executor=unittest.mock.Mock(
+            wraps=concurrent.futures.ThreadPoolExecutor(1)))
+        self.addCleanup(pool.executor.shutdown)
+        self.cache.pool = pool
+        root = self.volumes[0]
+        self.cache.get(root)
+        self.cache.max_age = -1
+        self.loop.run_until_complete(self.get(root))
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(self.measured, ['vm-root', 'vm-root'])
+        pool.executor.submit.assert_called_once_with(
+            self.cache._measure_all, [root])
+
+
+class TC_12_RevisionJanitor(QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        self.path = os.path.join(test_dir, 'revisions-to-remove')
+        self.removed = []
+        self.remove_allowed = asyncio.Event()
+        self.remove_allowed.set()
+        for name, value in (('delay', 0), ('interval', 0),
+                ('batch_size', 2)):
+            patch = unittest.mock.patch.object(qubes.storage.RevisionJanitor,
+                name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.janitor = self.new_janitor()
+
+    def new_janitor(self):
+        janitor = qubes.storage.RevisionJanitor(self.path, self.remove)
+        self.addCleanup(janitor.close)
+        return janitor
+
+    @asyncio.coroutine
+    def remove(self, revisions):
+        yield from self.remove_allowed.wait()
+        self.removed.append(list(revisions))
+
+    def run_janitor(self):
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+    def test_000_add(self):
+        self.janitor.add(['rev1', 'rev2', 'rev3'])
+        self.assertIn('rev1', self.janitor)
+        self.assertNotIn('rev4', self.janitor)
+        self.run_janitor()
+        self.assertEqual(self.removed, [['rev1', 'rev2'], ['rev3']])
+        self.assertNotIn('rev1', self.janitor)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_001_persistent(self):
+        self.remove_allowed.clear()
+        self.janitor.add(['rev1', 'rev2', 'rev3'])
+        self.run_janitor()
+        # removal of the first batch in progress, qubesd stops
+        self.janitor.close()
+        self.run_janitor()
+        with open(self.path) as queue_file:
+            self.assertEqual(json.load(queue_file), ['rev1', 'rev2', 'rev3'])
+        self.remove_allowed.set()
+        janitor = self.new_janitor()
+        self.assertIn('rev1', janitor)
+        self.run_janitor()
+        self.assertEqual(self.removed, [['rev1', 'rev2'], ['rev3']])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_002_busy(self):
+        with self.janitor.busy():
+            self.janitor.add(['rev1'])
+            self.run_janitor()
+            self.assertEqual(self.removed, [])
+        self.run_janitor()
+        self.assertEqual(self.removed, [['rev1']])
+
+    def test_003_delay(self):
+        self.janitor.delay = 10
+        self.janitor.add(['rev1'])
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual(self.removed, [])
+        self.janitor.close()
+        self.run_janitor()
+
+    def test_004_take(self):
+        self.janitor.delay = 10
+        self.janitor.add(['vm1-rev1', 'vm2-rev1', 'vm1-rev2'])
+        self.assertEqual(
+            self.janitor.take(lambda revision: revision.startswith('vm1-')),
+            ['vm1-rev1', 'vm1-rev2'])
+        self.assertEqual(self.janitor.queue, ['vm2-rev1'])
+        self.assertNotIn('vm1-rev1', self.janitor)
+        with open(self.path) as queue_file:
+            self.assertEqual(json.load(queue_file), ['vm2-rev1'])
+        self.janitor.close()
+        self.run_janitor()
+
+    def test_005_failure(self):
+        self.janitor._remove = unittest.mock.Mock(
+            side_effect=qubes.storage.StoragePoolException('failed'))
+        with self.assertLogs('qubes.storage', 'ERROR'):
+            self.janitor.add(['rev1'])
+            self.run_janitor()
+        # not retried forever
+        self.assertEqual(self.janitor.queue, [])
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TC_13_CopyProgress(QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vm = unittest.mock.Mock()
+        self.progress = qubes.storage.CopyProgress(self.vm, 'root')
+
+    def fired(self):
+        self.loop.run_until_complete(asyncio.sleep(0))
+        return [call[2] for call in self.vm.fire_event.mock_calls]
+
+    def test_000_from_thread(self):
+        thread = threading.Thread(target=self.progress, args=(10, 30))
+        thread.start()
+        thread.join()
+        # fired from the event loop, not the copying thread
+        self.assertFalse(self.vm.fire_event.called)
+        self.assertEqual(self.fired(),
+            [{'volume': 'root', 'copied': 10, 'total': 30}])
+        self.vm.fire_event.assert_called_once_with(
+            'domain-volume-copy-progress', volume='root', copied=10, total=30)
+
+    def test_001_rate_limit(self):
+        self.progress.interval = 10
+        for copied in (10, 20, 30):
+            self.progress(copied, 30)
+        # the last one is always fired, as the copy is done
+        self.assertEqual([kwargs['copied'] for kwargs in self.fired()],
+            [10, 30])
+        # and the next copy starts anew
+        self.progress(5, 30)
+        self.assertEqual([kwargs['copied'] for kwargs in self.fired()],
+            [10, 30, 5])
@@ -190,7 +190,9 @@ class TC_01_FileVolumes(qubes.tests.QubesTestCase):
         self.assertTrue(volume.snap_on_start)
         self.assertFalse(volume.save_on_stop)
         self.assertFalse(volume.rw)
+        self.assertIsNone(volume.usage_timestamp)
         self.assertEqual(volume.usage, 0)
+        self.assertIsInstance(volume.usage_timestamp, int)
         block = volume.block_device()
         assert isinstance(block, qubes.storage.BlockDevice)
         self.assertEqual(block.path,
@@ -360,6 +362,31 @@ class TC_01_FileVolumes(qubes.tests.QubesTestCase):
             volume_data = volume_file.read().strip('\0')
         self.assertNotEqual(volume_data, 'test')
 
+    def test_022_import_data_keep_data(self):
+        config = {
+            'name': 'root',
+            'pool': self.POOL_NAME,
+            'save_on_stop': True,
+            'rw': True,
+            'size': 1024 * 1024,
+        }
+        vm = qubes.tests.storage.TestVM(self)
+        volume = self.app.get_pool(self.POOL_NAME).init_volume(vm, config)
+        volume.create()
+        with open(volume.path, 'r+') as volume_file:
+            volume_file.write('old data')
+        import_path = volume.import_data(keep_data=True)
+        self.assertNotEqual(volume.path, import_path)
+        self.assertEqual(os.path.getsize(import_path), 1024 * 1024)
+        with open(import_path, 'r+') as import_file:
+            self.assertEqual(import_file.read(8), 'old data')
+            import_file.seek(0)
+            import_file.write('new')
+        volume.import_data_end(True)
+        with open(volume.path) as volume_file:
+            volume_data = volume_file.read().strip('\0')
+        self.assertEqual(volume_data, 'new data')
+
     def assertVolumePath(self, vm, dev_name, expected, rw=True):
         # :pylint: disable=invalid-name
         volumes = vm.volumes
@@ -0,0 +1,125 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+''' Tests for the copy engine of the file based storage drivers '''
+
+# pylint: disable=protected-access
+
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import unittest.mock
+
+import qubes.tests
+from qubes.storage import filecopy
+
+MiB = 1024**2
+
+
+class TC_00_FileCopy(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.test_dir = tempfile.mkdtemp(dir='/var/tmp',
+            prefix='test-filecopy-')
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        self.src = os.path.join(self.test_dir, 'src.img')
+        self.dst = os.path.join(self.test_dir, 'dst.img')
+        # data at 0-1MiB and 4-6MiB, hole up to 16MiB
+        self.data = {0: os.urandom(MiB), 4 * MiB: os.urandom(2 * MiB)}
+        with open(self.src, 'wb') as src_io:
+            for offset, data in self.data.items():
+                src_io.seek(offset)
+                src_io.write(data)
+            src_io.truncate(16 * MiB)
+        # exercise the copying code even on filesystems with reflinks
+        for name in ('attempt_ficlone', '_attempt_ficlonerange'):
+            patch = unittest.mock.patch.object(filecopy, name,
+                return_value=False)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def assertCopied(self):
+        with open(self.src, 'rb') as src_io, open(self.dst, 'rb') as dst_io:
+            self.assertEqual(src_io.read(), dst_io.read())
+        # holes of the source are not allocated
+        self.assertLess(os.stat(self.dst).st_blocks * 512, 8 * MiB)
+
+    def test_000_copy(self):
+        self.assertFalse(filecopy.copy_file(self.src, self.dst))
+        self.assertCopied()
+
+    def test_001_extents(self):
+        with open(self.src, 'rb') as src_io:
+            extents = list(filecopy.data_extents(src_io.fileno(), 16 * MiB))
+        self.assertEqual(extents, [(0, MiB), (4 * MiB, 2 * MiB)])
+        self.assertEqual(list(filecopy._chunks(extents, MiB)),
+            [(0, MiB), (4 * MiB, MiB), (5 * MiB, MiB)])
+
+    def test_002_parallel_chunks(self):
+        progress = []
+        copier = filecopy.FileCopy(
+            progress=lambda *args: progress.append(args), threads=3)
+        with unittest.mock.patch.object(filecopy, 'CHUNK_SIZE', 256 * 1024):
+            copier.run(self.src, self.dst)
+        self.assertCopied()
+        self.assertEqual(copier.total, 3 * MiB)
+        self.assertEqual(max(progress), (3 * MiB, 3 * MiB))
+
+    def test_003_buffered_fallback(self):
+        # overwrite some data with zeroes, which should become a hole
+        with open(self.src, 'r+b') as src_io:
+            src_io.seek(4 * MiB)
+            src_io.write(bytes(2 * MiB))
+        copier = filecopy.FileCopy()
+        copier._copy_file_range = False
+        copier.run(self.src, self.dst)
+        self.assertCopied()
+        self.assertLessEqual(os.stat(self.dst).st_blocks * 512, 2 * MiB)
+
+    def test_004_cancel(self):
+        def progress(copied, total):
+            # pylint: disable=unused-argument
+            copier.cancel()
+        copier = filecopy.FileCopy(progress=progress, threads=1)
+        with self.assertRaises(filecopy.CopyCancelled):
+            copier.run(self.src, self.dst)
+        self.assertTrue(copier.cancelled)
+        self.assertLess(copier.copied, copier.total)
+
+    def test_005_cancel_coroutine(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def copy(src, dst):
+            started.set()
+            release.wait()
+            copier.run(src, dst)
+
+        copier = filecopy.FileCopy()
+        task = asyncio.ensure_future(filecopy.run_in_executor(
+            copier, None, copy, self.src, self.dst))
+        self.loop.run_until_complete(
+            self.loop.run_in_executor(None, started.wait))
+        task.cancel()
+        self.loop.call_soon(release.set)
+        with self.assertRaises(asyncio.CancelledError):
+            self.loop.run_until_complete(task)
+        self.assertTrue(copier.cancelled)
+        # the copy did not start after cancelling
+        self.assertFalse(os.path.exists(self.dst))
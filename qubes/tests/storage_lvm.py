@@ -24,8 +24,10 @@
     'volume_group/thin_pool' combination. Pool variables without a prefix
     represent a :py:class:`qubes.storage.lvm.ThinPool`.
 '''
+import json
 import os
 import subprocess
+import sys
 import tempfile
 import unittest
 import unittest.mock
@@ -35,6 +37,7 @@ import asyncio
 import qubes.tests
 import qubes.tests.storage
 import qubes.storage
+import qubes.storage.lvm
 from qubes.storage.lvm import ThinPool, ThinVolume, qubes_lvm
 
 if 'DEFAULT_LVM_POOL' in os.environ.keys():
@@ -83,6 +86,10 @@ class ThinPoolBase(qubes.tests.QubesTestCase):
         ''' Remove the default lvm pool if it was created only for this test '''
         if self.created_pool:
             self.loop.run_until_complete(self.app.remove_pool(self.pool.name))
+        if qubes.storage.lvm.lvm_shell is not None:
+            # do not leave the shell process behind the test
+            self.loop.run_until_complete(qubes.storage.lvm.lvm_shell.stop())
+        qubes.storage.lvm.stop_udev_monitor()
         super(ThinPoolBase, self).tearDown()
 
 
@@ -815,6 +822,33 @@ class TC_00_ThinPool(ThinPoolBase):
 
         self.loop.run_until_complete(volume.remove())
 
+    def test_034_import_data_keep_data(self):
+        ''' Test volume import starting with the current data'''
+        config = {
+            'name': 'root',
+            'pool': self.pool.name,
+            'save_on_stop': True,
+            'rw': True,
+            'revisions_to_keep': 2,
+            'size': qubes.config.defaults['root_img_size'],
+        }
+        vm = qubes.tests.storage.TestVM(self)
+        volume = self.app.get_pool(self.pool.name).init_volume(vm, config)
+        self.loop.run_until_complete(volume.create())
+        with open(volume.path, 'r+b') as volume_file:
+            volume_file.write(b'old data')
+        import_path = self.loop.run_until_complete(
+            volume.import_data(keep_data=True))
+        with open(import_path, 'r+b') as import_file:
+            self.assertEqual(import_file.read(8), b'old data')
+            import_file.seek(0)
+            import_file.write(b'new')
+        self.loop.run_until_complete(volume.import_data_end(True))
+        with open(volume.path, 'rb') as volume_file:
+            self.assertEqual(volume_file.read(8), b'new data')
+
+        self.loop.run_until_complete(volume.remove())
+
     def test_040_volatile(self):
         '''Volatile volume test'''
         config = {
@@ -1062,3 +1096,617 @@ class TC_02_StorageHelpers(ThinPoolBase):
         pool = qubes.storage.search_pool_containing_dir(
             self.app.pools.values(), self.thin_dir.name)
         self.assertEqual(pool, self.pool)
+
+
+# emulates lvm shell: prompt on stdout, JSON report on LVM_REPORT_FD
+FAKE_LVM_SHELL = '''
+import json, os, sys, time
+report_fd = int(os.environ['LVM_REPORT_FD'])
+while True:
+    sys.stdout.write('lvm> ')
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line:
+        break
+    args = line.split()
+    report = {'log': [
+        {'log_type': 'status', 'log_message': 'success',
+            'log_ret_code': '1'}]}
+    if args[0] == 'lvfail':
+        report = {'log': [
+            {'log_type': 'error', 'log_message': 'failed: ' + args[1],
+                'log_ret_code': '0'},
+            {'log_type': 'status', 'log_message': '',
+                'log_ret_code': '5'}]}
+    elif args[0] == 'lvs':
+        report['report'] = [{'lv': [
+            {'vg_name': 'vg', 'pool_lv': 'pool', 'lv_name': 'vol',
+                'lv_size': '1048576', 'data_percent': '50.00',
+                'lv_attr': 'Vwi-a-tz--', 'origin': '', 'lv_uuid': 'uuid1'},
+            {'vg_name': 'vg', 'pool_lv': '', 'lv_name': 'pool',
+                'lv_size': '4194304', 'data_percent': '12.50',
+                'lv_attr': 'twi-aotz--', 'origin': '', 'lv_uuid': 'uuid2'}]}]
+    elif args[0] == 'lvsbig':
+        # larger than the pipe buffer and the reader limits
+        report['report'] = [{'lv': [{'lv_name': 'vol{}'.format(i)}
+            for i in range(100000)]}]
+        sys.stdout.write('  LV\\n' * 100000)
+    elif args[0] == 'lvhang':
+        time.sleep(60)
+    report['args'] = args
+    os.write(report_fd, json.dumps(report, indent=2).encode() + b'\\n')
+'''
+
+
+class TC_03_LvmShell(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.shell = qubes.storage.lvm.LvmShell()
+        self.shell.command = [sys.executable, '-c', FAKE_LVM_SHELL]
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.shell.stop())
+        super().tearDown()
+
+    def test_000_run(self):
+        report = self.loop.run_until_complete(
+            self.shell.run(['lvremove', '-f', 'vg/vol']))
+        self.assertEqual(report['args'], ['lvremove', '-f', 'vg/vol'] +
+            self.shell.report_options)
+        self.assertEqual(qubes.storage.lvm._lvm_report_status(report),
+            (0, b'', b''))
+
+    def test_001_run_concurrent(self):
+        reports = self.loop.run_until_complete(asyncio.gather(*(
+            self.shell.run(['lvremove', '-f', 'vg/vol{}'.format(i)])
+            for i in range(10))))
+        self.assertEqual([report['args'][2] for report in reports],
+            ['vg/vol{}'.format(i) for i in range(10)])
+        # all executed by a single process
+        self.assertIsNotNone(self.shell.process)
+
+    def test_002_run_failed(self):
+        report = self.loop.run_until_complete(
+            self.shell.run(['lvfail', 'vg/vol']))
+        returncode, stdout, stderr = \
+            qubes.storage.lvm._lvm_report_status(report)
+        self.assertNotEqual(returncode, 0)
+        with self.assertRaises(qubes.storage.StoragePoolException) as e:
+            qubes.storage.lvm._process_lvm_output(returncode, stdout, stderr,
+                self.log)
+        self.assertIn('failed: vg/vol', str(e.exception))
+
+    def test_003_start_failed(self):
+        self.shell.command = ['/nonexistent/lvm']
+        with self.assertRaises(qubes.storage.lvm.LvmShellError):
+            self.loop.run_until_complete(
+                self.shell.run(['lvremove', '-f', 'vg/vol']))
+        self.assertTrue(self.shell.failed)
+        with self.assertRaises(qubes.storage.lvm.LvmShellError):
+            self.loop.run_until_complete(
+                self.shell.run(['lvremove', '-f', 'vg/vol']))
+
+    def test_004_unsupported_argument(self):
+        with self.assertRaises(qubes.storage.lvm.LvmShellError):
+            self.loop.run_until_complete(
+                self.shell.run(['lvremove', '-f', 'vg/vol name']))
+        self.assertIsNone(self.shell.process)
+
+    def test_005_run_large_report(self):
+        report = self.loop.run_until_complete(
+            self.shell.run(['lvsbig']))
+        self.assertEqual(len(report['report'][0]['lv']), 100000)
+        # the shell is still usable
+        report = self.loop.run_until_complete(
+            self.shell.run(['lvremove', '-f', 'vg/vol']))
+        self.assertEqual(report['args'][0], 'lvremove')
+
+    def test_006_run_timeout(self):
+        self.shell.timeout = 0.5
+        with self.assertLogs('qubes.storage.lvm.shell', 'WARNING'):
+            with self.assertRaises(qubes.storage.lvm.LvmShellError):
+                self.loop.run_until_complete(self.shell.run(['lvhang']))
+        self.assertTrue(self.shell.failed)
+        self.assertIsNone(self.shell.process)
+
+    def test_010_qubes_lvm_coro(self):
+        with unittest.mock.patch('os.getuid', return_value=0), \
+                unittest.mock.patch.object(qubes.storage.lvm, 'lvm_shell',
+                    self.shell):
+            self.loop.run_until_complete(qubes.storage.lvm.qubes_lvm_coro(
+                ['remove', 'vg/vol'], self.log))
+            cache = self.loop.run_until_complete(
+                qubes.storage.lvm.init_cache_coro(self.log))
+        self.assertEqual(cache, {
+            'vg/vol': {'size': 1048576, 'usage': 524288, 'pool_lv': 'pool',
+                'attr': 'Vwi-a-tz--', 'origin': '', 'uuid': 'uuid1'},
+            'vg/pool': {'size': 4194304, 'usage': 524288, 'pool_lv': '',
+                'attr': 'twi-aotz--', 'origin': '', 'uuid': 'uuid2'},
+        })
+
+
+class TC_04_Cache(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.scans = []
+        self.scan_event = asyncio.Event()
+        self.volumes = {
+            'vg/pool': {'size': 4194304, 'usage': 524288, 'pool_lv': '',
+                'attr': 'twi-aotz--', 'origin': ''},
+            'vg/vm-test-root': {'size': 1048576, 'usage': 524288,
+                'pool_lv': 'pool', 'attr': 'Vwi-a-tz--', 'origin': ''},
+            'vg2/other': {'size': 1048576, 'usage': 0,
+                'pool_lv': 'pool', 'attr': 'Vwi-a-tz--', 'origin': ''},
+        }
+        for name, func in (('init_cache', self.init_cache),
+                ('init_cache_coro', self.init_cache_coro)):
+            patch = unittest.mock.patch('qubes.storage.lvm.' + name, func)
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.cache = qubes.storage.lvm.LvmCache(dict(self.volumes))
+        patch = unittest.mock.patch.object(qubes.storage.lvm, 'size_cache',
+            self.cache)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def init_cache(self, log=None, vids=None):
+        # pylint: disable=unused-argument
+        self.scans.append(vids)
+        return {vid: info for vid, info in self.volumes.items()
+            if vids is None or vid in vids}
+
+    @asyncio.coroutine
+    def init_cache_coro(self, log=None, vids=None):
+        yield from self.scan_event.wait()
+        return self.init_cache(log, vids)
+
+    def test_000_shared_scan(self):
+        tasks = [asyncio.ensure_future(qubes.storage.lvm.reset_cache_coro())
+            for _ in range(5)]
+        self.loop.run_until_complete(asyncio.sleep(0))
+        # the scan is blocked in init_cache_coro()
+        self.assertEqual(self.cache.generation, 0)
+        # the running scan might have missed changes of these callers
+        late_tasks = [
+            asyncio.ensure_future(qubes.storage.lvm.reset_cache_coro())
+            for _ in range(5)]
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.scan_event.set()
+        self.loop.run_until_complete(asyncio.wait(tasks + late_tasks))
+        self.assertEqual(self.scans, [None, None])
+        self.assertEqual(self.cache.generation, 2)
+        self.assertEqual(dict(self.cache), self.volumes)
+
+    def test_001_mapping(self):
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(set(self.cache), set(self.volumes))
+        self.assertEqual(self.cache['vg/pool'], self.volumes['vg/pool'])
+        self.assertIn('vg2/other', self.cache)
+        self.assertNotIn('vg/other', self.cache)
+        self.assertEqual(set(self.cache.volume_group('vg')),
+            {'pool', 'vm-test-root'})
+        self.assertEqual(self.cache.volume_group('vg3'), {})
+
+    def test_002_refresh_changed(self):
+        self.scan_event.set()
+        self.volumes['vg/vm-test-root-snap'] = dict(
+            self.volumes['vg/vm-test-root'], origin='vm-test-root')
+        del self.volumes['vg2/other']
+        self.cache.invalidate(['vg2/other', 'vg/vm-test-root-snap'])
+        self.loop.run_until_complete(self.cache.refresh_coro(()))
+        self.assertEqual(self.scans, [['vg/vm-test-root-snap', 'vg2/other']])
+        self.assertEqual(dict(self.cache), self.volumes)
+        self.assertEqual(self.cache.generation, 1)
+
+    def test_003_merge_requests(self):
+        tasks = [asyncio.ensure_future(self.cache.refresh_coro(['vg/pool']))]
+        self.loop.run_until_complete(asyncio.sleep(0))
+        tasks.append(asyncio.ensure_future(
+            self.cache.refresh_coro(['vg/vm-test-root'])))
+        tasks.append(asyncio.ensure_future(
+            self.cache.refresh_coro(['vg2/other'])))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.scan_event.set()
+        self.loop.run_until_complete(asyncio.wait(tasks))
+        self.assertEqual(self.scans,
+            [['vg/pool'], ['vg/vm-test-root', 'vg2/other']])
+        self.assertEqual([task.result() for task in tasks], [1, 2, 2])
+
+    def test_004_batches(self):
+        self.scan_event.set()
+        self.cache.batch_size = 2
+        self.loop.run_until_complete(self.cache.refresh_coro(self.volumes))
+        self.assertEqual(self.scans,
+            [['vg/pool', 'vg/vm-test-root'], ['vg2/other']])
+
+    def test_005_failed_refresh(self):
+        @asyncio.coroutine
+        def init_cache_coro(log=None, vids=None):
+            # pylint: disable=unused-argument
+            raise qubes.storage.StoragePoolException('lvs failed')
+        with unittest.mock.patch('qubes.storage.lvm.init_cache_coro',
+                init_cache_coro):
+            with self.assertRaises(qubes.storage.StoragePoolException):
+                self.loop.run_until_complete(
+                    self.cache.refresh_coro(['vg/pool']))
+        # retried by the next refresh
+        self.scan_event.set()
+        self.loop.run_until_complete(self.cache.refresh_coro(()))
+        self.assertEqual(self.scans, [['vg/pool']])
+
+    def test_010_refresh_cache_stale(self):
+        qubes.storage.lvm.refresh_cache(['vg/pool', 'vg/vm-test-root'])
+        self.assertEqual(self.scans, [])
+        self.cache.invalidate(['vg/vm-test-root'])
+        qubes.storage.lvm.refresh_cache(['vg/pool', 'vg/vm-test-root'])
+        self.assertEqual(self.scans, [['vg/vm-test-root']])
+        self.cache.updated['vg/pool'] -= self.cache.max_age + 1
+        qubes.storage.lvm.refresh_cache(['vg/pool', 'vg/vm-test-root'])
+        self.assertEqual(self.scans, [['vg/vm-test-root'], ['vg/pool']])
+
+    def test_011_refresh_cache_in_background(self):
+        self.volumes['vg/pool'] = dict(self.volumes['vg/pool'],
+            usage=1048576)
+        self.cache.invalidate(['vg/pool'])
+        pool = ThinPool(name='test', volume_group='vg', thin_pool='pool')
+
+        @asyncio.coroutine
+        def get_usage():
+            return pool.usage
+        # cached value is returned without waiting for lvs
+        self.assertEqual(self.loop.run_until_complete(get_usage()), 524288)
+        self.assertEqual(self.scans, [])
+        self.scan_event.set()
+        self.loop.run_until_complete(self.cache.refresh_coro(()))
+        self.assertEqual(self.scans, [['vg/pool']])
+        self.assertEqual(pool.usage, 1048576)
+
+    def test_012_udev_event(self):
+        monitor = unittest.mock.Mock()
+        monitor.poll.side_effect = [
+            {'DM_VG_NAME': 'vg', 'DM_LV_NAME': 'vm-test-root'},
+            {'DEVNAME': '/dev/sda'},
+            None]
+        self.scan_event.set()
+        qubes.storage.lvm._udev_event_received(monitor)
+        self.loop.run_until_complete(self.cache.refresh_coro(()))
+        self.assertEqual(self.scans, [['vg/vm-test-root']])
+
+    def test_020_lvm_command_vids(self):
+        self.assertEqual(qubes.storage.lvm._get_lvm_command_vids(
+            ['remove', '/dev/vg/vm-test-root']), ['vg/vm-test-root'])
+        self.assertEqual(qubes.storage.lvm._get_lvm_command_vids(
+            ['clone', '/dev/vg/vm-test-root', 'vg/vm-test-root-snap']),
+            ['vg/vm-test-root-snap'])
+        self.assertEqual(qubes.storage.lvm._get_lvm_command_vids(
+            ['create', 'vg/pool', 'vm-test-root', '1024']),
+            ['vg/pool', 'vg/vm-test-root'])
+        self.assertEqual(qubes.storage.lvm._get_lvm_command_vids(
+            ['rename', 'vg/vm-test-root', 'vg/vm-test-root-1-back']),
+            ['vg/vm-test-root', 'vg/vm-test-root-1-back'])
+
+    def test_021_lvs_missing_volumes(self):
+        log = unittest.mock.Mock()
+        qubes.storage.lvm._process_lvs_output(5,
+            b'  Failed to find logical volume "vg/vm-test-root-snap"\n', log)
+        self.assertFalse(log.warning.called)
+        with self.assertRaises(qubes.storage.StoragePoolException):
+            qubes.storage.lvm._process_lvs_output(5,
+                b'  Failed to find logical volume "vg/vm-test-root-snap"\n'
+                b'  Some other error\n', log)
+        with self.assertRaises(qubes.storage.StoragePoolException):
+            qubes.storage.lvm._process_lvs_output(5, b'', log)
+
+
+class TC_05_RemoveBatch(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.commands = []
+        self.existing = set()
+        self.log = unittest.mock.Mock()
+        for name, func in (('_run_lvm_coro', self.run_lvm_coro),
+                ('init_cache_coro', self.init_cache_coro)):
+            patch = unittest.mock.patch('qubes.storage.lvm.' + name, func)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    @asyncio.coroutine
+    def run_lvm_coro(self, cmd, log):
+        # pylint: disable=unused-argument
+        self.commands.append(cmd)
+        yield from asyncio.sleep(0)
+        failed = [vid for vid in cmd[1:] if vid.endswith('-busy')]
+        self.existing.difference_update(cmd[1:])
+        self.existing.update(failed)
+        if failed:
+            raise qubes.storage.StoragePoolException(
+                'Logical volume {} in use.'.format(failed[0]))
+        return True
+
+    @asyncio.coroutine
+    def init_cache_coro(self, log=None, vids=None):
+        # pylint: disable=unused-argument
+        return {vid: {} for vid in vids if vid in self.existing}
+
+    def remove(self, *vids):
+        return asyncio.ensure_future(qubes.storage.lvm.qubes_lvm_coro(
+            ['remove'] + list(vids), self.log))
+
+    def test_000_merge(self):
+        tasks = [self.remove('vg/vm-a-root-snap'),
+            self.remove('/dev/vg/vm-b-root-snap', 'vg/vm-b-private-snap'),
+            self.remove('vg2/vm-c-root-snap')]
+        self.loop.run_until_complete(asyncio.wait(tasks))
+        self.assertEqual(sorted(self.commands), [
+            ['remove', 'vg/vm-a-root-snap', 'vg/vm-b-private-snap',
+                'vg/vm-b-root-snap'],
+            ['remove', 'vg2/vm-c-root-snap'],
+        ])
+        for task in tasks:
+            self.assertTrue(task.result())
+
+    def test_001_merge_while_running(self):
+        tasks = [self.remove('vg/vm-a-root-snap')]
+        self.loop.run_until_complete(asyncio.sleep(0))
+        tasks.append(self.remove('vg/vm-b-root-snap'))
+        tasks.append(self.remove('vg/vm-c-root-snap'))
+        self.loop.run_until_complete(asyncio.wait(tasks))
+        self.assertEqual(self.commands, [
+            ['remove', 'vg/vm-a-root-snap'],
+            ['remove', 'vg/vm-b-root-snap', 'vg/vm-c-root-snap'],
+        ])
+
+    def test_002_partial_failure(self):
+        self.existing.update(['vg/vm-a-root-snap', 'vg/vm-b-root-busy'])
+        tasks = [self.remove('vg/vm-a-root-snap'),
+            self.remove('vg/vm-b-root-busy')]
+        self.loop.run_until_complete(asyncio.wait(tasks))
+        self.assertEqual(len(self.commands), 1)
+        self.assertTrue(tasks[0].result())
+        with self.assertRaises(qubes.storage.StoragePoolException) as e:
+            tasks[1].result()
+        self.assertIn('vg/vm-b-root-busy', str(e.exception))
+
+    def test_003_single_failure(self):
+        task = self.remove('vg/vm-a-root-busy')
+        with self.assertRaises(qubes.storage.StoragePoolException) as e:
+            self.loop.run_until_complete(task)
+        self.assertEqual(str(e.exception),
+            'Logical volume vg/vm-a-root-busy in use.')
+
+    def test_004_disabled(self):
+        with unittest.mock.patch.object(qubes.storage.lvm,
+                'lvm_batch_enabled', False):
+            tasks = [self.remove('vg/vm-a-root-snap'),
+                self.remove('vg/vm-b-root-snap')]
+            self.loop.run_until_complete(asyncio.wait(tasks))
+        self.assertEqual(len(self.commands), 2)
+
+
+class TC_06_PreparedSnapshots(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.commands = []
+        cache = qubes.storage.lvm.LvmCache({
+            'vg/pool': {'size': 4194304, 'usage': 0, 'pool_lv': '',
+                'attr': 'twi-aotz--', 'origin': ''},
+            'vg/vm-template-root': {'size': 1048576, 'usage': 0,
+                'pool_lv': 'pool', 'attr': 'Vwi-a-tz--', 'origin': ''},
+        })
+        for name, value in (('qubes_lvm_coro', self.qubes_lvm_coro),
+                ('refresh_cache_coro', self.refresh_cache_coro),
+                ('size_cache', cache)):
+            patch = unittest.mock.patch.object(qubes.storage.lvm, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.cache = cache.volume_group('vg')
+        self.pool = ThinPool(name='test', volume_group='vg',
+            thin_pool='pool', prepared_snapshots=1)
+        self.pool._snapshot_reserve.refill_delay = 0
+        self.addCleanup(self.pool.destroy)
+        self.origin = self.pool.init_volume(unittest.mock.Mock(), {
+            'name': 'root',
+            'vid': 'vg/vm-template-root',
+            'save_on_stop': True,
+            'rw': True,
+            'size': 1048576,
+        })
+        self.volume = self.pool.init_volume(unittest.mock.Mock(), {
+            'name': 'root',
+            'vid': 'vg/vm-disp1-root',
+            'snap_on_start': True,
+            'source': self.origin,
+            'size': 1048576,
+        })
+
+    @asyncio.coroutine
+    def qubes_lvm_coro(self, cmd, log):
+        # pylint: disable=unused-argument
+        self.commands.append(cmd)
+        names = [vid.split('/')[-1] for vid in cmd[1:]]
+        if cmd[0] == 'remove':
+            for name in names:
+                self.cache.pop(name, None)
+        elif cmd[0] == 'clone':
+            self.cache[names[1]] = dict(self.cache[names[0]],
+                origin=names[0])
+        elif cmd[0] == 'rename':
+            self.cache[names[1]] = self.cache.pop(names[0])
+        return True
+
+    @asyncio.coroutine
+    def refresh_cache_coro(self):
+        pass
+
+    def refill(self):
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+    def test_000_claim(self):
+        self.loop.run_until_complete(self.volume.start())
+        self.refill()
+        self.assertEqual(self.commands[:2], [
+            ['remove', 'vg/vm-disp1-root-snap'],
+            ['clone', '/dev/vg/vm-template-root', 'vg/vm-disp1-root-snap'],
+        ])
+        self.assertEqual(len(self.commands), 3)
+        self.assertEqual(self.commands[2][:2],
+            ['clone', 'vg/vm-template-root'])
+        prepared = self.commands[2][2]
+        self.assertTrue(prepared.startswith('vg/vm-template-root-'))
+        self.assertTrue(prepared.endswith('-prep'))
+        self.assertEqual([volume.vid for volume in self.pool.list_volumes()],
+            ['vg/vm-template-root'])
+
+        self.loop.run_until_complete(self.volume.stop())
+        del self.commands[:]
+        self.loop.run_until_complete(self.volume.start())
+        self.assertEqual(self.commands, [
+            ['remove', 'vg/vm-disp1-root-snap'],
+            ['rename', prepared, 'vg/vm-disp1-root-snap'],
+        ])
+        self.assertFalse(self.volume.is_outdated())
+        self.refill()
+        # and the reserve got refilled
+        self.assertEqual(self.commands[2][:2],
+            ['clone', 'vg/vm-template-root'])
+
+    def test_001_outdated(self):
+        self.loop.run_until_complete(self.volume.start())
+        self.refill()
+        prepared = self.commands[2][2]
+        self.loop.run_until_complete(self.volume.stop())
+        # the origin got committed without the reserve noticing
+        self.cache['vm-template-root-1-back'] = \
+            self.cache.pop('vm-template-root')
+        self.cache['vm-template-root'] = dict(
+            self.cache['vm-template-root-1-back'])
+        self.cache[prepared.split('/')[1]]['origin'] = \
+            'vm-template-root-1-back'
+        del self.commands[:]
+        self.loop.run_until_complete(self.volume.start())
+        self.assertEqual(self.commands, [
+            ['remove', 'vg/vm-disp1-root-snap'],
+            ['clone', '/dev/vg/vm-template-root', 'vg/vm-disp1-root-snap'],
+        ])
+        self.refill()
+        self.assertIn(['remove', prepared], self.commands)
+
+    def test_002_invalidate_on_commit(self):
+        self.loop.run_until_complete(self.volume.start())
+        self.refill()
+        prepared = self.commands[2][2]
+        self.cache['vm-template-root-import'] = dict(
+            self.cache['vm-template-root'])
+        self.origin._lock = unittest.mock.Mock(locked=lambda: True)
+        with unittest.mock.patch('os.path.exists', return_value=True):
+            self.loop.run_until_complete(
+                self.origin._commit('vg/vm-template-root-import'))
+        self.assertEqual(self.pool._snapshot_reserve.snapshots,
+            {'vg/vm-template-root': []})
+        self.refill()
+        self.assertIn(['remove', prepared], self.commands)
+
+
+class TC_07_RevisionJanitor(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.commands = []
+        attrs = {'pool_lv': 'pool', 'attr': 'Vwi-a-tz--', 'origin': '',
+            'size': 1048576, 'usage': 0}
+        cache = qubes.storage.lvm.LvmCache({
+            'vg/pool': {'size': 4194304, 'usage': 0, 'pool_lv': '',
+                'attr': 'twi-aotz--', 'origin': ''},
+            'vg/vm-test-root': dict(attrs),
+            'vg/vm-test-root-100-back': dict(attrs),
+            'vg/vm-test-root-200-back': dict(attrs),
+            'vg/vm-test-root-import': dict(attrs),
+        })
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, test_dir)
+        for name, value in (('qubes_lvm_coro', self.qubes_lvm_coro),
+                ('refresh_cache_coro', self.refresh_cache_coro),
+                ('size_cache', cache)):
+            patch = unittest.mock.patch.object(qubes.storage.lvm, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+        patch = unittest.mock.patch('qubes.config.qubes_base_dir', test_dir)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.cache = cache.volume_group('vg')
+        self.pool = ThinPool(name='test', volume_group='vg',
+            thin_pool='pool', revisions_to_keep=1)
+        self.pool._revision_janitor.delay = 0.05
+        self.addCleanup(self.pool.destroy)
+        self.volume = self.pool.init_volume(unittest.mock.Mock(), {
+            'name': 'root',
+            'vid': 'vg/vm-test-root',
+            'save_on_stop': True,
+            'rw': True,
+            'size': 1048576,
+        })
+
+    @asyncio.coroutine
+    def qubes_lvm_coro(self, cmd, log):
+        # pylint: disable=unused-argument
+        self.commands.append(cmd)
+        names = [vid.split('/')[-1] for vid in cmd[1:]]
+        if cmd[0] == 'remove':
+            for name in names:
+                self.cache.pop(name, None)
+        elif cmd[0] == 'rename':
+            self.cache[names[1]] = self.cache.pop(names[0])
+        return True
+
+    @asyncio.coroutine
+    def refresh_cache_coro(self):
+        pass
+
+    @asyncio.coroutine
+    def locked_commit(self):
+        with (yield from self.volume._lock):
+            yield from self.volume._commit('vg/vm-test-root-import')
+
+    def commit(self):
+        with unittest.mock.patch('os.path.exists', return_value=True), \
+                unittest.mock.patch('time.time', return_value=300):
+            self.loop.run_until_complete(self.locked_commit())
+
+    def test_000_prune_in_background(self):
+        self.commit()
+        self.assertEqual(list(self.volume.revisions), ['300-back'])
+        self.assertEqual([cmd[0] for cmd in self.commands],
+            ['rename', 'rename'])
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        self.assertEqual(self.commands[2:], [
+            ['remove', 'vg/vm-test-root-100-back',
+                'vg/vm-test-root-200-back'],
+        ])
+        self.assertEqual(self.pool._revision_janitor.queue, [])
+
+    def test_001_remove_queued(self):
+        self.commit()
+        self.pool._revision_janitor.close()
+        del self.commands[:]
+        with unittest.mock.patch('os.path.exists', return_value=True):
+            self.loop.run_until_complete(self.volume.remove())
+        self.assertEqual(sorted(vid for cmd in self.commands
+            for vid in cmd[1:]), [
+                'vg/vm-test-root',
+                'vg/vm-test-root-100-back',
+                'vg/vm-test-root-200-back',
+                'vg/vm-test-root-300-back',
+                'vg/vm-test-root-import',
+                'vg/vm-test-root-snap',
+            ])
+        self.assertEqual(self.pool._revision_janitor.queue, [])
+
+    def test_002_data_stamp(self):
+        self.cache['vm-test-root']['uuid'] = 'uuid-current'
+        self.cache['vm-test-root-import']['uuid'] = 'uuid-import'
+        stamp = self.volume.data_stamp()
+        self.assertEqual(stamp, 'lvm uuid-current 1048576')
+        # the device node of the committed LV may be the same
+        self.commit()
+        self.assertEqual(self.volume.data_stamp(), 'lvm uuid-import 1048576')
+        # let the old revisions get pruned
+        self.loop.run_until_complete(asyncio.sleep(0.2))
@@ -0,0 +1,116 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+''' Tests for block-hash manifests of volume images '''
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest.mock
+
+import qubes.tests
+from qubes.storage import manifest
+
+KiB = 1024
+
+
+def sha256(data):
+    return hashlib.sha256(data).digest()
+
+
+class TC_00_Manifest(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.test_dir = tempfile.mkdtemp(dir='/var/tmp',
+            prefix='test-manifest-')
+        self.addCleanup(shutil.rmtree, self.test_dir)
+
+    def test_000_parse_dump(self):
+        data = b'a' * 64 * KiB + b'b' * 10
+        hashes = [sha256(b'a' * 64 * KiB), sha256(b'b' * 10)]
+        dump = b''.join([b'65536 65546\n']
+            + [digest.hex().encode() + b'\n' for digest in hashes]
+            + [b'\n'])
+        parsed = manifest.Manifest.parse(dump)
+        self.assertEqual(parsed.block_size, 64 * KiB)
+        self.assertEqual(parsed.size, len(data))
+        self.assertEqual(parsed.hashes, hashes)
+        self.assertEqual(parsed.block_length(1), 10)
+        self.assertEqual(parsed.dump(), dump)
+
+    def test_001_parse_invalid(self):
+        digest = sha256(b'').hex().encode()
+        for untrusted_data in (
+                b'',
+                b'65536 65536\n' + digest + b'\n',
+                b'65536 65536\n\n',
+                b'65536 65536\n' + digest + b'\n' + digest + b'\n\n',
+                b'1000 1000\n' + digest + b'\n\n',
+                b'65536 -1\n\n',
+                b'65536 65536\n' + digest[:-2] + b'\n\n',
+                b'65536 65536\n' + b'x' * len(digest) + b'\n\n',
+                ):
+            with self.subTest(untrusted_data=untrusted_data):
+                with self.assertRaises(ValueError):
+                    manifest.Manifest.parse(untrusted_data)
+
+    def test_010_from_fd(self):
+        path = os.path.join(self.test_dir, 'volume.img')
+        block = os.urandom(64 * KiB)
+        with open(path, 'wb') as volume_io:
+            # data, hole, data, hole (shorter last block)
+            volume_io.write(block)
+            volume_io.seek(128 * KiB)
+            volume_io.write(block)
+            volume_io.truncate(256 * KiB - 10)
+        with open(path, 'rb') as volume_io:
+            result = manifest.Manifest.from_fd(volume_io.fileno(), 64 * KiB,
+                256 * KiB - 10)
+        self.assertEqual(result.hashes, [sha256(block),
+            sha256(bytes(64 * KiB)), sha256(block),
+            sha256(bytes(64 * KiB - 10))])
+
+    def test_020_store(self):
+        volume_path = os.path.join(self.test_dir, 'volume.img')
+        manifest_path = os.path.join(self.test_dir, 'root.manifest')
+        with open(volume_path, 'wb') as volume_io:
+            volume_io.write(b'data')
+        volume = unittest.mock.Mock(**{
+            'export.return_value': volume_path,
+            'data_stamp.return_value': None})
+        stamp = manifest.stamp(volume)
+        manifest.store(manifest_path, b'manifest data', stamp)
+
+        fd = manifest.open_stored(manifest_path, stamp)
+        self.assertIsNotNone(fd)
+        with open(fd, 'rb') as manifest_io:
+            self.assertEqual(manifest_io.read(), b'manifest data')
+
+        # the volume got written since
+        os.utime(volume_path, ns=(0, 0))
+        self.assertNotEqual(manifest.stamp(volume), stamp)
+        self.assertIsNone(manifest.open_stored(manifest_path,
+            manifest.stamp(volume)))
+        self.assertIsNone(manifest.open_stored(
+            os.path.join(self.test_dir, 'missing.manifest'), stamp))
+
+    def test_021_stamp_by_pool(self):
+        volume = unittest.mock.Mock(**{
+            'data_stamp.return_value': 'lvm uuid 1024'})
+        self.assertEqual(manifest.stamp(volume), 'lvm uuid 1024')
+        self.assertFalse(volume.export.called)
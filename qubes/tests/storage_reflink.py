@@ -22,10 +22,13 @@
 # pylint: disable=protected-access
 # pylint: disable=invalid-name
 
+import asyncio
 import os
 import shutil
 import subprocess
 import sys
+import tempfile
+import unittest.mock
 
 import qubes.tests
 from qubes.storage import reflink
@@ -93,6 +96,147 @@ class TC_01_ReflinkOnExt4(ReflinkMixin, qubes.tests.QubesTestCase):
         self.ficlone_supported = False
 
 
+class TC_10_PreparedSnapshots(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        self.pool = reflink.ReflinkPool(name='test', dir_path=self.test_dir,
+            setup_check='no', prepared_snapshots=1)
+        self.pool._snapshot_reserve.refill_delay = 0
+        self.addCleanup(self.pool.destroy)
+        self.pool.setup()
+        template = unittest.mock.Mock(dir_path_prefix='vm-templates')
+        template.name = 'template'
+        dispvm = unittest.mock.Mock(dir_path_prefix='appvms')
+        dispvm.name = 'disp1'
+        self.origin = self.pool.init_volume(template, {
+            'name': 'root', 'save_on_stop': True, 'rw': True, 'size': 4096})
+        self.volume = self.pool.init_volume(dispvm, {
+            'name': 'root', 'snap_on_start': True, 'source': self.origin,
+            'size': 4096})
+        self.loop.run_until_complete(self.origin.create())
+
+    def refill(self):
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+
+    def test_000_claim(self):
+        self.loop.run_until_complete(self.volume.start())
+        self.refill()
+        prepared = self.origin._prepared_snapshots
+        self.assertEqual(len(prepared), 1)
+        self.loop.run_until_complete(self.volume.stop())
+        with unittest.mock.patch.object(reflink, '_copy_file',
+                wraps=reflink._copy_file) as copy_file:
+            self.loop.run_until_complete(self.volume.start())
+        # the clean image was not copied from the origin, the prepared one
+        # got renamed instead
+        copied = [args[:2] for _, args, _ in copy_file.mock_calls]
+        self.assertNotIn((self.origin._path_clean, self.volume._path_clean),
+            copied)
+        self.assertIn((self.volume._path_clean, self.volume._path_dirty),
+            copied)
+        self.assertFalse(os.path.exists(prepared[0]))
+        self.assertFalse(self.volume.is_outdated())
+        self.refill()
+        self.assertEqual(len(self.origin._prepared_snapshots), 1)
+
+    def test_001_invalidate_on_commit(self):
+        self.loop.run_until_complete(self.volume.start())
+        self.refill()
+        prepared = self.origin._prepared_snapshots
+        self.loop.run_until_complete(self.origin.start())
+        self.loop.run_until_complete(self.origin.stop())
+        self.refill()
+        self.assertEqual(len(self.origin._prepared_snapshots), 1)
+        self.assertNotEqual(self.origin._prepared_snapshots, prepared)
+
+    def test_003_claimed_outdated(self):
+        self.loop.run_until_complete(self.volume.start())
+        self.refill()
+        prepared = self.origin._prepared_snapshots
+        self.loop.run_until_complete(self.volume.stop())
+        reserve = self.pool._snapshot_reserve
+        # the origin gets committed after the snapshot was claimed
+        generation = reserve.generation(self.origin)
+        with unittest.mock.patch.object(reserve, 'generation',
+                side_effect=[generation, generation + 1]), \
+                unittest.mock.patch.object(reflink, '_copy_file',
+                    wraps=reflink._copy_file) as copy_file:
+            self.loop.run_until_complete(self.volume.start())
+        self.assertIn((self.origin._path_clean, self.volume._path_clean),
+            [args[:2] for _, args, _ in copy_file.mock_calls])
+        self.assertFalse(os.path.exists(prepared[0]))
+
+    def test_004_copy_progress(self):
+        with open(self.origin._path_clean, 'r+b') as img:
+            img.write(b'data')
+        self.volume.copy_progress = unittest.mock.Mock()
+        self.loop.run_until_complete(self.volume.start())
+        # copies of the source and of the clean image, both done
+        self.assertEqual(self.volume.copy_progress.mock_calls[-1],
+            unittest.mock.call(4096, 4096))
+        self.assertGreaterEqual(
+            self.volume.copy_progress.mock_calls.count(
+                unittest.mock.call(4096, 4096)), 2)
+
+    def test_002_remove(self):
+        self.loop.run_until_complete(self.volume.start())
+        self.refill()
+        self.loop.run_until_complete(self.origin.remove())
+        self.assertEqual(self.origin._prepared_snapshots, [])
+        self.assertEqual(os.listdir(os.path.join(self.test_dir,
+            'vm-templates')), [])
+
+
+class TC_11_RevisionJanitor(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        self.pool = reflink.ReflinkPool(name='test', dir_path=self.test_dir,
+            setup_check='no', revisions_to_keep=1)
+        self.pool._revision_janitor.delay = 0.05
+        self.addCleanup(self.pool.destroy)
+        self.pool.setup()
+        vm = unittest.mock.Mock(dir_path_prefix='appvms')
+        vm.name = 'vm1'
+        self.volume = self.pool.init_volume(vm, {
+            'name': 'private', 'save_on_stop': True, 'rw': True,
+            'size': 4096})
+        self.loop.run_until_complete(self.volume.create())
+
+    def restart(self):
+        self.loop.run_until_complete(self.volume.start())
+        self.loop.run_until_complete(self.volume.stop())
+
+    def test_000_prune_in_background(self):
+        self.restart()
+        oldest = self.volume._path_revision('1')
+        self.restart()
+        # queued, but not removed yet
+        self.assertEqual(list(self.volume.revisions), ['2'])
+        self.assertIn(oldest, self.pool._revision_janitor)
+        self.assertTrue(os.path.exists(oldest))
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        self.assertFalse(os.path.exists(oldest))
+        self.assertNotIn(oldest, self.pool._revision_janitor)
+        self.assertEqual(list(self.volume.revisions), ['2'])
+        self.restart()
+        # revision numbers are not reused
+        self.assertEqual(list(self.volume.revisions), ['3'])
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+
+    def test_001_remove_queued(self):
+        self.restart()
+        self.restart()
+        self.pool._revision_janitor.close()
+        self.loop.run_until_complete(self.volume.remove())
+        self.assertEqual(self.pool._revision_janitor.queue, [])
+        self.assertEqual(os.listdir(os.path.join(self.test_dir, 'appvms')),
+            [])
+
+
 def setup_loopdev(img, cleanup_via=None):
     dev = str.strip(cmd('sudo', 'losetup', '-f', '--show', img).decode())
     if cleanup_via is not None:
@@ -0,0 +1,218 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest.mock
+
+import qubes.tests
+import qubes.tools.qubesd_stream
+from qubes.storage import manifest
+
+MiB = 1024**2
+
+
+class TC_00_qubesd_stream(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.test_dir = tempfile.mkdtemp(dir='/var/tmp',
+            prefix='test-qubesd-stream-')
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        self.volume_path = os.path.join(self.test_dir, 'volume.img')
+        self.data_path = os.path.join(self.test_dir, 'data')
+        self.manifest_path = os.path.join(self.test_dir, 'manifest')
+        self.stored_manifest = None
+        # 1MiB of data, 2MiB of zeroes, 1MiB of data
+        self.data = os.urandom(MiB) + bytes(2 * MiB) + os.urandom(MiB)
+        self.calls = []
+        self.responses = {}
+        patch = unittest.mock.patch('qubes.tools.qubesd_stream.qubesd_call',
+            side_effect=self.qubesd_call)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.args = qubes.tools.qubesd_stream.parser.parse_args(
+            ['import', 'mgmtvm', 'test-vm', 'private'])
+
+    def qubesd_call(self, socket_path, src, method, dest, arg, payload=b''):
+        # pylint: disable=unused-argument
+        self.calls.append((src, method, dest, arg, payload))
+        response = self.responses.get(method, b'0\0')
+        if not response.startswith(b'0\0'):
+            return response, []
+        if method == 'admin.vm.volume.Import':
+            return response, [os.open(self.volume_path, os.O_WRONLY)]
+        if method == 'admin.vm.volume.Export':
+            return response, [os.open(self.volume_path, os.O_RDONLY)]
+        if method == 'admin.vm.volume.ImportWithManifest':
+            fds = [os.open(self.volume_path, os.O_RDWR),
+                os.open(self.manifest_path, os.O_WRONLY | os.O_CREAT)]
+            if self.stored_manifest is not None:
+                read_fd, write_fd = os.pipe()
+                os.write(write_fd, self.stored_manifest)
+                os.close(write_fd)
+                fds.append(read_fd)
+            return response, fds
+        return response, []
+
+    def run_with_stdout(self, func, *args):
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with unittest.mock.patch.object(sys, 'stdout', stdout):
+            ret = func(*args)
+        stdout.flush()
+        return ret, stdout.buffer.getvalue()
+
+    def test_000_write_data_sparse(self):
+        with open(self.volume_path, 'wb') as volume:
+            volume.truncate(len(self.data))
+        fd = os.open(self.volume_path, os.O_WRONLY)
+        try:
+            qubes.tools.qubesd_stream.write_data(fd,
+                memoryview(self.data), 0)
+        finally:
+            os.close(fd)
+        with open(self.volume_path, 'rb') as volume:
+            self.assertEqual(volume.read(), self.data)
+        # zeroes were not written
+        self.assertLess(os.stat(self.volume_path).st_blocks * 512, 3 * MiB)
+
+    def test_010_import(self):
+        with open(self.volume_path, 'wb') as volume:
+            volume.truncate(len(self.data))
+        with open(self.data_path, 'wb') as data:
+            # more than the volume size, which should be ignored
+            data.write(self.data + b'extra')
+        self.responses['admin.vm.volume.Import'] = \
+            '0\0{} {}'.format(len(self.data), self.volume_path).encode()
+        with open(self.data_path, 'rb') as data:
+            ret, stdout = self.run_with_stdout(
+                qubes.tools.qubesd_stream.import_volume, self.args,
+                data.fileno())
+        self.assertEqual(ret, 0)
+        self.assertEqual(stdout, b'0\0')
+        with open(self.volume_path, 'rb') as volume:
+            self.assertEqual(volume.read(), self.data)
+        self.assertEqual(self.calls[0],
+            ('mgmtvm', 'admin.vm.volume.Import', 'test-vm', 'private', b''))
+        self.assertEqual(self.calls[-2][1],
+            'internal.vm.volume.ImportProgress')
+        self.assertTrue(self.calls[-2][4].startswith(
+            '{} '.format(len(self.data)).encode()))
+        self.assertEqual(self.calls[-1],
+            ('mgmtvm', 'internal.vm.volume.ImportEnd', 'test-vm', 'private',
+                b'ok'))
+
+    def test_011_import_denied(self):
+        self.responses['admin.vm.volume.Import'] = b'2\0QubesException\0\0'
+        ret, stdout = self.run_with_stdout(
+            qubes.tools.qubesd_stream.import_volume, self.args, 0)
+        self.assertEqual(ret, 1)
+        self.assertEqual(stdout, b'2\0QubesException\0\0')
+        self.assertEqual(len(self.calls), 1)
+
+    def test_020_export(self):
+        with open(self.volume_path, 'wb') as volume:
+            volume.write(self.data[:MiB])
+            volume.seek(3 * MiB)
+            volume.write(self.data[3 * MiB:])
+            # trailing hole
+            volume.truncate(len(self.data) + MiB)
+        self.responses['admin.vm.volume.Export'] = \
+            '0\0{} {}'.format(len(self.data) + MiB,
+                self.volume_path).encode()
+        with open(self.data_path, 'wb') as output:
+            ret = qubes.tools.qubesd_stream.export_volume(self.args,
+                output.fileno())
+        self.assertEqual(ret, 0)
+        with open(self.data_path, 'rb') as output:
+            self.assertEqual(output.read(),
+                b'0\0' + self.data + bytes(MiB))
+        self.assertEqual(self.calls[0],
+            ('mgmtvm', 'admin.vm.volume.Export', 'test-vm', 'private', b''))
+        self.assertEqual(self.calls[-1][1],
+            'internal.vm.volume.ExportProgress')
+        self.assertTrue(self.calls[-1][4].startswith(
+            '{} '.format(len(self.data) + MiB).encode()))
+
+    def prepare_manifest_import(self, block_size=64 * 1024):
+        blocks = [self.data[offset:offset + block_size]
+            for offset in range(0, len(self.data), block_size)]
+        # the current volume data differs in the first and last blocks
+        with open(self.volume_path, 'wb') as volume:
+            volume.write(os.urandom(block_size))
+            volume.write(b''.join(blocks[1:-1]))
+            volume.write(os.urandom(len(blocks[-1])))
+        self.responses['admin.vm.volume.ImportWithManifest'] = \
+            '0\0{} {}'.format(len(self.data), self.volume_path).encode()
+        return manifest.Manifest(block_size, len(self.data),
+            [hashlib.sha256(block).digest() for block in blocks]), blocks
+
+    def test_030_import_with_manifest(self):
+        new_manifest, blocks = self.prepare_manifest_import()
+        last = len(blocks) - 1
+        input_io = io.BytesIO(new_manifest.dump() + blocks[0] + blocks[last])
+        ret, stdout = self.run_with_stdout(
+            qubes.tools.qubesd_stream.import_volume_with_manifest, self.args,
+            input_io)
+        self.assertEqual(ret, 0)
+        self.assertEqual(stdout,
+            '0\0{} {}\n'.format(0, last).encode() + b'0\0')
+        with open(self.volume_path, 'rb') as volume:
+            self.assertEqual(volume.read(), self.data)
+        with open(self.manifest_path, 'rb') as manifest_io:
+            self.assertEqual(manifest_io.read(), new_manifest.dump())
+        self.assertEqual(self.calls[-1],
+            ('mgmtvm', 'internal.vm.volume.ImportEnd', 'test-vm', 'private',
+                b'ok'))
+
+    def test_031_import_with_stored_manifest(self):
+        new_manifest, blocks = self.prepare_manifest_import()
+        last = len(blocks) - 1
+        # according to the stored manifest, only the first block differs
+        self.stored_manifest = manifest.Manifest(new_manifest.block_size,
+            new_manifest.size, [b'\0' * 32] + new_manifest.hashes[1:]).dump()
+        input_io = io.BytesIO(new_manifest.dump() + blocks[0])
+        ret, stdout = self.run_with_stdout(
+            qubes.tools.qubesd_stream.import_volume_with_manifest, self.args,
+            input_io)
+        self.assertEqual(ret, 0)
+        self.assertEqual(stdout, b'0\0' + b'0\n' + b'0\0')
+        with open(self.volume_path, 'rb') as volume:
+            self.assertEqual(volume.read()[:-len(blocks[last])],
+                self.data[:-len(blocks[last])])
+
+    def test_032_import_with_manifest_bad_block(self):
+        new_manifest, blocks = self.prepare_manifest_import()
+        input_io = io.BytesIO(new_manifest.dump() + blocks[1] + blocks[0])
+        ret, _ = self.run_with_stdout(
+            qubes.tools.qubesd_stream.import_volume_with_manifest, self.args,
+            input_io)
+        self.assertEqual(ret, 0)
+        self.assertEqual(self.calls[-1],
+            ('mgmtvm', 'internal.vm.volume.ImportEnd', 'test-vm', 'private',
+                b'fail'))
+
+    def test_033_import_with_invalid_manifest(self):
+        ret, stdout = self.run_with_stdout(
+            qubes.tools.qubesd_stream.import_volume_with_manifest, self.args,
+            io.BytesIO(b'1 2\n\n'))
+        self.assertEqual(ret, 1)
+        self.assertTrue(stdout.startswith(b'2\0QubesException\0'))
+        self.assertEqual(self.calls, [])
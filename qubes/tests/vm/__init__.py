@@ -45,6 +45,12 @@ class TestVMsCollection(dict):
     def get_vms_connected_to(self, vm):
         return set()
 
+    def get_dependent_vms(self, vm, propname):
+        # the same VM may be stored under several keys (qid, name, ...)
+        dependents = {id(domain): domain for domain in self.values()
+            if getattr(domain, propname, None) is vm}
+        return list(dependents.values())
+
     def close(self):
         self.clear()
 
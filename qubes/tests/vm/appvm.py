@@ -32,7 +32,7 @@ class TestApp(object):
     labels = {1: qubes.Label(1, '0xcc0000', 'red')}
 
     def __init__(self):
-        self.domains = {}
+        self.domains = qubes.tests.vm.TestVMsCollection()
 
 class TestProp(object):
     # pylint: disable=too-few-public-methods
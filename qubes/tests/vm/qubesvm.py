@@ -44,7 +44,7 @@ class TestApp(object):
     labels = {1: qubes.Label(1, '0xcc0000', 'red')}
 
     def __init__(self):
-        self.domains = {}
+        self.domains = qubes.tests.vm.TestVMsCollection()
         self.host = unittest.mock.Mock()
         self.host.memory_total = 4096 * 1024
 
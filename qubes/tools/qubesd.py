@@ -25,10 +25,24 @@ parser = qubes.tools.QubesArgumentParser(description='Qubes OS daemon')
 parser.add_argument('--debug', action='store_true', default=False,
     help='Enable verbose error logging (all exceptions with full '
          'tracebacks) and also send tracebacks to Admin API clients')
+parser.add_argument('--save-delay', metavar='SECONDS', type=float,
+    default=0.5,
+    help='Write qubes.xml after this many seconds without further changes, '
+         'instead of after each change; Admin API calls changing the '
+         'configuration then return before the change is written, call '
+         'admin.store.Flush to wait for it; 0 disables delayed writes '
+         '(default: %(default)s)')
+parser.add_argument('--save-max-delay', metavar='SECONDS', type=float,
+    default=5,
+    help='Maximum time for which writing changes to qubes.xml can be '
+         'delayed (default: %(default)s)')
 
 def main(args=None):
     loop = asyncio.get_event_loop()
     libvirtaio.virEventRegisterAsyncIOImpl(loop=loop)
+    # published by a previous instance, which might have crashed - and it
+    # would stay in use while qubes.xml is loaded
+    system_info_generation = qubes.api.internal.unpublish_system_info()
     try:
         args = parser.parse_args(args)
     except:
@@ -36,6 +50,11 @@ def main(args=None):
         raise
 
     args.app.register_event_handlers()
+    # append changes to qubes.xml journal instead of rewriting it on each call
+    args.app.use_journal = True
+    if args.save_delay > 0:
+        args.app.save_delay = args.save_delay
+        args.app.save_max_delay = args.save_max_delay
 
     if args.debug:
         qubes.log.enable_debug()
@@ -46,6 +65,12 @@ def main(args=None):
         qubes.api.misc.QubesMiscAPI,
         app=args.app, debug=args.debug))
 
+    # keep system info for qrexec policy up to date, and published for
+    # qrexec-policy
+    args.app.api_internal_system_info = qubes.api.internal.SystemInfo(
+        args.app, qubes.api.internal.SYSTEM_INFO_PATH,
+        generation=system_info_generation)
+
     socknames = []
     for server in servers:
         for sock in server.sockets:
@@ -71,6 +96,8 @@ def main(args=None):
                     'socket {} got unlinked sometime before shutdown'.format(
                         sockname))
     finally:
+        args.app.api_internal_system_info.close()
+        args.app.flush_save()
         loop.close()
 
 if __name__ == '__main__':
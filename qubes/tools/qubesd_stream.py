@@ -0,0 +1,338 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+'''Stream volume data of admin.vm.volume.Import and admin.vm.volume.Export
+between the qrexec connection (stdin/stdout) and the volume.
+
+qubesd passes the volume opened along with its response, so no privileges
+(and no :program:`dd` process) are needed here. Imported data is read into
+a single reused buffer and all-zero blocks are skipped, keeping the volume
+sparse; exported data is sent with :py:func:`os.sendfile`, without passing
+through this process. The progress is reported to qubesd, which fires
+``domain-volume-import-progress``/``domain-volume-export-progress`` events.
+
+admin.vm.volume.ImportWithManifest transfers only the blocks that changed:
+
+1. The caller sends the manifest of the image (see
+   :py:mod:`qubes.storage.manifest`).
+2. The blocks whose hashes differ from the current volume data are listed
+   in a ``0\\0`` response: their indices separated by spaces, ending with
+   a newline. On error, the usual error response is sent instead.
+3. The caller sends these blocks, in that order.
+4. The final response (of internal.vm.volume.ImportEnd) is sent.
+'''
+
+import argparse
+import array
+import hashlib
+import os
+import socket
+import sys
+import time
+
+import qubes.api.admin
+import qubes.api.internal
+from qubes.storage import filecopy
+from qubes.storage import manifest
+
+#: size of a single read from stdin
+BUFFER_SIZE = 1024**2
+
+#: blocks of this size containing only zeroes are not written
+ZERO_BLOCK_SIZE = 64 * 1024
+
+#: minimum interval (in seconds) between progress reports
+PROGRESS_INTERVAL = 1.0
+
+_ZERO_BLOCK = bytes(ZERO_BLOCK_SIZE)
+
+parser = argparse.ArgumentParser(
+    description='Stream volume data to/from qubesd.')
+
+parser.add_argument('--socket', metavar='PATH',
+    default=qubes.api.admin.QubesAdminAPI.SOCKNAME,
+    help='path to the admin API socket')
+parser.add_argument('--internal-socket', metavar='PATH',
+    default=qubes.api.internal.QubesInternalAPI.SOCKNAME,
+    help='path to the internal API socket')
+parser.add_argument('action',
+    choices=('import', 'import-with-manifest', 'export'),
+    help='direction of the data')
+parser.add_argument('src', metavar='SRC',
+    help='source qube')
+parser.add_argument('dest', metavar='DEST',
+    help='destination qube')
+parser.add_argument('volume', metavar='VOLUME',
+    help='name of the volume')
+
+
+#: maximum number of file descriptors passed along with a response
+MAX_FDS = 4
+
+#: maximum number of lines of a manifest (and length of a line)
+MAX_MANIFEST_LINES = 2**22
+MAX_MANIFEST_LINE_LENGTH = 256
+
+
+def qubesd_call(socket_path, src, method, dest, arg, payload=b''):
+    '''Call qubesd and return its raw response, with the list of file
+    descriptors passed along with it.
+    '''
+    fds = array.array('i')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(b'\0'.join(
+            part.encode('ascii') for part in (src, method, dest, arg))
+            + b'\0' + payload)
+        sock.shutdown(socket.SHUT_WR)
+        data, ancdata, _, _ = sock.recvmsg(4096,
+            socket.CMSG_SPACE(MAX_FDS * fds.itemsize))
+        for level, type_, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[:len(cmsg_data)
+                    - len(cmsg_data) % fds.itemsize])
+        response = [data]
+        while data:
+            data = sock.recv(4096)
+            response.append(data)
+    return b''.join(response), list(fds)
+
+
+class Progress:
+    '''Rate-limited progress reports to qubesd'''
+
+    def __init__(self, args, method):
+        self.args = args
+        self.method = method
+        self.transferred = 0
+        self.start = time.monotonic()
+        self.last_report = self.start
+
+    def update(self, length, force=False):
+        self.transferred += length
+        now = time.monotonic()
+        if not force and now - self.last_report < PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+        rate = int(self.transferred / max(now - self.start, 1e-6))
+        qubesd_call(self.args.internal_socket, self.args.src, self.method,
+            self.args.dest, self.args.volume,
+            '{} {}'.format(self.transferred, rate).encode('ascii'))
+
+
+def open_volume(args, method, flags):
+    '''Call *method* and return the volume size and file descriptors
+    (the volume first). On error, pass the response to stdout and return
+    :py:obj:`None`.'''
+    response, fds = qubesd_call(args.socket, args.src, method, args.dest,
+        args.volume)
+    if not response.startswith(b'0\0'):
+        for fd in fds:
+            os.close(fd)
+        sys.stdout.buffer.write(response)
+        return None
+    size, path = response[2:].decode('ascii').split(' ', 1)
+    if not fds:
+        # a pipe, or an old qubesd - open it ourselves
+        fds = [os.open(path, flags)]
+    return int(size), fds
+
+
+def write_data(fd, data, offset):
+    '''Write *data* at *offset*, skipping all-zero blocks'''
+    start = None
+    for pos in range(0, len(data), ZERO_BLOCK_SIZE):
+        block = data[pos:pos + ZERO_BLOCK_SIZE]
+        if block != _ZERO_BLOCK[:len(block)]:
+            if start is None:
+                start = pos
+        elif start is not None:
+            pwrite_all(fd, data[start:pos], offset + start)
+            start = None
+    if start is not None:
+        pwrite_all(fd, data[start:], offset + start)
+
+
+def pwrite_all(fd, data, offset):
+    written = 0
+    while written < len(data):
+        written += os.pwrite(fd, data[written:], offset + written)
+
+
+def import_volume(args, input_fd):
+    '''Write *input_fd* into the volume, like
+    ``dd conv=sparse,notrunc,fdatasync``, and finish the import'''
+    ret = open_volume(args, 'admin.vm.volume.Import', os.O_WRONLY)
+    if ret is None:
+        return 1
+    size, (fd,) = ret
+    progress = Progress(args, 'internal.vm.volume.ImportProgress')
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    status = b'ok'
+    try:
+        offset = 0
+        while offset < size:
+            length = os.readv(input_fd,
+                [view[:min(BUFFER_SIZE, size - offset)]])
+            if not length:
+                break
+            write_data(fd, view[:length], offset)
+            offset += length
+            progress.update(length)
+        os.fdatasync(fd)
+        progress.update(0, force=True)
+    except OSError as e:
+        print('Failed to import volume data: {!s}'.format(e),
+            file=sys.stderr)
+        status = b'fail'
+    finally:
+        os.close(fd)
+    return import_end(args, status)
+
+
+def import_end(args, status):
+    '''Finish the import, passing the response to stdout'''
+    response, _ = qubesd_call(args.internal_socket, args.src,
+        'internal.vm.volume.ImportEnd', args.dest, args.volume, status)
+    sys.stdout.buffer.write(response)
+    return 0 if response.startswith(b'0\0') else 1
+
+
+def read_manifest(input_io):
+    '''Read a manifest, up to the empty line ending it'''
+    lines = []
+    while not lines or lines[-1] not in (b'\n', b''):
+        if len(lines) >= MAX_MANIFEST_LINES:
+            raise ValueError('Manifest too long')
+        lines.append(input_io.readline(MAX_MANIFEST_LINE_LENGTH))
+    return manifest.Manifest.parse(b''.join(lines))
+
+
+def import_volume_with_manifest(args, input_io):
+    '''Import only the blocks of the image (described by a manifest read
+    from *input_io* first) that differ from the current volume data'''
+    try:
+        new_manifest = read_manifest(input_io)
+    except ValueError as e:
+        sys.stdout.buffer.write(b'2\0QubesException\0\0'
+            + 'Invalid manifest: {!s}'.format(e).encode() + b'\0')
+        return 1
+    ret = open_volume(args, 'admin.vm.volume.ImportWithManifest', os.O_RDWR)
+    if ret is None:
+        return 1
+    size, fds = ret
+    fd, manifest_fd = fds[:2]
+    status = b'ok'
+    try:
+        if new_manifest.size != size:
+            raise ValueError('Image size {} does not match volume size '
+                '{}'.format(new_manifest.size, size))
+        current = None
+        if len(fds) > 2:
+            with open(fds.pop(), 'rb') as stored_io:
+                current = manifest.Manifest.parse(stored_io.read())
+            if current.block_size != new_manifest.block_size:
+                current = None
+        if current is None:
+            current = manifest.Manifest.from_fd(fd,
+                new_manifest.block_size, size)
+        needed = [index
+            for index, digest in enumerate(new_manifest.hashes)
+            if digest != current.hashes[index]]
+        sys.stdout.buffer.write(b'0\0' + ' '.join(
+            str(index) for index in needed).encode('ascii') + b'\n')
+        sys.stdout.flush()
+
+        progress = Progress(args, 'internal.vm.volume.ImportProgress')
+        buf = bytearray(new_manifest.block_size)
+        view = memoryview(buf)
+        for index in needed:
+            length = new_manifest.block_length(index)
+            if input_io.readinto(view[:length]) != length:
+                raise ValueError('Unexpected end of data')
+            if hashlib.sha256(view[:length]).digest() != \
+                    new_manifest.hashes[index]:
+                raise ValueError('Block {} does not match the manifest'.format(
+                    index))
+            # the old data is there, zeroes need to be written too
+            pwrite_all(fd, view[:length], index * new_manifest.block_size)
+            progress.update(length)
+        os.fdatasync(fd)
+        progress.update(0, force=True)
+        pwrite_all(manifest_fd, new_manifest.dump(), 0)
+    except (OSError, ValueError) as e:
+        print('Failed to import volume data: {!s}'.format(e),
+            file=sys.stderr)
+        status = b'fail'
+    finally:
+        for extra_fd in fds:
+            os.close(extra_fd)
+    return import_end(args, status)
+
+
+def export_volume(args, output_fd):
+    '''Send the volume data to *output_fd*, after a ``0\\0`` header'''
+    ret = open_volume(args, 'admin.vm.volume.Export', os.O_RDONLY)
+    if ret is None:
+        return 1
+    size, (fd,) = ret
+    progress = Progress(args, 'internal.vm.volume.ExportProgress')
+    try:
+        os.write(output_fd, b'0\0')
+        offset = 0
+        for start, length in filecopy.data_extents(fd, size):
+            # holes need to be sent too, as zeroes
+            write_zeroes(output_fd, start - offset)
+            progress.update(start - offset)
+            end = start + length
+            while start < end:
+                sent = os.sendfile(output_fd, fd, start, end - start)
+                if not sent:
+                    raise OSError('Unexpected end of volume data')
+                start += sent
+                progress.update(sent)
+            offset = end
+        write_zeroes(output_fd, size - offset)
+        progress.update(size - offset, force=True)
+    except OSError as e:
+        print('Failed to export volume data: {!s}'.format(e),
+            file=sys.stderr)
+        return 1
+    finally:
+        os.close(fd)
+    return 0
+
+
+def write_zeroes(fd, length):
+    zeroes = memoryview(bytes(min(length, BUFFER_SIZE)))
+    while length > 0:
+        length -= os.write(fd, zeroes[:min(length, BUFFER_SIZE)])
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    sys.stdout.flush()
+    if args.action == 'import':
+        return import_volume(args, sys.stdin.fileno())
+    if args.action == 'import-with-manifest':
+        return import_volume_with_manifest(args, sys.stdin.buffer)
+    return export_volume(args, sys.stdout.fileno())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -146,8 +146,48 @@ def urandom(size):
     return hashlib.sha512(rand).digest()
 
 
+#: entry points of each group, see :py:func:`iter_entry_points`
+_entry_points = {}
+
+#: objects returned by :py:func:`get_entry_point_one`
+_entry_points_loaded = {}
+
+
+def iter_entry_points(group, name=None):
+    '''Iterate over entry points of a group
+
+    Unlike :py:func:`pkg_resources.iter_entry_points`, which scans all
+    installed distributions on each call, entry points of each group are
+    looked up only once. Call :py:func:`refresh_entry_points` after
+    installing or removing plugins.
+
+    :param str group: entry point group, like ``'qubes.vm'``
+    :param str name: if not :py:obj:`None`, return only entry points of \
+        this name
+    '''
+    try:
+        epoints = _entry_points[group]
+    except KeyError:
+        epoints = tuple(pkg_resources.iter_entry_points(group))
+        _entry_points[group] = epoints
+    if name is None:
+        return iter(epoints)
+    return (ep for ep in epoints if ep.name == name)
+
+
+def refresh_entry_points():
+    '''Forget entry points (and objects loaded from them) looked up so far
+    '''
+    _entry_points.clear()
+    _entry_points_loaded.clear()
+
+
 def get_entry_point_one(group, name):
-    epoints = tuple(pkg_resources.iter_entry_points(group, name))
+    try:
+        return _entry_points_loaded[group, name]
+    except KeyError:
+        pass
+    epoints = tuple(iter_entry_points(group, name))
     if not epoints:
         raise KeyError(name)
     if len(epoints) > 1:
@@ -155,7 +195,9 @@ def get_entry_point_one(group, name):
             'more than 1 implementation of {!r} found: {}'.format(name,
                 ', '.join('{}.{}'.format(ep.module_name, '.'.join(ep.attrs))
                     for ep in epoints)))
-    return epoints[0].load()
+    obj = epoints[0].load()
+    _entry_points_loaded[group, name] = obj
+    return obj
 
 
 def random_string(length=5):
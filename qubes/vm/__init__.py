@@ -286,6 +286,28 @@ class BaseVM(qubes.PropertyHolder):
         '''Initialise logger for this domain.'''
         self.log = qubes.log.get_vm_logger(self.name)
 
+    @qubes.events.handler('property-set:name', 'property-set:uuid')
+    def on_property_set_lookup_key(self, event, name, newvalue,
+            oldvalue=None):
+        '''Keep name and UUID indexes of the VM collection up to date'''
+        # pylint: disable=unused-argument
+        domains = getattr(self.app, 'domains', None)
+        if isinstance(domains, qubes.app.VMCollection):
+            domains.reindex(self)
+
+    @qubes.events.handler(
+        'property-set:netvm', 'property-del:netvm',
+        'property-set:template', 'property-del:template',
+        'property-set:default_dispvm', 'property-del:default_dispvm',
+        'clone-properties')
+    def on_property_set_dependency(self, event, name=None, newvalue=None,
+            oldvalue=None, **kwargs):
+        '''Keep reverse dependency indexes of the VM collection up to date'''
+        # pylint: disable=unused-argument
+        domains = getattr(self.app, 'domains', None)
+        if isinstance(domains, qubes.app.VMCollection):
+            domains.update_dependencies(self)
+
     def __xml__(self):
         element = lxml.etree.Element('domain')
         element.set('id', 'domain-' + str(self.qid))
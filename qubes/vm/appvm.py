@@ -102,9 +102,8 @@ class AppVM(qubes.vm.qubesvm.QubesVM):
         ''' Returns a generator containing all Disposable VMs based on the
         current AppVM.
         '''
-        for vm in self.app.domains:
-            if hasattr(vm, 'template') and vm.template is self:
-                yield vm
+        for vm in self.app.domains.get_dependent_vms(self, 'template'):
+            yield vm
 
     @qubes.events.handler('domain-load')
     def on_domain_loaded(self, event):
@@ -216,9 +216,8 @@ class NetVMMixin(qubes.events.Emitter):
         ''' Return a generator containing all domains connected to the current
             NetVM.
         '''
-        for vm in self.app.domains:
-            if getattr(vm, 'netvm', None) is self:
-                yield vm
+        for vm in self.app.domains.get_dependent_vms(self, 'netvm'):
+            yield vm
 
     #
     # used in both
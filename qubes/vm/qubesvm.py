@@ -39,6 +39,7 @@ import lxml
 import qubes
 import qubes.config
 import qubes.exc
+import qubes.executors
 import qubes.storage
 import qubes.storage.file
 import qubes.utils
@@ -353,6 +354,20 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
             If you think some files are missing or damaged, raise an exception.
 
+        .. event:: domain-volume-copy-progress \
+                (subject, event, volume, copied, total)
+
+            Fired while a storage driver copies data into a volume of the
+            qube (when starting it, cloning or importing a volume), at most
+            every :py:attr:`qubes.storage.CopyProgress.interval` seconds,
+            and when the copy is done.
+
+            :param subject: Event emitter (the qube object)
+            :param event: Event name (``'domain-volume-copy-progress'``)
+            :param volume: name of the volume
+            :param copied: bytes of data copied so far (holes excluded)
+            :param total: bytes of data to copy
+
         .. event:: domain-is-fully-usable (subject, event)
 
             Fired at the end of :py:meth:`clone_disk_files` method.
@@ -1048,7 +1063,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                                 notify_function=notify_function)
 
                 qmemman_client = yield from asyncio.get_event_loop().\
-                    run_in_executor(None, self.request_memory, mem_required)
+                    run_in_executor(qubes.executors.get('qmemman'),
+                        self.request_memory, mem_required)
 
                 yield from self.storage.start()
 
@@ -1063,10 +1079,19 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             try:
                 self._update_libvirt_domain()
 
-                self.libvirt_domain.createWithFlags(
+                # the event loop keeps running while the domain is being
+                # created, accept stopped events of the new domain already
+                self._domain_stopped_event_received = False
+                self._domain_stopped_event_handled = False
+
+                yield from asyncio.get_event_loop().run_in_executor(
+                    qubes.executors.get('libvirt'),
+                    self.libvirt_domain.createWithFlags,
                     libvirt.VIR_DOMAIN_START_PAUSED)
 
             except Exception as exc:
+                self._domain_stopped_event_received = True
+                self._domain_stopped_event_handled = True
                 self.log.error('Start failed: %s', str(exc))
                 # let anyone receiving domain-pre-start know that startup failed
                 yield from self.fire_event_async('domain-start-failed',
@@ -1078,9 +1103,6 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                 if qmemman_client:
                     qmemman_client.close()
 
-            self._domain_stopped_event_received = False
-            self._domain_stopped_event_handled = False
-
             try:
                 yield from self.fire_event_async('domain-spawn',
                     start_guid=start_guid)
@@ -48,9 +48,8 @@ class TemplateVM(QubesVM):
         ''' Returns a generator containing all domains based on the current
             TemplateVM.
         '''
-        for vm in self.app.domains:
-            if hasattr(vm, 'template') and vm.template is self:
-                yield vm
+        for vm in self.app.domains.get_dependent_vms(self, 'template'):
+            yield vm
 
     netvm = qubes.VMProperty('netvm', load_stage=4, allow_none=True,
         default=None,
@@ -21,23 +21,27 @@
 # pylint: disable=no-else-return,useless-object-inheritance,try-except-raise
 
 ''' Qrexec policy parser and evaluator '''
+import collections
+import copy
 import enum
+import hashlib
+import heapq
 import itertools
 import json
 import os
 import os.path
-import socket
-import subprocess
+import threading
+
+from qubespolicy import call
+# pylint: disable=unused-import
+from qubespolicy.call import AccessDenied, QubesMgmtException, \
+    qubesd_call, QREXEC_CLIENT, QUBESD_INTERNAL_SOCK, QUBESD_SOCK
+# pylint: enable=unused-import
 
 # don't import 'qubes.config' please, it takes 0.3s
-QREXEC_CLIENT = '/usr/lib/qubes/qrexec-client'
 POLICY_DIR = '/etc/qubes-rpc/policy'
-QUBESD_INTERNAL_SOCK = '/var/run/qubesd.internal.sock'
-QUBESD_SOCK = '/var/run/qubesd.sock'
-
-
-class AccessDenied(Exception):
-    ''' Raised when qrexec policy denied access '''
+POLICY_DAEMON_SOCK = '/var/run/qubes/policy.sock'
+SYSTEM_INFO_PATH = '/var/run/qubes/system-info'
 
 
 class PolicySyntaxError(AccessDenied):
@@ -390,6 +394,66 @@ class PolicyRule(object):
             return self.override_target
 
 
+class SourceIndex(object):
+    ''' Rules of a policy, indexed by their source specification
+
+    Rules are split into buckets: by domain name, by tag (``@tag:``), by
+    type (``@type:``) and wildcard (``@anyvm``) ones. Only rules from the
+    buckets of a given source domain can match it, so only those need to
+    be checked with :py:meth:`PolicyRule.is_match`.
+
+    :param rules: list of :py:class:`PolicyRule`
+    '''
+
+    def __init__(self, rules):
+        self.rules = rules
+        #: number of rules indexed, the index is outdated if more were added
+        self.size = len(rules)
+        # bucket -> ordered list of rule indices
+        self.names = collections.defaultdict(list)
+        self.tags = collections.defaultdict(list)
+        self.types = collections.defaultdict(list)
+        self.wildcard = []
+        for index, rule in enumerate(rules):
+            source = rule.source
+            if source.startswith('@tag:'):
+                self.tags[source[len('@tag:'):]].append(index)
+            elif source.startswith('@type:'):
+                self.types[source[len('@type:'):]].append(index)
+            elif source == '@anyvm':
+                self.wildcard.append(index)
+            else:
+                if source == 'dom0':
+                    source = '@adminvm'
+                self.names[source].append(index)
+
+    def candidates(self, system_info, source):
+        ''' Rules which may match *source*, in the policy order
+
+        Every rule whose source specification matches *source* is returned,
+        but some other may be returned too.
+        '''
+        domain_info = system_info['domains'].get(source)
+        if domain_info is None:
+            # not a domain name, let PolicyRule.is_match sort it out
+            return iter(self.rules)
+        buckets = [
+            self.names.get('@adminvm' if source == 'dom0' else source, ()),
+            self.types.get(domain_info['type'], ()),
+            self.wildcard,
+        ]
+        buckets.extend(self.tags.get(tag, ()) for tag in domain_info['tags'])
+        return self._merge([bucket for bucket in buckets if bucket])
+
+    def _merge(self, buckets):
+        last = None
+        for index in heapq.merge(*buckets):
+            # the same tag can be listed twice
+            if index != last:
+                last = index
+                yield self.rules[index]
+
+
 class PolicyAction(object):
     ''' Object representing positive policy evaluation result -
     either ask or allow action '''
@@ -454,81 +518,8 @@ class PolicyAction(object):
         assert self.action == Action.allow
         assert self.target is not None
 
-        if self.target == '@adminvm':
-            self.target = 'dom0'
-        if self.target == 'dom0':
-            original_target_type = \
-                'keyword' if is_special_value(self.original_target) else 'name'
-            original_target = self.original_target.lstrip('@')
-            cmd = \
-                'QUBESRPC {service} {source} {original_target_type} ' \
-                '{original_target}'.format(
-                    service=self.service,
-                    source=self.source,
-                    original_target_type=original_target_type,
-                    original_target=original_target)
-        else:
-            cmd = '{user}:QUBESRPC {service} {source}'.format(
-                user=(self.rule.override_user or 'DEFAULT'),
-                service=self.service,
-                source=self.source)
-        if self.target.startswith('@dispvm:'):
-            target = self.spawn_dispvm()
-            dispvm = True
-        else:
-            target = self.target
-            dispvm = False
-            self.ensure_target_running()
-        qrexec_opts = ['-d', target, '-c', caller_ident]
-        if dispvm:
-            qrexec_opts.append('-W')
-        # XXX remove when #951 gets fixed
-        if self.source == target:
-            raise AccessDenied('loopback qrexec connection not supported')
-        try:
-            subprocess.call([QREXEC_CLIENT] + qrexec_opts + [cmd])
-        finally:
-            if dispvm:
-                self.cleanup_dispvm(target)
-
-
-    def spawn_dispvm(self):
-        '''
-        Create and start Disposable VM based on AppVM specified in
-        :py:attr:`target`
-        :return: name of new Disposable VM
-        '''
-        base_appvm = self.target.split(':', 1)[1]
-        dispvm_name = qubesd_call(base_appvm, 'admin.vm.CreateDisposable')
-        dispvm_name = dispvm_name.decode('ascii')
-        qubesd_call(dispvm_name, 'admin.vm.Start')
-        return dispvm_name
-
-    def ensure_target_running(self):
-        '''
-        Start domain if not running already
-
-        :return: None
-        '''
-        if self.target == 'dom0':
-            return
-        try:
-            qubesd_call(self.target, 'admin.vm.Start')
-        except QubesMgmtException as e:
-            if e.exc_type == 'QubesVMNotHaltedError':
-                pass
-            else:
-                raise
-
-    @staticmethod
-    def cleanup_dispvm(dispvm):
-        '''
-        Kill and remove Disposable VM
-
-        :param dispvm: name of Disposable VM
-        :return: None
-        '''
-        qubesd_call(dispvm, 'admin.vm.Kill')
+        call.execute(self.service, self.source, self.target,
+            self.original_target, caller_ident, self.rule.override_user)
 
 
 class Policy(object):
@@ -546,12 +537,7 @@ class Policy(object):
     '''
 
     def __init__(self, service, policy_dir=POLICY_DIR):
-        policy_file = os.path.join(policy_dir, service)
-        if not os.path.exists(policy_file):
-            # fallback to policy without specific argument set (if any)
-            policy_file = os.path.join(policy_dir, service.split('+')[0])
-        if not os.path.exists(policy_file):
-            raise PolicyNotFound(service)
+        policy_file = self.find_policy_file(service, policy_dir)
 
         #: policy storage directory
         self.policy_dir = policy_dir
@@ -561,42 +547,77 @@ class Policy(object):
 
         #: list of PolicyLine objects
         self.policy_rules = []
+
+        #: files the rules were loaded from, including @include-d ones
+        self.policy_files = []
+        self._digest = hashlib.sha256()
         try:
             self.load_policy_file(policy_file)
         except OSError as e:
             raise AccessDenied(
                 'failed to load {} file: {!s}'.format(e.filename, e))
+        #: hash of names and contents of :py:attr:`policy_files`
+        self.policy_hash = self._digest.hexdigest()
+        del self._digest
+        self._source_index = SourceIndex(self.policy_rules)
+
+    @staticmethod
+    def find_policy_file(service, policy_dir=POLICY_DIR):
+        ''' Find the policy file for a given service
+
+        :raise PolicyNotFound: when there is no policy for the service
+        :return: path of the file
+        '''
+        policy_file = os.path.join(policy_dir, service)
+        if not os.path.exists(policy_file):
+            # fallback to policy without specific argument set (if any)
+            policy_file = os.path.join(policy_dir, service.split('+')[0])
+        if not os.path.exists(policy_file):
+            raise PolicyNotFound(service)
+        return policy_file
 
     def load_policy_file(self, path):
         ''' Load policy file and append rules to :py:attr:`policy_rules`
 
         :param path: file to load
         '''
+        self.policy_files.append(path)
         with open(path) as policy_file:
-            for lineno, line in zip(itertools.count(start=1),
-                    policy_file.readlines()):
-                line = line.strip()
-                # compatibility with old keywords notation
-                line = line.replace('$', '@')
-                if not line:
-                    # skip empty lines
-                    continue
-                if line[0] == '#':
-                    # skip comments
-                    continue
-                if line.startswith('@include:'):
-                    include_path = line.split(':', 1)[1]
-                    # os.path.join will leave include_path unchanged if it's
-                    # already absolute
-                    include_path = os.path.join(self.policy_dir, include_path)
-                    self.load_policy_file(include_path)
-                else:
-                    self.policy_rules.append(PolicyRule(line, path, lineno))
+            lines = policy_file.readlines()
+        self._digest.update('{}\0{}\0'.format(path, ''.join(lines)).encode())
+        for lineno, line in zip(itertools.count(start=1), lines):
+            line = line.strip()
+            # compatibility with old keywords notation
+            line = line.replace('$', '@')
+            if not line:
+                # skip empty lines
+                continue
+            if line[0] == '#':
+                # skip comments
+                continue
+            if line.startswith('@include:'):
+                include_path = line.split(':', 1)[1]
+                # os.path.join will leave include_path unchanged if it's
+                # already absolute
+                include_path = os.path.join(self.policy_dir, include_path)
+                self.load_policy_file(include_path)
+            else:
+                self.policy_rules.append(PolicyRule(line, path, lineno))
+
+    @property
+    def source_index(self):
+        ''' :py:class:`SourceIndex` of :py:attr:`policy_rules`, built again
+        if rules were appended or the list replaced '''
+        index = getattr(self, '_source_index', None)
+        if index is None or index.rules is not self.policy_rules or \
+                index.size != len(self.policy_rules):
+            index = self._source_index = SourceIndex(self.policy_rules)
+        return index
 
     def find_matching_rule(self, system_info, source, target):
         ''' Find the first rule matching given arguments '''
 
-        for rule in self.policy_rules:
+        for rule in self.source_index.candidates(system_info, source):
             if rule.is_match(system_info, source, target):
                 return rule
         raise AccessDenied('no matching rule found')
@@ -612,7 +633,8 @@ class Policy(object):
 
         # iterate over rules in reversed order to easier handle 'deny'
         # actions - simply remove matching domains from allowed set
-        for rule in reversed(self.policy_rules):
+        for rule in reversed(list(
+                self.source_index.candidates(system_info, source))):
             if rule.is_match_single(system_info, rule.source, source):
                 if rule.action == Action.deny:
                     targets -= set(rule.expand_target(system_info))
@@ -656,6 +678,18 @@ class Policy(object):
         if target == '':
             target = '@default'
         rule = self.find_matching_rule(system_info, source, target)
+        return self.evaluate_rule(system_info, source, target, rule)
+
+    def evaluate_rule(self, system_info, source, target, rule,
+            targets_for_ask=None):
+        ''' Evaluate policy, knowing *rule* is the first rule matching given
+        arguments (see :py:meth:`find_matching_rule`)
+
+        :param targets_for_ask: result of :py:meth:`collect_targets_for_ask` \
+            for *source*, if already known
+        :raise AccessDenied: when action should be denied unconditionally
+        :return: :py:class:`PolicyAction`, like :py:meth:`evaluate`
+        '''
         if rule.action == Action.deny:
             raise AccessDenied(
                 'denied by policy {}:{}'.format(rule.filename, rule.lineno))
@@ -673,8 +707,10 @@ class Policy(object):
             if rule.override_target is not None:
                 targets = [actual_target]
             else:
-                targets = list(
-                    self.collect_targets_for_ask(system_info, source))
+                if targets_for_ask is None:
+                    targets_for_ask = self.collect_targets_for_ask(
+                        system_info, source)
+                targets = list(targets_for_ask)
             if not targets:
                 raise AccessDenied(
                     'policy define \'ask\' action at {}:{} but no target is '
@@ -705,45 +741,88 @@ class Policy(object):
                 'invalid action?! {}:{}'.format(rule.filename, rule.lineno))
 
 
-class QubesMgmtException(Exception):
-    ''' Exception returned by qubesd '''
-    def __init__(self, exc_type):
-        super(QubesMgmtException, self).__init__()
-        self.exc_type = exc_type
+class DecisionCache(object):
+    ''' Cache of policy evaluation results
 
+    Results of :py:meth:`Policy.evaluate` (including denials) are cached by
+    service, source, target, hash of the policy files
+    (:py:attr:`Policy.policy_hash`) and generation of system information
+    (see :py:func:`read_system_info`). All entries are dropped when the
+    generation changes; entries of changed policy are not used anymore
+    because of the different hash, and get removed as the least recently
+    used ones.
 
-def qubesd_call(dest, method, arg=None, payload=None):
-    if method.startswith('internal.'):
-        socket_path = QUBESD_INTERNAL_SOCK
-    else:
-        socket_path = QUBESD_SOCK
+    Thread-safe.
+
+    :param maxsize: maximum number of cached results
+    '''
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        #: generation of system information of cached results
+        self.generation = None
+        self.entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def evaluate(self, policy, system_info, generation, source, target):
+        ''' Evaluate *policy* like :py:meth:`Policy.evaluate`, or return
+        the cached result
+
+        :param generation: generation of *system_info*, \
+            :py:obj:`None` disables caching
+        '''
+        if generation is None:
+            return policy.evaluate(system_info, source, target)
+        key = (policy.service, source, target, policy.policy_hash)
+        with self._lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+            result = self.entries.get(key)
+            if result is not None:
+                self.entries.move_to_end(key)
+        if result is None:
+            try:
+                result = policy.evaluate(system_info, source, target)
+            except AccessDenied as e:
+                result = e
+            with self._lock:
+                if generation == self.generation:
+                    self.entries[key] = result
+                    if len(self.entries) > self.maxsize:
+                        self.entries.popitem(last=False)
+        # the caller can modify the action (or the exception)
+        result = copy.copy(result)
+        if isinstance(result, AccessDenied):
+            raise result
+        return result
+
+
+# (generation, system_info) of the last snapshot read by read_system_info()
+_system_info_cache = (None, None)
+
+
+def read_system_info():
+    ''' Get system information, with its generation number
+
+    The snapshot published by qubesd is used if available, and parsed only
+    if it changed since the last call. Otherwise qubesd is asked for it.
+
+    :return: tuple (generation, system_info), generation is \
+        :py:obj:`None` if the information was not taken from the snapshot
+    '''
+    global _system_info_cache  # pylint: disable=global-statement
     try:
-        client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        client_socket.connect(socket_path)
-    except IOError:
-        # TODO:
-        raise
-
-    # src, method, dest, arg
-    for call_arg in ('dom0', method, dest, arg):
-        if call_arg is not None:
-            client_socket.sendall(call_arg.encode('ascii'))
-        client_socket.sendall(b'\0')
-    if payload is not None:
-        client_socket.sendall(payload)
-
-    client_socket.shutdown(socket.SHUT_WR)
-
-    return_data = client_socket.makefile('rb').read()
-    if return_data.startswith(b'0\x00'):
-        return return_data[2:]
-    elif return_data.startswith(b'2\x00'):
-        (_, exc_type, _traceback, _format_string, _args) = \
-            return_data.split(b'\x00', 4)
-        raise QubesMgmtException(exc_type.decode('ascii'))
-    else:
-        raise AssertionError(
-            'invalid qubesd response: {!r}'.format(return_data))
+        with open(SYSTEM_INFO_PATH, 'rb') as info_file:
+            generation = int(info_file.readline())
+            if generation == _system_info_cache[0]:
+                return _system_info_cache
+            system_info = json.loads(info_file.read().decode('utf-8'))
+    except FileNotFoundError:
+        system_info = qubesd_call('dom0', 'internal.GetSystemInfo')
+        return None, json.loads(system_info.decode('utf-8'))
+    _system_info_cache = (generation, system_info)
+    return _system_info_cache
 
 
 def get_system_info():
@@ -759,7 +838,8 @@ def get_system_info():
           - template_for_dispvms: should DispVM based on this VM be allowed
           - default_dispvm: name of default AppVM for DispVMs started from here
 
+    The returned structure may be shared with other callers and must not be
+    modified. See :py:func:`read_system_info`.
     '''
 
-    system_info = qubesd_call('dom0', 'internal.GetSystemInfo')
-    return json.loads(system_info.decode('utf-8'))
+    return read_system_info()[1]
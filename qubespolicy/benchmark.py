@@ -0,0 +1,306 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+
+''' Benchmark of qrexec policy evaluation, on a synthetic policy
+
+Usage: ``python3 -m qubespolicy.benchmark [--help]``
+
+Compared are:
+
+- *cold start* - a new process for each call, parsing the policy (like
+  :program:`qrexec-policy` without the daemon); system information is
+  loaded from a file instead of asking qubesd, so the real cost is higher
+- *thin client* - a new :program:`qrexec-policy` process for each call,
+  asking :program:`qrexec-policy-daemon` for the decision (see
+  ``--client``)
+- *daemon round trip* - a call to the daemon, without starting a process
+- *daemon evaluation* - evaluation of the policy kept by the daemon
+- *cached evaluation* - the same, through the daemon's decision cache
+  (the round trip uses it too)
+- *linear matching* - finding the matching rule by checking all rules in
+  order
+- *indexed matching* - finding the matching rule using
+  :py:class:`qubespolicy.SourceIndex`
+
+All of them make the same calls, picked from a set of ``--distinct-calls``.
+
+Use ``--lines 10000`` for large policies. With ``--generate DIR``, the
+synthetic policy is written to ``DIR/policy`` (and system information to
+``DIR/system_info.json``) instead.
+'''
+
+import argparse
+import importlib.machinery
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import qubespolicy
+import qubespolicy.daemon
+
+parser = argparse.ArgumentParser(
+    description='Benchmark qrexec policy evaluation')
+parser.add_argument('--domains', type=int, default=50,
+    help='Number of domains (default: %(default)s)')
+parser.add_argument('--tags', type=int, default=10,
+    help='Number of distinct tags of domains (default: %(default)s)')
+parser.add_argument('--services', type=int, default=20,
+    help='Number of services (default: %(default)s)')
+parser.add_argument('--lines', type=int, default=100,
+    help='Number of policy lines of each service (default: %(default)s)')
+parser.add_argument('--distinct-calls', type=int, default=200,
+    help='Number of distinct calls (service, source, target), repeated '
+         'during measurements (default: %(default)s)')
+parser.add_argument('--duration', type=float, default=3,
+    help='Duration of each measurement, in seconds (default: %(default)s)')
+parser.add_argument('--generate', metavar='DIR',
+    help='Only generate the policy and system information into *DIR*')
+parser.add_argument('--seed', type=int, default=0,
+    help='Random seed for the generated policy (default: %(default)s)')
+
+#: :program:`qrexec-policy` in the source tree, if running from there
+SOURCE_CLIENT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'qvm-tools', 'qrexec-policy')
+parser.add_argument('--client', metavar='PATH',
+    default=SOURCE_CLIENT if os.path.exists(SOURCE_CLIENT)
+        else '/usr/bin/qrexec-policy',
+    help='qrexec-policy to measure (default: %(default)s)')
+
+COLD_START_SCRIPT = '''
+import json, sys
+import qubespolicy
+policy_dir, system_info_path, service, source, target = sys.argv[1:]
+with open(system_info_path) as system_info_file:
+    system_info = json.load(system_info_file)
+try:
+    qubespolicy.Policy(service, policy_dir).evaluate(
+        system_info, source, target)
+except qubespolicy.AccessDenied:
+    pass
+'''
+
+
+def load_client(path=SOURCE_CLIENT):
+    ''' Load :program:`qrexec-policy` from *path* as a module (it is a
+    script, not a part of :py:mod:`qubespolicy`) '''
+    loader = importlib.machinery.SourceFileLoader('qrexec_policy', path)
+    module = types.ModuleType(loader.name)
+    module.__file__ = path
+    loader.exec_module(module)
+    return module
+
+
+def generate_system_info(domains, tags=10, rand=random):
+    ''' Generate system information with *domains* domains (besides dom0),
+    each with one of *tags* tags, as returned by
+    :py:func:`qubespolicy.get_system_info` '''
+    system_info = {'domains': {
+        'dom0': {
+            'tags': [],
+            'type': 'AdminVM',
+            'default_dispvm': 'vm0',
+            'template_for_dispvms': False,
+            'icon': 'black',
+        },
+    }}
+    for index in range(domains):
+        system_info['domains']['vm{}'.format(index)] = {
+            'tags': ['tag{}'.format(rand.randrange(tags))],
+            'type': rand.choice(['AppVM', 'AppVM', 'AppVM', 'TemplateVM']),
+            'default_dispvm': 'vm0',
+            'template_for_dispvms': index == 0,
+            'icon': 'red',
+        }
+    return system_info
+
+
+def generate_policy_lines(system_info, lines, rand=random):
+    ''' Generate *lines* policy lines for domains of *system_info*, mostly
+    rules for specific domain pairs, some for tags and few for types,
+    ending with a wildcard rule '''
+    domains = sorted(system_info['domains'])
+    tags = sorted(set(itertools.chain.from_iterable(
+        domain_info['tags']
+        for domain_info in system_info['domains'].values())))
+    for _ in range(lines - 1):
+        kind = rand.randrange(100)
+        if kind < 80:
+            source, target = rand.sample(domains, 2)
+        elif kind < 99:
+            source = '@tag:' + rand.choice(tags)
+            target = rand.choice(domains + ['@anyvm', '@default'])
+        else:
+            source = '@type:' + rand.choice(['AppVM', 'TemplateVM'])
+            target = rand.choice(['@anyvm', '@dispvm', '@dispvm:vm0'])
+        if target == '@default':
+            action = 'ask'
+        else:
+            action = rand.choice(['allow', 'deny', 'ask'])
+        yield '{} {} {}'.format(source, target, action)
+    yield '@anyvm @anyvm deny'
+
+
+def generate_policy(policy_dir, system_info, services, lines, rand=random):
+    ''' Write policy files of *services* services, each with *lines* lines
+    (the last half of them ``@include:``-d from a common file) into
+    *policy_dir*; return the service names '''
+    os.makedirs(os.path.join(policy_dir, 'include'), exist_ok=True)
+    common_lines = lines // 2
+    with open(os.path.join(policy_dir, 'include', 'common'), 'w') as \
+            policy_file:
+        for line in generate_policy_lines(system_info, common_lines, rand):
+            policy_file.write(line + '\n')
+    service_names = []
+    for index in range(services):
+        service = 'benchmark.Service{}'.format(index)
+        with open(os.path.join(policy_dir, service), 'w') as policy_file:
+            for line in generate_policy_lines(system_info,
+                    lines - common_lines, rand):
+                # the wildcard rule is in the included file
+                if not line.startswith('@anyvm @anyvm'):
+                    policy_file.write(line + '\n')
+            policy_file.write('@include:include/common\n')
+        service_names.append(service)
+    return service_names
+
+
+def measure(func, duration):
+    ''' Call *func* repeatedly for *duration* seconds and return calls per
+    second '''
+    count = 0
+    start = time.monotonic()
+    end = start + duration
+    while True:
+        func()
+        count += 1
+        now = time.monotonic()
+        if now >= end:
+            return count / (now - start)
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    rand = random.Random(args.seed)
+    system_info = generate_system_info(args.domains, args.tags, rand)
+    domains = sorted(system_info['domains'])
+
+    if args.generate:
+        generate_policy(os.path.join(args.generate, 'policy'), system_info,
+            args.services, args.lines, rand)
+        with open(os.path.join(args.generate, 'system_info.json'),
+                'w') as info_file:
+            json.dump(system_info, info_file)
+        return 0
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        policy_dir = os.path.join(tmpdir, 'policy.d')
+        services = generate_policy(policy_dir, system_info, args.services,
+            args.lines, rand)
+        system_info_path = os.path.join(tmpdir, 'system_info.json')
+        with open(system_info_path, 'w') as info_file:
+            json.dump(system_info, info_file)
+        socket_path = os.path.join(tmpdir, 'policy.sock')
+
+        calls = [(rand.choice(services),) + tuple(rand.sample(domains, 2))
+            for _ in range(args.distinct_calls)]
+
+        def random_call():
+            return rand.choice(calls)
+
+        def cold_start():
+            service, source, target = random_call()
+            subprocess.check_call([sys.executable, '-c', COLD_START_SCRIPT,
+                policy_dir, system_info_path, service, source, target])
+
+        def thin_client():
+            service, source, target = random_call()
+            subprocess.call([sys.executable, args.client,
+                '--daemon-socket', socket_path, '--just-evaluate', '0',
+                source, target, service, 'ident'])
+
+        def round_trip():
+            service, source, target = random_call()
+            # pylint: disable=no-member
+            client.call_daemon({'daemon_socket': socket_path,
+                'domain': source, 'target': target, 'service_name': service})
+
+        def evaluation():
+            service, source, target = random_call()
+            try:
+                store.get(service).evaluate(system_info, source, target)
+            except qubespolicy.AccessDenied:
+                pass
+
+        def cached_evaluation():
+            service, source, target = random_call()
+            try:
+                server.decision_cache.evaluate(store.get(service),
+                    system_info, 1, source, target)
+            except qubespolicy.AccessDenied:
+                pass
+
+        def linear_matching():
+            service, source, target = random_call()
+            for rule in store.get(service).policy_rules:
+                if rule.is_match(system_info, source, target):
+                    break
+
+        def indexed_matching():
+            service, source, target = random_call()
+            try:
+                store.get(service).find_matching_rule(system_info, source,
+                    target)
+            except qubespolicy.AccessDenied:
+                pass
+
+        client = load_client(args.client)
+        store = qubespolicy.daemon.PolicyStore(policy_dir, watch=False)
+        start = time.monotonic()
+        store.load_all()
+        print('daemon start: {:.3f} s to load {} policy files'.format(
+            time.monotonic() - start, len(services)))
+        server = qubespolicy.daemon.PolicyServer(socket_path, store,
+            lambda: (1, system_info))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            for name, func in (
+                    ('cold start', cold_start),
+                    ('thin client', thin_client),
+                    ('daemon round trip', round_trip),
+                    ('daemon evaluation', evaluation),
+                    ('cached evaluation', cached_evaluation),
+                    ('linear matching', linear_matching),
+                    ('indexed matching', indexed_matching)):
+                print('{:<20}{:>12.1f} evaluations/s'.format(name,
+                    measure(func, args.duration)))
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+            store.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+
+''' Asking the user about and starting qrexec calls allowed by the policy
+
+This is used both by :py:class:`qubespolicy.PolicyAction` and by
+:program:`qrexec-policy`, which loads this module without the rest of
+:py:mod:`qubespolicy` (see :py:func:`load_call` there) to keep its startup
+fast - so it must not import anything but the modules it needs already.
+'''
+
+import os
+import socket
+
+QREXEC_CLIENT = '/usr/lib/qubes/qrexec-client'
+QUBESD_INTERNAL_SOCK = '/var/run/qubesd.internal.sock'
+QUBESD_SOCK = '/var/run/qubesd.sock'
+
+
+class AccessDenied(Exception):
+    ''' Raised when qrexec policy denied access '''
+
+
+class QubesMgmtException(Exception):
+    ''' Exception returned by qubesd '''
+    def __init__(self, exc_type):
+        super(QubesMgmtException, self).__init__(exc_type)
+        self.exc_type = exc_type
+
+
+def qubesd_call(dest, method, arg=None, payload=None):
+    ''' Call *method* of qubesd on *dest*, as dom0
+
+    :return: response data
+    :raises QubesMgmtException: if qubesd returned an exception
+    '''
+    if method.startswith('internal.'):
+        socket_path = QUBESD_INTERNAL_SOCK
+    else:
+        socket_path = QUBESD_SOCK
+    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client_socket.connect(socket_path)
+
+    # src, method, dest, arg
+    for call_arg in ('dom0', method, dest, arg):
+        if call_arg is not None:
+            client_socket.sendall(call_arg.encode('ascii'))
+        client_socket.sendall(b'\0')
+    if payload is not None:
+        client_socket.sendall(payload)
+
+    client_socket.shutdown(socket.SHUT_WR)
+
+    return_data = client_socket.makefile('rb').read()
+    if return_data.startswith(b'0\x00'):
+        return return_data[2:]
+    if return_data.startswith(b'2\x00'):
+        (_, exc_type, _traceback, _format_string, _args) = \
+            return_data.split(b'\x00', 4)
+        raise QubesMgmtException(exc_type.decode('ascii'))
+    raise AssertionError(
+        'invalid qubesd response: {!r}'.format(return_data))
+
+
+def ask(source, service, targets_for_ask, default_target, icons):
+    ''' Ask the user (through the policy agent) to confirm the call and
+    choose its target
+
+    :param icons: dict of icon names, by domain name (or ``@dispvm:...``)
+    :return: target chosen by the user, :py:obj:`None` if the call was \
+        denied
+    '''
+    # late import, needed only for 'ask' action
+    import pydbus
+    bus = pydbus.SystemBus()
+    proxy = bus.get('org.qubesos.PolicyAgent', '/org/qubesos/PolicyAgent')
+    response = proxy.Ask(source, service, targets_for_ask,
+        default_target or '', icons)
+    if response and response in targets_for_ask:
+        return response
+    return None
+
+
+def spawn_dispvm(base_appvm):
+    ''' Create and start Disposable VM based on *base_appvm*
+
+    :return: name of new Disposable VM
+    '''
+    dispvm_name = qubesd_call(base_appvm, 'admin.vm.CreateDisposable')
+    dispvm_name = dispvm_name.decode('ascii')
+    qubesd_call(dispvm_name, 'admin.vm.Start')
+    return dispvm_name
+
+
+def ensure_target_running(target):
+    ''' Start domain *target* if not running already '''
+    if target == 'dom0':
+        return
+    try:
+        qubesd_call(target, 'admin.vm.Start')
+    except QubesMgmtException as e:
+        if e.exc_type != 'QubesVMNotHaltedError':
+            raise
+
+
+def cleanup_dispvm(dispvm):
+    ''' Kill and remove Disposable VM *dispvm* '''
+    qubesd_call(dispvm, 'admin.vm.Kill')
+
+
+def execute(service, source, target, original_target, caller_ident,
+        user=None):
+    ''' Execute allowed service call
+
+    :param target: target domain, ``@dispvm:BASE`` for a new Disposable VM
+    :param original_target: target specified by the caller
+    :param caller_ident: service caller ident \
+        (``process_ident,source_name,source_id``)
+    :param user: user to run the service as, :py:obj:`None` for the default
+    '''
+    if target == '@adminvm':
+        target = 'dom0'
+    if target == 'dom0':
+        cmd = 'QUBESRPC {} {} {} {}'.format(service, source,
+            'keyword' if original_target.startswith('@') else 'name',
+            original_target.lstrip('@'))
+    else:
+        cmd = '{}:QUBESRPC {} {}'.format(user or 'DEFAULT', service, source)
+    # XXX remove when #951 gets fixed
+    if source == target:
+        raise AccessDenied('loopback qrexec connection not supported')
+    dispvm = None
+    if target.startswith('@dispvm:'):
+        target = dispvm = spawn_dispvm(target.split(':', 1)[1])
+    else:
+        ensure_target_running(target)
+    qrexec_opts = ['-d', target, '-c', caller_ident]
+    if dispvm:
+        qrexec_opts.append('-W')
+    try:
+        # not subprocess, to save on its import
+        os.spawnv(os.P_WAIT, QREXEC_CLIENT,
+            [QREXEC_CLIENT] + qrexec_opts + [cmd])
+    finally:
+        if dispvm:
+            cleanup_dispvm(dispvm)
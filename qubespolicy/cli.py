@@ -61,17 +61,45 @@ def create_default_policy(service_name):
         policy.write("@anyvm  @anyvm  ask\n")
 
 
-def main(args=None):
-    args = parser.parse_args(args)
-
-    # Add source domain information, required by qrexec-client for establishing
-    # connection
-    caller_ident = args.process_ident + "," + args.domain + "," + args.domain_id
+def setup_logging():
     log = logging.getLogger('qubespolicy')
     log.setLevel(logging.INFO)
     if not log.handlers:
         handler = logging.handlers.SysLogHandler(address='/dev/log')
         log.addHandler(handler)
+    return log
+
+
+def get_icons(system_info):
+    ''' Icons of domains (and of ``@dispvm:`` targets), for asking the
+    user '''
+    icons = {name: system_info['domains'][name]['icon']
+        for name in system_info['domains'].keys()}
+    for dispvm_base in system_info['domains']:
+        if not (system_info['domains'][dispvm_base]
+                ['template_for_dispvms']):
+            continue
+        dispvm_api_name = '@dispvm:' + dispvm_base
+        icons[dispvm_api_name] = \
+            system_info['domains'][dispvm_base]['icon']
+        icons[dispvm_api_name] = \
+            icons[dispvm_api_name].replace('app', 'disp')
+    return icons
+
+
+def handle_request(args):
+    ''' Evaluate the policy for a call and execute it, in-process
+
+    :program:`qrexec-policy` does this when qrexec-policy-daemon is not
+    running.
+
+    :param args: call arguments, as parsed by :py:data:`parser`
+    :return: exit code, 0 when the call was allowed
+    '''
+    # Add source domain information, required by qrexec-client for establishing
+    # connection
+    caller_ident = args.process_ident + "," + args.domain + "," + args.domain_id
+    log = logging.getLogger('qubespolicy')
     log_prefix = 'qrexec: {}: {} -> {}:'.format(
         args.service_name, args.domain, args.target)
     try:
@@ -106,26 +134,9 @@ def main(args=None):
                 qubespolicy.Action.ask: 1,
             }[action.action]
         if action.action == qubespolicy.Action.ask:
-            # late import to save on time for allow/deny actions
-            import pydbus
-            bus = pydbus.SystemBus()
-            proxy = bus.get('org.qubesos.PolicyAgent',
-                '/org/qubesos/PolicyAgent')
-
-            icons = {name: system_info['domains'][name]['icon']
-                for name in system_info['domains'].keys()}
-            for dispvm_base in system_info['domains']:
-                if not (system_info['domains'][dispvm_base]
-                        ['template_for_dispvms']):
-                    continue
-                dispvm_api_name = '@dispvm:' + dispvm_base
-                icons[dispvm_api_name] = \
-                    system_info['domains'][dispvm_base]['icon']
-                icons[dispvm_api_name] = \
-                    icons[dispvm_api_name].replace('app', 'disp')
-
-            response = proxy.Ask(args.domain, args.service_name,
-                action.targets_for_ask, action.target or '', icons)
+            response = qubespolicy.call.ask(args.domain, args.service_name,
+                action.targets_for_ask, action.target,
+                get_icons(system_info))
             if response:
                 action.handle_user_response(True, response)
             else:
@@ -140,5 +151,11 @@ def main(args=None):
         return 1
     return 0
 
+
+def main(args=None):
+    args = parser.parse_args(args)
+    setup_logging()
+    return handle_request(args)
+
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,342 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+
+''' Resident qrexec policy daemon
+
+:program:`qrexec-policy` runs in a new process for each qrexec call, and
+would need to parse the policy (with all the ``@include:``-d files) each
+time. Instead, the daemon keeps the policy of all services parsed, and
+:program:`qrexec-policy` just asks it for the decision. Policy files are
+watched with inotify, parsed policy is dropped when any of them changes and
+loaded again on the next call.
+'''
+
+import argparse
+import copy
+import ctypes
+import logging
+import os
+import select
+import shutil
+import socketserver
+import struct
+import sys
+import threading
+
+import qubespolicy
+import qubespolicy.cli
+
+parser = argparse.ArgumentParser(description='Evaluate qrexec policy for '
+                                             'qrexec-policy calls')
+parser.add_argument('--socket', metavar='PATH',
+    default=qubespolicy.POLICY_DAEMON_SOCK,
+    help='Listen on *socket*')
+parser.add_argument('--policy-dir', metavar='DIR',
+    default=qubespolicy.POLICY_DIR,
+    help='Look for policy in *policy-dir*')
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_IGNORED = 0x8000
+
+#: maximum size of a request
+MAX_REQUEST_SIZE = 4096
+
+#: request fields sent by :program:`qrexec-policy`, arguments of
+#: :py:meth:`PolicyServer.evaluate`
+REQUEST_FIELDS = ('domain', 'target', 'service_name')
+
+# struct inotify_event, without the name
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+    ''' Directories watched with inotify
+
+    :param callback: called (from the watching thread) on any change in \
+        the watched directories
+    '''
+    mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+        IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    def __init__(self, callback):
+        self.callback = callback
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        #: watched directories, by watch descriptor
+        self.watched = {}
+        self._lock = threading.Lock()
+        self._stop_r, self._stop_w = os.pipe2(os.O_CLOEXEC)
+        self._thread = None
+
+    def watch(self, path):
+        ''' Start watching directory *path* (if not watched yet) '''
+        with self._lock:
+            if path in self.watched.values():
+                return
+            watch_fd = self._libc.inotify_add_watch(self.fd,
+                os.fsencode(path), self.mask)
+            if watch_fd < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno), path)
+            self.watched[watch_fd] = path
+
+    def start(self):
+        ''' Start the watching thread '''
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            readable, _, _ = select.select([self.fd, self._stop_r], [], [])
+            if self._stop_r in readable:
+                return
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                watch_fd, mask, _, length = _INOTIFY_EVENT.unpack_from(data,
+                    offset)
+                offset += _INOTIFY_EVENT.size + length
+                if mask & IN_IGNORED:
+                    # directory removed, it needs to be watched again
+                    with self._lock:
+                        self.watched.pop(watch_fd, None)
+            # any event invalidates everything
+            self.callback()
+
+    def close(self):
+        ''' Stop the watching thread '''
+        os.write(self._stop_w, b'\0')
+        if self._thread is not None:
+            self._thread.join()
+        for fd in (self.fd, self._stop_r, self._stop_w):
+            os.close(fd)
+
+
+class PolicyStore(object):
+    ''' Parsed policy of services, loaded on the first call for each policy
+    file and kept until any of the policy files changes
+
+    :param policy_dir: policy directory
+    :param watch: whether to watch policy files with inotify
+    '''
+
+    def __init__(self, policy_dir=qubespolicy.POLICY_DIR, watch=True):
+        self.policy_dir = policy_dir
+        self.log = logging.getLogger('qubespolicy')
+        #: loaded policy (or exception raised when loading it), by file
+        self.policies = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.inotify = None
+        if watch:
+            self.inotify = Inotify(self.invalidate)
+            self.inotify.watch(self.policy_dir)
+            self.inotify.start()
+
+    def load_all(self):
+        ''' Load the policy of all services '''
+        for service in sorted(os.listdir(self.policy_dir)):
+            if service.startswith('.') or service.endswith('~') or \
+                    os.path.isdir(os.path.join(self.policy_dir, service)):
+                continue
+            try:
+                self.get(service)
+            except qubespolicy.AccessDenied as e:
+                self.log.error('error loading policy: %s', str(e))
+
+    def get(self, service):
+        ''' Return policy for *service*
+
+        :raise PolicyNotFound: when there is no policy for the service
+        :raise AccessDenied: when the policy failed to load
+        '''
+        policy_file = qubespolicy.Policy.find_policy_file(service,
+            self.policy_dir)
+        with self._lock:
+            policy = self.policies.get(policy_file)
+            generation = self._generation
+        if policy is None:
+            try:
+                policy = qubespolicy.Policy(service, self.policy_dir)
+            except qubespolicy.PolicyNotFound:
+                # removed in the meantime, don't cache that
+                raise
+            except qubespolicy.AccessDenied as e:
+                policy = e
+            else:
+                if self.inotify is not None:
+                    self.inotify.watch(self.policy_dir)
+                    for path in policy.policy_files:
+                        self.inotify.watch(os.path.dirname(path))
+            with self._lock:
+                # don't cache it if any file changed while loading
+                if generation == self._generation:
+                    self.policies[policy_file] = policy
+        if isinstance(policy, Exception):
+            raise policy
+        # rules are shared, only the service (with argument) differs
+        policy = copy.copy(policy)
+        policy.service = service
+        return policy
+
+    def invalidate(self):
+        ''' Drop all the loaded policy, because it changed '''
+        with self._lock:
+            self._generation += 1
+            self.policies.clear()
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+
+class PolicyRequestHandler(socketserver.StreamRequestHandler):
+    ''' Handle a single request of :program:`qrexec-policy`, see
+    :py:func:`call_daemon` in it for the protocol '''
+
+    def handle(self):
+        untrusted_request = self.rfile.read(MAX_REQUEST_SIZE)
+        try:
+            request = self.parse_request(untrusted_request)
+        except ValueError as e:
+            self.server.log.error('invalid request: %s', str(e))
+            response = [('result', 'deny')]
+        else:
+            response = self.server.evaluate(**request)
+        self.wfile.write(''.join('{}={}\n'.format(field, value)
+            for field, value in response).encode('ascii'))
+
+    @staticmethod
+    def parse_request(untrusted_request):
+        ''' Parse request of :program:`qrexec-policy`
+
+        :return: dict of :py:data:`REQUEST_FIELDS`
+        :raise ValueError: when the request is invalid
+        '''
+        untrusted_lines = untrusted_request.decode('ascii').splitlines()
+        untrusted_fields = dict(line.split('=', 1)
+            for line in untrusted_lines if '=' in line)
+        if len(untrusted_lines) != len(REQUEST_FIELDS) or \
+                sorted(untrusted_fields) != sorted(REQUEST_FIELDS):
+            raise ValueError('invalid fields')
+        return untrusted_fields
+
+
+class PolicyServer(socketserver.ThreadingMixIn,
+        socketserver.UnixStreamServer):
+    ''' Server evaluating policy for qrexec-policy calls
+
+    Only the decision is returned; asking the user and executing the call
+    is done by :program:`qrexec-policy`, in the caller's process.
+
+    :param socket_path: path of the socket to listen on
+    :param store: :py:class:`PolicyStore` to get the policy from
+    :param read_system_info: function returning system information with \
+        its generation, by default :py:func:`qubespolicy.read_system_info`
+    '''
+    daemon_threads = True
+
+    def __init__(self, socket_path, store, read_system_info=None):
+        self.store = store
+        self.read_system_info = read_system_info or \
+            qubespolicy.read_system_info
+        #: results of evaluation, reused for repeated calls
+        self.decision_cache = qubespolicy.DecisionCache()
+        self.log = logging.getLogger('qubespolicy')
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super(PolicyServer, self).__init__(socket_path, PolicyRequestHandler)
+
+    def evaluate(self, domain, target, service_name):
+        ''' Evaluate the policy for a call
+
+        :return: response fields, as a list of (field, value) tuples
+        '''
+        log_prefix = 'qrexec: {}: {} -> {}:'.format(
+            service_name, domain, target)
+        try:
+            generation, system_info = self.read_system_info()
+        except qubespolicy.QubesMgmtException as e:
+            self.log.error('%s error getting system info: %s',
+                log_prefix, str(e))
+            return [('result', 'deny')]
+        try:
+            policy = self.store.get(service_name)
+            action = self.decision_cache.evaluate(policy, system_info,
+                generation, domain, target)
+        except qubespolicy.PolicyNotFound:
+            # qrexec-policy will ask the user whether to create it
+            return [('result', 'notfound')]
+        except qubespolicy.PolicySyntaxError as e:
+            self.log.error('%s error loading policy: %s', log_prefix, str(e))
+            return [('result', 'deny')]
+        except qubespolicy.AccessDenied as e:
+            self.log.info('%s denied: %s', log_prefix, str(e))
+            return [('result', 'deny')]
+        response = [
+            ('result', action.action.name),
+            ('target', action.target or ''),
+            ('user', action.rule.override_user or ''),
+        ]
+        if action.action == qubespolicy.Action.ask:
+            icons = qubespolicy.cli.get_icons(system_info)
+            response.extend(('target_for_ask', name)
+                for name in action.targets_for_ask)
+            response.extend(('icon', '{} {}'.format(name, icon))
+                for name, icon in sorted(icons.items()))
+        return response
+
+    def server_close(self):
+        super(PolicyServer, self).server_close()
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    qubespolicy.cli.setup_logging()
+    store = PolicyStore(args.policy_dir)
+    store.load_all()
+    os.makedirs(os.path.dirname(args.socket), exist_ok=True)
+    server = PolicyServer(args.socket, store)
+    os.chmod(args.socket, 0o660)
+    shutil.chown(args.socket, group='qubes')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        store.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -18,8 +18,22 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 
+''' Graph of qrexec calls allowed by the policy
+
+The policy of each service is evaluated for all (source, target) pairs at
+once: for each source, only rules with a matching source (see
+:py:class:`qubespolicy.SourceIndex`) are considered, and each of them
+decides all the remaining targets matching its target specification
+(computed once per specification). Services are spread across worker
+processes. With ``--cache-dir``, the result for each service is kept and
+reused while its policy files and system information stay the same, so
+after a change to one policy file only that service is computed again.
+'''
+
 import argparse
+import hashlib
 import json
+import multiprocessing
 import os
 
 import sys
@@ -45,6 +59,12 @@ parser.add_argument('--system-info', action='store',
 parser.add_argument('--skip-labels', action='store_true',
     help='Do not include service names on the graph, also deduplicate '
          'connections.')
+parser.add_argument('--jobs', '-j', action='store', type=int,
+    default=os.cpu_count(),
+    help='Number of worker processes (default: number of CPUs)')
+parser.add_argument('--cache-dir', action='store',
+    help='Keep results for each service in *cache-dir*, and reuse them '
+         'if its policy and system information did not change')
 
 def handle_single_action(args, action):
     '''Get single policy action and output (or not) a line to add'''
@@ -67,6 +87,112 @@ def handle_single_action(args, action):
                 action.source, target, service)
     return ''
 
+def evaluate_all(policy, system_info, sources, targets):
+    '''Evaluate *policy* for all pairs of *sources* and *targets*
+
+    The result is the same as of calling :py:meth:`qubespolicy.Policy.evaluate`
+    for each pair (in the same order), skipping denied calls.
+
+    :return: generator of :py:class:`qubespolicy.PolicyAction`
+    '''
+    # target specification -> matching targets
+    target_sets = {}
+
+    def matching_targets(policy_value):
+        if policy_value not in target_sets:
+            target_sets[policy_value] = set(target for target in targets
+                if target != '@dispvm' and qubespolicy.PolicyRule.
+                    is_match_single(system_info, policy_value, target))
+        return target_sets[policy_value]
+
+    def matches_default_dispvm(policy_value, default_dispvm):
+        # see PolicyRule.is_match
+        if policy_value == '@dispvm':
+            return True
+        if default_dispvm is None:
+            return policy_value == '@anyvm'
+        return qubespolicy.PolicyRule.is_match_single(system_info,
+            policy_value, '@dispvm:' + default_dispvm)
+
+    for source in sources:
+        if source not in system_info['domains']:
+            for target in targets:
+                try:
+                    yield policy.evaluate(system_info, source, target)
+                except qubespolicy.AccessDenied:
+                    continue
+            continue
+        default_dispvm = system_info['domains'][source]['default_dispvm']
+        remaining = set(targets)
+        # target -> first matching rule
+        decisions = {}
+        for rule in policy.source_index.candidates(system_info, source):
+            if not rule.is_match_single(system_info, rule.source, source):
+                continue
+            matched = remaining & matching_targets(rule.target)
+            if '@dispvm' in remaining and \
+                    matches_default_dispvm(rule.target, default_dispvm):
+                matched.add('@dispvm')
+            for target in matched:
+                decisions[target] = rule
+            remaining -= matched
+            if not remaining:
+                break
+
+        targets_for_ask = None
+        for target in targets:
+            rule = decisions.get(target)
+            if rule is None or rule.action == qubespolicy.Action.deny:
+                continue
+            if rule.action == qubespolicy.Action.ask and \
+                    rule.override_target is None and targets_for_ask is None:
+                targets_for_ask = policy.collect_targets_for_ask(system_info,
+                    source)
+            try:
+                yield policy.evaluate_rule(system_info, source, target, rule,
+                    targets_for_ask)
+            except qubespolicy.AccessDenied:
+                continue
+
+# (args, system_info, sources, targets, hash of all of them) of a worker
+_worker_state = None
+
+def init_worker(args, system_info, sources, targets):
+    '''Set up a worker process (or the main one, when not using workers)'''
+    global _worker_state  # pylint: disable=global-statement
+    context = json.dumps([system_info, sources, targets, args.include_ask,
+        args.skip_labels, args.target], sort_keys=True)
+    _worker_state = (args, system_info, sources, targets,
+        hashlib.sha256(context.encode()).hexdigest())
+
+def graph_service(service):
+    '''Compute graph lines for a single service'''
+    args, system_info, sources, targets, context_hash = _worker_state
+    policy = qubespolicy.Policy(service, args.policy_dir)
+    cache_path = None
+    if args.cache_dir:
+        cache_key = context_hash + ' ' + policy.policy_hash
+        cache_path = os.path.join(args.cache_dir, service)
+        try:
+            with open(cache_path) as cache_file:
+                cached = json.load(cache_file)
+            if cached['key'] == cache_key:
+                return cached['lines']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    lines = []
+    for action in evaluate_all(policy, system_info, sources, targets):
+        line = handle_single_action(args, action)
+        if line:
+            lines.append(line)
+
+    if cache_path is not None:
+        with open(cache_path + '~', 'w') as cache_file:
+            json.dump({'key': cache_key, 'lines': lines}, cache_file)
+        os.rename(cache_path + '~', cache_path)
+    return lines
+
 def main(args=None):
     args = parser.parse_args(args)
 
@@ -89,29 +215,41 @@ def main(args=None):
     targets.extend('@dispvm:' + dom for dom in system_info['domains']
         if system_info['domains'][dom]['template_for_dispvms'])
 
-    connections = set()
-
-    output.write('digraph g {\n')
-    for service in os.listdir(args.policy_dir):
+    services = []
+    for service in sorted(os.listdir(args.policy_dir)):
         if os.path.isdir(os.path.join(args.policy_dir, service)):
             continue
         if args.service and service not in args.service and \
                 not any(service.startswith(srv + '+') for srv in args.service):
             continue
+        services.append(service)
 
-        policy = qubespolicy.Policy(service, args.policy_dir)
-        for source in sources:
-            for target in targets:
-                try:
-                    action = policy.evaluate(system_info, source, target)
-                    line = handle_single_action(args, action)
-                    if line in connections:
-                        continue
-                    if line:
-                        output.write(line)
-                    connections.add(line)
-                except qubespolicy.AccessDenied:
+    if args.cache_dir:
+        os.makedirs(args.cache_dir, exist_ok=True)
+
+    connections = set()
+
+    output.write('digraph g {\n')
+    init_args = (args, system_info, sources, targets)
+    if args.jobs > 1 and len(services) > 1:
+        pool = multiprocessing.Pool(min(args.jobs, len(services)),
+            initializer=init_worker, initargs=init_args)
+        results = pool.imap(graph_service, services)
+    else:
+        pool = None
+        init_worker(*init_args)
+        results = map(graph_service, services)
+    try:
+        for lines in results:
+            for line in lines:
+                if line in connections:
                     continue
+                output.write(line)
+                connections.add(line)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
     output.write('}\n')
     if args.output:
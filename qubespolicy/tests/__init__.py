@@ -17,14 +17,18 @@
 #
 # You should have received a copy of the GNU Lesser General Public
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
+import json
 import os
+import random
 import socket
+import tempfile
 import unittest.mock
 
 import shutil
 
 import qubes.tests
 import qubespolicy
+import qubespolicy.benchmark
 
 tmp_policy_dir = '/tmp/policy'
 
@@ -488,48 +492,52 @@ class TC_10_PolicyAction(qubes.tests.QubesTestCase):
         self.assertEqual(action.action, qubespolicy.Action.allow)
         self.assertEqual(action.target, 'test-vm2')
 
-    @unittest.mock.patch('qubespolicy.qubesd_call')
-    @unittest.mock.patch('subprocess.call')
-    def test_020_execute(self, mock_subprocess, mock_qubesd_call):
+    @unittest.mock.patch('qubespolicy.call.qubesd_call')
+    @unittest.mock.patch('os.spawnv')
+    def test_020_execute(self, mock_spawnv, mock_qubesd_call):
         rule = qubespolicy.PolicyRule('@anyvm @anyvm allow')
         action = qubespolicy.PolicyAction('test.service', 'test-vm1',
             'test-vm2', rule, 'test-vm2')
         action.execute('some-ident')
         self.assertEqual(mock_qubesd_call.mock_calls,
             [unittest.mock.call('test-vm2', 'admin.vm.Start')])
-        self.assertEqual(mock_subprocess.mock_calls,
-            [unittest.mock.call([qubespolicy.QREXEC_CLIENT, '-d', 'test-vm2',
-             '-c', 'some-ident', 'DEFAULT:QUBESRPC test.service test-vm1'])])
-
-    @unittest.mock.patch('qubespolicy.qubesd_call')
-    @unittest.mock.patch('subprocess.call')
-    def test_021_execute_dom0(self, mock_subprocess, mock_qubesd_call):
+        self.assertEqual(mock_spawnv.mock_calls,
+            [unittest.mock.call(os.P_WAIT, qubespolicy.QREXEC_CLIENT,
+                [qubespolicy.QREXEC_CLIENT, '-d', 'test-vm2',
+                 '-c', 'some-ident',
+                 'DEFAULT:QUBESRPC test.service test-vm1'])])
+
+    @unittest.mock.patch('qubespolicy.call.qubesd_call')
+    @unittest.mock.patch('os.spawnv')
+    def test_021_execute_dom0(self, mock_spawnv, mock_qubesd_call):
         rule = qubespolicy.PolicyRule('@anyvm dom0 allow')
         action = qubespolicy.PolicyAction('test.service', 'test-vm1',
             'dom0', rule, 'dom0')
         action.execute('some-ident')
         self.assertEqual(mock_qubesd_call.mock_calls, [])
-        self.assertEqual(mock_subprocess.mock_calls,
-            [unittest.mock.call([qubespolicy.QREXEC_CLIENT, '-d', 'dom0',
-             '-c', 'some-ident',
-             'QUBESRPC test.service test-vm1 name dom0'])])
-
-    @unittest.mock.patch('qubespolicy.qubesd_call')
-    @unittest.mock.patch('subprocess.call')
-    def test_021_execute_dom0_keyword(self, mock_subprocess, mock_qubesd_call):
+        self.assertEqual(mock_spawnv.mock_calls,
+            [unittest.mock.call(os.P_WAIT, qubespolicy.QREXEC_CLIENT,
+                [qubespolicy.QREXEC_CLIENT, '-d', 'dom0',
+                 '-c', 'some-ident',
+                 'QUBESRPC test.service test-vm1 name dom0'])])
+
+    @unittest.mock.patch('qubespolicy.call.qubesd_call')
+    @unittest.mock.patch('os.spawnv')
+    def test_021_execute_dom0_keyword(self, mock_spawnv, mock_qubesd_call):
         rule = qubespolicy.PolicyRule('@anyvm dom0 allow')
         action = qubespolicy.PolicyAction('test.service', 'test-vm1',
             'dom0', rule, '@adminvm')
         action.execute('some-ident')
         self.assertEqual(mock_qubesd_call.mock_calls, [])
-        self.assertEqual(mock_subprocess.mock_calls,
-            [unittest.mock.call([qubespolicy.QREXEC_CLIENT, '-d', 'dom0',
-             '-c', 'some-ident',
-             'QUBESRPC test.service test-vm1 keyword adminvm'])])
-
-    @unittest.mock.patch('qubespolicy.qubesd_call')
-    @unittest.mock.patch('subprocess.call')
-    def test_022_execute_dispvm(self, mock_subprocess, mock_qubesd_call):
+        self.assertEqual(mock_spawnv.mock_calls,
+            [unittest.mock.call(os.P_WAIT, qubespolicy.QREXEC_CLIENT,
+                [qubespolicy.QREXEC_CLIENT, '-d', 'dom0',
+                 '-c', 'some-ident',
+                 'QUBESRPC test.service test-vm1 keyword adminvm'])])
+
+    @unittest.mock.patch('qubespolicy.call.qubesd_call')
+    @unittest.mock.patch('os.spawnv')
+    def test_022_execute_dispvm(self, mock_spawnv, mock_qubesd_call):
         rule = qubespolicy.PolicyRule('@anyvm @dispvm:default-dvm allow')
         action = qubespolicy.PolicyAction('test.service', 'test-vm1',
             '@dispvm:default-dvm', rule, '@dispvm:default-dvm')
@@ -541,14 +549,15 @@ class TC_10_PolicyAction(qubes.tests.QubesTestCase):
             [unittest.mock.call('default-dvm', 'admin.vm.CreateDisposable'),
              unittest.mock.call('dispvm-name', 'admin.vm.Start'),
              unittest.mock.call('dispvm-name', 'admin.vm.Kill')])
-        self.assertEqual(mock_subprocess.mock_calls,
-            [unittest.mock.call([qubespolicy.QREXEC_CLIENT, '-d', 'dispvm-name',
-             '-c', 'some-ident', '-W',
-             'DEFAULT:QUBESRPC test.service test-vm1'])])
-
-    @unittest.mock.patch('qubespolicy.qubesd_call')
-    @unittest.mock.patch('subprocess.call')
-    def test_023_execute_already_running(self, mock_subprocess,
+        self.assertEqual(mock_spawnv.mock_calls,
+            [unittest.mock.call(os.P_WAIT, qubespolicy.QREXEC_CLIENT,
+                [qubespolicy.QREXEC_CLIENT, '-d', 'dispvm-name',
+                 '-c', 'some-ident', '-W',
+                 'DEFAULT:QUBESRPC test.service test-vm1'])])
+
+    @unittest.mock.patch('qubespolicy.call.qubesd_call')
+    @unittest.mock.patch('os.spawnv')
+    def test_023_execute_already_running(self, mock_spawnv,
             mock_qubesd_call):
         rule = qubespolicy.PolicyRule('@anyvm @anyvm allow')
         action = qubespolicy.PolicyAction('test.service', 'test-vm1',
@@ -558,13 +567,15 @@ class TC_10_PolicyAction(qubes.tests.QubesTestCase):
         action.execute('some-ident')
         self.assertEqual(mock_qubesd_call.mock_calls,
             [unittest.mock.call('test-vm2', 'admin.vm.Start')])
-        self.assertEqual(mock_subprocess.mock_calls,
-            [unittest.mock.call([qubespolicy.QREXEC_CLIENT, '-d', 'test-vm2',
-             '-c', 'some-ident', 'DEFAULT:QUBESRPC test.service test-vm1'])])
-
-    @unittest.mock.patch('qubespolicy.qubesd_call')
-    @unittest.mock.patch('subprocess.call')
-    def test_024_execute_startup_error(self, mock_subprocess,
+        self.assertEqual(mock_spawnv.mock_calls,
+            [unittest.mock.call(os.P_WAIT, qubespolicy.QREXEC_CLIENT,
+                [qubespolicy.QREXEC_CLIENT, '-d', 'test-vm2',
+                 '-c', 'some-ident',
+                 'DEFAULT:QUBESRPC test.service test-vm1'])])
+
+    @unittest.mock.patch('qubespolicy.call.qubesd_call')
+    @unittest.mock.patch('os.spawnv')
+    def test_024_execute_startup_error(self, mock_spawnv,
             mock_qubesd_call):
         rule = qubespolicy.PolicyRule('@anyvm @anyvm allow')
         action = qubespolicy.PolicyAction('test.service', 'test-vm1',
@@ -575,7 +586,7 @@ class TC_10_PolicyAction(qubes.tests.QubesTestCase):
             action.execute('some-ident')
         self.assertEqual(mock_qubesd_call.mock_calls,
             [unittest.mock.call('test-vm2', 'admin.vm.Start')])
-        self.assertEqual(mock_subprocess.mock_calls, [])
+        self.assertEqual(mock_spawnv.mock_calls, [])
 
 class TC_20_Policy(qubes.tests.QubesTestCase):
 
@@ -842,6 +853,178 @@ class TC_20_Policy(qubes.tests.QubesTestCase):
             policy.evaluate(system_info, 'test-vm3', '@default')
 
 
+    def test_040_source_index(self):
+        with open(os.path.join(tmp_policy_dir, 'test.service'), 'w') as f:
+            f.write('test-vm1 test-vm2 allow\n')
+            f.write('@tag:tag2 @anyvm ask\n')
+            f.write('dom0 test-vm1 allow\n')
+            f.write('@type:TemplateVM @anyvm deny\n')
+            f.write('@adminvm test-vm2 allow\n')
+            f.write('@tag:tag1 test-vm3 allow\n')
+            f.write('@anyvm @anyvm deny\n')
+        policy = qubespolicy.Policy('test.service', tmp_policy_dir)
+        index = policy.source_index
+
+        def candidates(source):
+            return [rule.lineno
+                for rule in index.candidates(system_info, source)]
+
+        self.assertEqual(candidates('test-vm1'), [1, 2, 6, 7])
+        self.assertEqual(candidates('test-vm3'), [7])
+        self.assertEqual(candidates('test-template'), [2, 4, 6, 7])
+        self.assertEqual(candidates('dom0'), [3, 5, 7])
+        # not a domain name, all the rules need to be checked
+        self.assertEqual(candidates('test-no-such-vm'),
+            [1, 2, 3, 4, 5, 6, 7])
+
+    def test_041_source_index_updated(self):
+        with open(os.path.join(tmp_policy_dir, 'test.service'), 'w') as f:
+            f.write('test-vm1 test-vm2 allow\n')
+        policy = qubespolicy.Policy('test.service', tmp_policy_dir)
+        policy.policy_rules.append(
+            qubespolicy.PolicyRule('test-vm2 test-vm1 allow'))
+        self.assertEqual(policy.find_matching_rule(
+            system_info, 'test-vm2', 'test-vm1'), policy.policy_rules[1])
+
+    def test_042_source_index_same_as_linear(self):
+        rand = random.Random(0)
+        with open(os.path.join(tmp_policy_dir, 'test.service'), 'w') as f:
+            f.write('dom0 test-vm1 allow\n')
+            f.write('@adminvm @dispvm allow\n')
+            for line in qubespolicy.benchmark.generate_policy_lines(
+                    system_info, 200, rand):
+                f.write(line + '\n')
+        policy = qubespolicy.Policy('test.service', tmp_policy_dir)
+        # shuffle rules, so the wildcard one is not the last
+        policy.policy_rules = rand.sample(policy.policy_rules,
+            len(policy.policy_rules))
+
+        def linear_find_matching_rule(source, target):
+            for rule in policy.policy_rules:
+                if rule.is_match(system_info, source, target):
+                    return rule
+            return None
+
+        sources = list(system_info['domains']) + ['test-no-such-vm']
+        targets = sources + ['@default', '@dispvm', '@adminvm',
+            '@dispvm:default-dvm', '@dispvm:test-vm3', '@dispvm:test-vm1']
+        for source in sources:
+            for target in targets:
+                try:
+                    rule = policy.find_matching_rule(system_info, source,
+                        target)
+                except qubespolicy.AccessDenied:
+                    rule = None
+                self.assertIs(rule,
+                    linear_find_matching_rule(source, target),
+                    (source, target))
+
+
+class TC_21_DecisionCache(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_21_DecisionCache, self).setUp()
+        if not os.path.exists(tmp_policy_dir):
+            os.mkdir(tmp_policy_dir)
+        self.write_policy('test-vm1 test-vm2 allow\n'
+            'test-vm1 test-vm3 allow\n'
+            'test-vm1 @default ask\n'
+            '@anyvm @anyvm deny\n')
+        self.cache = qubespolicy.DecisionCache()
+
+    def tearDown(self):
+        shutil.rmtree(tmp_policy_dir)
+        super(TC_21_DecisionCache, self).tearDown()
+
+    def write_policy(self, content):
+        with open(os.path.join(tmp_policy_dir, 'test.service'), 'w') as f:
+            f.write(content)
+
+    def evaluate(self, policy, generation, source, target):
+        with unittest.mock.patch.object(policy, 'evaluate',
+                wraps=policy.evaluate) as mock_evaluate:
+            try:
+                return self.cache.evaluate(policy, system_info, generation,
+                    source, target), mock_evaluate.call_count
+            except qubespolicy.AccessDenied as e:
+                return e, mock_evaluate.call_count
+
+    def test_000_hash(self):
+        policy = qubespolicy.Policy('test.service', tmp_policy_dir)
+        policy2 = qubespolicy.Policy('test.service+arg', tmp_policy_dir)
+        self.assertEqual(policy.policy_hash, policy2.policy_hash)
+        self.write_policy('test-vm1 test-vm2 deny\n')
+        policy3 = qubespolicy.Policy('test.service', tmp_policy_dir)
+        self.assertNotEqual(policy.policy_hash, policy3.policy_hash)
+
+    def test_010_cached(self):
+        policy = qubespolicy.Policy('test.service', tmp_policy_dir)
+        action, calls = self.evaluate(policy, 1, 'test-vm1', 'test-vm2')
+        self.assertEqual(calls, 1)
+        self.assertEqual(action.action, qubespolicy.Action.allow)
+        # modifying the result does not affect the cache
+        action.action = qubespolicy.Action.deny
+        action2, calls = self.evaluate(policy, 1, 'test-vm1', 'test-vm2')
+        self.assertEqual(calls, 0)
+        self.assertIsNot(action2, action)
+        self.assertEqual(action2.action, qubespolicy.Action.allow)
+        self.assertEqual(action2.target, 'test-vm2')
+
+        action, calls = self.evaluate(policy, 1, 'test-vm1', '')
+        self.assertEqual(calls, 1)
+        self.assertEqual(action.action, qubespolicy.Action.ask)
+        action.handle_user_response(True, 'test-vm3')
+        action, calls = self.evaluate(policy, 1, 'test-vm1', '')
+        self.assertEqual(calls, 0)
+        self.assertEqual(action.action, qubespolicy.Action.ask)
+        self.assertIsNone(action.target)
+
+    def test_011_cached_deny(self):
+        policy = qubespolicy.Policy('test.service', tmp_policy_dir)
+        for expected_calls in (1, 0):
+            exc, calls = self.evaluate(policy, 1, 'test-vm2', 'test-vm1')
+            self.assertIsInstance(exc, qubespolicy.AccessDenied)
+            self.assertIn('test.service:4', str(exc))
+            self.assertEqual(calls, expected_calls)
+
+    def test_020_invalidate_generation(self):
+        policy = qubespolicy.Policy('test.service', tmp_policy_dir)
+        self.evaluate(policy, 1, 'test-vm1', 'test-vm2')
+        _, calls = self.evaluate(policy, 2, 'test-vm1', 'test-vm2')
+        self.assertEqual(calls, 1)
+        self.assertEqual(len(self.cache.entries), 1)
+        # not cached at all without the generation
+        for _ in range(2):
+            _, calls = self.evaluate(policy, None, 'test-vm1', 'test-vm2')
+            self.assertEqual(calls, 1)
+
+    def test_021_invalidate_policy(self):
+        policy = qubespolicy.Policy('test.service', tmp_policy_dir)
+        self.evaluate(policy, 1, 'test-vm1', 'test-vm2')
+        self.write_policy('test-vm1 test-vm2 deny\n')
+        policy = qubespolicy.Policy('test.service', tmp_policy_dir)
+        exc, calls = self.evaluate(policy, 1, 'test-vm1', 'test-vm2')
+        self.assertEqual(calls, 1)
+        self.assertIsInstance(exc, qubespolicy.AccessDenied)
+
+    def test_022_service_argument(self):
+        policy = qubespolicy.Policy('test.service', tmp_policy_dir)
+        policy2 = qubespolicy.Policy('test.service+arg', tmp_policy_dir)
+        self.evaluate(policy, 1, 'test-vm1', 'test-vm2')
+        action, calls = self.evaluate(policy2, 1, 'test-vm1', 'test-vm2')
+        self.assertEqual(calls, 1)
+        self.assertEqual(action.service, 'test.service+arg')
+
+    def test_030_maxsize(self):
+        self.cache.maxsize = 2
+        policy = qubespolicy.Policy('test.service', tmp_policy_dir)
+        for target in ('test-vm2', 'test-vm3', 'test-vm2', 'dom0'):
+            self.evaluate(policy, 1, 'test-vm1', target)
+        self.assertEqual(list(self.cache.entries), [
+            ('test.service', 'test-vm1', 'test-vm2', policy.policy_hash),
+            ('test.service', 'test-vm1', 'dom0', policy.policy_hash),
+        ])
+
+
 class TC_30_Misc(qubes.tests.QubesTestCase):
     @unittest.mock.patch('socket.socket')
     def test_000_qubesd_call(self, mock_socket):
@@ -917,3 +1100,37 @@ class TC_30_Misc(qubes.tests.QubesTestCase):
             unittest.mock.call().makefile().read(),
         ])
 
+    def write_system_info(self, path, generation, data):
+        with open(path, 'w') as info_file:
+            info_file.write('{}\n'.format(generation))
+            json.dump(data, info_file)
+
+    @unittest.mock.patch('qubespolicy.qubesd_call')
+    def test_010_read_system_info(self, mock_qubesd_call):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'system-info')
+            with unittest.mock.patch('qubespolicy.SYSTEM_INFO_PATH', path):
+                self.write_system_info(path, 5, system_info)
+                generation, info = qubespolicy.read_system_info()
+                self.assertEqual(generation, 5)
+                self.assertEqual(info, system_info)
+                self.assertEqual(qubespolicy.get_system_info(), system_info)
+
+                # unchanged generation, not parsed again
+                self.write_system_info(path, 5, {'domains': {}})
+                self.assertIs(qubespolicy.read_system_info()[1], info)
+
+                self.write_system_info(path, 6, {'domains': {}})
+                self.assertEqual(qubespolicy.read_system_info(),
+                    (6, {'domains': {}}))
+        self.assertEqual(mock_qubesd_call.mock_calls, [])
+
+    @unittest.mock.patch('qubespolicy.qubesd_call')
+    def test_011_read_system_info_qubesd(self, mock_qubesd_call):
+        mock_qubesd_call.return_value = json.dumps(system_info).encode()
+        with unittest.mock.patch('qubespolicy.SYSTEM_INFO_PATH',
+                '/nonexistent/system-info'):
+            self.assertEqual(qubespolicy.read_system_info(),
+                (None, system_info))
+        self.assertEqual(mock_qubesd_call.mock_calls, [
+            unittest.mock.call('dom0', 'internal.GetSystemInfo')])
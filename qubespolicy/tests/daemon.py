@@ -0,0 +1,369 @@
+# -*- encoding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+import copy
+import os
+import tempfile
+import threading
+import time
+import unittest.mock
+
+import qubes.tests
+import qubespolicy
+import qubespolicy.benchmark
+import qubespolicy.daemon
+import qubespolicy.tests
+
+
+class TC_00_PolicyStore(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_00_PolicyStore, self).setUp()
+        self.policy_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.policy_dir.cleanup)
+        os.mkdir(os.path.join(self.policy_dir.name, 'include'))
+        self.write('test.service', '@include:include/common\n')
+        self.write('include/common', 'test-vm1 test-vm2 allow\n')
+
+    def write(self, name, content):
+        with open(os.path.join(self.policy_dir.name, name), 'w') as f:
+            f.write(content)
+
+    def wait_for(self, condition):
+        for _ in range(50):
+            if condition():
+                return
+            time.sleep(0.1)
+        self.fail('condition not met in time')
+
+    def test_000_get_cached(self):
+        store = qubespolicy.daemon.PolicyStore(self.policy_dir.name,
+            watch=False)
+        with unittest.mock.patch('qubespolicy.Policy',
+                wraps=qubespolicy.Policy) as policy_mock:
+            policy = store.get('test.service')
+            self.assertEqual(policy.service, 'test.service')
+            self.assertEqual(len(policy.policy_rules), 1)
+            policy2 = store.get('test.service+arg')
+            self.assertEqual(policy2.service, 'test.service+arg')
+            self.assertIs(policy2.policy_rules, policy.policy_rules)
+            self.assertEqual(policy_mock.call_count, 1)
+
+    def test_001_get_missing(self):
+        store = qubespolicy.daemon.PolicyStore(self.policy_dir.name,
+            watch=False)
+        with self.assertRaises(qubespolicy.PolicyNotFound):
+            store.get('missing.service')
+
+    def test_002_get_invalid(self):
+        self.write('invalid.service', 'test-vm1 test-vm2 invalid\n')
+        store = qubespolicy.daemon.PolicyStore(self.policy_dir.name,
+            watch=False)
+        with unittest.mock.patch('qubespolicy.Policy',
+                wraps=qubespolicy.Policy) as policy_mock:
+            for _ in range(2):
+                with self.assertRaises(qubespolicy.PolicySyntaxError):
+                    store.get('invalid.service')
+            self.assertEqual(policy_mock.call_count, 1)
+
+    def test_003_load_all(self):
+        self.write('invalid.service', 'test-vm1 test-vm2 invalid\n')
+        self.write('test.service~', 'test-vm1 test-vm2 invalid\n')
+        store = qubespolicy.daemon.PolicyStore(self.policy_dir.name,
+            watch=False)
+        store.load_all()
+        self.assertEqual(sorted(os.path.basename(path)
+                for path in store.policies),
+            ['invalid.service', 'test.service'])
+
+    def test_010_reload_on_change(self):
+        store = qubespolicy.daemon.PolicyStore(self.policy_dir.name)
+        self.addCleanup(store.close)
+        self.assertEqual(len(store.get('test.service').policy_rules), 1)
+        # change in an included file
+        self.write('include/common',
+            'test-vm1 test-vm2 allow\ntest-vm2 test-vm1 deny\n')
+        self.wait_for(lambda: not store.policies)
+        self.assertEqual(len(store.get('test.service').policy_rules), 2)
+
+    def test_011_reload_new_file(self):
+        store = qubespolicy.daemon.PolicyStore(self.policy_dir.name)
+        self.addCleanup(store.close)
+        with self.assertRaises(qubespolicy.PolicyNotFound):
+            store.get('new.service')
+        self.write('new.service', 'test-vm1 test-vm2 deny\n')
+        self.assertEqual(len(store.get('new.service').policy_rules), 1)
+
+
+class TC_10_PolicyServer(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_10_PolicyServer, self).setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.socket_path = os.path.join(self.tmpdir.name, 'policy.sock')
+        self.store = unittest.mock.Mock()
+        system_info = copy.deepcopy(qubespolicy.tests.system_info)
+        for domain_info in system_info['domains'].values():
+            domain_info['icon'] = 'appvm-red'
+        self.read_system_info = unittest.mock.Mock(
+            return_value=(1, system_info))
+        self.server = qubespolicy.daemon.PolicyServer(self.socket_path,
+            self.store, self.read_system_info)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+        if not os.path.exists(qubespolicy.benchmark.SOURCE_CLIENT):
+            self.skipTest('qrexec-policy not found')
+        self.client = qubespolicy.benchmark.load_client()
+
+    def call(self, domain, target, service_name):
+        return self.client.call_daemon({'daemon_socket': self.socket_path,
+            'domain': domain, 'target': target, 'service_name': service_name})
+
+    def policy(self, *lines):
+        policy = qubespolicy.Policy.__new__(qubespolicy.Policy)
+        policy.service = 'test.service'
+        policy.policy_hash = 'hash'
+        policy.policy_rules = [qubespolicy.PolicyRule(line, 'test.service',
+            lineno) for lineno, line in enumerate(lines, 1)]
+        self.store.get.return_value = policy
+
+    def test_000_parse_request(self):
+        request = qubespolicy.daemon.PolicyRequestHandler.parse_request(
+            b'domain=test-vm1\ntarget=test-vm2\n'
+            b'service_name=test.service+arg\n')
+        self.assertEqual(request, {
+            'domain': 'test-vm1',
+            'target': 'test-vm2',
+            'service_name': 'test.service+arg',
+        })
+
+    def test_001_parse_request_invalid(self):
+        valid = (b'domain=test-vm1\ntarget=test-vm2\n'
+            b'service_name=test.service\n')
+        for untrusted_request in (
+                b'',
+                valid + b'domain=test-vm2\n',
+                valid + b'extra\n',
+                valid.replace(b'target=', b'target2='),
+                valid.replace(b'test-vm1', b'test-vm\xff'),
+                ):
+            with self.subTest(untrusted_request=untrusted_request):
+                with self.assertRaises(ValueError):
+                    qubespolicy.daemon.PolicyRequestHandler.parse_request(
+                        untrusted_request)
+
+    def test_010_call_allow(self):
+        self.policy('test-vm1 test-vm2 allow,user=root')
+        decision = self.call('test-vm1', 'test-vm2', 'test.service')
+        self.assertEqual(decision, {
+            'result': 'allow',
+            'target': 'test-vm2',
+            'user': 'root',
+            'target_for_ask': [],
+            'icon': [],
+        })
+        self.store.get.assert_called_once_with('test.service')
+        self.assertEqual(len(self.server.decision_cache.entries), 1)
+
+    def test_011_call_deny(self):
+        self.policy('test-vm1 test-vm2 allow')
+        decision = self.call('test-vm2', 'test-vm1', 'test.service')
+        self.assertEqual(decision['result'], 'deny')
+
+    def test_012_call_ask(self):
+        self.policy('test-vm1 @dispvm:default-dvm '
+            'ask,default_target=@dispvm:default-dvm')
+        decision = self.call('test-vm1', '@dispvm:default-dvm',
+            'test.service')
+        self.assertEqual(decision['result'], 'ask')
+        self.assertEqual(decision['target'], '@dispvm:default-dvm')
+        self.assertEqual(decision['target_for_ask'], ['@dispvm:default-dvm'])
+        self.assertIn('test-vm1 appvm-red', decision['icon'])
+        self.assertIn('@dispvm:default-dvm dispvm-red', decision['icon'])
+
+    def test_013_call_policy_not_found(self):
+        self.store.get.side_effect = qubespolicy.PolicyNotFound(
+            'test.service')
+        decision = self.call('test-vm1', 'test-vm2', 'test.service')
+        self.assertEqual(decision['result'], 'notfound')
+        self.assertEqual(decision['target'], '')
+
+    def test_014_call_invalid(self):
+        decision = self.call('test-vm1', 'test-vm2\ntarget=dom0',
+            'test.service')
+        self.assertEqual(decision['result'], 'deny')
+        self.assertFalse(self.store.get.called)
+
+    def test_020_daemon_not_running(self):
+        self.assertIsNone(self.client.call_daemon({
+            'daemon_socket': os.path.join(self.tmpdir.name, 'missing'),
+            'domain': 'test-vm1', 'target': 'test-vm2',
+            'service_name': 'test.service'}))
+
+
+class TC_20_Client(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_20_Client, self).setUp()
+        if not os.path.exists(qubespolicy.benchmark.SOURCE_CLIENT):
+            self.skipTest('qrexec-policy not found')
+        self.client = qubespolicy.benchmark.load_client()
+        self.decision = {
+            'result': 'allow',
+            'target': 'test-vm2',
+            'user': '',
+            'target_for_ask': [],
+            'icon': [],
+        }
+        self.execute = self.client.execute
+        self.ask = self.client.ask
+        for name in ('call_daemon', 'fallback', 'ask', 'execute', 'syslog'):
+            patch = unittest.mock.patch.object(self.client, name)
+            setattr(self, name + '_mock', patch.start())
+            self.addCleanup(patch.stop)
+        self.call_daemon_mock.return_value = self.decision
+
+    def main(self, *argv):
+        return self.client.main(list(argv) +
+            ['1', 'test-vm1', 'test-vm2', 'test.service', 'SOCKET1'])
+
+    def test_000_parse_args(self):
+        args, fallback_argv = self.client.parse_args(['--just-evaluate',
+            '--daemon-socket', '/tmp/sock', '1', 'test-vm1', 'test-vm2',
+            'test.service', 'SOCKET1'])
+        self.assertEqual(args, {
+            'assume_yes_for_ask': False,
+            'just_evaluate': True,
+            'daemon_socket': '/tmp/sock',
+            'domain_id': '1',
+            'domain': 'test-vm1',
+            'target': 'test-vm2',
+            'service_name': 'test.service',
+            'process_ident': 'SOCKET1',
+        })
+        self.assertEqual(fallback_argv, ['--just-evaluate', '1', 'test-vm1',
+            'test-vm2', 'test.service', 'SOCKET1'])
+
+    def test_001_parse_args_fallback(self):
+        for argv in (['--help'], ['1', 'test-vm1'],
+                ['--unknown', '1', 'test-vm1', 'test-vm2', 'test.service',
+                    'SOCKET1']):
+            with self.subTest(argv=argv):
+                self.assertEqual(self.client.parse_args(argv), (None, argv))
+
+    def test_010_allow(self):
+        self.decision['user'] = 'root'
+        self.assertEqual(self.main(), 0)
+        self.assertFalse(self.ask_mock.called)
+        self.execute_mock.assert_called_once_with(unittest.mock.ANY,
+            'test-vm2', 'root')
+        self.assertFalse(self.fallback_mock.called)
+
+    def test_011_deny(self):
+        self.decision['result'] = 'deny'
+        self.assertEqual(self.main(), 1)
+        self.assertFalse(self.execute_mock.called)
+
+    def test_012_ask(self):
+        self.decision['result'] = 'ask'
+        self.decision['target_for_ask'] = ['test-vm2', 'test-vm3']
+        self.ask_mock.return_value = 'test-vm3'
+        self.assertEqual(self.main(), 0)
+        self.execute_mock.assert_called_once_with(unittest.mock.ANY,
+            'test-vm3', None)
+
+    def test_013_ask_deny(self):
+        self.decision['result'] = 'ask'
+        self.ask_mock.return_value = None
+        self.assertEqual(self.main(), 1)
+        self.assertFalse(self.execute_mock.called)
+
+    def test_014_ask_assume_yes(self):
+        self.decision['result'] = 'ask'
+        self.assertEqual(self.main('--assume-yes-for-ask'), 0)
+        self.assertFalse(self.ask_mock.called)
+        self.assertTrue(self.execute_mock.called)
+
+    def test_020_just_evaluate(self):
+        for result, retval in (('allow', 0), ('deny', 1), ('ask', 1)):
+            with self.subTest(result=result):
+                self.decision['result'] = result
+                self.assertEqual(self.main('--just-evaluate'), retval)
+        self.assertFalse(self.ask_mock.called)
+        self.assertFalse(self.execute_mock.called)
+
+    def test_030_fallback(self):
+        self.fallback_mock.return_value = 0
+        for decision in (None, {'result': 'notfound'}):
+            with self.subTest(decision=decision):
+                self.call_daemon_mock.return_value = decision
+                self.assertEqual(self.main('--just-evaluate'), 0)
+                self.fallback_mock.assert_called_with(['--just-evaluate',
+                    '1', 'test-vm1', 'test-vm2', 'test.service', 'SOCKET1'])
+
+    def test_040_execute(self):
+        args, _ = self.client.parse_args(['1', 'test-vm1', '@default',
+            'test.service', 'SOCKET1'])
+        with unittest.mock.patch.object(self.client.call, 'qubesd_call') as \
+                qubesd_mock, \
+                unittest.mock.patch('os.spawnv') as spawn_mock:
+            self.execute(args, 'test-vm2', None)
+            self.execute(args, '@adminvm', None)
+            qubesd_mock.return_value = b'disp123'
+            self.execute(args, '@dispvm:default-dvm', 'root')
+            with self.assertRaises(self.client.call.AccessDenied):
+                self.execute(args, 'test-vm1', None)
+        self.assertEqual(qubesd_mock.mock_calls, [
+            unittest.mock.call('test-vm2', 'admin.vm.Start'),
+            unittest.mock.call('default-dvm', 'admin.vm.CreateDisposable'),
+            unittest.mock.call('disp123', 'admin.vm.Start'),
+            unittest.mock.call('disp123', 'admin.vm.Kill'),
+        ])
+        client = self.client.call.QREXEC_CLIENT
+        self.assertEqual(spawn_mock.mock_calls, [
+            unittest.mock.call(os.P_WAIT, client, [client, '-d', 'test-vm2',
+                '-c', 'SOCKET1,test-vm1,1',
+                'DEFAULT:QUBESRPC test.service test-vm1']),
+            unittest.mock.call(os.P_WAIT, client, [client, '-d', 'dom0',
+                '-c', 'SOCKET1,test-vm1,1',
+                'QUBESRPC test.service test-vm1 keyword default']),
+            unittest.mock.call(os.P_WAIT, client, [client, '-d', 'disp123',
+                '-c', 'SOCKET1,test-vm1,1', '-W',
+                'root:QUBESRPC test.service test-vm1']),
+        ])
+
+    def test_041_ask(self):
+        args, _ = self.client.parse_args(['1', 'test-vm1', '@default',
+            'test.service', 'SOCKET1'])
+        self.decision.update({
+            'result': 'ask',
+            'target': 'test-vm2',
+            'target_for_ask': ['test-vm2', 'test-vm3'],
+            'icon': ['test-vm2 red', 'test-vm3 green'],
+        })
+        with unittest.mock.patch('pydbus.SystemBus') as bus_mock:
+            proxy = bus_mock.return_value.get.return_value
+            proxy.Ask.return_value = 'test-vm3'
+            self.assertEqual(self.ask(args, self.decision), 'test-vm3')
+            # not one of the targets offered
+            proxy.Ask.return_value = 'test-vm4'
+            self.assertIsNone(self.ask(args, self.decision))
+            proxy.Ask.return_value = ''
+            self.assertIsNone(self.ask(args, self.decision))
+        proxy.Ask.assert_called_with('test-vm1', 'test.service',
+            ['test-vm2', 'test-vm3'], 'test-vm2',
+            {'test-vm2': 'red', 'test-vm3': 'green'})
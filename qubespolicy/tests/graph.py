@@ -0,0 +1,124 @@
+# -*- encoding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+import json
+import os
+import random
+import tempfile
+import unittest.mock
+
+import qubes.tests
+import qubespolicy
+import qubespolicy.benchmark
+import qubespolicy.graph
+
+
+class TC_00_Graph(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_00_Graph, self).setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        rand = random.Random(0)
+        self.system_info = qubespolicy.benchmark.generate_system_info(20,
+            4, rand)
+        # some domains without default DispVM, or with another one
+        self.system_info['domains']['vm1']['default_dispvm'] = None
+        self.system_info['domains']['vm2']['default_dispvm'] = 'vm3'
+        self.system_info['domains']['vm3']['template_for_dispvms'] = True
+        self.system_info_path = os.path.join(self.tmpdir.name,
+            'system_info.json')
+        with open(self.system_info_path, 'w') as f:
+            json.dump(self.system_info, f)
+        self.policy_dir = os.path.join(self.tmpdir.name, 'policy')
+        self.services = qubespolicy.benchmark.generate_policy(
+            self.policy_dir, self.system_info, 4, 60, rand)
+        with open(os.path.join(self.policy_dir, self.services[0]), 'a') as f:
+            f.write('@anyvm @dispvm allow\n'
+                    '@anyvm @dispvm:@tag:tag1 ask\n'
+                    '@anyvm @anyvm ask,target=vm0\n')
+
+    def graph(self, *argv):
+        output = os.path.join(self.tmpdir.name, 'graph.dot')
+        qubespolicy.graph.main(['--policy-dir', self.policy_dir,
+            '--system-info', self.system_info_path, '--output', output] +
+            list(argv))
+        with open(output) as f:
+            return f.read()
+
+    def graph_pairwise(self, include_ask):
+        ''' Graph lines computed by evaluating each pair separately '''
+        args = qubespolicy.graph.parser.parse_args(['--include-ask']
+            if include_ask else [])
+        domains = list(self.system_info['domains'])
+        targets = domains + ['@dispvm', '@dispvm:vm0', '@dispvm:vm3']
+        lines = []
+        for service in sorted(self.services):
+            policy = qubespolicy.Policy(service, self.policy_dir)
+            for source in domains:
+                for target in targets:
+                    try:
+                        action = policy.evaluate(self.system_info, source,
+                            target)
+                    except qubespolicy.AccessDenied:
+                        continue
+                    line = qubespolicy.graph.handle_single_action(args,
+                        action)
+                    if line and line not in lines:
+                        lines.append(line)
+        return 'digraph g {\n' + ''.join(lines) + '}\n'
+
+    def test_000_same_as_pairwise(self):
+        for include_ask in (False, True):
+            expected = self.graph_pairwise(include_ask)
+            for jobs in ('1', '2'):
+                with self.subTest(include_ask=include_ask, jobs=jobs):
+                    argv = ['--jobs', jobs]
+                    if include_ask:
+                        argv.append('--include-ask')
+                    self.assertEqual(self.graph(*argv), expected)
+
+    def test_001_unknown_source(self):
+        output = self.graph('--jobs', '1', '--source', 'no-such-vm', 'vm4')
+        self.assertEqual(output, self.graph('--jobs', '1', '--source', 'vm4'))
+
+    def test_010_cache(self):
+        cache_dir = os.path.join(self.tmpdir.name, 'cache')
+        expected = self.graph('--jobs', '1')
+        self.assertEqual(self.graph('--jobs', '1', '--cache-dir', cache_dir),
+            expected)
+        self.assertEqual(sorted(os.listdir(cache_dir)), sorted(self.services))
+
+        with unittest.mock.patch('qubespolicy.graph.evaluate_all',
+                wraps=qubespolicy.graph.evaluate_all) as evaluate_mock:
+            self.assertEqual(self.graph('--jobs', '1', '--cache-dir',
+                cache_dir), expected)
+            self.assertEqual(evaluate_mock.call_count, 0)
+
+            # only the changed service is computed again
+            with open(os.path.join(self.policy_dir, self.services[1]),
+                    'r+') as f:
+                content = f.read()
+                f.seek(0)
+                f.write('vm5 vm6 allow\n' + content)
+            self.assertIn('"vm5" -> "vm6"', self.graph('--jobs', '1',
+                '--cache-dir', cache_dir))
+            self.assertEqual(evaluate_mock.call_count, 1)
+
+            # ... or all of them, when the options are different
+            self.graph('--jobs', '1', '--cache-dir', cache_dir,
+                '--include-ask')
+            self.assertEqual(evaluate_mock.call_count,
+                1 + len(self.services))
@@ -10,8 +10,8 @@ import setuptools.command.install
 # don't import: import * is unreliable and there is no need, since this is
 # compile time and we have source files
 def get_console_scripts():
-    yield 'qrexec-policy', 'qubespolicy.cli'
     yield 'qrexec-policy-agent', 'qubespolicy.agent'
+    yield 'qrexec-policy-daemon', 'qubespolicy.daemon'
     yield 'qrexec-policy-graph', 'qubespolicy.graph'
     for filename in os.listdir('./qubes/tools'):
         basename, ext = os.path.splitext(os.path.basename(filename))